@@ -0,0 +1,586 @@
+#!/usr/bin/env python3
+"""
+WARP代理池管理器的负载/浸泡基准测试。
+
+在本机启动 N 个替代WARP实例的SOCKS5后端 (监听 BASE_PORT 起的端口) 和一个回显/批量数据目标，
+生成对应的 warp_pool_config.json，以可配置延迟的桩函数替换 refresh_proxy_ip 后启动 proxy_manager，
+然后按指定并发驱动中央SOCKS5服务器和 /acquire、/release API。结果以 JSON 输出，包括每秒连接数、
+握手和连接耗时的 p50/p99、中继速率、IP刷新次数，以及管理器进程的线程数和内存占用，便于跟踪性能回归。
+使用 --nodes 时另外模拟多节点部署: 每个节点在各自的回环地址 (127.0.0.2、127.0.0.3 ...) 上运行同样数量的替代后端
+和一个节点代理 (src/pool_agent.py，同样使用桩刷新函数)，管理器通过 POOL_NODES 调度全部节点的后端。
+
+用法示例:
+    python benchmarks/bench_pool.py --backends 10 --concurrency 50 --duration 30
+    python benchmarks/bench_pool.py --scenarios bulk --manager-env SOCKS_SERVER_MODE=asyncio --output result.json
+    python benchmarks/bench_pool.py --scenarios connect --duration 3600 --sample-interval 10   # 浸泡测试
+    python benchmarks/bench_pool.py --backends 4 --nodes 2 --manager-env PREFER_LOCAL_BACKENDS=0   # 多节点
+
+替代后端和目标只依赖标准库; 管理器本身仍需要 requirements.txt 中的依赖。
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(REPO_ROOT, 'src')
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - [bench] %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+# --- 替代后端与目标 (--role backends) ---
+
+async def _pipe_stream(reader, writer):
+    """在两个流之间单向转发数据，源端关闭后半关闭目的端。"""
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        try:
+            writer.write_eof()
+        except (OSError, RuntimeError):
+            pass
+
+async def _serve_stand_in_backend(reader, writer, connect_latency):
+    """替代WARP实例的最小SOCKS5服务器 (无认证、仅CONNECT)，回复前等待 connect_latency 秒以模拟WARP的连接耗时。"""
+    try:
+        greeting = await reader.readexactly(2)
+        await reader.readexactly(greeting[1])
+        writer.write(b"\x05\x00")
+        request_header = await reader.readexactly(4)
+        address_type = request_header[3]
+        if address_type == 0x01:
+            target_host = socket.inet_ntoa(await reader.readexactly(4))
+        elif address_type == 0x03:
+            target_host = (await reader.readexactly((await reader.readexactly(1))[0])).decode("idna")
+        else:
+            target_host = socket.inet_ntop(socket.AF_INET6, await reader.readexactly(16))
+        target_port = struct.unpack("!H", await reader.readexactly(2))[0]
+        if connect_latency > 0:
+            await asyncio.sleep(connect_latency)
+        try:
+            target_reader, target_writer = await asyncio.open_connection(target_host, target_port)
+        except OSError:
+            writer.write(b"\x05\x05\x00\x01" + bytes(6))
+            await writer.drain()
+            return
+        writer.write(b"\x05\x00\x00\x01" + bytes(6))
+        await writer.drain()
+        await asyncio.gather(_pipe_stream(reader, target_writer), _pipe_stream(target_reader, writer))
+        target_writer.close()
+    except (asyncio.IncompleteReadError, ConnectionError, OSError):
+        pass
+    finally:
+        writer.close()
+
+async def _serve_target(reader, writer, exit_ip_count):
+    """
+    目标服务器。按首个数据块区分请求:
+    'GET ' 返回 trace 格式的随机出口IP; 'BULK <字节数>\\n' 发送指定数量的数据后关闭; 其余数据原样回显。
+    """
+    try:
+        first_chunk = await reader.read(65536)
+        if first_chunk.startswith(b"GET "):
+            ip_index = random.randrange(exit_ip_count)
+            exit_ip = f"198.18.{ip_index // 250}.{ip_index % 250 + 1}"
+            writer.write(f"HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\n\r\nfl=bench\nip={exit_ip}\ncolo=LCL\nwarp=on\n".encode())
+        elif first_chunk.startswith(b"BULK "):
+            remaining = int(first_chunk[5:].split(b"\n", 1)[0])
+            block = b"\x00" * 65536
+            while remaining > 0:
+                writer.write(block[:min(remaining, len(block))])
+                remaining -= len(block)
+                await writer.drain()
+        else:
+            while first_chunk:
+                writer.write(first_chunk)
+                await writer.drain()
+                first_chunk = await reader.read(65536)
+        await writer.drain()
+    except (ConnectionError, OSError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+async def _run_stand_ins(args):
+    """启动替代后端; --target-port 为 0 时不启动目标 (其他节点的替代后端只需要后端)。"""
+    servers = []
+    if args.target_port:
+        servers.append(await asyncio.start_server(
+            lambda r, w: _serve_target(r, w, args.exit_ips), '127.0.0.1', args.target_port, backlog=1024
+        ))
+    for index in range(args.backends):
+        servers.append(await asyncio.start_server(
+            lambda r, w: _serve_stand_in_backend(r, w, args.backend_latency_ms / 1000.0),
+            args.bind_host, args.base_port + index, backlog=1024
+        ))
+    logging.info(f"替代后端已启动: {args.backends} 个SOCKS5后端 ({args.bind_host}:{args.base_port}-{args.base_port + args.backends - 1})，目标端口 {args.target_port}。")
+    await asyncio.gather(*(server.serve_forever() for server in servers))
+
+# --- 使用桩刷新函数的管理器和节点代理 (--role manager / agent) ---
+
+def _install_stub_refresh(args, proxy_manager):
+    """以可配置延迟和失败率的桩函数替换 proxy_manager.refresh_proxy_ip。其他节点的后端仍通过节点代理刷新。"""
+    refresh_proxy_ip = proxy_manager.refresh_proxy_ip
+
+    def stub_refresh_proxy_ip(backend_warp_port):
+        instance_config = proxy_manager.WARP_POOL_CONFIG.get(backend_warp_port)
+        if instance_config is not None and instance_config.get("node") is not None:
+            return refresh_proxy_ip(backend_warp_port)
+        started_at = time.monotonic()
+        time.sleep(args.refresh_latency_ms / 1000.0 * random.uniform(0.5, 1.5))
+        proxy_manager._record_refresh_timings(backend_warp_port, {"driver": "bench-stub", "total": time.monotonic() - started_at})
+        return random.random() >= args.refresh_failure_rate
+
+    proxy_manager.refresh_proxy_ip = stub_refresh_proxy_ip
+
+def run_manager(args):
+    """导入 proxy_manager，替换 refresh_proxy_ip 为桩函数，然后运行其 main()。"""
+    sys.path.insert(0, SRC_DIR)
+    import proxy_manager
+    _install_stub_refresh(args, proxy_manager)
+    proxy_manager.main()
+
+def run_agent(args):
+    """导入 pool_agent，替换其使用的 pool_common.refresh_instance_ip 为桩函数，然后运行其 main()。"""
+    sys.path.insert(0, SRC_DIR)
+    import pool_agent
+
+    def stub_refresh_instance_ip(backend_warp_port, ns_name, idx):
+        started_at = time.monotonic()
+        time.sleep(args.refresh_latency_ms / 1000.0 * random.uniform(0.5, 1.5))
+        return random.random() >= args.refresh_failure_rate, {"driver": "bench-stub", "total": time.monotonic() - started_at}
+
+    pool_agent.pool_common.refresh_instance_ip = stub_refresh_instance_ip
+    pool_agent.main()
+
+# --- 负载生成 ---
+
+def _percentile(sorted_values, quantile):
+    """最近秩法分位数，列表为空时返回 None。"""
+    if not sorted_values:
+        return None
+    rank = max(int(round(quantile * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+def _latency_summary_ms(values):
+    ordered = sorted(values)
+    return {
+        "count": len(ordered),
+        "p50_ms": round(_percentile(ordered, 0.50) * 1000, 3) if ordered else None,
+        "p99_ms": round(_percentile(ordered, 0.99) * 1000, 3) if ordered else None,
+        "max_ms": round(ordered[-1] * 1000, 3) if ordered else None
+    }
+
+def _recv_exactly(sock, byte_count):
+    data = b''
+    while len(data) < byte_count:
+        chunk = sock.recv(byte_count - len(data))
+        if not chunk:
+            raise ConnectionError("连接被提前关闭")
+        data += chunk
+    return data
+
+def _socks_open(args):
+    """
+    通过中央SOCKS5服务器连接目标，返回 (套接字, 握手耗时, 连接耗时)。
+    握手耗时为TCP连接到收到方法选择回复; 连接耗时为发送CONNECT到收到回复 (含取后端和后端连接目标)。
+    """
+    started_at = time.monotonic()
+    sock = socket.create_connection(('127.0.0.1', args.socks_port), timeout=args.request_timeout)
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall(b"\x05\x01\x00")
+        if _recv_exactly(sock, 2) != b"\x05\x00":
+            raise ConnectionError("方法协商失败")
+        handshake_done_at = time.monotonic()
+        sock.sendall(b"\x05\x01\x00\x01" + socket.inet_aton('127.0.0.1') + struct.pack("!H", args.target_port))
+        reply = _recv_exactly(sock, 10)
+        if reply[1] != 0x00:
+            raise ConnectionError(f"CONNECT失败，回复码 0x{reply[1]:02x}")
+        return sock, handshake_done_at - started_at, time.monotonic() - handshake_done_at
+    except BaseException:
+        sock.close()
+        raise
+
+def _connect_worker(args, stop_at, result):
+    """短连接场景: 每个连接完成握手、CONNECT和一次回显往返后关闭。"""
+    while time.monotonic() < stop_at:
+        started_at = time.monotonic()
+        try:
+            sock, handshake_seconds, connect_seconds = _socks_open(args)
+            try:
+                sock.sendall(b"ping")
+                _recv_exactly(sock, 4)
+            finally:
+                sock.close()
+        except (OSError, ConnectionError) as e:
+            result["errors"].append(str(e))
+            continue
+        result["handshake"].append(handshake_seconds)
+        result["connect"].append(connect_seconds)
+        result["total"].append(time.monotonic() - started_at)
+
+def _bulk_worker(args, stop_at, result):
+    """批量下载场景: 每个连接从目标下载 --bulk-bytes 字节。"""
+    while time.monotonic() < stop_at:
+        try:
+            sock, handshake_seconds, connect_seconds = _socks_open(args)
+            try:
+                transfer_started_at = time.monotonic()
+                sock.sendall(f"BULK {args.bulk_bytes}\n".encode())
+                received = 0
+                buffer = bytearray(262144)
+                while received < args.bulk_bytes:
+                    count = sock.recv_into(buffer)
+                    if not count:
+                        break
+                    received += count
+            finally:
+                sock.close()
+        except (OSError, ConnectionError) as e:
+            result["errors"].append(str(e))
+            continue
+        result["handshake"].append(handshake_seconds)
+        result["connect"].append(connect_seconds)
+        result["bytes"] += received
+        result["per_connection_mb_s"].append(received / max(time.monotonic() - transfer_started_at, 1e-6) / 1048576)
+
+def _api_worker(args, stop_at, result):
+    """API场景: 循环调用 /acquire 和按租约ID的 /release，每个线程复用一个HTTP连接。"""
+    headers = {"Authorization": f"Bearer {args.api_token}"}
+    connection = http.client.HTTPConnection('127.0.0.1', args.api_port, timeout=args.request_timeout)
+    while time.monotonic() < stop_at:
+        try:
+            started_at = time.monotonic()
+            connection.request("GET", f"/acquire?wait={args.request_timeout / 2:.0f}", headers=headers)
+            response = connection.getresponse()
+            body = response.read()
+            if response.status != 200:
+                result["errors"].append(f"acquire HTTP {response.status}")
+                continue
+            acquired_at = time.monotonic()
+            lease_id = json.loads(body)["lease_id"]
+            connection.request("POST", f"/release/{lease_id}", headers=headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                result["errors"].append(f"release HTTP {response.status}")
+                continue
+            result["acquire"].append(acquired_at - started_at)
+            result["release"].append(time.monotonic() - acquired_at)
+        except (OSError, http.client.HTTPException, ValueError, KeyError) as e:
+            result["errors"].append(str(e))
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', args.api_port, timeout=args.request_timeout)
+    connection.close()
+
+SCENARIO_WORKERS = {
+    "connect": _connect_worker,
+    "bulk": _bulk_worker,
+    "api": _api_worker,
+}
+
+def run_scenario(name, args):
+    """以 --concurrency 个线程运行一个场景 --duration 秒，返回汇总结果。"""
+    result = {"errors": [], "handshake": [], "connect": [], "total": [], "acquire": [], "release": [],
+              "bytes": 0, "per_connection_mb_s": []}
+    started_at = time.monotonic()
+    stop_at = started_at + args.duration
+    workers = [
+        threading.Thread(target=SCENARIO_WORKERS[name], args=(args, stop_at, result), daemon=True)
+        for _ in range(args.concurrency)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(args.duration + args.request_timeout * 2)
+    elapsed = time.monotonic() - started_at
+
+    summary = {"duration_seconds": round(elapsed, 3), "concurrency": args.concurrency, "errors": len(result["errors"])}
+    if result["errors"]:
+        error_kinds = {}
+        for error in result["errors"]:
+            error_kinds[error] = error_kinds.get(error, 0) + 1
+        summary["error_kinds"] = dict(sorted(error_kinds.items(), key=lambda item: -item[1])[:5])
+    if name == "api":
+        summary["cycles_per_second"] = round(len(result["acquire"]) / elapsed, 2)
+        summary["acquire_latency"] = _latency_summary_ms(result["acquire"])
+        summary["release_latency"] = _latency_summary_ms(result["release"])
+        return summary
+    summary["connections_per_second"] = round(len(result["connect"]) / elapsed, 2)
+    summary["handshake_latency"] = _latency_summary_ms(result["handshake"])
+    summary["connect_latency"] = _latency_summary_ms(result["connect"])
+    if name == "connect":
+        summary["round_trip_latency"] = _latency_summary_ms(result["total"])
+    else:
+        per_connection = sorted(result["per_connection_mb_s"])
+        summary["relay_mb_per_second"] = round(result["bytes"] / elapsed / 1048576, 2)
+        summary["per_connection_mb_per_second_p50"] = round(_percentile(per_connection, 0.5), 2) if per_connection else None
+    return summary
+
+# --- 管理器进程观测 ---
+
+def _process_tree(pid):
+    """返回进程及其所有子进程 (多进程模式下的SOCKS工作进程) 的PID列表。"""
+    pids = [pid]
+    for known_pid in pids:
+        try:
+            with open(f"/proc/{known_pid}/task/{known_pid}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+def _sample_resources(pid):
+    """读取进程树的常驻内存 (KB) 和线程总数。"""
+    rss_kb = threads = 0
+    for tree_pid in _process_tree(pid):
+        try:
+            with open(f"/proc/{tree_pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss_kb += int(line.split()[1])
+                    elif line.startswith("Threads:"):
+                        threads += int(line.split()[1])
+        except OSError:
+            pass
+    return rss_kb, threads
+
+def _resource_sampler_loop(pid, interval, samples, stop_event, started_at):
+    while not stop_event.is_set():
+        rss_kb, threads = _sample_resources(pid)
+        samples.append({"t": round(time.monotonic() - started_at, 1), "rss_kb": rss_kb, "threads": threads})
+        stop_event.wait(interval)
+
+def _scrape_metric_totals(args):
+    """抓取 /metrics 并按指标名对所有标签组合求和。"""
+    connection = http.client.HTTPConnection('127.0.0.1', args.api_port, timeout=args.request_timeout)
+    try:
+        connection.request("GET", "/metrics")
+        text = connection.getresponse().read().decode()
+    finally:
+        connection.close()
+    totals = {}
+    for match in re.finditer(r'^([a-z_]+)(?:\{[^}]*\})? ([0-9.eE+-]+)$', text, re.M):
+        totals[match.group(1)] = totals.get(match.group(1), 0.0) + float(match.group(2))
+    return totals
+
+def _wait_until(predicate, timeout, description):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if predicate():
+                return
+        except (OSError, http.client.HTTPException, ValueError):
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"等待{description}超时 ({timeout} 秒)")
+
+def _port_open(port, host='127.0.0.1'):
+    with socket.create_connection((host, port), timeout=1):
+        return True
+
+def _node_host(node_index):
+    """第 node_index 个节点 (从 1 开始) 使用的回环地址。"""
+    return f"127.0.0.{node_index + 1}"
+
+# --- 编排 ---
+
+def orchestrate(args):
+    workdir = tempfile.mkdtemp(prefix="warp-pool-bench-")
+    os.makedirs(os.path.join(workdir, 'src'))
+    with open(os.path.join(workdir, 'src', 'warp_pool_config.json'), 'w') as f:
+        json.dump([{"id": i, "namespace": f"bench{i}", "port": args.base_port + i} for i in range(args.backends)], f)
+
+    script_path = os.path.abspath(__file__)
+    common_args = [
+        "--backends", str(args.backends), "--base-port", str(args.base_port), "--target-port", str(args.target_port),
+        "--backend-latency-ms", str(args.backend_latency_ms), "--exit-ips", str(args.exit_ips),
+        "--refresh-latency-ms", str(args.refresh_latency_ms), "--refresh-failure-rate", str(args.refresh_failure_rate)
+    ]
+    node_urls = [f"node{node_index}=http://{_node_host(node_index)}:{args.agent_port}" for node_index in range(1, args.nodes + 1)]
+    manager_env = dict(os.environ)
+    manager_env.update({
+        "API_SECRET_TOKEN": args.api_token,
+        "API_PORT": str(args.api_port),
+        "SOCKS_PORT": str(args.socks_port),
+        "PROXY_VALIDATION_TARGET_HOST": "127.0.0.1",
+        "PROXY_VALIDATION_TARGET_PORT": str(args.target_port),
+        "EXIT_IP_TRACE_URL": f"http://127.0.0.1:{args.target_port}/cdn-cgi/trace",
+        "WARP_POOL_CONFIG_WATCH_INTERVAL": "0",
+        # 刷新耗时由桩函数模拟，默认不再叠加全局速率限制; SOCKS连接在池为空时排队而不是立即失败
+        "REFRESH_RATE_LIMIT_PER_MINUTE": "0",
+        "SOCKS_CONNECT_WAIT": str(args.request_timeout / 2),
+        "POOL_NODES": ",".join(node_urls),
+        "POOL_AGENT_TOKEN": args.api_token,
+        "POOL_NODE_SYNC_INTERVAL": "2",
+    })
+    for assignment in args.manager_env:
+        key, _, value = assignment.partition("=")
+        manager_env[key] = value
+
+    processes = []
+    sampler_stop = threading.Event()
+    try:
+        backends_log = open(os.path.join(workdir, 'backends.log'), 'w')
+        processes.append(subprocess.Popen([sys.executable, script_path, "--role", "backends"] + common_args,
+                                          stdout=backends_log, stderr=subprocess.STDOUT))
+        _wait_until(lambda: _port_open(args.target_port) and _port_open(args.base_port + args.backends - 1), 15, "替代后端启动")
+
+        for node_index in range(1, args.nodes + 1):
+            node_workdir = os.path.join(workdir, f"node{node_index}")
+            os.makedirs(os.path.join(node_workdir, 'src'))
+            with open(os.path.join(node_workdir, 'src', 'warp_pool_config.json'), 'w') as f:
+                json.dump([{"id": i, "namespace": f"bench{i}", "port": args.base_port + i} for i in range(args.backends)], f)
+            # 后出现的参数覆盖前面的: 节点只运行替代后端，不再启动目标
+            node_args = common_args + ["--target-port", "0", "--bind-host", _node_host(node_index)]
+            node_log = open(os.path.join(node_workdir, 'node.log'), 'w')
+            processes.append(subprocess.Popen([sys.executable, script_path, "--role", "backends"] + node_args,
+                                              stdout=node_log, stderr=subprocess.STDOUT))
+            agent_env = dict(os.environ, POOL_AGENT_TOKEN=args.api_token, POOL_AGENT_HOST=_node_host(node_index),
+                             POOL_AGENT_PORT=str(args.agent_port), POOL_AGENT_NODE_NAME=f"node{node_index}")
+            processes.append(subprocess.Popen([sys.executable, script_path, "--role", "agent"] + node_args,
+                                              cwd=node_workdir, env=agent_env, stdout=node_log, stderr=subprocess.STDOUT))
+            _wait_until(lambda: _port_open(args.agent_port, _node_host(node_index))
+                        and _port_open(args.base_port + args.backends - 1, _node_host(node_index)), 15, f"节点 node{node_index} 启动")
+
+        manager_log = open(os.path.join(workdir, 'manager.log'), 'w')
+        manager = subprocess.Popen([sys.executable, script_path, "--role", "manager"] + common_args,
+                                   cwd=workdir, env=manager_env, stdout=manager_log, stderr=subprocess.STDOUT)
+        processes.append(manager)
+        _wait_until(lambda: _scrape_metric_totals(args).get("warp_pool_available_backends") == args.backends * (args.nodes + 1)
+                    and _port_open(args.socks_port), 60, "管理器就绪")
+        logging.info(f"管理器已就绪 (PID {manager.pid})，工作目录 {workdir}。")
+
+        run_started_at = time.monotonic()
+        samples = []
+        threading.Thread(target=_resource_sampler_loop, args=(manager.pid, args.sample_interval, samples, sampler_stop, run_started_at), daemon=True).start()
+        metrics_before = _scrape_metric_totals(args)
+
+        scenario_results = {}
+        for name in args.scenarios:
+            logging.info(f"场景 '{name}': 并发 {args.concurrency}，持续 {args.duration} 秒...")
+            scenario_results[name] = run_scenario(name, args)
+            logging.info(f"场景 '{name}' 完成: {json.dumps(scenario_results[name], ensure_ascii=False)}")
+            time.sleep(args.settle_seconds)
+
+        run_elapsed = time.monotonic() - run_started_at
+        metrics_after = _scrape_metric_totals(args)
+        sampler_stop.set()
+        samples.append(dict(zip(("t", "rss_kb", "threads"), (round(run_elapsed, 1),) + _sample_resources(manager.pid))))
+
+        def metric_delta(name):
+            return int(metrics_after.get(name, 0) - metrics_before.get(name, 0))
+
+        refresh_completed = metric_delta("warp_pool_refresh_completed_total")
+        report = {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "config": {
+                "backends": args.backends,
+                "nodes": args.nodes,
+                "concurrency": args.concurrency,
+                "duration_seconds": args.duration,
+                "backend_latency_ms": args.backend_latency_ms,
+                "refresh_latency_ms": args.refresh_latency_ms,
+                "refresh_failure_rate": args.refresh_failure_rate,
+                "manager_env": args.manager_env,
+            },
+            "scenarios": scenario_results,
+            "refresh": {
+                "completed": refresh_completed,
+                "failed": metric_delta("warp_pool_refresh_failed_total"),
+                "exit_ip_rerolls": metric_delta("warp_pool_refresh_exit_ip_rerolls_total"),
+                "completed_per_second": round(refresh_completed / run_elapsed, 3),
+            },
+            "manager_resources": {
+                "rss_kb_start": samples[0]["rss_kb"],
+                "rss_kb_end": samples[-1]["rss_kb"],
+                "rss_kb_max": max(sample["rss_kb"] for sample in samples),
+                "threads_start": samples[0]["threads"],
+                "threads_end": samples[-1]["threads"],
+                "threads_max": max(sample["threads"] for sample in samples),
+                "samples": samples,
+            },
+        }
+        output = json.dumps(report, ensure_ascii=False, indent=2)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(output + "\n")
+            logging.info(f"结果已写入 {args.output}。")
+        else:
+            print(output)
+    finally:
+        sampler_stop.set()
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if args.keep_workdir:
+            logging.info(f"已保留工作目录 {workdir} (含 manager.log)。")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="WARP代理池管理器的负载/浸泡基准测试")
+    parser.add_argument("--role", choices=("orchestrate", "backends", "manager", "agent"), default="orchestrate", help=argparse.SUPPRESS)
+    parser.add_argument("--bind-host", default="127.0.0.1", help=argparse.SUPPRESS)
+    parser.add_argument("--backends", type=int, default=10, help="每个节点的替代后端数量 (默认10)")
+    parser.add_argument("--nodes", type=int, default=0, help="模拟的其他节点数量，第 N 个节点使用回环地址 127.0.0.(N+1) (默认0)")
+    parser.add_argument("--agent-port", type=int, default=5100, help="模拟节点的节点代理端口 (默认5100)")
+    parser.add_argument("--base-port", type=int, default=int(os.environ.get('BASE_PORT', 10800)), help="替代后端的起始端口 (默认 BASE_PORT 或 10800)")
+    parser.add_argument("--target-port", type=int, default=18080, help="回显/批量数据目标的端口 (默认18080)")
+    parser.add_argument("--socks-port", type=int, default=10880, help="管理器中央SOCKS5服务器端口 (默认10880)")
+    parser.add_argument("--api-port", type=int, default=5000, help="管理器API端口 (默认5000)")
+    parser.add_argument("--api-token", default="bench-token", help="传给管理器的 API_SECRET_TOKEN")
+    parser.add_argument("--scenarios", type=lambda value: value.split(","), default=["connect", "bulk", "api"],
+                        help="逗号分隔的场景: connect (短连接)、bulk (批量下载)、api (获取/释放) (默认全部)")
+    parser.add_argument("--concurrency", type=int, default=20, help="每个场景的并发客户端数 (默认20)")
+    parser.add_argument("--duration", type=float, default=15, help="每个场景的持续时间(秒) (默认15)")
+    parser.add_argument("--bulk-bytes", type=int, default=16 * 1048576, help="bulk 场景每个连接下载的字节数 (默认16MiB)")
+    parser.add_argument("--backend-latency-ms", type=float, default=0, help="替代后端回复CONNECT前的延迟(毫秒)")
+    parser.add_argument("--refresh-latency-ms", type=float, default=200, help="桩刷新函数的平均耗时(毫秒) (默认200)")
+    parser.add_argument("--refresh-failure-rate", type=float, default=0.0, help="桩刷新函数的失败概率 (默认0)")
+    parser.add_argument("--exit-ips", type=int, default=1000, help="trace 端点随机返回的出口IP数量，越小越容易出现重复 (默认1000)")
+    parser.add_argument("--request-timeout", type=float, default=20, help="客户端单个请求的超时时间(秒) (默认20)")
+    parser.add_argument("--settle-seconds", type=float, default=2, help="场景之间的间隔(秒)，让刷新队列回落 (默认2)")
+    parser.add_argument("--sample-interval", type=float, default=1, help="采样管理器线程数和内存的间隔(秒) (默认1)")
+    parser.add_argument("--manager-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="传给管理器的额外环境变量，可重复 (例如 SOCKS_SERVER_MODE=asyncio)")
+    parser.add_argument("--output", help="把JSON结果写入文件而不是标准输出")
+    parser.add_argument("--keep-workdir", action="store_true", help="保留临时工作目录和管理器日志")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    cli_args = parse_args()
+    if cli_args.role == "backends":
+        asyncio.run(_run_stand_ins(cli_args))
+    elif cli_args.role == "manager":
+        run_manager(cli_args)
+    elif cli_args.role == "agent":
+        run_agent(cli_args)
+    else:
+        orchestrate(cli_args)
@@ -19,9 +19,18 @@ set -euo pipefail
 init_global_config() {
     # WARP池配置
     POOL_SIZE="${POOL_SIZE:-3}"                 # 代理池大小 (可被环境变量覆盖)
+    POOL_CREATE_PARALLELISM="${POOL_CREATE_PARALLELISM:-4}" # 同时创建的WARP实例数量上限 (可被环境变量覆盖)
     BASE_PORT="${BASE_PORT:-10800}"             # SOCKS5代理的基础端口号 (可被环境变量覆盖)
     WARP_LICENSE_KEY="${WARP_LICENSE_KEY:-}"    # WARP+ 许可证密钥 (可被环境变量覆盖，可选)
     WARP_ENDPOINT="${WARP_ENDPOINT:-}"          # 自定义WARP端点IP和端口 (可被环境变量覆盖，可选)
+    # 代理管理器连接实例的方式: dnat (经主机端口和DNAT规则) 或 direct (经veth直连命名空间地址和WARP内部端口)
+    BACKEND_ADDRESSING="${BACKEND_ADDRESSING:-dnat}"
+    # 是否为每个实例安装主机端口到命名空间的DNAT规则。direct 模式下默认不安装，只在需要按端口直接访问实例时开启
+    if [[ "$BACKEND_ADDRESSING" == "direct" ]]; then
+        POOL_PORT_DNAT="${POOL_PORT_DNAT:-0}"
+    else
+        POOL_PORT_DNAT="${POOL_PORT_DNAT:-1}"
+    fi
 
     # 路径配置 (均可被环境变量覆盖)
     CONFIG_BASE_DIR="${WARP_CONFIG_BASE_DIR:-/var/lib/warp-configs}"  # WARP配置目录
@@ -35,12 +44,18 @@ init_global_config() {
     LOG_FILE="/var/log/warp-pool.log"        # 日志文件路径
     LOCK_FILE="/tmp/warp_pool_$(id -u).lock" # 用户隔离的锁文件
     PID_FILE="/tmp/proxy_manager_$(id -u).pid" # 用户隔离的API服务进程ID文件
+    AGENT_PID_FILE="/tmp/pool_agent_$(id -u).pid" # 多节点部署中节点代理的进程ID文件
     WARP_POOL_CONFIG_FILE="${SCRIPT_DIR}/src/warp_pool_config.json" # WARP池配置文件
+    POOL_READY_DIR="/tmp/warp_pool_ready_$(id -u)" # 已就绪实例的记录目录，用于增量生成配置文件
+    POOL_BRING_UP_PID_FILE="/tmp/warp_pool_bring_up_$(id -u).pid" # 后台创建任务的PID文件
+    API_PORT="${API_PORT:-5000}"                # 代理管理API端口，resize 通过它等待实例排空
+    RESIZE_DRAIN_TIMEOUT="${RESIZE_DRAIN_TIMEOUT:-300}" # 缩容时等待实例上的会话结束的最长时间(秒)
 
     # Python应用配置
     VENV_DIR="${SCRIPT_DIR}/.venv"
     REQUIREMENTS_FILE="${SCRIPT_DIR}/requirements.txt"
     PROXY_MANAGER_SCRIPT="${SCRIPT_DIR}/src/proxy_manager.py"
+    POOL_AGENT_SCRIPT="${SCRIPT_DIR}/src/pool_agent.py"
     PYTHON_CMD="python3"
 
     # iptables配置
@@ -101,6 +116,8 @@ show_help() {
     echo "              选项: --foreground  在前台运行API服务，用于Docker或调试。"
     echo "  stop        停止API服务并清理所有网络资源。"
     echo "  restart     重启服务 (相当于 stop 后再 start)。"
+    echo "  resize      调整运行中代理池的大小，不重启API服务。缩容时等待实例上的会话结束后再移除。"
+    echo "              用法: resize <新的代理池大小>"
     echo "  status      检查服务和网络资源的状态。"
     echo "  cleanup     仅清理所有网络资源，不影响正在运行的API服务。"
     echo "  refresh-ip  刷新指定命名空间的WARP IP地址。"
@@ -108,6 +125,10 @@ show_help() {
     echo "  start-api   仅启动API服务 (假设网络资源已存在)。"
     echo "              选项: --foreground  在前台运行API服务。"
     echo "  stop-api    仅停止API服务。"
+    echo "  reload      平滑重启API服务 (SIGUSR2)，不断开已有连接，不丢失租约和粘性会话。"
+    echo "  start-agent 启动节点代理，供其他主机上的代理管理器 (POOL_NODES) 调度本机的代理池。需要设置 POOL_AGENT_TOKEN。"
+    echo "              选项: --foreground  在前台运行节点代理。"
+    echo "  stop-agent  停止节点代理。"
     echo "  help        显示此帮助信息。"
     echo ""
     echo "示例:"
@@ -190,15 +211,24 @@ cleanup_iptables() {
     "${SUDO_CMD[@]}" "$IPTABLES_CMD" $iptables_compat_flag -t nat -D POSTROUTING -j "${IPTABLES_CHAIN_PREFIX}_POSTROUTING" 2>/dev/null || true
     "${SUDO_CMD[@]}" "$IPTABLES_CMD" $iptables_compat_flag -D FORWARD -j "${IPTABLES_CHAIN_PREFIX}_FORWARD" 2>/dev/null || true
     
-    # 清空并删除自定义链
-    "${SUDO_CMD[@]}" "$IPTABLES_CMD" $iptables_compat_flag -t nat -F "${IPTABLES_CHAIN_PREFIX}_PREROUTING" 2>/dev/null || true
-    "${SUDO_CMD[@]}" "$IPTABLES_CMD" $iptables_compat_flag -t nat -X "${IPTABLES_CHAIN_PREFIX}_PREROUTING" 2>/dev/null || true
-    "${SUDO_CMD[@]}" "$IPTABLES_CMD" $iptables_compat_flag -t nat -F "${IPTABLES_CHAIN_PREFIX}_OUTPUT" 2>/dev/null || true
-    "${SUDO_CMD[@]}" "$IPTABLES_CMD" $iptables_compat_flag -t nat -X "${IPTABLES_CHAIN_PREFIX}_OUTPUT" 2>/dev/null || true
-    "${SUDO_CMD[@]}" "$IPTABLES_CMD" $iptables_compat_flag -t nat -F "${IPTABLES_CHAIN_PREFIX}_POSTROUTING" 2>/dev/null || true
-    "${SUDO_CMD[@]}" "$IPTABLES_CMD" $iptables_compat_flag -t nat -X "${IPTABLES_CHAIN_PREFIX}_POSTROUTING" 2>/dev/null || true
-    "${SUDO_CMD[@]}" "$IPTABLES_CMD" $iptables_compat_flag -F "${IPTABLES_CHAIN_PREFIX}_FORWARD" 2>/dev/null || true
-    "${SUDO_CMD[@]}" "$IPTABLES_CMD" $iptables_compat_flag -X "${IPTABLES_CHAIN_PREFIX}_FORWARD" 2>/dev/null || true
+    # 在一个事务中清空并删除自定义链 (先声明以确保链存在，避免删除不存在的链导致事务失败)
+    if ! "${SUDO_CMD[@]}" "${IPTABLES_CMD}-restore" --noflush 2>/dev/null <<EOF
+*nat
+:${IPTABLES_CHAIN_PREFIX}_PREROUTING - [0:0]
+:${IPTABLES_CHAIN_PREFIX}_OUTPUT - [0:0]
+:${IPTABLES_CHAIN_PREFIX}_POSTROUTING - [0:0]
+-X ${IPTABLES_CHAIN_PREFIX}_PREROUTING
+-X ${IPTABLES_CHAIN_PREFIX}_OUTPUT
+-X ${IPTABLES_CHAIN_PREFIX}_POSTROUTING
+COMMIT
+*filter
+:${IPTABLES_CHAIN_PREFIX}_FORWARD - [0:0]
+-X ${IPTABLES_CHAIN_PREFIX}_FORWARD
+COMMIT
+EOF
+    then
+        log "WARNING" "删除iptables自定义链失败，可能仍有规则引用这些链。"
+    fi
     
     # 检查是否使用ufw，如果是则清理ufw规则
     if command -v ufw &> /dev/null && ufw status | grep -q "Status: active"; then
@@ -211,17 +241,71 @@ cleanup_iptables() {
     log "INFO" "✅ iptables规则清理完成。"
 }
 
+# 销毁单个命名空间: 停止其中的WARP进程，卸载绑定挂载，删除命名空间、veth设备和配置目录
+destroy_namespace() {
+    local ns_name="$1"
+    log "INFO" "     - 正在清理命名空间 $ns_name..."
+    local idx="${ns_name#ns}"
+    
+    # 停止并清理WARP进程PID文件
+    local warp_pid_file="${CONFIG_BASE_DIR}/${ns_name}/warp.pid"
+    if "${SUDO_CMD[@]}" test -f "$warp_pid_file"; then
+        local warp_pid
+        warp_pid=$("${SUDO_CMD[@]}" cat "$warp_pid_file")
+        log "INFO" "     - 停止命名空间 $ns_name 中的WARP进程 (PID: $warp_pid)..."
+        "${SUDO_CMD[@]}" kill -9 "$warp_pid" >/dev/null 2>&1 || true
+        "${SUDO_CMD[@]}" rm -f "$warp_pid_file" 2>/dev/null || true
+    fi
+
+    # 卸载绑定挂载
+    "${SUDO_CMD[@]}" ip netns exec "$ns_name" sh -c '
+        umount /var/lib/cloudflare-warp &>/dev/null || true
+        umount /run/cloudflare-warp &>/dev/null || true
+    ' 2>/dev/null || true
+
+    # 强制杀死命名空间内的所有进程
+    if pids=$("${SUDO_CMD[@]}" ip netns pids "$ns_name" 2>/dev/null); then
+        [[ -n "$pids" ]] && "${SUDO_CMD[@]}" kill -9 $pids >/dev/null 2>&1 || true
+    fi
+    sleep 0.5
+    
+    # 删除命名空间
+    "${SUDO_CMD[@]}" ip netns del "$ns_name" >/dev/null 2>&1 || true
+    
+    # 删除veth设备
+    local veth_host="veth$idx"
+    if "${SUDO_CMD[@]}" ip link show "$veth_host" &> /dev/null; then
+        "${SUDO_CMD[@]}" ip link del "$veth_host" >/dev/null 2>&1 || true
+    fi
+    
+    # 删除相关目录
+    "${SUDO_CMD[@]}" rm -rf "/etc/netns/$ns_name" "${CONFIG_BASE_DIR}/${ns_name}" "${IPC_BASE_DIR}/${ns_name}" 2>/dev/null || true
+}
+
 # --- 资源清理 ---
 cleanup_resources() {
     log "INFO" "🧹 开始全面清理网络资源..."
 
+    # 中止仍在后台创建实例的任务，避免清理过程中又创建出新的命名空间
+    if [[ -f "$POOL_BRING_UP_PID_FILE" ]]; then
+        local bring_up_pid
+        bring_up_pid=$(cat "$POOL_BRING_UP_PID_FILE")
+        if [[ -n "$bring_up_pid" ]] && kill -0 "$bring_up_pid" 2>/dev/null; then
+            log "INFO" "   - 中止后台实例创建任务 (PID: $bring_up_pid)..."
+            pkill -P "$bring_up_pid" 2>/dev/null || true
+            kill "$bring_up_pid" 2>/dev/null || true
+        fi
+        rm -f "$POOL_BRING_UP_PID_FILE"
+    fi
+
     # 清理持久化的iptables规则文件
     log "INFO" "   - 清理持久化的iptables规则文件..."
     "${SUDO_CMD[@]}" rm -f /etc/iptables/rules.v4 2>/dev/null || true
 
     # 1. 清理配置文件
     log "INFO" "   - 清理 ${WARP_POOL_CONFIG_FILE}..."
-    "${SUDO_CMD[@]}" rm -f "$WARP_POOL_CONFIG_FILE" 2>/dev/null || true
+    "${SUDO_CMD[@]}" rm -f "$WARP_POOL_CONFIG_FILE" "${WARP_POOL_CONFIG_FILE}.lock" 2>/dev/null || true
+    "${SUDO_CMD[@]}" rm -rf "$POOL_READY_DIR" 2>/dev/null || true
     log "INFO" "   ✅ 配置文件已清理。"
 
     # 2. 清理iptables
@@ -236,42 +320,7 @@ cleanup_resources() {
         log "INFO" "   - 未发现需要清理的网络命名空间。"
     else
         for ns_name in $existing_ns; do
-            log "INFO" "     - 正在清理命名空间 $ns_name..."
-            local idx="${ns_name#ns}"
-            
-            # 停止并清理WARP进程PID文件
-            local warp_pid_file="${CONFIG_BASE_DIR}/${ns_name}/warp.pid"
-            if "${SUDO_CMD[@]}" test -f "$warp_pid_file"; then
-                local warp_pid
-                warp_pid=$("${SUDO_CMD[@]}" cat "$warp_pid_file")
-                log "INFO" "     - 停止命名空间 $ns_name 中的WARP进程 (PID: $warp_pid)..."
-                "${SUDO_CMD[@]}" kill -9 "$warp_pid" >/dev/null 2>&1 || true
-                "${SUDO_CMD[@]}" rm -f "$warp_pid_file" 2>/dev/null || true
-            fi
-
-            # 卸载绑定挂载
-            "${SUDO_CMD[@]}" ip netns exec "$ns_name" sh -c '
-                umount /var/lib/cloudflare-warp &>/dev/null || true
-                umount /run/cloudflare-warp &>/dev/null || true
-            ' 2>/dev/null || true
-
-            # 强制杀死命名空间内的所有进程
-            if pids=$("${SUDO_CMD[@]}" ip netns pids "$ns_name" 2>/dev/null); then
-                [[ -n "$pids" ]] && "${SUDO_CMD[@]}" kill -9 $pids >/dev/null 2>&1 || true
-            fi
-            sleep 0.5
-            
-            # 删除命名空间
-            "${SUDO_CMD[@]}" ip netns del "$ns_name" >/dev/null 2>&1 || true
-            
-            # 删除veth设备
-            local veth_host="veth$idx"
-            if "${SUDO_CMD[@]}" ip link show "$veth_host" &> /dev/null; then
-                "${SUDO_CMD[@]}" ip link del "$veth_host" >/dev/null 2>&1 || true
-            fi
-            
-            # 删除相关目录
-            "${SUDO_CMD[@]}" rm -rf "/etc/netns/$ns_name" "${CONFIG_BASE_DIR}/${ns_name}" "${IPC_BASE_DIR}/${ns_name}" 2>/dev/null || true
+            destroy_namespace "$ns_name"
         done
         log "INFO" "   ✅ 网络命名空间清理完成。"
     fi
@@ -293,9 +342,7 @@ cleanup_resources() {
 
 
 # --- API 服务管理 ---
-start_api() {
-    log "INFO" "🐍 启动代理管理API服务..."
-
+prepare_python_env() {
     # 1. 检查Python虚拟环境
     if [[ ! -d "$VENV_DIR" ]]; then
         log "INFO" "   - 创建Python虚拟环境到 ${VENV_DIR}..."
@@ -310,6 +357,11 @@ start_api() {
     else
         log "WARNING" "   - 未找到 ${REQUIREMENTS_FILE}，请确保依赖已安装。"
     fi
+}
+
+start_api() {
+    log "INFO" "🐍 启动代理管理API服务..."
+    prepare_python_env || return 1
 
     # 3. 检查API是否已在运行
     if [[ -f "$PID_FILE" ]] && ps -p "$(cat "$PID_FILE")" > /dev/null; then
@@ -321,12 +373,23 @@ start_api() {
     local venv_python="${VENV_DIR}/bin/python"
     export POOL_SIZE # 导出环境变量供Python脚本使用
     export BASE_PORT
+    export BACKEND_ADDRESSING
+    export PROXY_MANAGER_PID_FILE="$PID_FILE" # 平滑重启后由新进程改写为自己的PID
     
     if [[ "$1" == true ]]; then # 前台运行
         log "INFO" "   - 在前台启动API服务..."
         # 不使用exec，以便trap可以捕获信号
-        # 直接执行，使脚本在前台运行，允许trap捕获Ctrl+C
-        "$venv_python" "$PROXY_MANAGER_SCRIPT"
+        # 放到后台再wait，使脚本在前台运行，允许trap捕获Ctrl+C
+        "$venv_python" "$PROXY_MANAGER_SCRIPT" &
+        local pid=$!
+        echo "$pid" > "$PID_FILE"
+        wait "$pid" || true
+        # 平滑重启后新进程不是本脚本的子进程，无法wait，只能轮询PID文件跟随
+        while [[ -f "$PID_FILE" ]]; do
+            pid=$(cat "$PID_FILE")
+            kill -0 "$pid" 2>/dev/null || break
+            sleep 2
+        done
     else # 后台运行
         log "INFO" "   - 在后台启动API服务..."
         nohup "$venv_python" "$PROXY_MANAGER_SCRIPT" > "$LOG_FILE" 2>&1 &
@@ -363,6 +426,87 @@ stop_api() {
     log "INFO" "   ✅ API服务已停止。"
 }
 
+reload_api() {
+    log "INFO" "🔄 平滑重启代理管理API服务..."
+    if [[ ! -f "$PID_FILE" ]] || ! ps -p "$(cat "$PID_FILE")" > /dev/null; then
+        log "ERROR" "API服务未在运行，无法平滑重启。"
+        return 1
+    fi
+    local old_pid new_pid
+    old_pid=$(cat "$PID_FILE")
+    log "INFO" "   - 向主进程 (PID: $old_pid) 发送 SIGUSR2..."
+    kill -USR2 "$old_pid" || { log "ERROR" "发送信号失败。"; return 1; }
+
+    # 新进程就绪并接管监听套接字后会把自己的PID写入PID文件
+    local waited=0
+    while (( waited < 120 )); do
+        new_pid=$(cat "$PID_FILE" 2>/dev/null || true)
+        if [[ -n "$new_pid" && "$new_pid" != "$old_pid" ]] && ps -p "$new_pid" > /dev/null; then
+            log "INFO" "   ✅ 新进程 (PID: $new_pid) 已接管服务，旧进程将在现有连接结束后退出。日志: $LOG_FILE"
+            return 0
+        fi
+        if ! ps -p "$old_pid" > /dev/null; then
+            log "ERROR" "旧进程已退出但没有新进程接管，请检查日志: $LOG_FILE"
+            return 1
+        fi
+        sleep 1
+        waited=$((waited + 1))
+    done
+    log "ERROR" "等待新进程接管超时，旧进程 (PID: $old_pid) 仍在服务，请检查日志: $LOG_FILE"
+    return 1
+}
+
+# --- 节点代理管理 (多节点部署) ---
+start_agent() {
+    log "INFO" "🛰️ 启动节点代理..."
+    if [[ -z "${POOL_AGENT_TOKEN:-}" ]]; then
+        log "ERROR" "未设置 POOL_AGENT_TOKEN。节点代理可以刷新本机实例的IP，必须设置与代理管理器相同的令牌。"
+        return 1
+    fi
+    if [[ "$POOL_PORT_DNAT" != "1" ]]; then
+        log "WARNING" "   - POOL_PORT_DNAT 未开启，其他主机上的代理管理器无法通过主机端口连接本机实例。"
+    fi
+    prepare_python_env || return 1
+
+    if [[ -f "$AGENT_PID_FILE" ]] && ps -p "$(cat "$AGENT_PID_FILE")" > /dev/null; then
+        log "WARNING" "节点代理已在运行 (PID: $(cat "$AGENT_PID_FILE"))。"
+        return 0
+    fi
+
+    local venv_python="${VENV_DIR}/bin/python"
+    export POOL_AGENT_TOKEN
+    if [[ "$1" == true ]]; then # 前台运行
+        log "INFO" "   - 在前台启动节点代理..."
+        "$venv_python" "$POOL_AGENT_SCRIPT" &
+        local pid=$!
+        echo "$pid" > "$AGENT_PID_FILE"
+        wait "$pid" || true
+        rm -f "$AGENT_PID_FILE"
+    else # 后台运行
+        log "INFO" "   - 在后台启动节点代理..."
+        nohup "$venv_python" "$POOL_AGENT_SCRIPT" >> "$LOG_FILE" 2>&1 &
+        local pid=$!
+        echo "$pid" > "$AGENT_PID_FILE"
+        log "INFO" "   ✅ 节点代理已启动 (PID: $pid)，监听端口 ${POOL_AGENT_PORT:-5100}。日志: $LOG_FILE"
+    fi
+}
+
+stop_agent() {
+    log "INFO" "🛑 停止节点代理..."
+    if [[ -f "$AGENT_PID_FILE" ]]; then
+        local pid
+        pid=$(cat "$AGENT_PID_FILE")
+        if ps -p "$pid" > /dev/null; then
+            kill "$pid" || true
+        else
+            log "INFO" "   - PID文件中的进程 ($pid) 未在运行。"
+        fi
+        rm -f "$AGENT_PID_FILE"
+    fi
+    pkill -f "$POOL_AGENT_SCRIPT" >/dev/null 2>&1 || true
+    log "INFO" "   ✅ 节点代理已停止。"
+}
+
 # --- 核心创建逻辑 ---
 check_dependencies() {
     log "INFO" "🔍 检查系统依赖..."
@@ -651,122 +795,158 @@ create_pool() {
     register_warp_globally || { log "ERROR" "WARP全局注册失败，中止操作。"; return 1; }
 
     "${SUDO_CMD[@]}" sysctl -w net.ipv4.ip_forward=1 >/dev/null
-    "${SUDO_CMD[@]}" sh -c "echo 1 > /proc/sys/net/ipv4/conf/all/route_localnet"
+    if [[ "$POOL_PORT_DNAT" == "1" ]]; then
+        # 发往 127.0.0.1 的连接需要经DNAT转发到命名空间
+        "${SUDO_CMD[@]}" sh -c "echo 1 > /proc/sys/net/ipv4/conf/all/route_localnet"
+    fi
 
     setup_iptables_chains
-
-    for i in $(seq 0 $(($POOL_SIZE-1))); do
-        local ns_name="ns$i"
-        log "INFO" "✨ 正在创建 WARP 实例 $i (命名空间: $ns_name)..."
-        
-        # 网络配置 (使用 /256 和 %256 来确保每个实例都有唯一的 /24 子网)
-        local subnet_third=$((i / 256))
-        local subnet_fourth=$((i % 256))
-        local gateway_ip="10.${subnet_third}.${subnet_fourth}.1"
-        local namespace_ip="10.${subnet_third}.${subnet_fourth}.2"
-        local subnet="${gateway_ip%.*}.0/24"
-        local veth_host="veth$i"
-        local veth_ns="veth${i}-ns"
-        
-        # 创建命名空间和veth
-        "${SUDO_CMD[@]}" ip netns add "$ns_name"
-        "${SUDO_CMD[@]}" ip link add "$veth_host" type veth peer name "$veth_ns"
-        "${SUDO_CMD[@]}" ip link set "$veth_ns" netns "$ns_name"
-        "${SUDO_CMD[@]}" ip addr add "$gateway_ip/24" dev "$veth_host"
-        "${SUDO_CMD[@]}" ip link set "$veth_host" up
-        
-        # 配置命名空间内部网络
-        "${SUDO_CMD[@]}" ip netns exec "$ns_name" ip addr add "$namespace_ip/24" dev "$veth_ns"
-        "${SUDO_CMD[@]}" ip netns exec "$ns_name" ip link set lo up
-        "${SUDO_CMD[@]}" ip netns exec "$ns_name" ip link set "$veth_ns" up
-        "${SUDO_CMD[@]}" ip netns exec "$ns_name" ip route add default via "$gateway_ip"
-
-        # 绑定配置目录
-        "${SUDO_CMD[@]}" mkdir -p "${CONFIG_BASE_DIR}/${ns_name}" "${IPC_BASE_DIR}/${ns_name}"
-        "${SUDO_CMD[@]}" ip netns exec "$ns_name" mkdir -p /var/lib/cloudflare-warp /run/cloudflare-warp
-        "${SUDO_CMD[@]}" ip netns exec "$ns_name" mount --bind "${CONFIG_BASE_DIR}/${ns_name}" /var/lib/cloudflare-warp
-        "${SUDO_CMD[@]}" ip netns exec "$ns_name" mount --bind "${IPC_BASE_DIR}/${ns_name}" /run/cloudflare-warp
-
-        # 初始化WARP
-        local warp_internal_port=$((40000 + i))
-        if ! init_warp_instance "$ns_name" "$i" "$warp_internal_port" "$WARP_LICENSE_KEY" "$WARP_ENDPOINT"; then
-            log "ERROR" "WARP实例 $ns_name 初始化失败。中止代理池创建。"
-            return 1
+    # 整个代理池的规则一次性生成并原子地安装; 实例就绪前发往其端口的连接会被拒绝
+    apply_pool_iptables_rules $(seq 0 $(($POOL_SIZE-1))) || return 1
+
+    rm -rf "$POOL_READY_DIR"
+    mkdir -p "$POOL_READY_DIR"
+    write_pool_config
+
+    # 在后台以有限的并行度创建实例，每个实例就绪后立即写入配置文件，
+    # 代理管理器监视配置文件并将新实例加入运行中的代理池。
+    # 后台任务不继承脚本锁，以便 stop/restart 可以中止尚未完成的创建。
+    bring_up_instances $(seq 0 $(($POOL_SIZE-1))) 200>&- &
+    local bring_up_pid=$!
+    echo "$bring_up_pid" > "$POOL_BRING_UP_PID_FILE"
+
+    # 等待第一个实例就绪后即可启动API服务
+    while ! grep -q '"port"' "$WARP_POOL_CONFIG_FILE"; do
+        if ! kill -0 "$bring_up_pid" 2>/dev/null; then
+            wait "$bring_up_pid" || true
+            if ! grep -q '"port"' "$WARP_POOL_CONFIG_FILE"; then
+                log "ERROR" "❌ 没有任何WARP实例创建成功，中止操作。"
+                return 1
+            fi
+            break
         fi
+        sleep 1
+    done
+    log "INFO" "✅ 首个WARP实例已就绪，其余实例将在后台继续创建并逐个加入代理池。"
+}
 
-        # 配置iptables规则
-        local host_port=$((BASE_PORT + i))
-        local comment_args="-m comment --comment \"${IPTABLES_COMMENT_PREFIX}-DNAT-$host_port\""
-        
-        # 检查是否在nftables模式下运行，如果是则使用兼容模式
-        local iptables_compat_flag=""
-        if [[ "$IPTABLES_CMD" == "iptables-nft" ]] || [[ "$IPTABLES_CMD" == "iptables" && -n "$(iptables -V | grep -i nft)" ]]; then
-            iptables_compat_flag="--compat"
-        fi
-        
-        # 添加PREROUTING DNAT规则 (仅匹配发往本机的流量)
-        # 先尝试删除可能存在的旧规则，避免重复
-        "${SUDO_CMD[@]}" "$IPTABLES_CMD" $iptables_compat_flag -t nat -D "${IPTABLES_CHAIN_PREFIX}_PREROUTING" -m addrtype --dst-type LOCAL -p tcp --dport "$host_port" -j DNAT --to-destination "$namespace_ip:$warp_internal_port" $comment_args 2>/dev/null || true
-        # 添加新规则
-        if ! "${SUDO_CMD[@]}" "$IPTABLES_CMD" $iptables_compat_flag -t nat -A "${IPTABLES_CHAIN_PREFIX}_PREROUTING" -m addrtype --dst-type LOCAL -p tcp --dport "$host_port" -j DNAT --to-destination "$namespace_ip:$warp_internal_port" $comment_args 2>/dev/null; then
-            log "ERROR" "无法为实例 $i (命名空间: $ns_name) 添加PREROUTING DNAT规则。"
-            return 1
-        fi
-        
-        # 添加OUTPUT DNAT规则 (仅匹配发往本机的流量)
-        "${SUDO_CMD[@]}" "$IPTABLES_CMD" $iptables_compat_flag -t nat -D "${IPTABLES_CHAIN_PREFIX}_OUTPUT" -m addrtype --dst-type LOCAL -p tcp --dport "$host_port" -j DNAT --to-destination "$namespace_ip:$warp_internal_port" $comment_args 2>/dev/null || true
-        if ! "${SUDO_CMD[@]}" "$IPTABLES_CMD" $iptables_compat_flag -t nat -A "${IPTABLES_CHAIN_PREFIX}_OUTPUT" -m addrtype --dst-type LOCAL -p tcp --dport "$host_port" -j DNAT --to-destination "$namespace_ip:$warp_internal_port" $comment_args 2>/dev/null; then
-            log "ERROR" "无法为实例 $i (命名空间: $ns_name) 添加OUTPUT DNAT规则。"
-            return 1
-        fi
-        
-        # 添加FORWARD规则
-        comment_args="-m comment --comment \"${IPTABLES_COMMENT_PREFIX}-FWD-$subnet\""
-        # 允许从命名空间到外部的流量
-        "${SUDO_CMD[@]}" "$IPTABLES_CMD" $iptables_compat_flag -D "${IPTABLES_CHAIN_PREFIX}_FORWARD" -s "$subnet" -j ACCEPT $comment_args 2>/dev/null || true
-        if ! "${SUDO_CMD[@]}" "$IPTABLES_CMD" $iptables_compat_flag -A "${IPTABLES_CHAIN_PREFIX}_FORWARD" -s "$subnet" -j ACCEPT $comment_args 2>/dev/null; then
-            log "ERROR" "无法为实例 $i (命名空间: $ns_name) 添加FORWARD (outbound) 规则。"
-            return 1
-        fi
-        
-        # 允许从外部到命名空间的流量
-        "${SUDO_CMD[@]}" "$IPTABLES_CMD" $iptables_compat_flag -D "${IPTABLES_CHAIN_PREFIX}_FORWARD" -d "$subnet" -j ACCEPT $comment_args 2>/dev/null || true
-        if ! "${SUDO_CMD[@]}" "$IPTABLES_CMD" $iptables_compat_flag -A "${IPTABLES_CHAIN_PREFIX}_FORWARD" -d "$subnet" -j ACCEPT $comment_args 2>/dev/null; then
-            log "ERROR" "无法为实例 $i (命名空间: $ns_name) 添加FORWARD (inbound) 规则。"
-            return 1
-        fi
-        
-        # 添加POSTROUTING MASQUERADE规则
-        comment_args="-m comment --comment \"${IPTABLES_COMMENT_PREFIX}-MASQ-$subnet\""
-        "${SUDO_CMD[@]}" "$IPTABLES_CMD" $iptables_compat_flag -t nat -D "${IPTABLES_CHAIN_PREFIX}_POSTROUTING" -s "$subnet" -j MASQUERADE $comment_args 2>/dev/null || true
-        if ! "${SUDO_CMD[@]}" "$IPTABLES_CMD" $iptables_compat_flag -t nat -A "${IPTABLES_CHAIN_PREFIX}_POSTROUTING" -s "$subnet" -j MASQUERADE $comment_args 2>/dev/null; then
-            log "ERROR" "无法为实例 $i (命名空间: $ns_name) 添加POSTROUTING MASQUERADE规则。"
-            return 1
-        fi
+# 输出指定编号实例在命名空间内的地址
+instance_namespace_ip() {
+    echo "10.$(($1 / 256)).$(($1 % 256)).2"
+}
 
+# 创建单个WARP实例: 命名空间、veth、绑定挂载和WARP初始化
+create_warp_instance() {
+    local i="$1"
+    local ns_name="ns$i"
+    log "INFO" "✨ 正在创建 WARP 实例 $i (命名空间: $ns_name)..."
+    
+    # 网络配置 (使用 /256 和 %256 来确保每个实例都有唯一的 /24 子网)
+    local subnet_third=$((i / 256))
+    local subnet_fourth=$((i % 256))
+    local gateway_ip="10.${subnet_third}.${subnet_fourth}.1"
+    local namespace_ip="10.${subnet_third}.${subnet_fourth}.2"
+    local subnet="${gateway_ip%.*}.0/24"
+    local veth_host="veth$i"
+    local veth_ns="veth${i}-ns"
+    
+    # 创建命名空间和veth
+    "${SUDO_CMD[@]}" ip netns add "$ns_name"
+    "${SUDO_CMD[@]}" ip link add "$veth_host" type veth peer name "$veth_ns"
+    "${SUDO_CMD[@]}" ip link set "$veth_ns" netns "$ns_name"
+    "${SUDO_CMD[@]}" ip addr add "$gateway_ip/24" dev "$veth_host"
+    "${SUDO_CMD[@]}" ip link set "$veth_host" up
+    
+    # 配置命名空间内部网络
+    "${SUDO_CMD[@]}" ip netns exec "$ns_name" ip addr add "$namespace_ip/24" dev "$veth_ns"
+    "${SUDO_CMD[@]}" ip netns exec "$ns_name" ip link set lo up
+    "${SUDO_CMD[@]}" ip netns exec "$ns_name" ip link set "$veth_ns" up
+    "${SUDO_CMD[@]}" ip netns exec "$ns_name" ip route add default via "$gateway_ip"
+
+    # 绑定配置目录
+    "${SUDO_CMD[@]}" mkdir -p "${CONFIG_BASE_DIR}/${ns_name}" "${IPC_BASE_DIR}/${ns_name}"
+    "${SUDO_CMD[@]}" ip netns exec "$ns_name" mkdir -p /var/lib/cloudflare-warp /run/cloudflare-warp
+    "${SUDO_CMD[@]}" ip netns exec "$ns_name" mount --bind "${CONFIG_BASE_DIR}/${ns_name}" /var/lib/cloudflare-warp
+    "${SUDO_CMD[@]}" ip netns exec "$ns_name" mount --bind "${IPC_BASE_DIR}/${ns_name}" /run/cloudflare-warp
+
+    # 初始化WARP
+    local warp_internal_port=$((40000 + i))
+    if ! init_warp_instance "$ns_name" "$i" "$warp_internal_port" "$WARP_LICENSE_KEY" "$WARP_ENDPOINT"; then
+        log "ERROR" "WARP实例 $ns_name 初始化失败。"
+        return 1
+    fi
+
+    # iptables规则已由 apply_pool_iptables_rules 为整个代理池统一安装
+    local host_port=$((BASE_PORT + i))
+    if [[ "$POOL_PORT_DNAT" == "1" ]]; then
         log "INFO" "✅ 实例 $i 创建成功，代理监听在 127.0.0.1:$host_port"
-    done
-    log "INFO" "✅✅✅ WARP 代理池创建完成！"
+    else
+        log "INFO" "✅ 实例 $i 创建成功，代理监听在 $namespace_ip:$warp_internal_port"
+    fi
+}
 
-    # --- 生成 warp_pool_config.json ---
-    log "INFO" "📝 生成 ${WARP_POOL_CONFIG_FILE}..."
+# 按就绪记录以原子方式重写 warp_pool_config.json (先写临时文件再重命名)
+write_pool_config() {
     local json_content="["
-    for i in $(seq 0 $(($POOL_SIZE-1))); do
-        local ns_name="ns$i"
-        local host_port=$((BASE_PORT + i))
-        
-        if [[ "$i" -gt 0 ]]; then
+    local entry_file
+    for entry_file in $(ls "$POOL_READY_DIR" | sort -n); do
+        if [[ "$json_content" != "[" ]]; then
             json_content+=","
         fi
-        
-        json_content+=$(printf '{"id": %d, "namespace": "%s", "port": %d}' "$i" "$ns_name" "$host_port")
+        json_content+=$(cat "${POOL_READY_DIR}/${entry_file}")
     done
     json_content+="]"
-    
-    echo "$json_content" > "$WARP_POOL_CONFIG_FILE"
-    log "INFO" "✅ ${WARP_POOL_CONFIG_FILE} 已生成。"
 
-    # --- 持久化 iptables 规则 ---
+    local tmp_file="${WARP_POOL_CONFIG_FILE}.tmp"
+    echo "$json_content" > "$tmp_file"
+    mv -f "$tmp_file" "$WARP_POOL_CONFIG_FILE"
+}
+
+# 记录一个已就绪的实例并更新配置文件。并行创建的实例通过 flock 串行化写入。
+register_ready_instance() {
+    local i="$1"
+    (
+        flock -x 201
+        printf '{"id": %d, "namespace": "%s", "port": %d, "namespace_ip": "%s", "internal_port": %d}' \
+            "$i" "ns$i" "$((BASE_PORT + i))" "$(instance_namespace_ip "$i")" "$((40000 + i))" > "${POOL_READY_DIR}/${i}"
+        write_pool_config
+    ) 201>"${WARP_POOL_CONFIG_FILE}.lock"
+    log "INFO" "📝 实例 $i 已加入 ${WARP_POOL_CONFIG_FILE}。"
+}
+
+# 以最多 POOL_CREATE_PARALLELISM 个并发任务创建指定编号的实例，单个实例失败不影响其他实例
+bring_up_instances() {
+    local running=0
+    local failed=0
+    local i
+    for i in "$@"; do
+        if (( running >= POOL_CREATE_PARALLELISM )); then
+            wait -n || failed=$((failed + 1))
+            running=$((running - 1))
+        fi
+        (
+            create_warp_instance "$i"
+            register_ready_instance "$i"
+        ) &
+        running=$((running + 1))
+    done
+    while (( running > 0 )); do
+        wait -n || failed=$((failed + 1))
+        running=$((running - 1))
+    done
+
+    if (( failed > 0 )); then
+        log "WARNING" "⚠️ WARP 代理池创建完成，其中 $failed 个实例创建失败 (共 $# 个)。"
+    else
+        log "INFO" "✅✅✅ WARP 代理池创建完成！"
+    fi
+
+    persist_iptables_rules
+    rm -f "$POOL_BRING_UP_PID_FILE"
+}
+
+# --- 持久化 iptables 规则 ---
+persist_iptables_rules() {
     log "INFO" "💾 持久化iptables规则..."
     if ! "${SUDO_CMD[@]}" mkdir -p /etc/iptables; then
         log "ERROR" "无法创建 /etc/iptables 目录。"
@@ -779,6 +959,151 @@ create_pool() {
     log "INFO" "✅ iptables规则已保存到 /etc/iptables/rules.v4"
 }
 
+# 以 iptables-restore 格式输出指定编号实例的 DNAT/FORWARD/MASQUERADE 规则。
+# 在 --noflush 模式下声明自定义链会先清空该链，因此每次应用都会整体替换代理池的规则集。
+generate_pool_iptables_rules() {
+    local i
+    echo "*nat"
+    echo ":${IPTABLES_CHAIN_PREFIX}_PREROUTING - [0:0]"
+    echo ":${IPTABLES_CHAIN_PREFIX}_OUTPUT - [0:0]"
+    echo ":${IPTABLES_CHAIN_PREFIX}_POSTROUTING - [0:0]"
+    for i in "$@"; do
+        local namespace_ip="10.$((i / 256)).$((i % 256)).2"
+        local subnet="10.$((i / 256)).$((i % 256)).0/24"
+        local warp_internal_port=$((40000 + i))
+        local host_port=$((BASE_PORT + i))
+        if [[ "$POOL_PORT_DNAT" == "1" ]]; then
+            # DNAT规则仅匹配发往本机的流量
+            echo "-A ${IPTABLES_CHAIN_PREFIX}_PREROUTING -m addrtype --dst-type LOCAL -p tcp --dport $host_port -m comment --comment \"${IPTABLES_COMMENT_PREFIX}-DNAT-$host_port\" -j DNAT --to-destination $namespace_ip:$warp_internal_port"
+            echo "-A ${IPTABLES_CHAIN_PREFIX}_OUTPUT -m addrtype --dst-type LOCAL -p tcp --dport $host_port -m comment --comment \"${IPTABLES_COMMENT_PREFIX}-DNAT-$host_port\" -j DNAT --to-destination $namespace_ip:$warp_internal_port"
+        fi
+        echo "-A ${IPTABLES_CHAIN_PREFIX}_POSTROUTING -s $subnet -m comment --comment \"${IPTABLES_COMMENT_PREFIX}-MASQ-$subnet\" -j MASQUERADE"
+    done
+    echo "COMMIT"
+    echo "*filter"
+    echo ":${IPTABLES_CHAIN_PREFIX}_FORWARD - [0:0]"
+    for i in "$@"; do
+        local subnet="10.$((i / 256)).$((i % 256)).0/24"
+        # 允许命名空间与外部之间双向的流量
+        echo "-A ${IPTABLES_CHAIN_PREFIX}_FORWARD -s $subnet -m comment --comment \"${IPTABLES_COMMENT_PREFIX}-FWD-$subnet\" -j ACCEPT"
+        echo "-A ${IPTABLES_CHAIN_PREFIX}_FORWARD -d $subnet -m comment --comment \"${IPTABLES_COMMENT_PREFIX}-FWD-$subnet\" -j ACCEPT"
+    done
+    echo "COMMIT"
+}
+
+# 以单个 iptables-restore 事务安装指定编号实例的规则。失败时原有规则保持不变。
+# 已建立的连接由 conntrack 维持，替换规则集不会影响正在进行的中继。
+apply_pool_iptables_rules() {
+    log "INFO" "🧱 以单个事务安装 $# 个实例的iptables规则..."
+    if ! generate_pool_iptables_rules "$@" | "${SUDO_CMD[@]}" "${IPTABLES_CMD}-restore" --noflush; then
+        log "ERROR" "${IPTABLES_CMD}-restore 安装规则失败，原有规则保持不变。"
+        return 1
+    fi
+    log "INFO" "✅ iptables规则已安装。"
+}
+
+# 等待代理管理器排空并移除指定编号的实例。
+# 设置了 API_SECRET_TOKEN 时通过管理API查询后端是否已移除，否则检查到后端端口的TCP连接是否都已结束。
+wait_for_instances_drained() {
+    local deadline=$((SECONDS + RESIZE_DRAIN_TIMEOUT))
+    local i
+    if [[ -z "${API_SECRET_TOKEN:-}" ]]; then
+        # 给代理管理器留出检测配置文件变化的时间
+        sleep 3
+    fi
+    for i in "$@"; do
+        local host_port=$((BASE_PORT + i))
+        # 代理管理器到实例的连接: direct 模式下直连命名空间地址，否则经主机端口
+        local session_filter="( dport = :${host_port} )"
+        if [[ "$BACKEND_ADDRESSING" == "direct" ]]; then
+            session_filter="( dst $(instance_namespace_ip "$i"):$((40000 + i)) )"
+        fi
+        while (( SECONDS < deadline )); do
+            if [[ -n "${API_SECRET_TOKEN:-}" ]]; then
+                local http_code
+                http_code=$(curl -s -o /dev/null -w '%{http_code}' -H "Authorization: Bearer ${API_SECRET_TOKEN}" \
+                    "http://127.0.0.1:${API_PORT}/admin/backends/${host_port}" 2>/dev/null) || true
+                # 404 表示已移除; 000 表示API未运行，没有需要等待的会话
+                if [[ "$http_code" == "404" || "$http_code" == "000" ]]; then
+                    break
+                fi
+            elif [[ -z "$(ss -Htn state established "$session_filter" 2>/dev/null)" ]]; then
+                break
+            fi
+            sleep 2
+        done
+        if (( SECONDS >= deadline )); then
+            log "WARNING" "⚠️ 等待实例排空超过 ${RESIZE_DRAIN_TIMEOUT} 秒，剩余实例将被强制移除。"
+            return 0
+        fi
+        log "INFO" "   - 实例 $i (端口 $host_port) 已排空。"
+    done
+}
+
+# 调整运行中代理池的大小，不重启代理管理器。
+# 扩容时并行创建缺少的实例并逐个加入配置文件; 缩容时先从配置文件中移除多余的实例，
+# 代理管理器停止为其分配新会话，等已有会话结束后再销毁其命名空间。
+resize_pool() {
+    local new_size="$1"
+    if ! [[ "$new_size" =~ ^[0-9]+$ ]] || (( new_size < 1 )); then
+        log "ERROR" "resize 命令需要一个正整数作为新的代理池大小。"
+        return 1
+    fi
+    if [[ ! -d "$POOL_READY_DIR" ]]; then
+        log "ERROR" "未找到运行中的代理池，请先执行 start。"
+        return 1
+    fi
+    if [[ -f "$POOL_BRING_UP_PID_FILE" ]] && kill -0 "$(cat "$POOL_BRING_UP_PID_FILE")" 2>/dev/null; then
+        log "ERROR" "实例仍在后台创建中，请稍后再调整代理池大小。"
+        return 1
+    fi
+
+    local to_create=()
+    local to_remove=()
+    local i
+    for i in $(seq 0 $((new_size - 1))); do
+        if [[ ! -f "${POOL_READY_DIR}/${i}" ]]; then
+            to_create+=("$i")
+        fi
+    done
+    for i in $(ls "$POOL_READY_DIR" | sort -n); do
+        if (( i >= new_size )); then
+            to_remove+=("$i")
+        fi
+    done
+    log "INFO" "📐 调整代理池大小为 $new_size: 新建实例 [${to_create[*]}]，移除实例 [${to_remove[*]}]。"
+
+    if (( ${#to_remove[@]} > 0 )); then
+        (
+            flock -x 201
+            for i in "${to_remove[@]}"; do
+                rm -f "${POOL_READY_DIR}/${i}"
+            done
+            write_pool_config
+        ) 201>"${WARP_POOL_CONFIG_FILE}.lock"
+        log "INFO" "⏳ 已从 ${WARP_POOL_CONFIG_FILE} 中移除实例，等待其上的会话结束..."
+        wait_for_instances_drained "${to_remove[@]}"
+        apply_pool_iptables_rules $(seq 0 $((new_size - 1))) || return 1
+        for i in "${to_remove[@]}"; do
+            destroy_namespace "ns$i"
+        done
+        log "INFO" "✅ 已移除 ${#to_remove[@]} 个实例。"
+    fi
+
+    if (( ${#to_create[@]} > 0 )); then
+        # 清理先前创建失败的实例可能留下的命名空间
+        for i in "${to_create[@]}"; do
+            if "${SUDO_CMD[@]}" ip netns list | awk '{print $1}' | grep -qx "ns$i"; then
+                destroy_namespace "ns$i"
+            fi
+        done
+        apply_pool_iptables_rules $(seq 0 $((new_size - 1))) || return 1
+        bring_up_instances "${to_create[@]}"
+    else
+        persist_iptables_rules
+    fi
+}
+
 # --- 状态检查 ---
 show_status() {
     log "INFO" "📊 服务状态检查..."
@@ -794,6 +1119,9 @@ show_status() {
             log "INFO" "   - API 服务: ❌ 已停止"
         fi
     fi
+    if [[ -f "$AGENT_PID_FILE" ]] && ps -p "$(cat "$AGENT_PID_FILE")" > /dev/null; then
+        log "INFO" "   - 节点代理: ✅ 运行中 (PID: $(cat "$AGENT_PID_FILE"))"
+    fi
 
     # 2. 代理池实例状态
     log "INFO" "   - 代理池实例:"
@@ -828,12 +1156,17 @@ try:
         ns = p['namespace']
         port = p['port']
         # 计算对应的内部端口
-        internal_port = 40000 + p['id']
+        internal_port = p.get('internal_port', 40000 + p['id'])
+        # direct 模式下代理管理器直连命名空间地址，检查同一地址
+        if sys.argv[2] == 'direct' and p.get('namespace_ip'):
+            check_host, check_port = p['namespace_ip'], internal_port
+        else:
+            check_host, check_port = '127.0.0.1', port
         
         # 检查端口连通性
         try:
             # 增加超时时间以适应网络命名空间转发
-            if check_port_connectivity('127.0.0.1', port, timeout=15):
+            if check_port_connectivity(check_host, check_port, timeout=15):
                 listen_status = '✅'
             else:
                 # 如果连通性检查失败，检查命名空间内端口是否监听
@@ -862,11 +1195,11 @@ try:
             print(f\"     - 实例 {p['id']} ({ns}): 检查WARP状态时出错: {e}\", file=sys.stderr)
             warp_status = '❌'
             
-        print(f\"     - 实例 {p['id']} ({ns}): 代理端口 127.0.0.1:{port} [监听: {listen_status}] | WARP连接 [状态: {warp_status}]\")
+        print(f\"     - 实例 {p['id']} ({ns}): 代理端口 {check_host}:{check_port} [监听: {listen_status}] | WARP连接 [状态: {warp_status}]\")
 except Exception as e:
     print(f'Error checking status: {e}', file=sys.stderr)
 "
-        "$PYTHON_CMD" -c "$python_checker_code" "$WARP_POOL_CONFIG_FILE"
+        "$PYTHON_CMD" -c "$python_checker_code" "$WARP_POOL_CONFIG_FILE" "$BACKEND_ADDRESSING"
     fi
 
     # 3. iptables 规则状态
@@ -1005,6 +1338,13 @@ main() {
                 log "INFO" "🎉 服务重启完成。"
             ) 200>"$LOCK_FILE"
             ;;
+        resize)
+            (
+                flock -xn 200 || { log "ERROR" "脚本已在运行，请勿重复执行。"; exit 1; }
+                log "INFO" "命令: resize ${2:-}"
+                resize_pool "${2:-}"
+            ) 200>"$LOCK_FILE"
+            ;;
         status)
             show_status
             ;;
@@ -1023,6 +1363,18 @@ main() {
             log "INFO" "命令: stop-api"
             stop_api
             ;;
+        reload)
+            log "INFO" "命令: reload"
+            reload_api
+            ;;
+        start-agent)
+            log "INFO" "命令: start-agent"
+            start_agent "$foreground"
+            ;;
+        stop-agent)
+            log "INFO" "命令: stop-agent"
+            stop_agent
+            ;;
         help|*)
             show_help
             ;;
@@ -0,0 +1,148 @@
+"""
+WARP代理池节点代理。
+
+多节点部署时，每台运行 manage_pool.sh 代理池的其他主机上运行一个节点代理，供中心管理器 (proxy_manager.py，
+通过 POOL_NODES 配置) 同步本机的后端列表并远程刷新IP。节点代理不持有代理池状态: 后端的获取、验证、
+健康探测和调度都由中心管理器完成，中心管理器直接连接本机的后端端口 (DNAT 主机端口)。
+
+接口 (均需 Authorization: Bearer <POOL_AGENT_TOKEN>):
+    GET  /backends                 本节点的后端列表 (读取 warp_pool_config.json)
+    POST /backends/<端口>/refresh   刷新指定后端的IP (使用与管理器相同的刷新驱动 REFRESH_DRIVER，见 pool_common.py)
+    GET  /health                   节点代理是否在运行
+
+用法: POOL_AGENT_TOKEN=... python3 src/pool_agent.py (或 ./manage_pool.sh start-agent)
+"""
+import os
+import sys
+import socket
+import logging
+import secrets
+import threading
+from functools import wraps
+from flask import Flask, jsonify, request
+
+try:
+    import waitress  # 可选: 生产级WSGI服务器 (pip install waitress)，未安装时使用 Flask 开发服务器
+except ImportError:
+    waitress = None
+
+import pool_common  # 与管理器共用的配置文件读取和IP刷新驱动
+
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO').strip().upper(),
+    format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+# --- 节点代理配置 ---
+POOL_AGENT_HOST = os.environ.get('POOL_AGENT_HOST', '0.0.0.0')
+POOL_AGENT_PORT = int(os.environ.get('POOL_AGENT_PORT', 5100))
+POOL_AGENT_TOKEN = os.environ.get('POOL_AGENT_TOKEN', '')
+POOL_AGENT_NODE_NAME = os.environ.get('POOL_AGENT_NODE_NAME', socket.gethostname())
+# 中心管理器连接本节点后端端口使用的地址。为空时使用 POOL_AGENT_HOST; 监听所有地址时由管理器使用访问节点代理所用的主机名
+POOL_AGENT_ADVERTISE_HOST = os.environ.get('POOL_AGENT_ADVERTISE_HOST', '').strip()
+POOL_AGENT_THREADS = int(os.environ.get('POOL_AGENT_THREADS', 8))
+
+agent_app = Flask(__name__)
+config_lock = threading.Lock()
+config_state = {"signature": None, "backends": {}} # 配置文件签名与 端口 -> 实例 (由 config_lock 保护)
+refreshing_ports = set() # 正在刷新的端口 (由 config_lock 保护)
+
+def _advertise_host():
+    if POOL_AGENT_ADVERTISE_HOST:
+        return POOL_AGENT_ADVERTISE_HOST
+    return None if POOL_AGENT_HOST in ('0.0.0.0', '::', '') else POOL_AGENT_HOST
+
+def _load_node_backends():
+    """返回本节点的后端 {端口: 实例}。配置文件变化时重新读取，配置文件不存在时返回空字典。"""
+    signature = pool_common.pool_config_file_signature()
+    with config_lock:
+        if signature == config_state["signature"]:
+            return dict(config_state["backends"])
+    try:
+        config_list = pool_common.load_pool_config_file() if signature is not None else []
+    except Exception as e:
+        logging.warning(f"节点代理: 无法解析配置文件 '{pool_common.WARP_POOL_CONFIG_FILE}'，继续使用上次读取的后端列表: {e}")
+        with config_lock:
+            return dict(config_state["backends"])
+    backends = {
+        instance['port']: instance for instance in config_list
+        if isinstance(instance, dict) and isinstance(instance.get('port'), int)
+    }
+    with config_lock:
+        config_state["signature"] = signature
+        config_state["backends"] = backends
+    logging.info(f"节点代理: 已加载 {len(backends)} 个后端 {sorted(backends)}。")
+    return dict(backends)
+
+def require_agent_token(f):
+    """校验 Bearer 令牌 (POOL_AGENT_TOKEN)。"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        auth_header = request.headers.get('Authorization', '')
+        token = auth_header[len('Bearer '):] if auth_header.startswith('Bearer ') else ''
+        if not token or not secrets.compare_digest(token, POOL_AGENT_TOKEN):
+            logging.warning(f"节点代理: 来自 {request.remote_addr} 的请求令牌无效。")
+            return jsonify({"error": "未授权"}), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
+@agent_app.route('/health', methods=['GET'])
+@require_agent_token
+def agent_health():
+    return jsonify({"node": POOL_AGENT_NODE_NAME, "status": "ok"})
+
+@agent_app.route('/backends', methods=['GET'])
+@require_agent_token
+def list_node_backends():
+    """返回本节点的后端列表: [{"id", "namespace", "port", "refresh_policy"}]。"""
+    backends = _load_node_backends()
+    return jsonify({
+        "node": POOL_AGENT_NODE_NAME,
+        "advertise_host": _advertise_host(),
+        "backends": [
+            {
+                "id": instance.get('id'),
+                "namespace": instance.get('namespace'),
+                "port": port,
+                "refresh_policy": instance.get('refresh_policy')
+            }
+            for port, instance in sorted(backends.items())
+        ]
+    })
+
+@agent_app.route('/backends/<int:backend_port>/refresh', methods=['POST'])
+@require_agent_token
+def refresh_node_backend(backend_port):
+    """同步刷新一个后端的IP，完成后返回结果和各阶段耗时。同一端口已在刷新时返回 409。"""
+    instance = _load_node_backends().get(backend_port)
+    if instance is None:
+        return jsonify({"error": f"端口 {backend_port} 不是本节点的后端"}), 404
+    with config_lock:
+        if backend_port in refreshing_ports:
+            return jsonify({"error": f"端口 {backend_port} 正在刷新"}), 409
+        refreshing_ports.add(backend_port)
+    try:
+        refreshed, timings = pool_common.refresh_instance_ip(backend_port, instance.get('namespace'), instance.get('id'))
+    finally:
+        with config_lock:
+            refreshing_ports.discard(backend_port)
+    timings = {phase: (round(value, 3) if isinstance(value, float) else value) for phase, value in timings.items()}
+    logging.info(f"节点代理: {request.remote_addr} 请求刷新端口 {backend_port}，结果: {'成功' if refreshed else '失败'}。")
+    return jsonify({"port": backend_port, "refreshed": bool(refreshed), "timings": timings})
+
+def main():
+    if not POOL_AGENT_TOKEN:
+        logging.critical("严重错误: 未设置环境变量 'POOL_AGENT_TOKEN'。节点代理可以刷新本机后端的IP，必须设置令牌。")
+        sys.exit(1)
+    backends = _load_node_backends()
+    if not backends:
+        logging.warning(f"节点代理: 配置文件 '{pool_common.WARP_POOL_CONFIG_FILE}' 中暂无后端，实例创建完成后会自动提供给管理器。")
+    logging.info(f"节点代理 {POOL_AGENT_NODE_NAME} 正在启动，监听地址 {POOL_AGENT_HOST}:{POOL_AGENT_PORT}，"
+                 f"后端连接地址: {_advertise_host() or '(由管理器决定)'}，刷新驱动: {pool_common.REFRESH_DRIVER}。")
+    if waitress is not None:
+        waitress.serve(agent_app, host=POOL_AGENT_HOST, port=POOL_AGENT_PORT, threads=POOL_AGENT_THREADS)
+    else:
+        agent_app.run(host=POOL_AGENT_HOST, port=POOL_AGENT_PORT, threaded=True)
+
+if __name__ == '__main__':
+    main()
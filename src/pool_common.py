@@ -0,0 +1,136 @@
+"""
+代理管理器 (proxy_manager.py) 和节点代理 (pool_agent.py) 共用的部分: 代理池配置文件的读取和后端IP刷新驱动。
+本模块不持有代理池状态，导入时也不配置日志或启动任何线程。
+"""
+import os
+import re
+import json
+import time
+import logging
+import subprocess
+
+# --- 后端 WARP 代理池配置 ---
+WARP_POOL_CONFIG_FILE = 'src/warp_pool_config.json'
+
+# --- IP刷新驱动配置 ---
+# 'script': 调用 manage_pool.sh refresh-ip (默认)
+# 'native': 直接于命名空间中执行 warp-cli，并以自适应间隔轮询连接状态
+REFRESH_DRIVER = os.environ.get('REFRESH_DRIVER', 'script').strip().lower()
+NATIVE_REFRESH_DEADLINE = float(os.environ.get('NATIVE_REFRESH_DEADLINE', 30)) # 原生刷新的总时限(秒)
+NATIVE_REFRESH_POLL_INITIAL = float(os.environ.get('NATIVE_REFRESH_POLL_INITIAL', 0.1)) # 首次轮询状态的间隔(秒)
+NATIVE_REFRESH_POLL_MAX = float(os.environ.get('NATIVE_REFRESH_POLL_MAX', 1.0)) # 轮询间隔上限(秒)
+WARP_CLI_COMMAND_TIMEOUT = 15 # 单条 warp-cli 命令的超时时间(秒)
+SCRIPT_REFRESH_TIMEOUT = 60 # manage_pool.sh refresh-ip 的超时时间(秒)
+
+def load_pool_config_file():
+    """读取并解析代理池配置文件，返回实例列表。"""
+    with open(WARP_POOL_CONFIG_FILE, 'r') as f:
+        config_list = json.load(f)
+    if not isinstance(config_list, list):
+        raise ValueError("配置文件内容不是一个有效的列表。")
+    return config_list
+
+def pool_config_file_signature():
+    """返回配置文件的 (inode, mtime, size)，文件不存在时返回 None。manage_pool.sh 以重命名方式原子替换该文件。"""
+    try:
+        stat_result = os.stat(WARP_POOL_CONFIG_FILE)
+    except FileNotFoundError:
+        return None
+    return (stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+
+def refresh_instance_ip(backend_warp_port, ns_name, idx):
+    """
+    使用 REFRESH_DRIVER 刷新本机一个后端实例 (命名空间 ns_name，实例编号 idx) 的IP。
+    返回 (是否成功, 各阶段耗时)，耗时字典包含 "driver" 和 "total" (秒)。
+    """
+    if REFRESH_DRIVER == 'native':
+        return _refresh_instance_ip_native(backend_warp_port, ns_name)
+    return _refresh_instance_ip_script(backend_warp_port, ns_name, idx)
+
+def _refresh_instance_ip_script(backend_warp_port, ns_name, idx):
+    """脚本刷新驱动: 调用 manage_pool.sh refresh-ip。"""
+    refresh_started_at = time.monotonic()
+    timings = {"driver": "script"}
+    try:
+        # manage_pool.sh 位于本模块所在目录的上一级
+        manage_pool_script = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'manage_pool.sh'))
+        if not os.path.exists(manage_pool_script):
+            logging.error(f"管理脚本 {manage_pool_script} 不存在。")
+            return False, timings
+
+        cmd = ['sudo', manage_pool_script, 'refresh-ip', ns_name, str(idx)]
+        logging.info(f"执行IP刷新命令: {' '.join(cmd)}")
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=SCRIPT_REFRESH_TIMEOUT)
+        timings["total"] = time.monotonic() - refresh_started_at
+        if result.returncode == 0:
+            logging.info(f"端口 {backend_warp_port} ({ns_name}) 的IP刷新成功。")
+            return True, timings
+        logging.error(f"端口 {backend_warp_port} ({ns_name}) 的IP刷新失败。返回码: {result.returncode}, 错误: {result.stderr}")
+    except subprocess.TimeoutExpired:
+        logging.error(f"端口 {backend_warp_port} ({ns_name}) 的IP刷新超时。")
+    except Exception as e:
+        logging.error(f"端口 {backend_warp_port} ({ns_name}) 的IP刷新过程中发生错误: {e}")
+    timings["total"] = time.monotonic() - refresh_started_at
+    return False, timings
+
+def _warp_cli_command(ns_name, *warp_cli_args):
+    """构造在指定命名空间中执行 warp-cli 的命令。非 root 运行时通过 'sudo -n' 提权。"""
+    cmd = ['ip', 'netns', 'exec', ns_name, 'warp-cli', '--accept-tos', *warp_cli_args]
+    if os.geteuid() != 0:
+        cmd = ['sudo', '-n'] + cmd
+    return cmd
+
+def _run_warp_cli(ns_name, *warp_cli_args, timeout=WARP_CLI_COMMAND_TIMEOUT):
+    """在指定命名空间中执行一条 warp-cli 命令，返回 CompletedProcess。"""
+    return subprocess.run(_warp_cli_command(ns_name, *warp_cli_args), capture_output=True, text=True, timeout=timeout)
+
+WARP_CONNECTED_PATTERN = re.compile(r'Status( update)?:\s*Connected\b')
+
+def _refresh_instance_ip_native(backend_warp_port, ns_name):
+    """
+    原生IP刷新驱动: 直接在命名空间中执行 warp-cli disconnect/connect，
+    然后以指数增长的短间隔轮询 status，直到连接成功或超过 NATIVE_REFRESH_DEADLINE。
+    记录断开、连接和首次检测到 Connected 的各阶段耗时。
+    """
+    started_at = time.monotonic()
+    deadline = started_at + NATIVE_REFRESH_DEADLINE
+    timings = {"driver": "native"}
+    try:
+        disconnect_result = _run_warp_cli(ns_name, 'disconnect')
+        timings["disconnect"] = time.monotonic() - started_at
+        if disconnect_result.returncode != 0:
+            logging.warning(f"原生刷新: 断开 {ns_name} 中的WARP连接失败: {disconnect_result.stderr.strip()}")
+
+        connect_started_at = time.monotonic()
+        connect_result = _run_warp_cli(ns_name, 'connect', timeout=max(min(WARP_CLI_COMMAND_TIMEOUT, deadline - connect_started_at), 1))
+        timings["connect"] = time.monotonic() - connect_started_at
+        if connect_result.returncode != 0:
+            logging.error(f"原生刷新: 在 {ns_name} 中重新连接WARP失败。返回码: {connect_result.returncode}, 错误: {connect_result.stderr.strip()}")
+            timings["total"] = time.monotonic() - started_at
+            return False, timings
+
+        poll_started_at = time.monotonic()
+        poll_interval = NATIVE_REFRESH_POLL_INITIAL
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            status_result = _run_warp_cli(ns_name, 'status', timeout=max(min(WARP_CLI_COMMAND_TIMEOUT, remaining), 1))
+            if WARP_CONNECTED_PATTERN.search(status_result.stdout):
+                timings["first_connected"] = time.monotonic() - poll_started_at
+                timings["total"] = time.monotonic() - started_at
+                logging.info(f"原生刷新: 端口 {backend_warp_port} ({ns_name}) 的IP刷新成功。耗时: 断开 {timings['disconnect']:.2f}s, "
+                             f"连接 {timings['connect']:.2f}s, 等待Connected {timings['first_connected']:.2f}s, 总计 {timings['total']:.2f}s。")
+                return True, timings
+            time.sleep(max(min(poll_interval, deadline - time.monotonic()), 0))
+            poll_interval = min(poll_interval * 2, NATIVE_REFRESH_POLL_MAX)
+
+        timings["total"] = time.monotonic() - started_at
+        logging.error(f"原生刷新: 端口 {backend_warp_port} ({ns_name}) 在 {NATIVE_REFRESH_DEADLINE} 秒内未恢复到 Connected 状态。")
+        return False, timings
+    except subprocess.TimeoutExpired:
+        logging.error(f"原生刷新: 端口 {backend_warp_port} ({ns_name}) 的 warp-cli 命令超时。")
+    except Exception as e:
+        logging.error(f"原生刷新: 端口 {backend_warp_port} ({ns_name}) 的IP刷新过程中发生错误: {e}")
+    timings["total"] = time.monotonic() - started_at
+    return False, timings
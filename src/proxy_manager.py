@@ -1,45 +1,147 @@
 import threading
+import asyncio
+import atexit
 import subprocess
 import time
 import os
 import logging
+import logging.handlers
 import json
+import bisect
+import heapq
+import hmac
+import math
+import re
 import sys
-from queue import Queue
-from flask import Flask, jsonify, request
+import random
+import signal
+from queue import Empty, Full, Queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, g, jsonify, request
+from werkzeug.serving import make_server
 from functools import wraps
 import socket
 import struct
+import select
+import errno
 import secrets
+import ssl
+import ipaddress
+import urllib.parse
+import urllib.request
+import zlib
 import socks  # 用于连接后端的SOCKS5 WARP服务 (pip install PySocks)
+from pool_common import (  # 与节点代理共用的配置文件读取和IP刷新驱动
+    WARP_POOL_CONFIG_FILE, REFRESH_DRIVER, load_pool_config_file, pool_config_file_signature, refresh_instance_ip
+)
+try:
+    import waitress  # 可选: 生产级WSGI服务器 (pip install waitress)，未安装时使用 Flask 开发服务器
+except ImportError:
+    waitress = None
 
 # --- 日志记录配置 ---
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+# 调用线程只做级别判断并把记录放入有界队列，消息格式化 (参数为基本类型时) 和写入都由后台监听线程完成，
+# 连接处理线程不会因日志I/O或处理器锁而阻塞。队列已满时丢弃记录并计数，而不是阻塞调用方。
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').strip().upper()
+if not isinstance(logging.getLevelName(LOG_LEVEL), int):
+    LOG_LEVEL = 'INFO'
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000)) # 日志队列容量，0 表示在调用线程中同步写日志
+# 每个SOCKS连接结束时输出一条 key=value 格式的会话摘要 (INFO): 1 输出 (默认)，0 关闭
+SOCKS_SESSION_LOG = int(os.environ.get('SOCKS_SESSION_LOG', 1))
+# 逐步骤调试日志 (握手、获取后端、连接、中继、释放) 的连接采样比例，0 (默认) 表示关闭。
+# 被采样的连接以 DEBUG 级别输出全部步骤，不受 LOG_LEVEL 限制。
+SOCKS_TRACE_SAMPLE_RATE = float(os.environ.get('SOCKS_TRACE_SAMPLE_RATE', 0))
+
+class _LogfmtFields:
+    """
+    按 key=value 格式输出的日志字段。作为日志参数传递，只在记录真正输出时 (在日志线程中) 拼接。
+    保存字段的副本，之后对原字典的修改不会出现在日志中。
+    """
+    __slots__ = ("fields",)
+
+    def __init__(self, fields):
+        self.fields = dict(fields)
+
+    def __str__(self):
+        return " ".join(
+            f'{key}="{value}"' if " " in str(value) else f"{key}={value}"
+            for key, value in self.fields.items() if value is not None
+        )
+
+# 只有这些类型的消息参数在监听线程中格式化; 其他参数 (代理池状态字典、集合等) 可能在记录输出前被修改
+_DEFERRED_LOG_ARG_TYPES = (str, int, float, type(None), _LogfmtFields)
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    把日志记录放入队列，队列已满时丢弃记录。消息参数都是不可变的基本类型时，格式化留给监听线程;
+    否则在调用线程中格式化，使日志反映记录时的状态。
+    """
+
+    def prepare(self, record):
+        # 单个字典参数会被 LogRecord 直接作为 args (映射格式化)，同样在调用线程中格式化
+        args = record.args or ()
+        if not isinstance(args, tuple) or not all(isinstance(arg, _DEFERRED_LOG_ARG_TYPES) for arg in args):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            _metrics_inc("warp_pool_log_records_dropped_total")
+
+log_output_handler = logging.StreamHandler()
+log_output_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+if LOG_QUEUE_SIZE > 0:
+    log_listener = logging.handlers.QueueListener(Queue(LOG_QUEUE_SIZE), log_output_handler)
+    logging.basicConfig(level=LOG_LEVEL, handlers=[_DeferredQueueHandler(log_listener.queue)])
+    log_listener.start()
+    # 退出前写完队列中剩余的记录
+    atexit.register(log_listener.stop)
+else:
+    logging.basicConfig(level=LOG_LEVEL, handlers=[log_output_handler])
+socks_session_logger = logging.getLogger("warp_pool.session")
+socks_session_logger.setLevel(logging.INFO if SOCKS_SESSION_LOG else logging.WARNING)
+socks_trace_logger = logging.getLogger("warp_pool.trace")
+if SOCKS_TRACE_SAMPLE_RATE > 0:
+    socks_trace_logger.setLevel(logging.DEBUG)
 
 app = Flask(__name__)
 
 # --- API 安全配置 ---
 # 强烈建议通过环境变量设置此令牌
 API_SECRET_TOKEN = os.environ.get('API_SECRET_TOKEN')
-if not API_SECRET_TOKEN:
+API_SECRET_TOKEN_GENERATED = not API_SECRET_TOKEN # 未设置时生成临时令牌，由 main() 在启动API时提示
+if API_SECRET_TOKEN_GENERATED:
     API_SECRET_TOKEN = secrets.token_hex(16)
-    logging.warning("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-    logging.warning("!!! 警告: 环境变量 'API_SECRET_TOKEN' 未设置。               !!!")
-    logging.warning("!!! 为安全起见，已生成一个临时的随机令牌。                  !!!")
-    logging.warning(f"!!! 临时令牌: {API_SECRET_TOKEN}                      !!!")
-    logging.warning("!!! 在生产环境中，请务必设置一个安全的、持久的令牌。        !!!")
-    logging.warning("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
 app.config['API_SECRET_TOKEN'] = API_SECRET_TOKEN
 
 
 # --- SOCKS5 服务器配置 ---
 SOCKS_SERVER_HOST = os.environ.get('SOCKS_HOST', '0.0.0.0')
 SOCKS_SERVER_PORT = int(os.environ.get('SOCKS_PORT', 10880))
+# 服务器运行模式: 'threaded' (每个客户端一个线程) 或 'asyncio' (所有客户端共享一个事件循环)
+SOCKS_SERVER_MODE = os.environ.get('SOCKS_SERVER_MODE', 'threaded').strip().lower()
+SOCKS_HANDSHAKE_TIMEOUT = float(os.environ.get('SOCKS_HANDSHAKE_TIMEOUT', 10)) # 握手/请求阶段的总时限(秒)，逐字节发送的慢速客户端也不能超过
+SOCKS_HANDSHAKE_RECV_SIZE = 4096 # 握手阶段单次 recv 的最大字节数，足以容纳合并发送的问候、请求和首段负载
+SOCKS_BACKEND_CONNECT_TIMEOUT = float(os.environ.get('SOCKS_BACKEND_CONNECT_TIMEOUT', 8)) # 通过单个后端WARP连接目标的超时时间(秒)
+SOCKS_CONNECT_DEADLINE = float(os.environ.get('SOCKS_CONNECT_DEADLINE', 20)) # 一个CONNECT请求 (含故障转移重试) 的总时限(秒)
+SOCKS_CONNECT_MAX_ATTEMPTS = int(os.environ.get('SOCKS_CONNECT_MAX_ATTEMPTS', 3)) # 一个CONNECT请求最多尝试的后端数量 (含竞速)
+# 大于 0 时，第一个后端在该时间(秒)内未连通则用第二个后端并行连接，先成功者胜出; 0 表示不竞速
+SOCKS_CONNECT_RACE_DELAY = float(os.environ.get('SOCKS_CONNECT_RACE_DELAY', 0))
+# 线程模式下并行的连接尝试和故障后端的归还共用的线程池大小 (asyncio 模式下用于归还后端); 线程用尽时新的尝试排队等待 (仍受总时限约束)
+SOCKS_CONNECT_THREADS = int(os.environ.get('SOCKS_CONNECT_THREADS', 32))
+# asyncio 模式下获取后端 (可能在等待队列中最多等待 SOCKS_CONNECT_WAIT 秒) 使用的线程池大小;
+# 归还后端使用上面的连接尝试线程池，不会排在等待中的获取之后
+SOCKS_ASYNC_ACQUIRE_THREADS = int(os.environ.get('SOCKS_ASYNC_ACQUIRE_THREADS', 64))
 SOCKS_VERSION = 5
+# SOCKS5 认证方法
+AUTH_METHOD_NO_AUTH = 0x00
+AUTH_METHOD_USERNAME_PASSWORD = 0x02
+AUTH_METHOD_NO_ACCEPTABLE = 0xFF
+USERPASS_AUTH_VERSION = 0x01 # RFC 1929 子协商版本
 # SOCKS5 命令
 CMD_CONNECT = 0x01
 # SOCKS5 地址类型
@@ -57,65 +159,1050 @@ REP_TTL_EXPIRED = 0x06
 REP_COMMAND_NOT_SUPPORTED = 0x07
 REP_ADDRESS_TYPE_NOT_SUPPORTED = 0x08
 
+# --- 多进程配置 ---
+# 大于 0 时启用多进程模式: 主进程作为协调器持有代理池状态并提供API，SOCKS_WORKER_PROCESSES 个工作进程
+# 通过 SO_REUSEPORT 共同监听 SOCKS_SERVER_PORT，经 Unix 套接字向协调器获取和归还后端。
+SOCKS_WORKER_PROCESSES = int(os.environ.get('SOCKS_WORKER_PROCESSES', 0))
+POOL_COORDINATOR_SOCKET = os.environ.get('POOL_COORDINATOR_SOCKET', '/tmp/warp_pool_coordinator.sock')
+SOCKS_WORKER_STATS_INTERVAL = float(os.environ.get('SOCKS_WORKER_STATS_INTERVAL', 1)) # 工作进程上报指标和中继统计的间隔(秒)
+# 当前进程为SOCKS工作进程时的编号 (由协调器在启动工作进程时设置)，否则为 None
+socks_worker_id = int(os.environ['SOCKS_WORKER_ID']) if os.environ.get('SOCKS_WORKER_ID') else None
+
+# --- 数据中继配置 ---
+# 中继引擎: 'auto' (Linux 上优先使用 splice 零拷贝), 'splice' 或 'copy' (recv_into 缓冲区复制)
+SOCKS_RELAY_ENGINE = os.environ.get('SOCKS_RELAY_ENGINE', 'auto').strip().lower()
+RELAY_BUFFER_SIZE = int(os.environ.get('RELAY_BUFFER_SIZE', 65536)) # 每次转发的最大字节数
+
+# --- 准入控制配置 ---
+# 以下限制均在单个进程内计数 (多进程模式下每个工作进程分别计数)，0 表示不限制
+SOCKS_MAX_CLIENTS = int(os.environ.get('SOCKS_MAX_CLIENTS', 0)) # 同时存在的客户端连接数上限，超出时新连接被立即拒绝
+SOCKS_MAX_HANDSHAKES = int(os.environ.get('SOCKS_MAX_HANDSHAKES', 0)) # 同时处于握手阶段 (尚未收到完整的CONNECT请求) 的连接数上限
+SOCKS_RELAY_IDLE_TIMEOUT = float(os.environ.get('SOCKS_RELAY_IDLE_TIMEOUT', 0)) # 中继双向都没有数据超过该时间(秒)后关闭连接并归还后端
+SOCKS_MAX_SESSION_DURATION = float(os.environ.get('SOCKS_MAX_SESSION_DURATION', 0)) # 单个连接中继的最长时间(秒)，到期后关闭连接
+SOCKS_PER_IP_MAX_SESSIONS = int(os.environ.get('SOCKS_PER_IP_MAX_SESSIONS', 0)) # 每个客户端IP同时存在的连接数上限
+SOCKS_PER_IP_BANDWIDTH = float(os.environ.get('SOCKS_PER_IP_BANDWIDTH', 0)) # 每个客户端IP所有连接合计的带宽上限 (字节/秒，上下行合计)
+SOCKS_PER_IP_BURST = float(os.environ.get('SOCKS_PER_IP_BURST', SOCKS_PER_IP_BANDWIDTH)) # 带宽令牌桶的容量(字节)，即允许的突发量
+
+# --- 粘性会话配置 ---
+# 客户端通过用户名/密码认证 (RFC 1929) 提供的用户名作为会话键，同一会话键的连接固定使用同一个后端
+STICKY_SESSION_IDLE_TTL = float(os.environ.get('STICKY_SESSION_IDLE_TTL', 300)) # 会话无活跃连接超过该时间(秒)后释放后端
+SOCKS_AUTH_PASSWORD = os.environ.get('SOCKS_AUTH_PASSWORD', '') # 非空时要求客户端使用用户名/密码认证且密码与之匹配
 
 # --- 后端 WARP 代理池配置 ---
-WARP_POOL_CONFIG_FILE = 'src/warp_pool_config.json'
-WARP_POOL_CONFIG = {} # 将以端口为键，存储 { "id": ..., "namespace": ... }
+# 配置文件路径 WARP_POOL_CONFIG_FILE 见 pool_common.py
+# manage_pool.sh 并行创建实例，每个实例就绪后立即写入配置文件；管理器按此间隔(秒)检查并加入新实例。0 表示仅在启动时加载
+WARP_POOL_CONFIG_WATCH_INTERVAL = float(os.environ.get('WARP_POOL_CONFIG_WATCH_INTERVAL', 2))
+WARP_POOL_CONFIG = {} # 将以端口为键，存储 { "id": ..., "namespace": ..., "namespace_ip": ..., "internal_port": ... }
 WARP_INSTANCE_IP = '127.0.0.1' # 后端WARP实例监听本地地址，供管理器连接
+# 管理器连接后端的方式: 'dnat' (默认) 连接 WARP_INSTANCE_IP:主机端口，由 iptables DNAT 转发到命名空间;
+# 'direct' 经 veth 直接连接配置中的 namespace_ip:internal_port，省去每个连接的 NAT 和 conntrack 开销。
+# 主机端口始终是后端在代理池中的标识; 缺少命名空间地址的实例仍使用 DNAT 端口。
+BACKEND_ADDRESSING = os.environ.get('BACKEND_ADDRESSING', 'dnat').strip().lower()
 IP_REFRESH_WAIT = 5  # IP刷新后的等待时间(秒)
 
+# --- 多节点配置 ---
+# 其他主机各自运行 manage_pool.sh 代理池和节点代理 (src/pool_agent.py)。管理器定期从节点代理同步后端列表，
+# 直接连接节点的后端端口，并通过节点代理刷新IP。格式: "名称=http://地址:端口,..."; 空字符串表示只使用本机后端。
+POOL_NODES = os.environ.get('POOL_NODES', '').strip()
+POOL_AGENT_TOKEN = os.environ.get('POOL_AGENT_TOKEN', '') # 访问节点代理的 Bearer 令牌
+POOL_NODE_SYNC_INTERVAL = float(os.environ.get('POOL_NODE_SYNC_INTERVAL', 10)) # 同步节点后端列表的间隔(秒)
+POOL_NODE_TIMEOUT = float(os.environ.get('POOL_NODE_TIMEOUT', 5)) # 同步请求的超时时间(秒)
+POOL_NODE_REFRESH_TIMEOUT = float(os.environ.get('POOL_NODE_REFRESH_TIMEOUT', 90)) # 通过节点代理刷新IP的超时时间(秒)
+# 连续同步失败达到该次数后视为节点离线: 其后端被排空移除 (已有会话继续直到结束)，节点恢复后自动重新加入
+POOL_NODE_FAILURE_THRESHOLD = max(1, int(os.environ.get('POOL_NODE_FAILURE_THRESHOLD', 3)))
+# 获取后端时是否优先使用本机后端，本机没有可用后端时才使用其他节点的后端
+PREFER_LOCAL_BACKENDS = os.environ.get('PREFER_LOCAL_BACKENDS', '1').strip().lower() not in ('0', 'false', 'no')
+# 其他节点的后端在代理池中以虚拟端口标识 (不对应任何监听端口): 基数 + 节点序号 × 间隔 + 实例编号，
+# 因此各节点可以使用相同的 BASE_PORT。节点序号由节点名称的哈希值决定 (1 ~ POOL_NODE_INDEX_SLOTS)，
+# 与节点在 POOL_NODES 中的顺序无关，同一节点的后端在管理器重启、平滑重启或调整节点顺序后仍使用相同的标识
+POOL_NODE_PORT_BASE = 100000
+POOL_NODE_PORT_STRIDE = 1000
+POOL_NODE_INDEX_SLOTS = 9000
+
+# --- 后端共享配置 ---
+# 每个后端端口可同时承载的SOCKS会话数。1 (默认) 表示每个连接独占一个后端；
+# 大于 1 时启用共享模式，SOCKS会话不再独占后端，也不会在会话结束时触发IP刷新。
+# /acquire 接口始终保持独占语义。
+BACKEND_MAX_SESSIONS = max(1, int(os.environ.get('BACKEND_MAX_SESSIONS', 1)))
+# 共享模式下的调度依据: 'sessions' (活跃会话最少优先) 或 'bytes' (累计转发字节最少优先)
+BACKEND_SCHEDULING_METRIC = os.environ.get('BACKEND_SCHEDULING_METRIC', 'sessions').strip().lower()
+
+# --- 获取等待队列配置 ---
+ACQUIRE_WAIT_QUEUE_MAX = int(os.environ.get('ACQUIRE_WAIT_QUEUE_MAX', 256)) # 等待队列的最大长度
+ACQUIRE_MAX_WAIT = float(os.environ.get('ACQUIRE_MAX_WAIT', 60)) # /acquire?wait= 允许的最长等待时间(秒)
+SOCKS_CONNECT_WAIT = float(os.environ.get('SOCKS_CONNECT_WAIT', 0)) # SOCKS连接在池为空时的等待时间(秒)，0 表示立即失败
+
+# --- API租约配置 ---
+# /acquire 获取的后端以租约形式持有，客户端需在到期前调用 /renew 续约，过期的租约会被自动回收并刷新IP
+LEASE_DEFAULT_TTL = float(os.environ.get('LEASE_DEFAULT_TTL', 600)) # 租约默认有效期(秒)
+LEASE_MAX_TTL = float(os.environ.get('LEASE_MAX_TTL', 3600)) # /acquire 和 /renew 的 ?ttl= 允许的最长有效期(秒)
+
+# --- API服务器配置 ---
+# 'auto' (默认): 安装了 waitress 时使用 waitress，否则使用 Flask 开发服务器; 也可指定 'waitress' 或 'flask'
+API_SERVER = os.environ.get('API_SERVER', 'auto').strip().lower()
+API_SERVER_THREADS = int(os.environ.get('API_SERVER_THREADS', 32)) # waitress 的请求处理线程数
+API_SERVER_CONNECTION_LIMIT = int(os.environ.get('API_SERVER_CONNECTION_LIMIT', 1000)) # waitress 同时保持的最大连接数
+API_BATCH_MAX = int(os.environ.get('API_BATCH_MAX', 256)) # /acquire/batch 和 /release/batch 单次请求的最大数量
+
+# --- 平滑重启配置 ---
+# 收到 SIGUSR2 时，把监听套接字和代理池状态快照交给新启动的进程，旧进程停止接受新连接并在已有中继结束后退出。
+RELOAD_STATE_FILE = os.environ.get('RELOAD_STATE_FILE', f'/tmp/warp_pool_state_{os.getuid()}.json') # 代理池状态快照文件
+RELOAD_REFRESH_WAIT = float(os.environ.get('RELOAD_REFRESH_WAIT', 60)) # 等待进行中的IP刷新完成的最长时间(秒)，超时的端口由新进程重新刷新
+RELOAD_PAUSE_TIMEOUT = float(os.environ.get('RELOAD_PAUSE_TIMEOUT', 15)) # 等待正在握手的SOCKS连接和处理中的API请求完成的最长时间(秒)，超时则放弃重启
+RELOAD_READY_TIMEOUT = float(os.environ.get('RELOAD_READY_TIMEOUT', 30)) # 等待新进程就绪的最长时间(秒)，超时则放弃重启
+RELOAD_DRAIN_TIMEOUT = float(os.environ.get('RELOAD_DRAIN_TIMEOUT', 300)) # 旧进程等待已有中继结束的最长时间(秒)，超时后强制退出
+PROXY_MANAGER_PID_FILE = os.environ.get('PROXY_MANAGER_PID_FILE', '') # 交接完成后写入新进程PID的文件 (由 manage_pool.sh 设置)，空字符串表示不写入
+
+# --- IP刷新调度配置 ---
+REFRESH_WORKERS = int(os.environ.get('REFRESH_WORKERS', 4)) # 同时执行IP刷新的工作线程数
+REFRESH_RATE_LIMIT_PER_MINUTE = float(os.environ.get('REFRESH_RATE_LIMIT_PER_MINUTE', 30)) # 全局重连速率上限 (次/分钟)，0 表示不限制
+REFRESH_RATE_BURST = max(1, int(os.environ.get('REFRESH_RATE_BURST', REFRESH_WORKERS))) # 速率限制允许的突发次数
+REFRESH_MAX_ATTEMPTS = max(1, int(os.environ.get('REFRESH_MAX_ATTEMPTS', 3))) # 单次刷新任务的最多尝试次数，用尽后端口直接返回代理池
+REFRESH_BACKOFF_BASE = float(os.environ.get('REFRESH_BACKOFF_BASE', 5)) # 刷新失败后的初始退避时间(秒)，按连续失败次数指数增长
+REFRESH_BACKOFF_MAX = float(os.environ.get('REFRESH_BACKOFF_MAX', 300)) # 最大退避时间(秒)
+# 刷新任务优先级 (数值越小越优先)
+REFRESH_PRIORITY_HIGH = 0
+REFRESH_PRIORITY_NORMAL = 1
+REFRESH_PRIORITY_LOW = 2
+
+# IP刷新驱动 (REFRESH_DRIVER: 'script' 或 'native') 及其配置见 pool_common.py
+
+# --- IP刷新策略配置 ---
+# 后端被释放时是否刷新IP由刷新策略决定:
+#   'always'   每次正常释放后都刷新 (默认，与早期行为一致)
+#   'uses:N'   自上次刷新以来被使用 N 次后刷新
+#   'age:T'    当前出口IP使用超过 T 秒后刷新 (支持 s/m/h 后缀)
+#   'bytes:X'  自上次刷新以来转发超过 X 字节后刷新 (支持 K/M/G 后缀)
+#   'error'    仅在会话出错 (后端无法连接目标) 时刷新
+#   'never'    从不因释放而刷新
+# 配置文件中的实例可通过 "refresh_policy" 字段覆盖，API /release 可通过 ?refresh= 参数覆盖单次释放。
+REFRESH_POLICY = os.environ.get('REFRESH_POLICY', 'always').strip().lower()
+
 # --- 代理验证配置 ---
 PROXY_VALIDATION_TARGET_HOST = os.environ.get('PROXY_VALIDATION_TARGET_HOST', '1.1.1.1')
 PROXY_VALIDATION_TARGET_PORT = int(os.environ.get('PROXY_VALIDATION_TARGET_PORT', 443))
 PROXY_VALIDATION_TIMEOUT = 10 # 验证连接的超时时间(秒)
 
+# --- 出口IP索引配置 ---
+# 通过后端请求 trace 端点 (每行一个 key=value，如 Cloudflare 的 /cdn-cgi/trace) 获取后端当前的出口IP。
+# IP刷新后的新出口IP与其他后端的当前IP或最近被替换的IP重复时，自动再次刷新。
+EXIT_IP_TRACE_URL = os.environ.get('EXIT_IP_TRACE_URL', 'http://www.cloudflare.com/cdn-cgi/trace').strip() # 空字符串表示不获取出口IP
+EXIT_IP_TRACE_TIMEOUT = float(os.environ.get('EXIT_IP_TRACE_TIMEOUT', 10)) # 获取出口IP的超时时间(秒)
+EXIT_IP_RECENT_WINDOW = float(os.environ.get('EXIT_IP_RECENT_WINDOW', 600)) # 被替换的出口IP在该时间(秒)内仍视为最近使用过
+EXIT_IP_MAX_REROLLS = max(0, int(os.environ.get('EXIT_IP_MAX_REROLLS', 3))) # 因出口IP重复连续再次刷新的次数上限，0 表示只记录不重刷
+EXIT_IP_HISTORY_SIZE = 20 # 每个后端保留的出口IP历史条数
+
+# --- 后端健康探测配置 ---
+# 后台探测线程定期通过空闲后端连接验证目标，记录连接延迟和失败率的指数移动平均 (EWMA)，
+# 失败率过高的后端被隔离 (移出可用代理池) 直至连续探测成功。
+HEALTH_PROBE_INTERVAL = float(os.environ.get('HEALTH_PROBE_INTERVAL', 30)) # 探测间隔(秒)，0 表示关闭后台探测
+HEALTH_PROBE_TIMEOUT = float(os.environ.get('HEALTH_PROBE_TIMEOUT', 5)) # 单次探测的超时时间(秒)
+HEALTH_PROBE_CONCURRENCY = max(1, int(os.environ.get('HEALTH_PROBE_CONCURRENCY', 8))) # 同时进行的探测数量上限
+HEALTH_EWMA_ALPHA = float(os.environ.get('HEALTH_EWMA_ALPHA', 0.3)) # EWMA 平滑系数，越大越偏重最近的结果
+HEALTH_QUARANTINE_FAILURE_RATE = float(os.environ.get('HEALTH_QUARANTINE_FAILURE_RATE', 0.5)) # 失败率 EWMA 达到该值时隔离后端
+HEALTH_RECOVERY_SUCCESSES = max(1, int(os.environ.get('HEALTH_RECOVERY_SUCCESSES', 2))) # 解除隔离所需的连续成功次数
+# 获取后端时的选择方式: 'latency' (优先延迟最低的健康后端，默认) 或 'fifo' (严格按队列顺序)
+BACKEND_SELECTION = os.environ.get('BACKEND_SELECTION', 'latency').strip().lower()
+
 # --- 代理状态管理 ---
 available_proxies = Queue() # 存储可用的后端WARP端口 (例如: 10800, 10801)
 in_use_proxies = {} # 存储正在被使用的后端WARP端口信息 (被SOCKS或API占用)
 proxy_lock = threading.Lock() # 用于保护 available_proxies 和 in_use_proxies 的线程锁
+backend_active_sessions = {} # 共享模式下每个后端端口上的活跃SOCKS会话数 (由 proxy_lock 保护)
+backend_relayed_bytes = {} # 共享模式下每个后端端口累计转发的字节数 (由 proxy_lock 保护)
+pool_waiters = deque() # 等待后端端口的请求 (FIFO，由 proxy_lock 保护)
+refresh_cond = threading.Condition() # 保护以下刷新调度器状态，并用于唤醒刷新工作线程
+refresh_pending = {} # 等待执行的刷新任务: 端口 -> {"priority", "enqueued_at", "not_before", "attempt"}
+refresh_in_flight = {} # 正在刷新的端口 -> 开始时间
+refresh_failures = {} # 端口 -> 连续刷新失败次数
+refresh_rate_bucket = {"tokens": float(REFRESH_RATE_BURST), "updated_at": time.time()} # 全局重连令牌桶
+refresh_stats = {"completed_total": 0, "failed_total": 0, "retries_total": 0, "rate_limited_waits_total": 0, "exit_ip_rerolls_total": 0}
+refresh_workers_started = False
+refresh_paused = False # 平滑重启期间暂停执行新的刷新任务 (由 refresh_cond 保护)
+refresh_timings = {} # 端口 -> 最近一次IP刷新的各阶段耗时(秒) (由 refresh_cond 保护)
+backend_usage = {} # 端口 -> 自上次IP刷新以来的使用情况 {"uses", "bytes", "ip_since"} (由 proxy_lock 保护)
+sticky_sessions = {} # 会话键 -> {"port", "active_connections", "connections_total", "relayed_bytes", "created_at", "last_used"}
+sticky_lock = threading.Lock() # 只保护 sticky_sessions，会话复用时不需要获取 proxy_lock
+sticky_reaper_started = False
+api_leases = {} # 租约ID -> {"port", "ttl", "expires_at", "client_ip", "acquired_at"} (由 lease_cond 保护)
+lease_heap = [] # (到期时间, 租约ID) 最小堆; 续约时压入新条目，过时的条目在弹出时丢弃 (由 lease_cond 保护)
+lease_cond = threading.Condition() # 保护租约状态，并用于唤醒租约回收线程
+lease_stats = {"granted_total": 0, "renewed_total": 0, "released_total": 0, "expired_total": 0}
+lease_reaper_started = False
+backend_health = {} # 端口 -> {"latency_ewma", "failure_rate", "consecutive_successes", "probes_total", "failures_total", "last_probe_at"} (由 proxy_lock 保护)
+quarantined_proxies = {} # 被隔离的端口 -> {"since", "parked"}; parked 表示端口由隔离区持有而不在可用代理池中 (由 proxy_lock 保护)
+backend_exit_ips = {} # 端口 -> {"ip", "colo", "since", "checked_at", "history": deque[(ip, since)]} (由 proxy_lock 保护)
+recent_exit_ips = {} # 最近被替换的出口IP -> 被替换的时间 (由 proxy_lock 保护)
+exit_ip_rerolls = {} # 端口 -> 因出口IP重复已连续再次刷新的次数 (由 proxy_lock 保护)
+exit_ip_stats = {"lookups_total": 0, "lookup_failures_total": 0, "duplicates_total": 0} # 出口IP查询统计 (由 proxy_lock 保护)
+# 端口 -> 连接后端使用的 (地址, 端口)。主进程中只登记 direct 模式下的命名空间地址和其他节点后端的节点地址
+# (写入时持有 proxy_lock，读取无需加锁); SOCKS工作进程中由协调器随获取结果下发
+backend_direct_addresses = {}
+draining_proxies = {} # 排空中的端口 -> {"since", "remove", "idle"}; 不再分配新会话，remove 表示空闲后从代理池移除 (由 proxy_lock 保护)
+wait_queue_stats = { # 等待队列统计 (由 proxy_lock 保护)
+    "waits_total": 0,
+    "granted_total": 0,
+    "timeouts_total": 0,
+    "rejected_queue_full_total": 0,
+    "wait_seconds_total": 0.0,
+    "wait_seconds_max": 0.0
+}
+
+# --- 数据中继统计 ---
+# 每个转发方向在结束时一次性合并计数，避免在转发热路径上加锁
+relay_stats = {
+    "client_to_target_bytes": 0,
+    "target_to_client_bytes": 0,
+    "sessions_by_engine": {"splice": 0, "copy": 0, "asyncio": 0}
+}
+relay_stats_lock = threading.Lock()
+
+# --- 运行指标 (Prometheus 文本格式) ---
+# 热路径上的计数和直方图观测只写入当前线程自己的分片，不加锁;
+# /metrics 抓取时再汇总所有分片。已结束线程的分片会被合并到 metrics_retired 后丢弃。
+
+# 指标名 -> (类型, 说明, 直方图桶上界)
+METRIC_DEFINITIONS = {
+    "warp_pool_socks_connections_total": ("counter", "中央SOCKS5服务器接受的客户端连接数", None),
+    "warp_pool_socks_replies_total": ("counter", "按回复码统计的SOCKS5回复数", None),
+    "warp_pool_socks_connect_failovers_total": ("counter", "CONNECT请求额外使用的后端数 (retry: 故障后重试, race: 竞速)", None),
+    "warp_pool_socks_early_data_bytes_total": ("counter", "在CONNECT回复之前随握手一起读入并转发给目标的客户端数据字节数 (线程模式)", None),
+    "warp_pool_socks_rejected_total": ("counter", "被准入控制立即拒绝的客户端连接数 (按原因)", None),
+    "warp_pool_socks_relay_timeouts_total": ("counter", "因空闲超时或达到最长会话时长而关闭的中继数", None),
+    "warp_pool_socks_throttled_seconds_total": ("counter", "因客户端IP带宽限制而暂停转发的累计时间(秒)", None),
+    "warp_pool_relayed_bytes_total": ("counter", "按后端和方向统计的转发字节数", None),
+    "warp_pool_socks_handshake_duration_seconds": ("histogram", "SOCKS5握手和请求解析耗时", (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)),
+    "warp_pool_backend_connect_duration_seconds": ("histogram", "通过后端WARP连接目标的耗时", (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20)),
+    "warp_pool_acquire_wait_duration_seconds": ("histogram", "获取后端端口的等待时间", (0.001, 0.01, 0.1, 0.5, 1, 5, 10, 30, 60)),
+    "warp_pool_api_batch_ports_total": ("counter", "通过批量接口获取或释放的后端端口数", None),
+    "warp_pool_log_records_dropped_total": ("counter", "日志队列已满时丢弃的日志记录数", None),
+    "warp_pool_refresh_duration_seconds": ("histogram", "IP刷新总耗时", (0.5, 1, 2, 5, 10, 20, 30, 60, 120)),
+    "warp_pool_validation_duration_seconds": ("histogram", "后端验证和健康探测耗时", (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)),
+}
+METRICS_SHARD_COMPACT_THRESHOLD = 256 # 分片数量超过该值时合并已结束线程的分片
+metrics_shards = [] # [(线程, 分片)]，分片为 {"counters": {}, "histograms": {}}
+metrics_retired = {"counters": {}, "histograms": {}} # 已结束线程的分片汇总 (由 metrics_shards_lock 保护)
+metrics_shards_lock = threading.Lock()
+_metrics_local = threading.local()
+
+def _metrics_shard():
+    """返回当前线程的指标分片，首次使用时登记。"""
+    shard = getattr(_metrics_local, "shard", None)
+    if shard is None:
+        shard = {"counters": {}, "histograms": {}}
+        _metrics_local.shard = shard
+        with metrics_shards_lock:
+            metrics_shards.append((threading.current_thread(), shard))
+            if len(metrics_shards) > METRICS_SHARD_COMPACT_THRESHOLD:
+                _compact_metrics_shards_locked()
+    return shard
+
+def _merge_metrics_shard(target, shard):
+    """将一个分片的计数和直方图累加到 target。"""
+    for key, value in shard["counters"].copy().items():
+        target["counters"][key] = target["counters"].get(key, 0) + value
+    for key, state in shard["histograms"].copy().items():
+        merged = target["histograms"].get(key)
+        if merged is None:
+            target["histograms"][key] = list(state)
+        else:
+            for index, value in enumerate(state):
+                merged[index] += value
+
+def _compact_metrics_shards_locked():
+    """将已结束线程的分片合并到 metrics_retired。调用方必须持有 metrics_shards_lock。"""
+    live_shards = []
+    for thread, shard in metrics_shards:
+        if thread.is_alive():
+            live_shards.append((thread, shard))
+        else:
+            _merge_metrics_shard(metrics_retired, shard)
+    metrics_shards[:] = live_shards
+
+def _metrics_inc(name, labels=(), value=1):
+    """计数器加 value。labels 为 ((标签名, 值), ...) 元组。"""
+    counters = _metrics_shard()["counters"]
+    key = (name, labels)
+    counters[key] = counters.get(key, 0) + value
+
+def _metrics_observe(name, value, labels=()):
+    """向直方图记录一次观测值。分片中的状态为 [各桶计数 (含 +Inf)..., 总和]。"""
+    histograms = _metrics_shard()["histograms"]
+    key = (name, labels)
+    state = histograms.get(key)
+    buckets = METRIC_DEFINITIONS[name][2]
+    if state is None:
+        state = histograms[key] = [0] * (len(buckets) + 2)
+    state[bisect.bisect_left(buckets, value)] += 1
+    state[-1] += value
+
+def _format_metric_labels(labels):
+    """将标签元组格式化为 {name="value",...}。"""
+    if not labels:
+        return ""
+    formatted = []
+    for name, value in labels:
+        escaped_value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        formatted.append(f'{name}="{escaped_value}"')
+    return "{" + ",".join(formatted) + "}"
+
+def _metrics_totals():
+    """汇总本进程所有线程的指标分片。"""
+    totals = {"counters": {}, "histograms": {}}
+    with metrics_shards_lock:
+        _compact_metrics_shards_locked()
+        _merge_metrics_shard(totals, metrics_retired)
+        live_shards = [shard for _, shard in metrics_shards]
+    for shard in live_shards:
+        _merge_metrics_shard(totals, shard)
+    return totals
+
+def _render_metrics():
+    """汇总所有分片、SOCKS工作进程上报的指标和代理池状态，生成 Prometheus 文本格式的指标。"""
+    totals = _metrics_totals()
+    with socks_workers_lock:
+        worker_totals = [stats["metrics"] for stats in socks_worker_stats.values()]
+    for worker_total in worker_totals:
+        _merge_metrics_shard(totals, worker_total)
+
+    lines = []
+    for name, (metric_type, help_text, buckets) in METRIC_DEFINITIONS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        if metric_type == "counter":
+            for (metric_name, labels), value in sorted(totals["counters"].items()):
+                if metric_name == name:
+                    lines.append(f"{name}{_format_metric_labels(labels)} {value}")
+            continue
+        for (metric_name, labels), state in sorted(totals["histograms"].items()):
+            if metric_name != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ("+Inf",), state[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_metric_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_metric_labels(labels)} {state[-1]:.6f}")
+            lines.append(f"{name}_count{_format_metric_labels(labels)} {cumulative}")
+
+    # 代理池状态类指标在抓取时直接读取
+    with proxy_lock:
+        gauges = {
+            "warp_pool_backends": len(WARP_POOL_CONFIG),
+            "warp_pool_available_backends": available_proxies.qsize(),
+            "warp_pool_in_use_backends": len(in_use_proxies),
+            "warp_pool_quarantined_backends": len(quarantined_proxies),
+            "warp_pool_draining_backends": len(draining_proxies),
+            "warp_pool_shared_sessions": sum(backend_active_sessions.values()),
+            "warp_pool_acquire_waiters": len(pool_waiters),
+            "warp_pool_distinct_exit_ips": len({entry["ip"] for entry in backend_exit_ips.values() if entry["ip"] is not None}),
+        }
+        exit_ip_counters = dict(exit_ip_stats)
+        wait_queue_counters = _wait_queue_snapshot_locked()
+    with sticky_lock:
+        gauges["warp_pool_sticky_sessions"] = len(sticky_sessions)
+    lease_snapshot = _lease_snapshot()
+    gauges["warp_pool_api_leases"] = lease_snapshot["active"]
+    refresh_scheduler_snapshot = _refresh_scheduler_snapshot()
+    gauges["warp_pool_refresh_pending"] = refresh_scheduler_snapshot["queue_depth"]
+    gauges["warp_pool_refresh_in_flight"] = len(refresh_scheduler_snapshot["in_flight"])
+    admission_snapshots = [_admission_snapshot()]
+    if SOCKS_WORKER_PROCESSES > 0:
+        socks_workers_snapshot = _socks_workers_snapshot()
+        gauges["warp_pool_socks_workers"] = sum(1 for worker in socks_workers_snapshot.values() if worker["alive"])
+        admission_snapshots += [worker["admission"] for worker in socks_workers_snapshot.values() if worker["admission"]]
+    gauges["warp_pool_socks_clients"] = sum(snapshot["clients"] for snapshot in admission_snapshots)
+    gauges["warp_pool_socks_handshakes"] = sum(snapshot["handshakes"] for snapshot in admission_snapshots)
+    if pool_nodes:
+        with pool_nodes_lock:
+            gauges["warp_pool_nodes"] = len(pool_nodes)
+            gauges["warp_pool_nodes_up"] = sum(1 for node in pool_nodes.values() if node["state"] == 'up')
+    for name, value in gauges.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+
+    snapshot_counters = {
+        "warp_pool_refresh_completed_total": refresh_scheduler_snapshot["completed_total"],
+        "warp_pool_refresh_failed_total": refresh_scheduler_snapshot["failed_total"],
+        "warp_pool_refresh_retries_total": refresh_scheduler_snapshot["retries_total"],
+        "warp_pool_refresh_exit_ip_rerolls_total": refresh_scheduler_snapshot["exit_ip_rerolls_total"],
+        "warp_pool_exit_ip_lookups_total": exit_ip_counters["lookups_total"],
+        "warp_pool_exit_ip_lookup_failures_total": exit_ip_counters["lookup_failures_total"],
+        "warp_pool_exit_ip_duplicates_total": exit_ip_counters["duplicates_total"],
+        "warp_pool_acquire_wait_timeouts_total": wait_queue_counters["timeouts_total"],
+        "warp_pool_acquire_wait_rejected_total": wait_queue_counters["rejected_queue_full_total"],
+        "warp_pool_api_leases_expired_total": lease_snapshot["expired_total"],
+    }
+    for name, value in snapshot_counters.items():
+        lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+def _measure_backend_latency(backend_warp_port, timeout):
+    """通过指定后端连接验证目标并返回连接耗时(秒)，失败时抛出异常。"""
+    started_at = time.monotonic()
+    backend_host, backend_connect_port = _backend_address(backend_warp_port)
+    # 使用 PySocks 创建一个通过指定后端代理的连接
+    conn = socks.create_connection(
+        (PROXY_VALIDATION_TARGET_HOST, PROXY_VALIDATION_TARGET_PORT),
+        proxy_type=socks.SOCKS5,
+        proxy_addr=backend_host,
+        proxy_port=backend_connect_port,
+        timeout=timeout
+    )
+    conn.close()
+    return time.monotonic() - started_at
 
 def validate_proxy(backend_warp_port):
     """
     通过尝试连接到一个已知目标来验证一个后端WARP代理是否真的可用。
-    返回 True 表示验证成功，False 表示失败。
+    验证结果同时计入后端健康统计。返回 True 表示验证成功，False 表示失败。
     """
     logging.info(f"验证中: 正在测试后端端口 {backend_warp_port} 的连通性...")
+    validation_started_at = time.monotonic()
     try:
-        # 使用 PySocks 创建一个通过指定后端代理的连接
-        conn = socks.create_connection(
-            (PROXY_VALIDATION_TARGET_HOST, PROXY_VALIDATION_TARGET_PORT),
-            proxy_type=socks.SOCKS5,
-            proxy_addr=WARP_INSTANCE_IP,
-            proxy_port=backend_warp_port,
-            timeout=PROXY_VALIDATION_TIMEOUT
-        )
-        conn.close()
-        logging.info(f"验证成功: 后端端口 {backend_warp_port} 可以成功连接到 {PROXY_VALIDATION_TARGET_HOST}:{PROXY_VALIDATION_TARGET_PORT}。")
+        latency = _measure_backend_latency(backend_warp_port, PROXY_VALIDATION_TIMEOUT)
+        _metrics_observe("warp_pool_validation_duration_seconds", latency, (("kind", "validate"), ("result", "success")))
+        logging.info(f"验证成功: 后端端口 {backend_warp_port} 可以成功连接到 {PROXY_VALIDATION_TARGET_HOST}:{PROXY_VALIDATION_TARGET_PORT}，耗时 {latency * 1000:.0f} 毫秒。")
+        _record_backend_health(backend_warp_port, latency)
         return True
     except (socks.ProxyConnectionError, socket.timeout, OSError) as e:
         logging.warning(f"验证失败: 后端端口 {backend_warp_port} 无法连接到验证目标。错误: {e}")
+        _metrics_observe("warp_pool_validation_duration_seconds", time.monotonic() - validation_started_at, (("kind", "validate"), ("result", "failure")))
+        _record_backend_health(backend_warp_port, None)
         return False
     except Exception as e:
         logging.error(f"验证中发生未知错误 (端口 {backend_warp_port}): {e}")
         return False
 
+# --- 后端健康探测与隔离 ---
+# 健康统计和隔离状态由 proxy_lock 保护。被隔离的端口不会进入可用代理池:
+# 隔离时若端口在池中则移出并安排一次低优先级IP刷新，之后归还的端口 (刷新完成、会话结束) 也暂留在隔离区，
+# 直到探测连续成功 HEALTH_RECOVERY_SUCCESSES 次后才返回代理池。
+
+def _record_backend_health_locked(port, latency):
+    """
+    记录一次探测/验证结果 (latency 为 None 表示失败)，更新 EWMA 并处理隔离状态变化。
+    返回 'quarantined'、'recovered' 或 None。调用方必须持有 proxy_lock。
+    """
+    health = backend_health.setdefault(port, {
+        "latency_ewma": None, "failure_rate": 0.0, "consecutive_successes": 0,
+        "probes_total": 0, "failures_total": 0, "last_probe_at": None
+    })
+    health["probes_total"] += 1
+    health["last_probe_at"] = time.time()
+    if latency is None:
+        health["failures_total"] += 1
+        health["consecutive_successes"] = 0
+        health["failure_rate"] = HEALTH_EWMA_ALPHA + (1 - HEALTH_EWMA_ALPHA) * health["failure_rate"]
+    else:
+        health["consecutive_successes"] += 1
+        health["failure_rate"] = (1 - HEALTH_EWMA_ALPHA) * health["failure_rate"]
+        if health["latency_ewma"] is None:
+            health["latency_ewma"] = latency
+        else:
+            health["latency_ewma"] = HEALTH_EWMA_ALPHA * latency + (1 - HEALTH_EWMA_ALPHA) * health["latency_ewma"]
+
+    if port not in quarantined_proxies:
+        if health["failure_rate"] >= HEALTH_QUARANTINE_FAILURE_RATE:
+            parked = port in available_proxies.queue
+            if parked:
+                available_proxies.queue.remove(port)
+            quarantined_proxies[port] = {"since": time.time(), "parked": parked}
+            return 'quarantined'
+    elif health["consecutive_successes"] >= HEALTH_RECOVERY_SUCCESSES:
+        if quarantined_proxies.pop(port)["parked"]:
+            _return_port_to_pool_locked(port)
+        return 'recovered'
+    return None
+
+def _record_backend_health(port, latency):
+    """记录一次探测/验证结果，并在空闲后端被隔离时为其安排低优先级IP刷新。"""
+    with proxy_lock:
+        if port not in WARP_POOL_CONFIG:
+            # 探测期间后端已被移除
+            return
+        transition = _record_backend_health_locked(port, latency)
+        refresh_parked_port = (transition == 'quarantined' and quarantined_proxies[port]["parked"]
+                               and not backend_active_sessions.get(port))
+        if refresh_parked_port:
+            # 端口交给刷新流程，刷新完成后仍在隔离中则重新暂留在隔离区
+            quarantined_proxies[port]["parked"] = False
+        failure_rate = backend_health[port]["failure_rate"]
+    if transition == 'quarantined':
+        logging.warning(f"健康探测: 后端端口 {port} 失败率 {failure_rate:.2f} 达到阈值，已隔离。")
+        if refresh_parked_port:
+            schedule_refresh(port, priority=REFRESH_PRIORITY_LOW)
+    elif transition == 'recovered':
+        logging.info(f"健康探测: 后端端口 {port} 连续 {HEALTH_RECOVERY_SUCCESSES} 次探测成功，已解除隔离。")
+
+def _probe_backend_latency(port):
+    """对一个后端执行一次健康探测，返回连接耗时(秒)，失败返回 None。"""
+    probe_started_at = time.monotonic()
+    try:
+        latency = _measure_backend_latency(port, HEALTH_PROBE_TIMEOUT)
+    except Exception as e:
+        logging.debug(f"健康探测: 后端端口 {port} 探测失败: {e}")
+        _metrics_observe("warp_pool_validation_duration_seconds", time.monotonic() - probe_started_at, (("kind", "probe"), ("result", "failure")))
+        return None
+    _metrics_observe("warp_pool_validation_duration_seconds", latency, (("kind", "probe"), ("result", "success")))
+    return latency
+
+def _health_prober_loop():
+    """定期探测所有空闲后端和被隔离的后端。"""
+    logging.info(f"健康探测: 后台探测线程已启动，间隔 {HEALTH_PROBE_INTERVAL} 秒，并发 {HEALTH_PROBE_CONCURRENCY}。")
+    with ThreadPoolExecutor(max_workers=HEALTH_PROBE_CONCURRENCY, thread_name_prefix="health-probe") as executor:
+        while True:
+            time.sleep(HEALTH_PROBE_INTERVAL)
+            with proxy_lock:
+                probe_ports = [port for port in available_proxies.queue if not backend_active_sessions.get(port)]
+                probe_ports.extend(port for port in quarantined_proxies if port not in probe_ports)
+            for port, latency in zip(probe_ports, executor.map(_probe_backend_latency, probe_ports)):
+                _record_backend_health(port, latency)
+
+def _backend_selection_score_locked(port):
+    """后端的选择评分 (越小越优先): 延迟 EWMA 按失败率加权，尚无探测数据时按探测超时计。调用方必须持有 proxy_lock。"""
+    health = backend_health.get(port)
+    if health is None or health["latency_ewma"] is None:
+        return HEALTH_PROBE_TIMEOUT
+    return health["latency_ewma"] * (1 + health["failure_rate"])
+
+def _backend_health_snapshot():
+    """返回后端健康统计与隔离状态的快照 (用于 /status)。"""
+    now = time.time()
+    with proxy_lock:
+        return {
+            "quarantined": {port: round(now - info["since"], 1) for port, info in quarantined_proxies.items()},
+            "backends": {
+                port: {
+                    "latency_ms": round(health["latency_ewma"] * 1000, 1) if health["latency_ewma"] is not None else None,
+                    "failure_rate": round(health["failure_rate"], 3),
+                    "probes_total": health["probes_total"],
+                    "failures_total": health["failures_total"]
+                }
+                for port, health in backend_health.items()
+            }
+        }
+
+# --- 代理池获取与等待队列 ---
+class _PoolWaiter:
+    """等待队列中的一个请求。由 _dispatch_pool_waiters_locked 在有端口可用时直接分配。"""
+    __slots__ = ("event", "port", "shared", "in_use_info", "in_use_port_field", "enqueued_at")
+
+    def __init__(self, shared, in_use_info, in_use_port_field):
+        self.event = threading.Event()
+        self.port = None
+        self.shared = shared
+        self.in_use_info = in_use_info
+        self.in_use_port_field = in_use_port_field
+        self.enqueued_at = time.time()
+
+def _backend_locality_rank_locked(port):
+    """后端的位置优先级: 启用 PREFER_LOCAL_BACKENDS 时本机后端为 0，其他节点的后端为 1。调用方必须持有 proxy_lock。"""
+    if not PREFER_LOCAL_BACKENDS or not pool_nodes:
+        return 0
+    return 0 if WARP_POOL_CONFIG.get(port, {}).get("node") is None else 1
+
+def _take_idle_available_port_locked():
+    """
+    从可用队列中取出一个没有共享会话的后端端口，没有时返回 None。调用方必须持有 proxy_lock。
+    'latency' 选择方式下取评分最低 (延迟最低) 的端口，评分相同时保持队列顺序; 'fifo' 下取第一个。
+    优先使用本机后端时只在本机没有空闲后端时才选择其他节点的后端。
+    """
+    idle_ports = [port for port in available_proxies.queue if not backend_active_sessions.get(port)]
+    if not idle_ports:
+        return None
+    best_rank = min(_backend_locality_rank_locked(port) for port in idle_ports)
+    idle_ports = [port for port in idle_ports if _backend_locality_rank_locked(port) == best_rank]
+    if BACKEND_SELECTION == 'latency':
+        port = min(idle_ports, key=_backend_selection_score_locked)
+    else:
+        port = idle_ports[0]
+    available_proxies.queue.remove(port)
+    return port
+
+def _acquire_shared_backend_port_locked():
+    """
+    共享模式下选择负载最低且未达到会话上限的可用后端端口，并增加其会话计数 (优先使用本机后端时先比较位置)。
+    端口保留在可用队列中。调用方必须持有 proxy_lock。
+    """
+    best_port = None
+    best_key = None
+    for port in available_proxies.queue:
+        active_sessions = backend_active_sessions.get(port, 0)
+        if active_sessions >= BACKEND_MAX_SESSIONS:
+            continue
+        selection_score = _backend_selection_score_locked(port) if BACKEND_SELECTION == 'latency' else 0
+        if BACKEND_SCHEDULING_METRIC == 'bytes':
+            load_key = (_backend_locality_rank_locked(port), backend_relayed_bytes.get(port, 0), active_sessions, selection_score)
+        else:
+            load_key = (_backend_locality_rank_locked(port), active_sessions, selection_score, backend_relayed_bytes.get(port, 0))
+        if best_key is None or load_key < best_key:
+            best_port, best_key = port, load_key
+    if best_port is not None:
+        backend_active_sessions[best_port] = backend_active_sessions.get(best_port, 0) + 1
+    return best_port
+
+def _try_take_backend_port_locked(shared, in_use_info, in_use_port_field):
+    """
+    立即尝试获取一个后端端口，失败返回 None。独占获取会登记到 in_use_proxies。
+    调用方必须持有 proxy_lock。
+    """
+    if shared:
+        return _acquire_shared_backend_port_locked()
+    port = _take_idle_available_port_locked()
+    if port is not None:
+        proxy_info = dict(in_use_info)
+        proxy_info[in_use_port_field] = port
+        proxy_info["acquired_at"] = time.time()
+        in_use_proxies[port] = proxy_info
+    return port
+
+def _dispatch_pool_waiters_locked():
+    """
+    按 FIFO 顺序把可用端口 (或共享会话容量) 直接交给等待中的请求。
+    队首请求无法满足时停止，保证先到先得。调用方必须持有 proxy_lock。
+    """
+    while pool_waiters:
+        waiter = pool_waiters[0]
+        port = _try_take_backend_port_locked(waiter.shared, waiter.in_use_info, waiter.in_use_port_field)
+        if port is None:
+            break
+        pool_waiters.popleft()
+        waiter.port = port
+        waited = time.time() - waiter.enqueued_at
+        wait_queue_stats["granted_total"] += 1
+        wait_queue_stats["wait_seconds_total"] += waited
+        wait_queue_stats["wait_seconds_max"] = max(wait_queue_stats["wait_seconds_max"], waited)
+        waiter.event.set()
+
+def _return_port_to_pool_locked(port):
+    """
+    将一个后端端口放回可用代理池，并优先交给等待队列。调用方必须持有 proxy_lock。
+    被隔离的端口暂留在隔离区，解除隔离后才返回代理池; 排空中的端口不再返回代理池。
+    """
+    if port not in WARP_POOL_CONFIG:
+        return
+    if port in draining_proxies:
+        if _settle_drained_backend_locked(port) == 'removed':
+            logging.info(f"后端管理: 排空中的后端端口 {port} 已空闲，已从代理池移除。")
+        else:
+            logging.info(f"后端管理: 后端端口 {port} 已排空。")
+        return
+    if port in quarantined_proxies:
+        quarantined_proxies[port]["parked"] = True
+        return
+    available_proxies.put(port)
+    _dispatch_pool_waiters_locked()
+
+def _acquire_backend_port(in_use_info, in_use_port_field, shared=False, wait_seconds=0):
+    """
+    从代理池获取一个后端端口。独占获取时以 in_use_info 为模板登记到 in_use_proxies。
+    池为空且 wait_seconds > 0 时进入 FIFO 等待队列，直到有端口归还或超时。
+    返回 (端口, None) 或 (None, 失败原因)，失败原因为 'empty'、'queue_full'、'timeout' 或 'reloading'。
+    """
+    acquire_started_at = time.monotonic()
+    port, failure_reason = _acquire_backend_port_or_wait(in_use_info, in_use_port_field, shared, wait_seconds)
+    _metrics_observe("warp_pool_acquire_wait_duration_seconds", time.monotonic() - acquire_started_at,
+                     (("result", failure_reason or "granted"),))
+    return port, failure_reason
+
+def _acquire_backend_port_or_wait(in_use_info, in_use_port_field, shared, wait_seconds):
+    """_acquire_backend_port 的实现: 立即获取，或在等待队列中等待。"""
+    with proxy_lock:
+        # 已有请求在排队时，新请求不能插队
+        if not pool_waiters:
+            port = _try_take_backend_port_locked(shared, in_use_info, in_use_port_field)
+            if port is not None:
+                return port, None
+        if wait_seconds <= 0:
+            return None, 'empty'
+        if reload_state["phase"] != 'serving':
+            # 平滑重启暂停期间不进入等待队列，以免拖住重启
+            return None, 'reloading'
+        if len(pool_waiters) >= ACQUIRE_WAIT_QUEUE_MAX:
+            wait_queue_stats["rejected_queue_full_total"] += 1
+            return None, 'queue_full'
+        waiter = _PoolWaiter(shared, in_use_info, in_use_port_field)
+        pool_waiters.append(waiter)
+        wait_queue_stats["waits_total"] += 1
+
+    waiter.event.wait(wait_seconds)
+
+    with proxy_lock:
+        # 超时与分配可能同时发生，以持锁后的状态为准
+        if waiter.port is not None:
+            return waiter.port, None
+        _withdraw_pool_waiter_locked(waiter)
+        # 队首请求离开后，后面的请求可能已经可以被满足
+        _dispatch_pool_waiters_locked()
+    # 平滑重启时等待中的请求会被提前唤醒
+    return None, 'reloading' if reload_state["phase"] != 'serving' else 'timeout'
+
+def _withdraw_pool_waiter_locked(waiter):
+    """把一个已超时的请求移出等待队列并记录等待统计。调用方必须持有 proxy_lock。"""
+    try:
+        pool_waiters.remove(waiter)
+    except ValueError:
+        pass
+    waited = time.time() - waiter.enqueued_at
+    wait_queue_stats["timeouts_total"] += 1
+    wait_queue_stats["wait_seconds_total"] += waited
+    wait_queue_stats["wait_seconds_max"] = max(wait_queue_stats["wait_seconds_max"], waited)
+
+def _acquire_backend_ports_batch(in_use_infos, in_use_port_field, wait_seconds, all_or_nothing):
+    """
+    为 in_use_infos 中的每个模板各独占获取一个后端端口。一次持锁取走所有立即可用的端口，
+    不足的部分作为连续的请求进入 FIFO 等待队列，共同等待到 wait_seconds 截止。
+    all_or_nothing 为 True 时，未能全部获取就归还已取得的端口。
+    返回 (与 in_use_infos 顺序对应的端口列表，未获取的位置为 None, 失败原因或 None)。
+    """
+    acquire_started_at = time.monotonic()
+    ports = [None] * len(in_use_infos)
+    waiters = []
+    failure_reason = None
+    with proxy_lock:
+        taken_count = 0
+        # 与单个获取相同，已有请求在排队时不能插队
+        if not pool_waiters:
+            while taken_count < len(in_use_infos):
+                port = _try_take_backend_port_locked(False, in_use_infos[taken_count], in_use_port_field)
+                if port is None:
+                    break
+                ports[taken_count] = port
+                taken_count += 1
+        missing_count = len(in_use_infos) - taken_count
+        if missing_count and wait_seconds <= 0:
+            failure_reason = 'empty'
+        elif missing_count and reload_state["phase"] != 'serving':
+            failure_reason = 'reloading'
+        elif missing_count and len(pool_waiters) + missing_count > ACQUIRE_WAIT_QUEUE_MAX:
+            wait_queue_stats["rejected_queue_full_total"] += 1
+            failure_reason = 'queue_full'
+        elif missing_count:
+            for index in range(taken_count, len(in_use_infos)):
+                waiter = _PoolWaiter(False, in_use_infos[index], in_use_port_field)
+                waiters.append((index, waiter))
+                pool_waiters.append(waiter)
+            wait_queue_stats["waits_total"] += missing_count
+
+    if waiters:
+        # 等待队列按 FIFO 分配，依次等待每个请求即可，总时长不超过截止时间
+        wait_deadline = time.monotonic() + wait_seconds
+        for _, waiter in waiters:
+            if not waiter.event.wait(max(wait_deadline - time.monotonic(), 0)):
+                break
+        with proxy_lock:
+            for index, waiter in waiters:
+                if waiter.port is not None:
+                    ports[index] = waiter.port
+                else:
+                    _withdraw_pool_waiter_locked(waiter)
+                    failure_reason = 'reloading' if reload_state["phase"] != 'serving' else 'timeout'
+            _dispatch_pool_waiters_locked()
+
+    if failure_reason is not None and all_or_nothing:
+        with proxy_lock:
+            for port in ports:
+                if port is not None:
+                    # 端口尚未交给客户端使用，直接放回代理池，无需刷新IP
+                    in_use_proxies.pop(port, None)
+                    _return_port_to_pool_locked(port)
+        ports = [None] * len(in_use_infos)
+    _metrics_observe("warp_pool_acquire_wait_duration_seconds", time.monotonic() - acquire_started_at,
+                     (("result", failure_reason or "granted"),))
+    return ports, failure_reason
+
+def _wait_queue_snapshot_locked():
+    """返回等待队列的深度和统计信息。调用方必须持有 proxy_lock。"""
+    snapshot = dict(wait_queue_stats)
+    snapshot["depth"] = len(pool_waiters)
+    finished = snapshot["granted_total"] + snapshot["timeouts_total"]
+    snapshot["wait_seconds_avg"] = round(snapshot["wait_seconds_total"] / finished, 3) if finished else 0.0
+    snapshot["wait_seconds_total"] = round(snapshot["wait_seconds_total"], 3)
+    snapshot["wait_seconds_max"] = round(snapshot["wait_seconds_max"], 3)
+    return snapshot
+
+# --- IP刷新策略 ---
+# 策略解析为 (类型, 阈值, 原始描述) 三元组; 使用情况在 proxy_lock 下记录和判断。
+
+REFRESH_POLICY_KINDS = ('always', 'never', 'error', 'uses', 'age', 'bytes')
+_REFRESH_POLICY_UNITS = {
+    'age': {'': 1, 's': 1, 'm': 60, 'h': 3600},
+    'bytes': {'': 1, 'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3},
+    'uses': {'': 1}
+}
+
+def _parse_refresh_policy(policy_spec):
+    """解析刷新策略描述 (如 'uses:10', 'age:10m', 'bytes:500M')。无效时返回 None。"""
+    spec = str(policy_spec).strip().lower()
+    kind, _, value = spec.partition(':')
+    if kind not in REFRESH_POLICY_KINDS:
+        return None
+    if kind in ('always', 'never', 'error'):
+        return (kind, None, kind) if not value else None
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([a-z]?)', value.strip())
+    if not match or match.group(2) not in _REFRESH_POLICY_UNITS[kind]:
+        return None
+    threshold = float(match.group(1)) * _REFRESH_POLICY_UNITS[kind][match.group(2)]
+    if not math.isfinite(threshold) or threshold <= 0: # 过长的数字串会溢出为 inf
+        return None
+    return (kind, threshold, spec)
+
+pool_refresh_policy = _parse_refresh_policy(REFRESH_POLICY)
+if pool_refresh_policy is None:
+    logging.warning(f"未知的 REFRESH_POLICY '{REFRESH_POLICY}'，将使用 'always' 策略。")
+    pool_refresh_policy = ('always', None, 'always')
+
+def _refresh_policy_for_port(port):
+    """返回后端端口生效的刷新策略: 实例配置优先，否则使用全局策略。"""
+    return WARP_POOL_CONFIG.get(port, {}).get("refresh_policy", pool_refresh_policy)
+
+def _record_backend_usage_locked(port, relayed_byte_count=0):
+    """记录后端端口的一次使用。调用者必须持有 proxy_lock。"""
+    usage = backend_usage.setdefault(port, {"uses": 0, "bytes": 0, "ip_since": time.time()})
+    usage["uses"] += 1
+    usage["bytes"] += relayed_byte_count
+
+def _backend_needs_refresh_locked(port, had_error=False, policy=None):
+    """
+    根据刷新策略和使用情况判断后端端口释放后是否需要刷新IP。调用者必须持有 proxy_lock。
+    出错的会话在 'always' 策略下不刷新 (与早期行为一致，改为验证后返回代理池)。
+    """
+    if port in draining_proxies:
+        # 排空中的后端不再分配新会话，无需刷新IP
+        return False
+    kind, threshold, _ = policy or _refresh_policy_for_port(port)
+    usage = backend_usage.get(port, {"uses": 0, "bytes": 0, "ip_since": time.time()})
+    if kind == 'always':
+        return not had_error
+    if kind == 'never':
+        return False
+    if kind == 'error':
+        return had_error
+    if kind == 'uses':
+        return usage["uses"] >= threshold
+    if kind == 'age':
+        return time.time() - usage["ip_since"] >= threshold
+    return usage["bytes"] >= threshold
+
+def _reset_backend_usage(port):
+    """IP刷新成功后重置后端端口的使用情况。"""
+    with proxy_lock:
+        backend_usage[port] = {"uses": 0, "bytes": 0, "ip_since": time.time()}
+
+def _refresh_policy_snapshot():
+    """返回刷新策略与各后端使用情况的快照 (用于 /status)。"""
+    now = time.time()
+    with proxy_lock:
+        usage_snapshot = {
+            port: {"uses": usage["uses"], "bytes": usage["bytes"], "ip_age_seconds": round(now - usage["ip_since"], 1)}
+            for port, usage in backend_usage.items()
+        }
+        overrides = {port: info["refresh_policy"][2] for port, info in WARP_POOL_CONFIG.items() if "refresh_policy" in info}
+    return {"default": pool_refresh_policy[2], "overrides": overrides, "usage": usage_snapshot}
+
 # --- 初始化代理池 (将在 main 函数中调用) ---
-def initialize_proxy_pool_from_config(config_data):
-    """根据加载的配置数据初始化代理池。"""
+def initialize_proxy_pool_from_config(config_data, index_exit_ips=True):
+    """
+    根据加载的配置数据初始化代理池。已登记的端口会被跳过，
+    因此同样用于将配置文件中新增的实例加入运行中的代理池。
+    平滑重启时由状态快照恢复代理池，index_exit_ips 为 False，只为快照中没有的端口查询出口IP。
+    其他节点的后端带有 'node'、'host' 和 'node_port' 字段 (由 _node_backend_instances 生成)，始终通过节点地址连接。
+    """
     logging.info(f"根据配置文件初始化后端代理池... 代理数量: {len(config_data)}")
+    added_ports = []
     for instance in config_data:
         port = instance.get('port')
-        if port is not None:
-            WARP_POOL_CONFIG[port] = {
-                "id": instance.get('id'),
-                "namespace": instance.get('namespace')
-            }
-            available_proxies.put(port)
-            logging.info(f"已添加后端端口 {port} (命名空间: {instance.get('namespace')}) 到可用代理池。")
-        else:
+        if port is None:
             logging.warning(f"在配置中发现一个缺少 'port' 字段的实例: {instance}")
+            continue
+        if port in WARP_POOL_CONFIG:
+            continue
+        instance_config = {
+            "id": instance.get('id'),
+            "namespace": instance.get('namespace')
+        }
+        if instance.get('node') is not None:
+            # 其他节点的后端: 命名空间地址在本机不可达，通过节点地址上的 DNAT 主机端口连接
+            instance_config["node"] = instance['node']
+            instance_config["node_port"] = instance.get('node_port')
+            direct_address = (instance.get('host'), instance.get('node_port'))
+        else:
+            direct_address = _parse_direct_address(instance)
+            if direct_address is not None:
+                instance_config["namespace_ip"], instance_config["internal_port"] = direct_address
+            elif BACKEND_ADDRESSING == 'direct':
+                logging.warning(f"后端端口 {port} 的配置缺少有效的 'namespace_ip' 和 'internal_port'，将通过 {WARP_INSTANCE_IP}:{port} (DNAT) 连接。")
+        if instance.get('refresh_policy'):
+            instance_policy = _parse_refresh_policy(instance.get('refresh_policy'))
+            if instance_policy is None:
+                logging.warning(f"后端端口 {port} 的刷新策略 '{instance.get('refresh_policy')}' 无效，将使用默认策略 '{pool_refresh_policy[2]}'。")
+            else:
+                instance_config["refresh_policy"] = instance_policy
+        with proxy_lock:
+            WARP_POOL_CONFIG[port] = instance_config
+            if "node" in instance_config or (BACKEND_ADDRESSING == 'direct' and direct_address is not None):
+                backend_direct_addresses[port] = direct_address
+            backend_usage[port] = {"uses": 0, "bytes": 0, "ip_since": time.time()}
+            _return_port_to_pool_locked(port)
+        added_ports.append(port)
+        logging.info(f"已添加后端端口 {port} (命名空间: {instance.get('namespace')}, 连接地址: {_backend_address_label(port)}) 到可用代理池。")
+    if added_ports and EXIT_IP_TRACE_URL and index_exit_ips:
+        threading.Thread(target=_index_backend_exit_ips, args=(added_ports,), name="exit-ip-indexer", daemon=True).start()
     return len(WARP_POOL_CONFIG) > 0
 
+def _parse_direct_address(instance):
+    """从实例配置中读取命名空间地址和WARP内部端口，返回 (地址, 端口)，缺少或无效时返回 None。"""
+    namespace_ip = instance.get('namespace_ip')
+    internal_port = instance.get('internal_port')
+    if namespace_ip is None or internal_port is None:
+        return None
+    try:
+        return str(ipaddress.ip_address(namespace_ip)), int(internal_port)
+    except ValueError:
+        logging.warning(f"实例配置中的命名空间地址 '{namespace_ip}' 或内部端口 '{internal_port}' 无效。")
+        return None
+
+def _backend_address(backend_port):
+    """返回连接后端WARP实例使用的 (地址, 端口): direct 模式下为命名空间地址和内部端口，否则为 DNAT 主机端口。"""
+    direct_address = backend_direct_addresses.get(backend_port)
+    if direct_address is not None:
+        return direct_address
+    return WARP_INSTANCE_IP, backend_port
+
+def _backend_address_label(backend_port):
+    backend_host, backend_connect_port = _backend_address(backend_port)
+    return f"{backend_host}:{backend_connect_port}"
+
+def _pool_config_watcher_loop(last_signature):
+    """后台线程: 配置文件发生变化时，将新就绪的实例加入运行中的代理池。"""
+    while True:
+        time.sleep(WARP_POOL_CONFIG_WATCH_INTERVAL)
+        signature = pool_config_file_signature()
+        if signature is None or signature == last_signature:
+            continue
+        last_signature = signature
+        try:
+            config_list = load_pool_config_file()
+        except Exception as e:
+            logging.warning(f"配置监视: 无法解析配置文件 '{WARP_POOL_CONFIG_FILE}': {e}")
+            continue
+        changes = _reconcile_pool_config(config_list)
+        if changes["added"] or changes["resumed"] or changes["removed"]:
+            logging.info(f"配置监视: 新增 {changes['added']}, 取消移除 {changes['resumed']}, 移除 {changes['removed']}。"
+                         f"当前后端WARP代理池大小: {len(WARP_POOL_CONFIG)}")
+
+# --- 后端动态增删与排空 ---
+def _backend_idle_locked(port):
+    """后端是否空闲: 在可用队列中或暂留在隔离区，且没有共享会话。调用方必须持有 proxy_lock。"""
+    if backend_active_sessions.get(port):
+        return False
+    return port in available_proxies.queue or quarantined_proxies.get(port, {}).get("parked", False)
+
+def _settle_drained_backend_locked(port):
+    """
+    排空中的后端已空闲: 需要移除时清除其全部状态，否则保持为已排空 (不接受新会话)。
+    返回 'removed' 或 'drained'。调用方必须持有 proxy_lock。
+    """
+    if not draining_proxies[port]["remove"]:
+        draining_proxies[port]["idle"] = True
+        return 'drained'
+    WARP_POOL_CONFIG.pop(port, None)
+    backend_direct_addresses.pop(port, None)
+    exit_ip_entry = backend_exit_ips.pop(port, None)
+    if exit_ip_entry is not None and exit_ip_entry["ip"] is not None:
+        recent_exit_ips[exit_ip_entry["ip"]] = time.time()
+    for backend_state in (backend_usage, backend_health, quarantined_proxies, draining_proxies,
+                          backend_relayed_bytes, backend_active_sessions, exit_ip_rerolls):
+        backend_state.pop(port, None)
+    return 'removed'
+
+def _drain_backend(port, remove=False):
+    """
+    排空一个后端: 不再分配新会话，已有的中继和租约继续使用直到结束。
+    remove 为 True 时后端空闲后从代理池移除。
+    返回 'removed'、'drained'、'draining'、'removing'，端口未登记时返回 None。
+    """
+    with proxy_lock:
+        if port not in WARP_POOL_CONFIG:
+            return None
+        idle = _backend_idle_locked(port)
+        if port in available_proxies.queue:
+            available_proxies.queue.remove(port)
+        drain_entry = draining_proxies.setdefault(port, {"since": time.time(), "remove": False, "idle": False})
+        drain_entry["remove"] = drain_entry["remove"] or remove
+        if idle or drain_entry["idle"]:
+            state = _settle_drained_backend_locked(port)
+        else:
+            state = 'removing' if drain_entry["remove"] else 'draining'
+    logging.info(f"后端管理: 后端端口 {port} 开始{'移除' if remove else '排空'}，当前状态: {state}。")
+    return state
+
+def _resume_backend(port):
+    """取消一个后端的排空/移除。已空闲的后端立即返回代理池。端口未处于排空状态时返回 False。"""
+    with proxy_lock:
+        drain_entry = draining_proxies.pop(port, None)
+        if drain_entry is None:
+            return False
+        if drain_entry["idle"]:
+            _return_port_to_pool_locked(port)
+    logging.info(f"后端管理: 后端端口 {port} 已恢复接受新会话。")
+    return True
+
+def _reconcile_pool_config(config_list, node=None):
+    """
+    将运行中的代理池与配置对齐: 新增实例加入代理池，配置中已不存在的实例排空后移除，
+    正在移除但仍在配置中的实例取消移除。正在使用的端口不受影响，直到其会话结束。
+    node 为 None 时只对齐本机后端 (配置文件)，否则只对齐该节点的后端。
+    """
+    desired = {
+        instance.get('port'): instance for instance in config_list
+        if isinstance(instance, dict) and instance.get('port') is not None
+    }
+    with proxy_lock:
+        current_ports = {port for port, instance_config in WARP_POOL_CONFIG.items() if instance_config.get("node") == node}
+        removing_ports = {port for port, drain_entry in draining_proxies.items() if drain_entry["remove"] and port in current_ports}
+    added = [port for port in desired if port not in current_ports]
+    resumed = [port for port in desired if port in removing_ports]
+    removed_ports = [port for port in current_ports if port not in desired and port not in removing_ports]
+    if added:
+        initialize_proxy_pool_from_config([desired[port] for port in added])
+    for port in resumed:
+        _resume_backend(port)
+    removed = {port: _drain_backend(port, remove=True) for port in removed_ports}
+    return {"added": added, "resumed": resumed, "removed": removed}
+
+def _backend_state_locked(port):
+    """返回一个后端的管理状态。调用方必须持有 proxy_lock。"""
+    drain_entry = draining_proxies.get(port)
+    if drain_entry is not None:
+        if drain_entry["remove"]:
+            return 'removing'
+        return 'drained' if drain_entry["idle"] else 'draining'
+    if port in quarantined_proxies:
+        return 'quarantined'
+    if port in in_use_proxies:
+        return 'in_use'
+    if port in available_proxies.queue:
+        return 'available'
+    return 'refreshing'
+
+def _backend_admin_snapshot(ports=None):
+    """返回后端的登记信息与管理状态 (用于管理API)。"""
+    with proxy_lock:
+        return {
+            port: {
+                "id": WARP_POOL_CONFIG[port].get("id"),
+                "namespace": WARP_POOL_CONFIG[port].get("namespace"),
+                "node": WARP_POOL_CONFIG[port].get("node"),
+                "address": _backend_address_label(port),
+                "state": _backend_state_locked(port),
+                "active_sessions": backend_active_sessions.get(port, 0),
+                "exit_ip": backend_exit_ips[port]["ip"] if port in backend_exit_ips else None
+            }
+            for port in (WARP_POOL_CONFIG if ports is None else ports) if port in WARP_POOL_CONFIG
+        }
+
 def refresh_proxy_ip(backend_warp_port):
     """
     刷新指定后端WARP代理实例的IP地址。
@@ -130,193 +1217,1343 @@ def refresh_proxy_ip(backend_warp_port):
     idx = instance_config['id']
     
     logging.info(f"为端口 {backend_warp_port} (命名空间 {ns_name}) 请求IP刷新。")
-    
-    # 调用外部脚本刷新IP
+
+    if instance_config.get('node') is not None:
+        return _refresh_node_backend(backend_warp_port, instance_config)
+
+    refreshed, timings = refresh_instance_ip(backend_warp_port, ns_name, idx)
+    _record_refresh_timings(backend_warp_port, timings)
+    return refreshed
+
+def _record_refresh_timings(backend_warp_port, timings):
+    """记录一个后端最近一次IP刷新的各阶段耗时 (秒，保留三位小数)。"""
+    rounded = {phase: (round(value, 3) if isinstance(value, float) else value) for phase, value in timings.items()}
+    if isinstance(timings.get("total"), float):
+        _metrics_observe("warp_pool_refresh_duration_seconds", timings["total"], (("driver", timings.get("driver", REFRESH_DRIVER)),))
+    with refresh_cond:
+        refresh_timings[backend_warp_port] = rounded
+
+# --- 多节点联合 ---
+# 其他节点的后端由各节点的节点代理 (src/pool_agent.py) 提供: 管理器定期同步节点的后端列表，以虚拟端口登记到代理池。
+# 获取、验证、健康探测和出口IP查询直接连接节点地址上的后端端口，IP刷新通过节点代理执行。
+# 节点连续同步失败达到 POOL_NODE_FAILURE_THRESHOLD 次视为离线，其后端被排空移除; 节点恢复后重新加入。
+
+pool_nodes = {} # 节点名称 -> {"index", "url", "state", "consecutive_failures", "last_sync_at", "last_error", "advertise_host", "backends"} (由 pool_nodes_lock 保护)
+pool_nodes_lock = threading.Lock()
+
+def _pool_node_index(node_name):
+    """节点序号: 由节点名称决定，不随节点在 POOL_NODES 中的位置变化。"""
+    return zlib.crc32(node_name.encode('utf-8')) % POOL_NODE_INDEX_SLOTS + 1
+
+def _node_backend_port(node, backend_id):
+    """其他节点上实例的虚拟端口 = POOL_NODE_PORT_BASE + 节点序号 × POOL_NODE_PORT_STRIDE + 实例编号。"""
+    return POOL_NODE_PORT_BASE + node["index"] * POOL_NODE_PORT_STRIDE + backend_id
+
+def _parse_pool_nodes(nodes_spec):
+    """
+    解析 POOL_NODES ("名称=http://地址:端口,...")，返回 {节点名称: 节点状态}。
+    两个节点名称的序号相同时抛出 ValueError (它们的虚拟端口会重叠)，需要修改其中一个节点的名称。
+    """
+    nodes = {}
+    node_names_by_index = {}
+    for item in (item.strip() for item in nodes_spec.split(',') if item.strip()):
+        node_name, separator, agent_url = item.partition('=')
+        node_name, agent_url = node_name.strip(), agent_url.strip().rstrip('/')
+        parsed_url = urllib.parse.urlsplit(agent_url)
+        if not separator or not node_name or parsed_url.scheme not in ('http', 'https') or not parsed_url.hostname:
+            logging.warning(f"多节点: 忽略无效的节点配置 '{item}' (格式: 名称=http://地址:端口)。")
+            continue
+        if node_name in nodes:
+            logging.warning(f"多节点: 节点名称 '{node_name}' 重复，忽略 '{item}'。")
+            continue
+        node_index = _pool_node_index(node_name)
+        if node_index in node_names_by_index:
+            raise ValueError(f"节点 '{node_names_by_index[node_index]}' 和 '{node_name}' 的名称哈希到相同的节点序号 {node_index}，请修改其中一个节点的名称。")
+        node_names_by_index[node_index] = node_name
+        nodes[node_name] = {
+            "index": node_index, "url": agent_url, "state": "unknown", "consecutive_failures": 0,
+            "last_sync_at": None, "last_error": None, "advertise_host": None, "backends": []
+        }
+    return nodes
+
+def _node_agent_request(node, method, path, timeout):
+    """向节点代理发送请求并返回解析后的 JSON 响应。连接失败或返回错误状态码时抛出异常。"""
+    agent_request = urllib.request.Request(f"{node['url']}{path}", method=method, headers={"Authorization": f"Bearer {POOL_AGENT_TOKEN}"})
+    with urllib.request.urlopen(agent_request, timeout=timeout) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+def _node_advertise_host(node, payload):
+    """连接节点后端使用的地址。节点代理监听所有地址时不知道自己的外部地址，此时使用访问节点代理所用的主机名。"""
+    return payload.get("advertise_host") or urllib.parse.urlsplit(node["url"]).hostname
+
+def _node_backend_instances(node_name, node, payload):
+    """把节点代理返回的后端列表转换为代理池实例 (以虚拟端口标识，见 _node_backend_port)。"""
+    advertise_host = _node_advertise_host(node, payload)
+    instances = []
+    for backend in payload.get("backends", []):
+        backend_id = backend.get("id")
+        if not isinstance(backend_id, int) or not 0 <= backend_id < POOL_NODE_PORT_STRIDE or not isinstance(backend.get("port"), int):
+            logging.warning(f"多节点: 忽略节点 {node_name} 上编号或端口无效的后端 {backend}。")
+            continue
+        instances.append({
+            "port": _node_backend_port(node, backend_id),
+            "id": backend_id,
+            "namespace": backend.get("namespace"),
+            "node": node_name,
+            "host": advertise_host,
+            "node_port": backend["port"],
+            "refresh_policy": backend.get("refresh_policy")
+        })
+    return instances
+
+def _sync_pool_node(node_name):
+    """从节点代理同步一个节点的后端列表并与代理池对齐。连续失败达到阈值时排空移除该节点的全部后端。返回同步是否成功。"""
+    with pool_nodes_lock:
+        node = dict(pool_nodes[node_name])
     try:
-        # 获取脚本目录
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        manage_pool_script = os.path.join(script_dir, '..', 'manage_pool.sh')
-        # 转换为绝对路径
-        manage_pool_script = os.path.abspath(manage_pool_script)
-        
-        # 检查脚本是否存在
-        if not os.path.exists(manage_pool_script):
-            logging.error(f"管理脚本 {manage_pool_script} 不存在。")
-            return False
-        
-        # 构造命令
-        cmd = ['sudo', manage_pool_script, 'refresh-ip', ns_name, str(idx)]
-        logging.info(f"执行IP刷新命令: {' '.join(cmd)}")
-        
-        # 执行命令
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
-        if result.returncode == 0:
-            logging.info(f"端口 {backend_warp_port} ({ns_name}) 的IP刷新成功。")
-            return True
-        else:
-            logging.error(f"端口 {backend_warp_port} ({ns_name}) 的IP刷新失败。返回码: {result.returncode}, 错误: {result.stderr}")
-            return False
-    except subprocess.TimeoutExpired:
-        logging.error(f"端口 {backend_warp_port} ({ns_name}) 的IP刷新超时。")
+        payload = _node_agent_request(node, 'GET', '/backends', POOL_NODE_TIMEOUT)
+        instances = _node_backend_instances(node_name, node, payload)
+    except Exception as e:
+        with pool_nodes_lock:
+            node = pool_nodes[node_name]
+            node["consecutive_failures"] += 1
+            node["last_error"] = str(e)
+            was_down = node["state"] == 'down'
+            went_down = not was_down and node["consecutive_failures"] >= POOL_NODE_FAILURE_THRESHOLD
+            if went_down:
+                node["state"] = 'down'
+            consecutive_failures = node["consecutive_failures"]
+        if went_down:
+            changes = _reconcile_pool_config([], node=node_name)
+            logging.error(f"多节点: 节点 {node_name} ({node['url']}) 连续 {consecutive_failures} 次同步失败，视为离线，"
+                          f"排空移除其后端 {sorted(changes['removed'])}。最后一次错误: {e}")
+        elif not was_down:
+            logging.warning(f"多节点: 同步节点 {node_name} ({node['url']}) 失败 (连续 {consecutive_failures} 次): {e}")
+        return False
+
+    changes = _reconcile_pool_config(instances, node=node_name)
+    with pool_nodes_lock:
+        node = pool_nodes[node_name]
+        came_up = node["state"] != 'up'
+        node.update(state='up', consecutive_failures=0, last_sync_at=time.time(), last_error=None,
+                    advertise_host=_node_advertise_host(node, payload), backends=instances)
+    if came_up:
+        logging.info(f"多节点: 节点 {node_name} ({node['url']}) 在线，共 {len(instances)} 个后端。")
+    if changes["added"] or changes["resumed"] or changes["removed"]:
+        logging.info(f"多节点: 节点 {node_name} 新增 {changes['added']}, 取消移除 {changes['resumed']}, 移除 {sorted(changes['removed'])}。"
+                     f"当前后端WARP代理池大小: {len(WARP_POOL_CONFIG)}")
+    return True
+
+def _sync_pool_nodes():
+    """并发同步全部节点，离线节点的请求超时不影响其他节点。"""
+    with pool_nodes_lock:
+        node_names = list(pool_nodes)
+    if not node_names:
+        return
+    with ThreadPoolExecutor(max_workers=len(node_names), thread_name_prefix="node-sync") as executor:
+        list(executor.map(_sync_pool_node, node_names))
+
+def _pool_node_sync_loop():
+    """后台线程: 定期同步各节点的后端列表。"""
+    while True:
+        time.sleep(POOL_NODE_SYNC_INTERVAL)
+        _sync_pool_nodes()
+
+def _refresh_node_backend(backend_warp_port, instance_config):
+    """通过节点代理刷新其他节点上的后端IP。节点离线时直接返回失败 (其后端已在排空移除)。"""
+    node_name = instance_config["node"]
+    with pool_nodes_lock:
+        node = dict(pool_nodes[node_name]) if node_name in pool_nodes else None
+    if node is None or node["state"] == 'down':
+        logging.warning(f"多节点: 节点 {node_name} 离线，无法刷新端口 {backend_warp_port} 的IP。")
         return False
+    started_at = time.monotonic()
+    timings = {"driver": "agent"}
+    try:
+        result = _node_agent_request(node, 'POST', f"/backends/{instance_config['node_port']}/refresh", POOL_NODE_REFRESH_TIMEOUT)
     except Exception as e:
-        logging.error(f"端口 {backend_warp_port} ({ns_name}) 的IP刷新过程中发生错误: {e}")
+        timings["total"] = time.monotonic() - started_at
+        _record_refresh_timings(backend_warp_port, timings)
+        logging.error(f"多节点: 通过节点 {node_name} 刷新端口 {backend_warp_port} (节点端口 {instance_config['node_port']}) 的IP失败: {e}")
         return False
+    timings["total"] = time.monotonic() - started_at
+    if isinstance(result.get("timings"), dict):
+        timings["node"] = result["timings"]
+    _record_refresh_timings(backend_warp_port, timings)
+    if result.get("refreshed"):
+        logging.info(f"多节点: 节点 {node_name} 上端口 {backend_warp_port} (节点端口 {instance_config['node_port']}) 的IP刷新成功，耗时 {timings['total']:.2f}s。")
+        return True
+    logging.error(f"多节点: 节点 {node_name} 上端口 {backend_warp_port} (节点端口 {instance_config['node_port']}) 的IP刷新失败。")
+    return False
+
+def _pool_nodes_snapshot():
+    """返回各节点的同步状态和在代理池中的后端数量 (用于 /status)。"""
+    with proxy_lock:
+        node_backend_counts = {}
+        for instance_config in WARP_POOL_CONFIG.values():
+            node_name = instance_config.get("node")
+            node_backend_counts[node_name] = node_backend_counts.get(node_name, 0) + 1
+    with pool_nodes_lock:
+        nodes = {
+            node_name: {
+                "url": node["url"],
+                "state": node["state"],
+                "advertise_host": node["advertise_host"],
+                "consecutive_failures": node["consecutive_failures"],
+                "last_sync_at": node["last_sync_at"],
+                "last_error": node["last_error"],
+                "backends": node_backend_counts.get(node_name, 0)
+            }
+            for node_name, node in pool_nodes.items()
+        }
+    return {"prefer_local": PREFER_LOCAL_BACKENDS, "local_backends": node_backend_counts.get(None, 0), "nodes": nodes}
+
+# --- 出口IP索引 ---
+# 每个后端的当前出口IP和历史记录保存在内存中 (由 proxy_lock 保护)。IP刷新成功后查询新的出口IP，
+# 与其他后端的当前IP或最近被替换的IP重复时，由刷新调度器再次刷新，最多连续 EXIT_IP_MAX_REROLLS 次。
+
+def _fetch_backend_exit_ip(backend_warp_port):
+    """通过后端请求 EXIT_IP_TRACE_URL，返回 (出口IP, 数据中心)。失败时返回 (None, None)。"""
+    trace_url = urllib.parse.urlsplit(EXIT_IP_TRACE_URL)
+    use_tls = trace_url.scheme == 'https'
+    request_path = (trace_url.path or '/') + (f"?{trace_url.query}" if trace_url.query else '')
+    response = b''
+    backend_host, backend_connect_port = _backend_address(backend_warp_port)
+    try:
+        conn = socks.create_connection(
+            (trace_url.hostname, trace_url.port or (443 if use_tls else 80)),
+            proxy_type=socks.SOCKS5,
+            proxy_addr=backend_host,
+            proxy_port=backend_connect_port,
+            timeout=EXIT_IP_TRACE_TIMEOUT
+        )
+        try:
+            if use_tls:
+                conn = ssl.create_default_context().wrap_socket(conn, server_hostname=trace_url.hostname)
+            # 使用 HTTP/1.0 避免分块编码，响应在连接关闭时结束
+            conn.sendall(f"GET {request_path} HTTP/1.0\r\nHost: {trace_url.netloc}\r\nUser-Agent: warp-proxypool\r\n\r\n".encode("ascii"))
+            while len(response) < 65536:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    break
+                response += chunk
+        finally:
+            conn.close()
+    except Exception as e:
+        logging.warning(f"出口IP: 无法通过后端端口 {backend_warp_port} 请求 {EXIT_IP_TRACE_URL}: {e}")
+        return None, None
+
+    response_head, _, body = response.partition(b"\r\n\r\n")
+    status_line = response_head.split(b"\r\n", 1)[0]
+    if status_line.split(b" ")[1:2] != [b"200"]:
+        logging.warning(f"出口IP: 后端端口 {backend_warp_port} 的 trace 请求返回了非200响应: {status_line[:100]!r}")
+        return None, None
+    trace_fields = dict(
+        line.split("=", 1) for line in body.decode("utf-8", errors="replace").splitlines() if "=" in line
+    )
+    try:
+        exit_ip = str(ipaddress.ip_address(trace_fields.get("ip", "").strip()))
+    except ValueError:
+        logging.warning(f"出口IP: 后端端口 {backend_warp_port} 的 trace 响应中没有有效的 ip 字段。")
+        return None, None
+    return exit_ip, trace_fields.get("colo", "").strip() or None
+
+def _lookup_backend_exit_ip(backend_warp_port):
+    """查询一个后端的出口IP并计入统计，失败时返回 (None, None)。"""
+    exit_ip, colo = _fetch_backend_exit_ip(backend_warp_port)
+    with proxy_lock:
+        exit_ip_stats["lookups_total"] += 1
+        if exit_ip is None:
+            exit_ip_stats["lookup_failures_total"] += 1
+    return exit_ip, colo
+
+def _exit_ip_conflict_locked(port, exit_ip, now):
+    """
+    返回出口IP的冲突原因: 'live:<端口>' (与另一个后端的当前IP相同)、'recent' (最近被替换过，含本后端刷新前的IP)，
+    无冲突时返回 None。同时清理超出时间窗口的最近IP记录。调用方必须持有 proxy_lock。
+    """
+    for stale_ip in [ip for ip, replaced_at in recent_exit_ips.items() if now - replaced_at >= EXIT_IP_RECENT_WINDOW]:
+        del recent_exit_ips[stale_ip]
+    for other_port, entry in backend_exit_ips.items():
+        if other_port != port and entry["ip"] == exit_ip:
+            return f'live:{other_port}'
+    own_entry = backend_exit_ips.get(port)
+    if exit_ip in recent_exit_ips or (own_entry is not None and own_entry["ip"] == exit_ip):
+        return 'recent'
+    return None
 
-def _refresh_and_return_task(port_to_refresh):
+def _record_backend_exit_ip_locked(port, exit_ip, colo, now):
+    """把后端的出口IP记入索引，被替换的旧IP进入最近使用窗口。调用方必须持有 proxy_lock。"""
+    entry = backend_exit_ips.setdefault(port, {
+        "ip": None, "colo": None, "since": None, "checked_at": None, "history": deque(maxlen=EXIT_IP_HISTORY_SIZE)
+    })
+    if entry["ip"] != exit_ip:
+        if entry["ip"] is not None:
+            recent_exit_ips[entry["ip"]] = now
+        entry["history"].append((exit_ip, now))
+        entry["since"] = now
+    entry["ip"] = exit_ip
+    entry["colo"] = colo
+    entry["checked_at"] = now
+
+def _index_refreshed_exit_ip(port):
+    """
+    IP刷新并验证成功后查询新的出口IP。重复且未超过重刷上限时返回 'reroll' (端口不记录新IP)，
+    否则记入索引并返回 None。查询失败时不影响端口返回代理池。
+    """
+    exit_ip, colo = _lookup_backend_exit_ip(port)
+    if exit_ip is None:
+        return None
+    now = time.time()
+    with proxy_lock:
+        conflict = _exit_ip_conflict_locked(port, exit_ip, now)
+        if conflict is None:
+            exit_ip_rerolls.pop(port, None)
+            _record_backend_exit_ip_locked(port, exit_ip, colo, now)
+            return None
+        exit_ip_stats["duplicates_total"] += 1
+        rerolls = exit_ip_rerolls.get(port, 0)
+        if rerolls < EXIT_IP_MAX_REROLLS and port in WARP_POOL_CONFIG and port not in draining_proxies:
+            exit_ip_rerolls[port] = rerolls + 1
+            reroll = True
+        else:
+            exit_ip_rerolls.pop(port, None)
+            _record_backend_exit_ip_locked(port, exit_ip, colo, now)
+            reroll = False
+    if reroll:
+        logging.warning(f"出口IP: 后端端口 {port} 刷新后的出口IP {exit_ip} 重复 ({conflict})，将再次刷新 (第 {rerolls + 1}/{EXIT_IP_MAX_REROLLS} 次)。")
+        return 'reroll'
+    logging.warning(f"出口IP: 后端端口 {port} 的出口IP {exit_ip} 重复 ({conflict})，已达到重刷上限，仍将其返回代理池。")
+    return None
+
+def _index_backend_exit_ips(ports):
+    """查询一批新加入代理池的后端的出口IP并记入索引 (不触发重刷)，重复的IP只记录警告。"""
+    with ThreadPoolExecutor(max_workers=HEALTH_PROBE_CONCURRENCY, thread_name_prefix="exit-ip") as executor:
+        lookups = list(zip(ports, executor.map(_lookup_backend_exit_ip, ports)))
+    for port, (exit_ip, colo) in lookups:
+        if exit_ip is None:
+            continue
+        now = time.time()
+        with proxy_lock:
+            if port not in WARP_POOL_CONFIG:
+                continue
+            conflict = _exit_ip_conflict_locked(port, exit_ip, now)
+            if conflict is not None:
+                exit_ip_stats["duplicates_total"] += 1
+            _record_backend_exit_ip_locked(port, exit_ip, colo, now)
+        if conflict is not None:
+            logging.warning(f"出口IP: 后端端口 {port} 的出口IP {exit_ip} 重复 ({conflict})，将在下次IP刷新时更换。")
+        else:
+            logging.info(f"出口IP: 后端端口 {port} 的出口IP为 {exit_ip} ({colo})。")
+
+def _exit_ip_snapshot():
+    """返回出口IP索引的快照 (用于 /status)。"""
+    now = time.time()
+    with proxy_lock:
+        current_ips = [entry["ip"] for entry in backend_exit_ips.values() if entry["ip"] is not None]
+        return {
+            "backends": {
+                port: {
+                    "ip": entry["ip"],
+                    "colo": entry["colo"],
+                    "ip_age_seconds": round(now - entry["since"], 1) if entry["since"] is not None else None,
+                    "history": [ip for ip, _ in entry["history"]]
+                }
+                for port, entry in backend_exit_ips.items()
+            },
+            "distinct_ips": len(set(current_ips)),
+            "recent_ips": len(recent_exit_ips),
+            **exit_ip_stats
+        }
+
+def _refresh_and_return_task(port_to_refresh, final_attempt=True):
     """
-    在后台线程中刷新一个后端WARP代理的IP，验证其可用性，然后将其返回到可用代理池。
+    刷新一个后端WARP代理的IP，验证其可用性，然后将其返回到可用代理池。
     'port_to_refresh' 是一个后端WARP端口 (例如: 10800)。
+    刷新失败且 final_attempt 为 False 时端口不返回代理池，由刷新调度器退避后重试。
+    返回 True 表示IP刷新成功; 返回 'reroll' 表示新出口IP重复，端口不返回代理池，由刷新调度器立即再次刷新。
     """
     logging.info(f"后台任务: 开始为后端端口 {port_to_refresh} 刷新IP...")
     refreshed_successfully = refresh_proxy_ip(port_to_refresh)
     
     if not refreshed_successfully:
+        if not final_attempt:
+            logging.warning(f"后台任务: 端口 {port_to_refresh} 的IP刷新失败，将在退避后重试。")
+            return False
         logging.warning(f"后台任务: IP刷新失败，将端口 {port_to_refresh} 直接返回代理池以供后续重试。")
         with proxy_lock:
-            available_proxies.put(port_to_refresh)
-        return
+            _return_port_to_pool_locked(port_to_refresh)
+        return False
 
+    _reset_backend_usage(port_to_refresh)
     # IP刷新成功后，进行验证
     logging.info(f"后台任务: IP刷新成功，现在开始验证端口 {port_to_refresh} 的可用性。")
     is_valid = validate_proxy(port_to_refresh)
     
+    if is_valid and EXIT_IP_TRACE_URL and _index_refreshed_exit_ip(port_to_refresh) == 'reroll':
+        return 'reroll'
     if is_valid:
         with proxy_lock:
-            available_proxies.put(port_to_refresh)
+            _return_port_to_pool_locked(port_to_refresh)
         logging.info(f"后台任务: 后端端口 {port_to_refresh} 验证成功，已返回可用代理池。")
     else:
         # 如果验证失败，将代理端口重新放回队列的末尾，并记录错误。
         # 这可以防止代理池因暂时的网络问题而耗尽。
         logging.warning(f"后台任务: 后端端口 {port_to_refresh} 在IP刷新后未能通过验证。将端口放回队列末尾以供后续重试。")
         with proxy_lock:
-            available_proxies.put(port_to_refresh)
+            _return_port_to_pool_locked(port_to_refresh)
+    return True
 
-# --- API 认证装饰器 ---
-def require_token(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        token = None
-        if 'Authorization' in request.headers:
-            auth_header = request.headers['Authorization']
-            try:
-                token_type, token = auth_header.split()
-                if token_type.lower() != 'bearer':
-                    token = None # 不是 Bearer 令牌
-            except ValueError:
-                # Authorization 头格式不正确
-                pass
-        
-        if not token or token != app.config['API_SECRET_TOKEN']:
+# --- IP刷新调度器 ---
+# 所有IP刷新请求都进入同一个调度队列，由固定数量的工作线程执行，
+# 并受全局重连速率限制，避免突发的释放同时触发大量 warp-cli 断开/重连。
+
+def _refresh_backoff_seconds(consecutive_failures):
+    """根据连续失败次数计算指数退避时间(秒)。"""
+    if consecutive_failures <= 0:
+        return 0.0
+    return min(REFRESH_BACKOFF_BASE * (2 ** (consecutive_failures - 1)), REFRESH_BACKOFF_MAX)
+
+def schedule_refresh(port, priority=REFRESH_PRIORITY_NORMAL, delay=0.0):
+    """
+    将一个后端端口加入IP刷新调度队列。同一端口在队列中只保留一个任务 (取更高的优先级)。
+    端口在刷新完成前不在可用代理池中。
+    """
+    _ensure_refresh_workers_started()
+    with refresh_cond:
+        job = refresh_pending.get(port)
+        if job is not None:
+            job["priority"] = min(job["priority"], priority)
+        elif port in refresh_in_flight:
+            logging.warning(f"刷新调度: 端口 {port} 已在刷新中，忽略重复的刷新请求。")
+            return
+        else:
+            refresh_pending[port] = {
+                "priority": priority,
+                "enqueued_at": time.time(),
+                "not_before": time.time() + delay,
+                "attempt": 1
+            }
+        refresh_cond.notify()
+    logging.info(f"刷新调度: 端口 {port} 已加入刷新队列 (优先级 {priority})。")
+
+def _select_refresh_job_locked(now):
+    """
+    选出下一个可执行的刷新任务端口，没有就绪任务时返回 None。调用方必须持有 refresh_cond。
+    有请求在等待队列中时，优先刷新连续失败次数最少 (最可能尽快回到池中) 的后端。
+    """
+    demand = bool(pool_waiters)
+    best_port = None
+    best_key = None
+    for port, job in refresh_pending.items():
+        if job["not_before"] > now:
+            continue
+        failures = refresh_failures.get(port, 0) if demand else 0
+        job_key = (job["priority"], failures, job["enqueued_at"])
+        if best_key is None or job_key < best_key:
+            best_port, best_key = port, job_key
+    return best_port
+
+def _take_refresh_rate_token_locked(now):
+    """
+    从全局重连令牌桶中取出一个令牌。成功返回 0，否则返回需要等待的秒数。
+    调用方必须持有 refresh_cond。
+    """
+    if REFRESH_RATE_LIMIT_PER_MINUTE <= 0:
+        return 0.0
+    refill_rate = REFRESH_RATE_LIMIT_PER_MINUTE / 60.0
+    refresh_rate_bucket["tokens"] = min(
+        float(REFRESH_RATE_BURST),
+        refresh_rate_bucket["tokens"] + (now - refresh_rate_bucket["updated_at"]) * refill_rate
+    )
+    refresh_rate_bucket["updated_at"] = now
+    if refresh_rate_bucket["tokens"] >= 1.0:
+        refresh_rate_bucket["tokens"] -= 1.0
+        return 0.0
+    return (1.0 - refresh_rate_bucket["tokens"]) / refill_rate
+
+def _refresh_worker_loop():
+    """刷新工作线程: 按优先级取出就绪任务，在速率限制内执行刷新，失败时按退避重新排队。"""
+    while True:
+        with refresh_cond:
+            while True:
+                if refresh_paused:
+                    refresh_cond.wait()
+                    continue
+                now = time.time()
+                port = _select_refresh_job_locked(now)
+                if port is not None:
+                    token_wait = _take_refresh_rate_token_locked(now)
+                    if token_wait <= 0:
+                        break
+                    refresh_stats["rate_limited_waits_total"] += 1
+                    refresh_cond.wait(token_wait)
+                    continue
+                pending_deadlines = [job["not_before"] for job in refresh_pending.values()]
+                refresh_cond.wait(max(min(pending_deadlines) - now, 0.05) if pending_deadlines else None)
+            job = refresh_pending.pop(port)
+            refresh_in_flight[port] = time.time()
+
+        final_attempt = job["attempt"] >= REFRESH_MAX_ATTEMPTS
+        try:
+            refreshed = _refresh_and_return_task(port, final_attempt=final_attempt)
+        except Exception as e:
+            logging.error(f"刷新调度: 端口 {port} 的刷新任务发生未处理的错误: {e}")
+            refreshed = False
+            if final_attempt:
+                with proxy_lock:
+                    _return_port_to_pool_locked(port)
+
+        with refresh_cond:
+            refresh_in_flight.pop(port, None)
+            if refreshed == 'reroll':
+                # 出口IP重复: 不计为失败，保持原有尝试次数立即重新排队 (仍受全局速率限制)
+                refresh_failures.pop(port, None)
+                refresh_pending[port] = {
+                    "priority": job["priority"],
+                    "enqueued_at": job["enqueued_at"],
+                    "not_before": time.time(),
+                    "attempt": job["attempt"]
+                }
+                refresh_stats["exit_ip_rerolls_total"] += 1
+            elif refreshed:
+                refresh_failures.pop(port, None)
+                refresh_stats["completed_total"] += 1
+            else:
+                refresh_failures[port] = refresh_failures.get(port, 0) + 1
+                refresh_stats["failed_total"] += 1
+                if not final_attempt:
+                    backoff = _refresh_backoff_seconds(refresh_failures[port])
+                    refresh_pending[port] = {
+                        "priority": job["priority"],
+                        "enqueued_at": job["enqueued_at"],
+                        "not_before": time.time() + backoff,
+                        "attempt": job["attempt"] + 1
+                    }
+                    refresh_stats["retries_total"] += 1
+                    logging.info(f"刷新调度: 端口 {port} 将在 {backoff:.1f} 秒后进行第 {job['attempt'] + 1} 次刷新尝试。")
+            refresh_cond.notify_all()
+
+def _ensure_refresh_workers_started():
+    """按需启动固定数量的刷新工作线程 (只启动一次)。"""
+    global refresh_workers_started
+    with refresh_cond:
+        if refresh_workers_started:
+            return
+        refresh_workers_started = True
+    for worker_index in range(max(1, REFRESH_WORKERS)):
+        threading.Thread(target=_refresh_worker_loop, name=f"refresh-worker-{worker_index}", daemon=True).start()
+    logging.info(f"刷新调度: 已启动 {max(1, REFRESH_WORKERS)} 个刷新工作线程，全局速率上限 {REFRESH_RATE_LIMIT_PER_MINUTE} 次/分钟。")
+
+def _pause_refresh_workers(timeout):
+    """平滑重启: 刷新工作线程不再领取新任务，并等待进行中的刷新完成。返回超时后仍在刷新中的端口。"""
+    global refresh_paused
+    deadline = time.monotonic() + timeout
+    with refresh_cond:
+        refresh_paused = True
+        while refresh_in_flight and deadline > time.monotonic():
+            refresh_cond.wait(deadline - time.monotonic())
+        return sorted(refresh_in_flight)
+
+def _resume_refresh_workers():
+    """平滑重启被放弃: 恢复执行刷新任务。"""
+    global refresh_paused
+    with refresh_cond:
+        refresh_paused = False
+        refresh_cond.notify_all()
+
+def _refresh_scheduler_snapshot():
+    """返回刷新调度器的队列深度、进行中的刷新和统计信息。"""
+    now = time.time()
+    with refresh_cond:
+        return {
+            "workers": max(1, REFRESH_WORKERS),
+            "rate_limit_per_minute": REFRESH_RATE_LIMIT_PER_MINUTE,
+            "queue_depth": len(refresh_pending),
+            "queued_ports": sorted(refresh_pending),
+            "in_flight": {port: round(now - started_at, 1) for port, started_at in refresh_in_flight.items()},
+            "consecutive_failures": dict(refresh_failures),
+            "driver": REFRESH_DRIVER,
+            "last_refresh_timings": dict(refresh_timings),
+            **refresh_stats
+        }
+
+# --- API租约 ---
+# 租约按到期时间保存在最小堆中，回收线程只需查看堆顶，等待时间即为最近一个租约的剩余有效期。
+# 租约锁 lease_cond 与 proxy_lock 从不嵌套持有。
+
+def _parse_lease_ttl(raw_ttl):
+    """解析 ?ttl= 参数 (秒)，未提供时返回默认值，超过上限时截断，无效时返回 None。"""
+    if raw_ttl is None:
+        return LEASE_DEFAULT_TTL
+    try:
+        ttl = float(raw_ttl)
+    except ValueError:
+        return None
+    if not math.isfinite(ttl) or ttl <= 0: # NaN 到期时间会破坏 lease_heap 的排序
+        return None
+    return min(ttl, LEASE_MAX_TTL)
+
+def _create_lease(lease_id, port, ttl, client_ip):
+    """为API获取的后端端口登记租约，返回到期时间。"""
+    now = time.time()
+    expires_at = now + ttl
+    with lease_cond:
+        api_leases[lease_id] = {"port": port, "ttl": ttl, "expires_at": expires_at, "client_ip": client_ip, "acquired_at": now}
+        heapq.heappush(lease_heap, (expires_at, lease_id))
+        lease_stats["granted_total"] += 1
+        if lease_heap[0][1] == lease_id:
+            # 新租约成为最早到期的租约，唤醒回收线程重新计算等待时间
+            lease_cond.notify()
+    _ensure_lease_reaper_started()
+    return expires_at
+
+def _renew_lease(lease_id, ttl=None):
+    """续约: 从现在起延长 ttl 秒 (默认沿用租约原有的有效期)。租约不存在时返回 None。"""
+    with lease_cond:
+        lease = api_leases.get(lease_id)
+        if lease is None:
+            return None
+        if ttl is not None:
+            lease["ttl"] = ttl
+        lease["expires_at"] = time.time() + lease["ttl"]
+        heapq.heappush(lease_heap, (lease["expires_at"], lease_id))
+        lease_stats["renewed_total"] += 1
+        # 频繁续约会留下大量过时条目，超过一定比例时重建堆
+        if len(lease_heap) > 2 * len(api_leases) + 64:
+            lease_heap[:] = [(info["expires_at"], heap_lease_id) for heap_lease_id, info in api_leases.items()]
+            heapq.heapify(lease_heap)
+        return dict(lease)
+
+def _drop_lease(lease_id):
+    """后端被正常释放时删除其租约 (堆中的条目在弹出时丢弃)。"""
+    if lease_id is None:
+        return None
+    with lease_cond:
+        lease = api_leases.pop(lease_id, None)
+        if lease is not None:
+            lease_stats["released_total"] += 1
+        return lease
+
+def _lease_port(lease_id):
+    """返回租约对应的后端端口，租约不存在时返回 None。"""
+    with lease_cond:
+        lease = api_leases.get(lease_id)
+        return lease["port"] if lease is not None else None
+
+def _lease_ports(lease_ids):
+    """批量查询租约对应的后端端口，返回 {租约ID: 端口}，不存在的租约对应 None。"""
+    with lease_cond:
+        return {lease_id: (api_leases[lease_id]["port"] if lease_id in api_leases else None) for lease_id in lease_ids}
+
+def _reclaim_expired_lease(lease_id, lease):
+    """回收一个过期租约的后端端口并交给IP刷新流程。端口已被释放或重新分配时不做处理。"""
+    port = lease["port"]
+    with proxy_lock:
+        proxy_info = in_use_proxies.get(port)
+        if proxy_info is None or proxy_info.get("lease_id") != lease_id:
+            return
+        in_use_proxies.pop(port)
+        _record_backend_usage_locked(port)
+    logging.warning(f"API租约: 客户端 {lease['client_ip']} 的租约 {lease_id} (后端端口 {port}) 已过期未续约，回收端口并安排IP刷新。")
+    schedule_refresh(port)
+
+def _pop_expired_leases_locked(now):
+    """从 lease_heap 中弹出在 now 之前到期的租约并删除，返回 [(租约ID, 租约)]。调用方必须持有 lease_cond。"""
+    expired_leases = []
+    while lease_heap and lease_heap[0][0] <= now:
+        expires_at, lease_id = heapq.heappop(lease_heap)
+        lease = api_leases.get(lease_id)
+        # 已释放或已续约的租约留下的条目直接丢弃
+        if lease is not None and lease["expires_at"] == expires_at:
+            del api_leases[lease_id]
+            lease_stats["expired_total"] += 1
+            expired_leases.append((lease_id, lease))
+    return expired_leases
+
+def _lease_reaper_loop():
+    """等待最早到期的租约，回收所有已过期的租约。"""
+    while True:
+        with lease_cond:
+            now = time.time()
+            expired_leases = _pop_expired_leases_locked(now)
+            if not expired_leases:
+                lease_cond.wait(lease_heap[0][0] - now if lease_heap else None)
+                continue
+        for lease_id, lease in expired_leases:
+            try:
+                _reclaim_expired_lease(lease_id, lease)
+            except Exception as e_reclaim:
+                logging.error(f"API租约: 回收租约 {lease_id} 时出错: {e_reclaim}")
+
+def _ensure_lease_reaper_started():
+    """按需启动租约回收线程 (只启动一次)。"""
+    global lease_reaper_started
+    with lease_cond:
+        if lease_reaper_started:
+            return
+        lease_reaper_started = True
+    threading.Thread(target=_lease_reaper_loop, name="lease-reaper", daemon=True).start()
+
+def _lease_snapshot():
+    """返回租约数量和统计信息 (用于 /status 和 /metrics)。"""
+    now = time.time()
+    with lease_cond:
+        return {
+            "active": len(api_leases),
+            "next_expiry_in_seconds": round(min(lease["expires_at"] for lease in api_leases.values()) - now, 1) if api_leases else None,
+            **lease_stats
+        }
+
+# --- API 认证装饰器 ---
+def require_token(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = None
+        if 'Authorization' in request.headers:
+            auth_header = request.headers['Authorization']
+            try:
+                token_type, token = auth_header.split()
+                if token_type.lower() != 'bearer':
+                    token = None # 不是 Bearer 令牌
+            except ValueError:
+                # Authorization 头格式不正确
+                pass
+        
+        if not token or token != app.config['API_SECRET_TOKEN']:
             logging.warning(f"API 认证失败: 来自 {request.remote_addr} 的请求缺少或令牌不正确。")
             return jsonify({"error": "需要有效的 Bearer 令牌"}), 401
         
         return f(*args, **kwargs)
     return decorated_function
 
+def _parse_acquire_args():
+    """解析 /acquire 类接口的 ?wait= 和 ?ttl= 参数，返回 (等待秒数, 租约有效期, 错误信息或 None)。"""
+    try:
+        wait_seconds = float(request.args.get('wait', 0))
+    except ValueError:
+        return None, None, "参数 'wait' 必须是秒数"
+    if not math.isfinite(wait_seconds): # float() 接受 'nan' 和 'inf'
+        return None, None, "参数 'wait' 必须是秒数"
+    lease_ttl = _parse_lease_ttl(request.args.get('ttl'))
+    if lease_ttl is None:
+        return None, None, "参数 'ttl' 必须是正的秒数"
+    return min(max(wait_seconds, 0.0), ACQUIRE_MAX_WAIT), lease_ttl, None
+
+def _parse_batch_mode():
+    """解析批量接口的 ?mode= 参数: 'all' (默认，全部成功或全部不做) 返回 True，'partial' (尽力而为) 返回 False，无效时返回 None。"""
+    mode = request.args.get('mode', 'all').strip().lower()
+    return {'all': True, 'partial': False}.get(mode)
+
+def _client_facing_socks_host():
+    """返回告知客户端的中央SOCKS5服务器地址: 监听所有地址时使用客户端访问API所用的主机名。"""
+    if SOCKS_SERVER_HOST != '0.0.0.0':
+        return SOCKS_SERVER_HOST
+    return request.host.split(':')[0]
+
+def _api_in_use_info(client_facing_socks_host, lease_id):
+    """构造API获取的后端在 in_use_proxies 中的登记信息模板。"""
+    return {
+        "type": "api_acquired",
+        "api_client_ip": request.remote_addr,
+        "central_socks_server_advertised": f"{client_facing_socks_host}:{SOCKS_SERVER_PORT}",
+        "lease_id": lease_id,
+    }
+
+def _acquire_failure_message(failure_reason, wait_seconds):
+    error_messages = {
+        'empty': "没有可用的后端代理",
+        'queue_full': "没有可用的后端代理，且等待队列已满",
+        'timeout': f"在 {wait_seconds:.1f} 秒内没有可用的后端代理",
+        'reloading': "服务正在平滑重启，请稍后重试",
+    }
+    return error_messages.get(failure_reason, "没有可用的后端代理")
+
 @app.route('/acquire', methods=['GET'])
 @require_token
 def acquire_proxy():
     """
     获取一个后端WARP端口。客户端应使用返回的中央SOCKS5服务器地址。
-    返回中央SOCKS5服务器地址和作为释放凭证的后端端口号。
+    返回中央SOCKS5服务器地址、作为释放凭证的后端端口号和租约ID。
+    租约有效期由 ?ttl= 指定 (默认 LEASE_DEFAULT_TTL)，需在到期前调用 /renew/<租约ID> 续约。
     """
-    with proxy_lock:
-        if available_proxies.empty():
-            logging.warning(f"API /acquire: 没有可用的后端代理给 {request.remote_addr}")
-            return jsonify({"error": "没有可用的后端代理"}), 503
-        
-        backend_port_acquired = available_proxies.get()
-        
-        client_facing_socks_host = request.host.split(':')[0]
-        if SOCKS_SERVER_HOST != '0.0.0.0':
-            client_facing_socks_host = SOCKS_SERVER_HOST
-
-        in_use_proxies[backend_port_acquired] = {
-            "type": "api_acquired",
-            "acquired_at": time.time(),
-            "api_client_ip": request.remote_addr,
-            "central_socks_server_advertised": f"{client_facing_socks_host}:{SOCKS_SERVER_PORT}",
-            "backend_port_in_use": backend_port_acquired
+    wait_seconds, lease_ttl, error_message = _parse_acquire_args()
+    if error_message:
+        return jsonify({"error": error_message}), 400
+
+    client_facing_socks_host = _client_facing_socks_host()
+    lease_id = secrets.token_urlsafe(18)
+    in_use_info = _api_in_use_info(client_facing_socks_host, lease_id)
+    backend_port_acquired, failure_reason = _acquire_backend_port(in_use_info, "backend_port_in_use", wait_seconds=wait_seconds)
+    if backend_port_acquired is None:
+        logging.warning(f"API /acquire: 没有可用的后端代理给 {request.remote_addr} (原因: {failure_reason}, 等待 {wait_seconds:.1f} 秒)")
+        return jsonify({"error": _acquire_failure_message(failure_reason, wait_seconds)}), 503
+
+    lease_expires_at = _create_lease(lease_id, backend_port_acquired, lease_ttl, request.remote_addr)
+    logging.info(f"API /acquire: 后端WARP端口 {backend_port_acquired} 已被 {request.remote_addr} 获取 (租约 {lease_id}, 有效期 {lease_ttl:.0f} 秒)。 "
+                f"客户端应使用中央SOCKS服务: {client_facing_socks_host}:{SOCKS_SERVER_PORT}")
+
+    return jsonify({
+        "proxy_to_use": f"socks5://{client_facing_socks_host}:{SOCKS_SERVER_PORT}",
+        "backend_port_token_for_release": backend_port_acquired,
+        "lease_id": lease_id,
+        "lease_ttl_seconds": lease_ttl,
+        "lease_expires_at": lease_expires_at,
+        "message": f"请连接到中央SOCKS5服务器 '{client_facing_socks_host}:{SOCKS_SERVER_PORT}'。 "
+                   f"调用 /release 接口时请使用 'backend_port_token_for_release' ({backend_port_acquired}) 或租约ID，"
+                   f"并在 {lease_ttl:.0f} 秒内调用 /renew/{lease_id} 续约，否则后端将被回收。"
+    })
+
+@app.route('/acquire/batch', methods=['POST'])
+@require_token
+def acquire_proxy_batch():
+    """
+    一次获取多个后端WARP端口，每个端口各有独立的租约。?count= 指定数量 (最多 API_BATCH_MAX)，
+    ?wait= 和 ?ttl= 同 /acquire。?mode=all (默认) 时在等待截止前未能获取全部端口则一个也不分配;
+    ?mode=partial 时返回截止前获取到的所有端口。
+    """
+    try:
+        count = int(request.args.get('count', ''))
+    except ValueError:
+        count = 0
+    if not 1 <= count <= API_BATCH_MAX:
+        return jsonify({"error": f"参数 'count' 必须是 1 到 {API_BATCH_MAX} 之间的整数"}), 400
+    all_or_nothing = _parse_batch_mode()
+    if all_or_nothing is None:
+        return jsonify({"error": "参数 'mode' 必须是 'all' 或 'partial'"}), 400
+    wait_seconds, lease_ttl, error_message = _parse_acquire_args()
+    if error_message:
+        return jsonify({"error": error_message}), 400
+
+    client_facing_socks_host = _client_facing_socks_host()
+    lease_ids = [secrets.token_urlsafe(18) for _ in range(count)]
+    in_use_infos = [_api_in_use_info(client_facing_socks_host, lease_id) for lease_id in lease_ids]
+    ports, failure_reason = _acquire_backend_ports_batch(in_use_infos, "backend_port_in_use", wait_seconds, all_or_nothing)
+    leases = [
+        {
+            "lease_id": lease_id,
+            "backend_port_token_for_release": port,
+            "lease_expires_at": _create_lease(lease_id, port, lease_ttl, request.remote_addr)
         }
-        logging.info(f"API /acquire: 后端WARP端口 {backend_port_acquired} 已被 {request.remote_addr} 获取。 "
-                    f"客户端应使用中央SOCKS服务: {client_facing_socks_host}:{SOCKS_SERVER_PORT}")
-        
-        return jsonify({
-            "proxy_to_use": f"socks5://{client_facing_socks_host}:{SOCKS_SERVER_PORT}",
-            "backend_port_token_for_release": backend_port_acquired,
-            "message": f"请连接到中央SOCKS5服务器 '{client_facing_socks_host}:{SOCKS_SERVER_PORT}'。 "
-                       f"调用 /release 接口时请使用 'backend_port_token_for_release' ({backend_port_acquired})。"
-        })
+        for lease_id, port in zip(lease_ids, ports) if port is not None
+    ]
+    if not leases:
+        logging.warning(f"API /acquire/batch: 无法为 {request.remote_addr} 获取 {count} 个后端代理 (原因: {failure_reason}, 等待 {wait_seconds:.1f} 秒)")
+        return jsonify({"error": _acquire_failure_message(failure_reason, wait_seconds), "requested": count, "granted": 0}), 503
+
+    _metrics_inc("warp_pool_api_batch_ports_total", (("operation", "acquire"),), len(leases))
+    logging.info(f"API /acquire/batch: {request.remote_addr} 获取了 {len(leases)}/{count} 个后端WARP端口 "
+                 f"{[lease['backend_port_token_for_release'] for lease in leases]} (租约有效期 {lease_ttl:.0f} 秒)。")
+    return jsonify({
+        "proxy_to_use": f"socks5://{client_facing_socks_host}:{SOCKS_SERVER_PORT}",
+        "requested": count,
+        "granted": len(leases),
+        "lease_ttl_seconds": lease_ttl,
+        "leases": leases
+    })
 
 @app.route('/release/<int:backend_port_token>', methods=['POST'])
 @require_token
 def release_proxy(backend_port_token):
     """
-    释放一个先前通过API获取的后端WARP代理 (由 backend_port_token 指定)
-    并在后台线程中启动IP刷新。
+    释放一个先前通过API获取的后端WARP代理 (由 backend_port_token 指定)。
+    是否在后台刷新IP由刷新策略决定，可通过 ?refresh=<策略> 覆盖本次释放 (例如 ?refresh=never)。
     """
     logging.info(f"API /release: 来自 {request.remote_addr} 的请求，释放后端端口凭证 {backend_port_token}。")
+    return _release_api_backend(backend_port_token)
+
+@app.route('/release/<lease_id>', methods=['POST'])
+@require_token
+def release_proxy_by_lease(lease_id):
+    """按租约ID释放一个通过API获取的后端WARP代理，参数同 /release/<backend_port_token>。"""
+    logging.info(f"API /release: 来自 {request.remote_addr} 的请求，释放租约 {lease_id}。")
+    backend_port_token = _lease_port(lease_id)
+    if backend_port_token is None:
+        return jsonify({"error": f"租约 {lease_id} 不存在或已过期"}), 404
+    return _release_api_backend(backend_port_token)
+
+def _parse_release_policy_override():
+    """解析释放接口的 ?refresh= 参数，返回 (策略或 None, 错误信息或 None)。"""
+    if not request.args.get('refresh'):
+        return None, None
+    policy_override = _parse_refresh_policy(request.args.get('refresh'))
+    if policy_override is None:
+        return None, f"无效的刷新策略: {request.args.get('refresh')}"
+    return policy_override, None
+
+def _release_in_use_port_locked(backend_port_token, policy_override):
+    """
+    把一个已登记的后端端口移出 in_use_proxies，按刷新策略直接放回代理池或留待刷新。
+    返回 (登记信息, 是否需要刷新)。调用方必须持有 proxy_lock 并已确认端口在使用中。
+    """
+    proxy_info = in_use_proxies.pop(backend_port_token)
+    _record_backend_usage_locked(backend_port_token)
+    needs_refresh = _backend_needs_refresh_locked(backend_port_token, policy=policy_override)
+    if not needs_refresh:
+        _return_port_to_pool_locked(backend_port_token)
+    return proxy_info, needs_refresh
+
+def _release_api_backend(backend_port_token):
+    """释放一个API获取的后端端口并删除其租约，按刷新策略决定是否刷新IP。返回 Flask 响应。"""
+    policy_override, error_message = _parse_release_policy_override()
+    if error_message:
+        return jsonify({"error": error_message}), 400
+
     with proxy_lock:
-        if backend_port_token not in in_use_proxies:
-            logging.warning(f"API /release: 在 'in_use_proxies' 中未找到后端端口凭证 {backend_port_token} (请求来源: {request.remote_addr})。")
-            return jsonify({"error": f"后端端口凭证 {backend_port_token} 未在使用或无效"}), 400
-        
-        proxy_info = in_use_proxies.pop(backend_port_token)
-        usage_duration = time.time() - proxy_info.get("acquired_at", time.time())
-        logging.info(f"API /release: 后端端口 {backend_port_token} 已被 {request.remote_addr} 释放。占用时长: {usage_duration:.2f} 秒。")
+        released = backend_port_token in in_use_proxies
+        if released:
+            proxy_info, needs_refresh = _release_in_use_port_locked(backend_port_token, policy_override)
+    # 响应在锁外构造，避免序列化期间阻塞代理池
+    if not released:
+        logging.warning(f"API /release: 在 'in_use_proxies' 中未找到后端端口凭证 {backend_port_token} (请求来源: {request.remote_addr})。")
+        return jsonify({"error": f"后端端口凭证 {backend_port_token} 未在使用或无效"}), 400
+    usage_duration = time.time() - proxy_info.get("acquired_at", time.time())
+    logging.info(f"API /release: 后端端口 {backend_port_token} 已被 {request.remote_addr} 释放。占用时长: {usage_duration:.2f} 秒。")
+    _drop_lease(proxy_info.get("lease_id"))
 
-    threading.Thread(target=_refresh_and_return_task, args=(backend_port_token,)).start()
-    logging.info(f"API /release: 已为后端端口 {backend_port_token} 启动后台IP刷新任务。")
+    if not needs_refresh:
+        logging.info(f"API /release: 按刷新策略无需刷新，后端端口 {backend_port_token} 已直接返回代理池。")
+        return jsonify({"status": f"后端端口 {backend_port_token} 已释放并直接返回代理池 (未刷新IP)"})
+
+    schedule_refresh(backend_port_token)
+    logging.info(f"API /release: 已为后端端口 {backend_port_token} 安排后台IP刷新任务。")
     
     return jsonify({"status": f"已为后端端口 {backend_port_token} 发起释放和IP刷新流程"})
 
+@app.route('/release/batch', methods=['POST'])
+@require_token
+def release_proxy_batch():
+    """
+    一次释放多个API获取的后端WARP代理。请求体为 JSON: {"lease_ids": [...], "backend_ports": [...]}，两者可任选其一或同时提供。
+    ?refresh= 同 /release。?mode=all (默认) 时只要有一个凭证无效就一个也不释放; ?mode=partial 时释放所有有效的凭证并列出无效的凭证。
+    """
+    all_or_nothing = _parse_batch_mode()
+    if all_or_nothing is None:
+        return jsonify({"error": "参数 'mode' 必须是 'all' 或 'partial'"}), 400
+    policy_override, error_message = _parse_release_policy_override()
+    if error_message:
+        return jsonify({"error": error_message}), 400
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({"error": "请求体必须是包含 'lease_ids' 或 'backend_ports' 的 JSON 对象"}), 400
+    lease_ids = payload.get('lease_ids') or []
+    backend_ports = payload.get('backend_ports') or []
+    if (not isinstance(lease_ids, list) or not isinstance(backend_ports, list)
+            or not all(isinstance(lease_id, str) for lease_id in lease_ids)
+            or not all(isinstance(port, int) and not isinstance(port, bool) for port in backend_ports)):
+        return jsonify({"error": "'lease_ids' 必须是字符串列表，'backend_ports' 必须是整数列表"}), 400
+    if not 1 <= len(lease_ids) + len(backend_ports) <= API_BATCH_MAX:
+        return jsonify({"error": f"每次最多释放 {API_BATCH_MAX} 个，且至少提供一个凭证"}), 400
+
+    # 凭证 -> 后端端口; 租约不存在时为 None
+    credentials = _lease_ports(lease_ids)
+    credentials.update({port: port for port in backend_ports})
+
+    with proxy_lock:
+        invalid = [credential for credential, port in credentials.items() if port not in in_use_proxies]
+        released = {}
+        if not (invalid and all_or_nothing):
+            for port in dict.fromkeys(port for port in credentials.values() if port in in_use_proxies):
+                released[port] = _release_in_use_port_locked(port, policy_override)
+    if invalid and all_or_nothing:
+        logging.warning(f"API /release/batch: 来自 {request.remote_addr} 的请求包含 {len(invalid)} 个无效凭证，未释放任何后端。")
+        return jsonify({"error": "部分凭证不存在、已过期或未在使用，未释放任何后端", "invalid": invalid}), 400
+
+    refreshed_ports = []
+    for port, (proxy_info, needs_refresh) in released.items():
+        _drop_lease(proxy_info.get("lease_id"))
+        if needs_refresh:
+            schedule_refresh(port)
+            refreshed_ports.append(port)
+    if released:
+        _metrics_inc("warp_pool_api_batch_ports_total", (("operation", "release"),), len(released))
+    logging.info(f"API /release/batch: {request.remote_addr} 释放了 {len(released)} 个后端端口 {sorted(released)}，"
+                 f"其中 {len(refreshed_ports)} 个安排了IP刷新，{len(invalid)} 个凭证无效。")
+    return jsonify({
+        "released": sorted(released),
+        "refreshing": sorted(refreshed_ports),
+        "invalid": invalid
+    })
+
+@app.route('/renew/<lease_id>', methods=['POST'])
+@require_token
+def renew_lease(lease_id):
+    """为一个API租约续约。可选参数 ?ttl= 指定新的有效期 (秒)，默认沿用原有效期。"""
+    lease_ttl = None
+    if request.args.get('ttl') is not None:
+        lease_ttl = _parse_lease_ttl(request.args.get('ttl'))
+        if lease_ttl is None:
+            return jsonify({"error": "参数 'ttl' 必须是正的秒数"}), 400
+    lease = _renew_lease(lease_id, lease_ttl)
+    if lease is None:
+        logging.warning(f"API /renew: 来自 {request.remote_addr} 的续约请求，租约 {lease_id} 不存在或已过期。")
+        return jsonify({"error": f"租约 {lease_id} 不存在或已过期"}), 404
+    return jsonify({
+        "lease_id": lease_id,
+        "backend_port_token_for_release": lease["port"],
+        "lease_ttl_seconds": lease["ttl"],
+        "lease_expires_at": lease["expires_at"]
+    })
+
+@app.route('/admin/backends', methods=['GET'])
+@require_token
+def list_backends():
+    """列出所有已登记的后端及其管理状态。"""
+    return jsonify({"backends": _backend_admin_snapshot()})
+
+@app.route('/admin/backends', methods=['POST'])
+@require_token
+def add_backends():
+    """
+    向运行中的代理池添加后端。请求体为一个实例对象或实例列表，格式同 warp_pool_config.json
+    ({"id", "namespace", "port"}，可选 "refresh_policy")。正在移除的同端口后端会取消移除。
+    """
+    payload = request.get_json(silent=True)
+    instances = payload if isinstance(payload, list) else [payload]
+    if not instances or not all(isinstance(instance, dict) and isinstance(instance.get('port'), int) for instance in instances):
+        return jsonify({"error": "请求体必须是包含整数 'port' 字段的实例对象或实例列表"}), 400
+    with proxy_lock:
+        existing_ports = set(WARP_POOL_CONFIG)
+    new_instances = [instance for instance in instances if instance['port'] not in existing_ports]
+    if new_instances:
+        initialize_proxy_pool_from_config(new_instances)
+    resumed = [instance['port'] for instance in instances if instance['port'] in existing_ports and _resume_backend(instance['port'])]
+    logging.info(f"API /admin/backends: {request.remote_addr} 添加后端 {[instance['port'] for instance in new_instances]}，取消移除 {resumed}。")
+    return jsonify({
+        "added": [instance['port'] for instance in new_instances],
+        "resumed": resumed,
+        "backends": _backend_admin_snapshot([instance['port'] for instance in instances])
+    })
+
+@app.route('/admin/backends/<int:backend_port>', methods=['GET'])
+@require_token
+def get_backend(backend_port):
+    """查询一个后端的管理状态。后端已被移除时返回 404。"""
+    snapshot = _backend_admin_snapshot([backend_port])
+    if backend_port not in snapshot:
+        return jsonify({"error": f"后端端口 {backend_port} 未登记"}), 404
+    return jsonify(snapshot[backend_port])
+
+@app.route('/admin/backends/<int:backend_port>', methods=['DELETE'])
+@require_token
+def remove_backend(backend_port):
+    """排空并移除一个后端: 立即停止分配新会话，已有的中继和租约结束后从代理池移除。"""
+    state = _drain_backend(backend_port, remove=True)
+    if state is None:
+        return jsonify({"error": f"后端端口 {backend_port} 未登记"}), 404
+    logging.info(f"API /admin/backends: {request.remote_addr} 移除后端端口 {backend_port}，当前状态: {state}。")
+    return jsonify({"port": backend_port, "state": state})
+
+@app.route('/admin/backends/<int:backend_port>/drain', methods=['POST'])
+@require_token
+def drain_backend(backend_port):
+    """排空一个后端: 停止分配新会话，已有的中继和租约继续使用直到结束，后端保留登记。"""
+    state = _drain_backend(backend_port)
+    if state is None:
+        return jsonify({"error": f"后端端口 {backend_port} 未登记"}), 404
+    logging.info(f"API /admin/backends: {request.remote_addr} 排空后端端口 {backend_port}，当前状态: {state}。")
+    return jsonify({"port": backend_port, "state": state})
+
+@app.route('/admin/backends/<int:backend_port>/resume', methods=['POST'])
+@require_token
+def resume_backend(backend_port):
+    """取消一个后端的排空或移除，使其重新接受新会话。"""
+    if not _resume_backend(backend_port):
+        return jsonify({"error": f"后端端口 {backend_port} 未登记或未处于排空状态"}), 404
+    return jsonify(_backend_admin_snapshot([backend_port]).get(backend_port, {}))
+
+@app.route('/admin/reload', methods=['POST'])
+@require_token
+def reload_pool_config():
+    """重新读取 warp_pool_config.json 并与运行中的代理池对齐。"""
+    try:
+        config_list = load_pool_config_file()
+    except Exception as e:
+        logging.error(f"API /admin/reload: 无法加载配置文件 '{WARP_POOL_CONFIG_FILE}': {e}")
+        return jsonify({"error": f"无法加载配置文件: {e}"}), 500
+    changes = _reconcile_pool_config(config_list)
+    logging.info(f"API /admin/reload: {request.remote_addr} 重新加载配置，新增 {changes['added']}, "
+                 f"取消移除 {changes['resumed']}, 移除 {changes['removed']}。")
+    return jsonify(changes)
+
+# /status 无需认证。粘性会话键 (客户端的SOCKS用户名) 和租约ID (持有者凭它续约或释放租约) 只以带密钥的散列显示:
+# 同一进程内同一个值的散列相同，便于对照，但无法由散列反推或猜测原值
+status_redaction_key = secrets.token_bytes(16)
+
+def _status_redacted(value):
+    return "hmac:" + hmac.new(status_redaction_key, str(value).encode('utf-8'), 'sha256').hexdigest()[:12]
+
 @app.route('/status', methods=['GET'])
 def pool_status():
     """获取后端WARP代理池状态以及中央SOCKS服务器信息"""
+    refresh_scheduler_snapshot = _refresh_scheduler_snapshot()
+    refresh_policy_snapshot = _refresh_policy_snapshot()
+    sticky_sessions_snapshot = {
+        _status_redacted(session_key): session for session_key, session in _sticky_sessions_snapshot().items()
+    }
+    backend_health_snapshot = _backend_health_snapshot()
+    lease_snapshot = _lease_snapshot()
+    # 持锁期间只复制原始数据，格式化在锁外进行
     with proxy_lock:
-        current_in_use_details = {}
-        for port, info in in_use_proxies.items():
-            info_copy = info.copy()
-            if "client_address_on_socks_server" in info_copy and isinstance(info_copy["client_address_on_socks_server"], tuple):
-                 info_copy["client_address_on_socks_server"] = f"{info_copy['client_address_on_socks_server'][0]}:{info_copy['client_address_on_socks_server'][1]}"
-            current_in_use_details[port] = info_copy
-
-        return jsonify({
-            "central_socks5_server_listening_on": f"中央SOCKS5服务器监听地址: {SOCKS_SERVER_HOST}:{SOCKS_SERVER_PORT}",
-            "backend_warp_pool_size": f"后端WARP代理池大小: {len(WARP_POOL_CONFIG)}",
-            "available_backend_ports_count": f"可用后端代理数量: {available_proxies.qsize()}",
-            "available_backend_ports_list": f"可用后端代理端口列表: {list(available_proxies.queue)}",
-            "in_use_backend_ports_count": f"正在使用的后端代理数量: {len(in_use_proxies)}",
-            "in_use_backend_ports_details": f"正在使用的后端代理详情: {current_in_use_details}"
-        })
+        available_ports = list(available_proxies.queue)
+        in_use_snapshot = {port: info.copy() for port, info in in_use_proxies.items()}
+        wait_queue_snapshot = _wait_queue_snapshot_locked()
+        active_sessions_snapshot = dict(backend_active_sessions)
+        draining_snapshot = {port: _backend_state_locked(port) for port in draining_proxies}
+
+    current_in_use_details = {}
+    for port, info_copy in in_use_snapshot.items():
+        if "client_address_on_socks_server" in info_copy and isinstance(info_copy["client_address_on_socks_server"], tuple):
+             info_copy["client_address_on_socks_server"] = f"{info_copy['client_address_on_socks_server'][0]}:{info_copy['client_address_on_socks_server'][1]}"
+        for secret_field in ("lease_id", "sticky_session_key"):
+            if info_copy.get(secret_field) is not None:
+                info_copy[secret_field] = _status_redacted(info_copy[secret_field])
+        current_in_use_details[port] = info_copy
+
+    return jsonify({
+        "central_socks5_server_listening_on": f"中央SOCKS5服务器监听地址: {SOCKS_SERVER_HOST}:{SOCKS_SERVER_PORT}",
+        "socks_workers": f"SOCKS工作进程: {SOCKS_WORKER_PROCESSES} 个 {_socks_workers_snapshot()}" if SOCKS_WORKER_PROCESSES > 0 else "SOCKS工作进程: 未启用 (单进程模式)",
+        "backend_warp_pool_size": f"后端WARP代理池大小: {len(WARP_POOL_CONFIG)}",
+        "available_backend_ports_count": f"可用后端代理数量: {len(available_ports)}",
+        "available_backend_ports_list": f"可用后端代理端口列表: {available_ports}",
+        "in_use_backend_ports_count": f"正在使用的后端代理数量: {len(in_use_snapshot)}",
+        "in_use_backend_ports_details": f"正在使用的后端代理详情: {current_in_use_details}",
+        "wait_queue": f"等待队列: {wait_queue_snapshot}",
+        "draining_backends": f"排空/移除中的后端: {draining_snapshot}",
+        "refresh_scheduler": f"IP刷新调度器: {refresh_scheduler_snapshot}",
+        "refresh_policy": f"IP刷新策略: {refresh_policy_snapshot}",
+        "backend_health": f"后端健康: 选择方式 {BACKEND_SELECTION}, 隔离中 {backend_health_snapshot['quarantined']}, 探测统计 {backend_health_snapshot['backends']}",
+        "exit_ips": f"出口IP: {_exit_ip_snapshot()}" if EXIT_IP_TRACE_URL else "出口IP: 未启用",
+        "api_leases": f"API租约: 默认有效期 {LEASE_DEFAULT_TTL:.0f} 秒, {lease_snapshot}",
+        "sticky_sessions": f"粘性会话: 空闲超时 {STICKY_SESSION_IDLE_TTL:.0f} 秒, 当前 {len(sticky_sessions_snapshot)} 个会话 {sticky_sessions_snapshot}",
+        "backend_sharing": f"后端共享: 每个后端最多 {BACKEND_MAX_SESSIONS} 个会话, 调度依据 {BACKEND_SCHEDULING_METRIC}, 活跃会话 {active_sessions_snapshot}",
+        "admission_control": f"准入控制: {_admission_limits_description()}, " + (
+            "各工作进程的状态见 socks_workers" if SOCKS_WORKER_PROCESSES > 0 else f"当前 {_admission_snapshot()}"),
+        "pool_nodes": f"多节点: {_pool_nodes_snapshot()}" if pool_nodes else "多节点: 未启用 (只使用本机后端)",
+        "relay_statistics": f"数据中继统计: {_relay_stats_snapshot()}"
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """以 Prometheus 文本格式导出运行指标"""
+    return Response(_render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# --- SOCKS准入控制 ---
+# 接受连接时检查连接总数、握手中的连接数和客户端IP的连接数，超出上限的连接不创建处理线程，立即拒绝;
+# 中继阶段按客户端IP的令牌桶限制带宽，并关闭空闲超时或超过最长时长的中继，避免个别客户端长期占用后端。
+
+admission_lock = threading.Lock() # 保护以下准入状态
+admission_state = {"clients": 0, "handshakes": 0, "rejection_logged_at": 0.0}
+admission_clients_by_ip = {} # 客户端IP -> {"sessions": 连接数, "bucket": 带宽令牌桶 (未限速时为 None)}
+admission_rejected = {"max_clients": 0, "max_handshakes": 0, "per_ip_sessions": 0} # 按原因统计的拒绝次数
+ADMISSION_REJECTION_LOG_INTERVAL = 10.0 # 拒绝连接的警告日志最短间隔(秒)，避免连接洪泛时刷屏
+RELAY_TIMEOUT_CHECK_INTERVAL = 1.0 # 检查中继空闲和最长时长的间隔(秒)
+
+class _TokenBucket:
+    """
+    客户端IP的带宽令牌桶，由该IP的所有连接和转发方向共享。令牌不足时仍然扣除 (余额可以为负)，
+    返回调用方在转发下一块数据之前应等待的时间，使长期平均速率不超过 rate。
+    """
+    __slots__ = ("rate", "capacity", "tokens", "updated_at", "lock")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, byte_count):
+        """扣除 byte_count 个令牌，返回需要等待的秒数 (不需要等待时为 0)。"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= byte_count
+            if self.tokens >= 0:
+                return 0.0
+            delay = -self.tokens / self.rate
+        _metrics_inc("warp_pool_socks_throttled_seconds_total", value=delay)
+        return delay
+
+def _admit_socks_client(client_ip):
+    """
+    为新连接登记准入计数 (连接数、握手中的连接数和客户端IP的连接数)。
+    返回 None 表示已接纳，否则返回拒绝原因: 'max_clients'、'max_handshakes' 或 'per_ip_sessions'。
+    """
+    with admission_lock:
+        client_entry = admission_clients_by_ip.get(client_ip)
+        if SOCKS_MAX_CLIENTS > 0 and admission_state["clients"] >= SOCKS_MAX_CLIENTS:
+            rejection_reason = 'max_clients'
+        elif SOCKS_MAX_HANDSHAKES > 0 and admission_state["handshakes"] >= SOCKS_MAX_HANDSHAKES:
+            rejection_reason = 'max_handshakes'
+        elif SOCKS_PER_IP_MAX_SESSIONS > 0 and client_entry is not None and client_entry["sessions"] >= SOCKS_PER_IP_MAX_SESSIONS:
+            rejection_reason = 'per_ip_sessions'
+        else:
+            admission_state["clients"] += 1
+            admission_state["handshakes"] += 1
+            if client_entry is None:
+                bucket = _TokenBucket(SOCKS_PER_IP_BANDWIDTH, SOCKS_PER_IP_BURST) if SOCKS_PER_IP_BANDWIDTH > 0 else None
+                client_entry = admission_clients_by_ip[client_ip] = {"sessions": 0, "bucket": bucket}
+            client_entry["sessions"] += 1
+            return None
+        admission_rejected[rejection_reason] += 1
+        now = time.monotonic()
+        log_rejection = now - admission_state["rejection_logged_at"] >= ADMISSION_REJECTION_LOG_INTERVAL
+        if log_rejection:
+            admission_state["rejection_logged_at"] = now
+            rejected_snapshot = dict(admission_rejected)
+    _metrics_inc("warp_pool_socks_rejected_total", (("reason", rejection_reason),))
+    if log_rejection:
+        logging.warning(f"SOCKS准入控制: 拒绝来自 {client_ip} 的新连接 (原因: {rejection_reason})，累计拒绝 {rejected_snapshot}。")
+    return rejection_reason
+
+def _end_socks_handshake_admission():
+    """连接已收到完整的CONNECT请求，不再计入握手中的连接数。"""
+    with admission_lock:
+        admission_state["handshakes"] -= 1
+
+def _release_socks_client_admission(client_ip, handshaking):
+    """连接结束，撤销 _admit_socks_client 登记的计数。handshaking 表示连接结束时仍处于握手阶段。"""
+    with admission_lock:
+        admission_state["clients"] -= 1
+        if handshaking:
+            admission_state["handshakes"] -= 1
+        client_entry = admission_clients_by_ip[client_ip]
+        client_entry["sessions"] -= 1
+        if client_entry["sessions"] == 0:
+            del admission_clients_by_ip[client_ip]
+
+def _client_bandwidth_bucket(client_ip):
+    """返回客户端IP的带宽令牌桶，未设置 SOCKS_PER_IP_BANDWIDTH 时返回 None。"""
+    with admission_lock:
+        client_entry = admission_clients_by_ip.get(client_ip)
+        return client_entry["bucket"] if client_entry is not None else None
+
+def _reject_socks_client(client_socket):
+    """立即拒绝未被接纳的连接 (线程模式): 不读取握手数据，回复"没有可接受的认证方法"后关闭。"""
+    try:
+        client_socket.setblocking(False)
+        client_socket.send(struct.pack("!BB", SOCKS_VERSION, AUTH_METHOD_NO_ACCEPTABLE))
+    except OSError:
+        pass
+    client_socket.close()
+
+def _relay_timeouts_enabled():
+    return SOCKS_RELAY_IDLE_TIMEOUT > 0 or SOCKS_MAX_SESSION_DURATION > 0
+
+def _relay_timeout_reason(relay_activity, relay_started_at):
+    """
+    检查中继是否应被关闭。relay_activity 是两个转发方向共同更新的 [最近一次收到数据的时间]。
+    返回 'idle_timeout'、'max_duration' 或 None (未超时)。
+    """
+    now = time.monotonic()
+    if SOCKS_MAX_SESSION_DURATION > 0 and now - relay_started_at >= SOCKS_MAX_SESSION_DURATION:
+        return 'max_duration'
+    if SOCKS_RELAY_IDLE_TIMEOUT > 0 and now - relay_activity[0] >= SOCKS_RELAY_IDLE_TIMEOUT:
+        return 'idle_timeout'
+    return None
+
+def _wait_relay_finished(stop_event, relay_activity, relay_started_at):
+    """线程模式: 等待任一转发方向结束。中继空闲超时或达到最长时长时设置 stop_event 并返回原因，否则返回 None。"""
+    if not _relay_timeouts_enabled():
+        stop_event.wait()
+        return None
+    while not stop_event.wait(RELAY_TIMEOUT_CHECK_INTERVAL):
+        relay_timeout = _relay_timeout_reason(relay_activity, relay_started_at)
+        if relay_timeout is not None:
+            stop_event.set()
+            return relay_timeout
+    return None
+
+def _admission_limits_description():
+    """以文字描述当前生效的准入限制 (用于 /status)。"""
+    def limit(value, unit=""):
+        return f"{value:g}{unit}" if value > 0 else "不限"
+    return (f"连接数上限 {limit(SOCKS_MAX_CLIENTS)}, 握手中连接数上限 {limit(SOCKS_MAX_HANDSHAKES)}, "
+            f"握手时限 {SOCKS_HANDSHAKE_TIMEOUT:g} 秒, 中继空闲超时 {limit(SOCKS_RELAY_IDLE_TIMEOUT, ' 秒')}, "
+            f"最长会话时长 {limit(SOCKS_MAX_SESSION_DURATION, ' 秒')}, 每IP连接数上限 {limit(SOCKS_PER_IP_MAX_SESSIONS)}, "
+            f"每IP带宽上限 {limit(SOCKS_PER_IP_BANDWIDTH, ' 字节/秒')}")
+
+def _admission_snapshot():
+    """返回本进程的准入控制状态 (用于 /status 和工作进程上报)。"""
+    with admission_lock:
+        busiest_client_ips = sorted(admission_clients_by_ip.items(), key=lambda item: item[1]["sessions"], reverse=True)[:10]
+        return {
+            "clients": admission_state["clients"],
+            "handshakes": admission_state["handshakes"],
+            "client_ips": len(admission_clients_by_ip),
+            "busiest_client_ips": {client_ip: entry["sessions"] for client_ip, entry in busiest_client_ips},
+            "rejected": dict(admission_rejected),
+        }
 
 # --- SOCKS5 服务器实现 ---
 
-def _forward_data(source_sock, dest_sock, stop_event, direction_log):
-    """在两个套接字之间转发数据，直到发生错误或 stop_event 被设置。"""
+def _record_relay_bytes(direction_key, byte_count):
+    """将一个转发方向结束时累计的字节数合并到全局中继统计。"""
+    if byte_count:
+        with relay_stats_lock:
+            relay_stats[direction_key] += byte_count
+
+def _relay_stats_snapshot():
+    """返回中继统计的一致性快照 (含当前使用的中继引擎)。"""
+    with relay_stats_lock:
+        snapshot = dict(relay_stats)
+        snapshot["sessions_by_engine"] = dict(relay_stats["sessions_by_engine"])
+    # 多进程模式下合并各工作进程最近一次上报的中继统计
+    with socks_workers_lock:
+        worker_relay_stats = [stats["relay"] for stats in socks_worker_stats.values()]
+    for worker_relay in worker_relay_stats:
+        snapshot["client_to_target_bytes"] += worker_relay["client_to_target_bytes"]
+        snapshot["target_to_client_bytes"] += worker_relay["target_to_client_bytes"]
+        for engine_name, session_count in worker_relay["sessions_by_engine"].items():
+            snapshot["sessions_by_engine"][engine_name] = snapshot["sessions_by_engine"].get(engine_name, 0) + session_count
+    snapshot["threaded_relay_engine"] = _select_relay_engine()[0] if SOCKS_SERVER_MODE != 'asyncio' else 'asyncio'
+    return snapshot
+
+def _forward_data(source_sock, dest_sock, stop_event, direction_log, relay_bytes=None, direction_key=None, trace=False,
+                  relay_activity=None, bandwidth_bucket=None):
+    """
+    在两个套接字之间转发数据，直到发生错误或 stop_event 被设置。
+    使用可复用的 recv_into 缓冲区，避免为每个数据块分配新的 bytes 对象。
+    若提供 relay_bytes/direction_key，则在结束时记录该方向转发的字节数。
+    trace 为 True (会话被采样) 时才输出连接关闭/重置等逐步骤的调试日志。
+    若提供 relay_activity，每收到数据就更新其中的最近活动时间; 若提供 bandwidth_bucket，按令牌桶限速转发。
+    """
+    buffer = bytearray(RELAY_BUFFER_SIZE)
+    buffer_view = memoryview(buffer)
+    transferred = 0
     try:
         source_sock.settimeout(1.0)
         while not stop_event.is_set():
             try:
-                data = source_sock.recv(4096)
+                received = source_sock.recv_into(buffer)
             except socket.timeout:
                 if stop_event.is_set(): break
                 continue
             except ConnectionResetError:
-                logging.warning(f"转发器 {direction_log}: 连接被对方重置。")
+                if trace:
+                    socks_trace_logger.debug("转发器 %s: 连接被对方重置。", direction_log)
                 break
             except Exception as e:
                 if stop_event.is_set(): break
                 logging.error(f"转发器 {direction_log}: 接收数据时出错: {e}")
                 break
             
-            if not data:
-                logging.info(f"转发器 {direction_log}: 源连接已关闭 (收到空数据)。")
+            if not received:
+                if trace:
+                    socks_trace_logger.debug("转发器 %s: 源连接已关闭 (收到空数据)。", direction_log)
                 break
+            if relay_activity is not None:
+                relay_activity[0] = time.monotonic()
+            if bandwidth_bucket is not None:
+                throttle_delay = bandwidth_bucket.consume(received)
+                if throttle_delay and stop_event.wait(throttle_delay):
+                    break
             
             try:
-                dest_sock.sendall(data)
+                dest_sock.sendall(buffer_view[:received])
+                transferred += received
             except socket.error as e:
                 if stop_event.is_set(): break
                 logging.error(f"转发器 {direction_log}: 发送数据时套接字出错: {e}")
@@ -329,271 +2566,2338 @@ def _forward_data(source_sock, dest_sock, stop_event, direction_log):
         if not stop_event.is_set():
              logging.error(f"转发器 {direction_log}: 转发循环中发生未处理的异常: {e}")
     finally:
-        logging.info(f"转发器 {direction_log}: 正在停止。")
+        if trace:
+            socks_trace_logger.debug("转发器 %s: 正在停止。", direction_log)
+        if direction_key is not None:
+            if relay_bytes is not None:
+                relay_bytes[direction_key] += transferred
+            _record_relay_bytes(direction_key, transferred)
         stop_event.set()
 
-def _release_backend_port_after_socks_usage(backend_port_to_release, refresh_ip_flag=True):
+def _forward_data_splice(source_sock, dest_sock, stop_event, direction_log, relay_bytes=None, direction_key=None, trace=False,
+                         relay_activity=None, bandwidth_bucket=None):
+    """
+    使用 os.splice 经由管道在两个套接字之间转发数据，负载不进入用户态。
+    若内核拒绝对该套接字使用 splice (且尚未转发任何数据)，则回退到 _forward_data。
+    """
+    pipe_read_fd, pipe_write_fd = os.pipe()
+    source_fd = source_sock.fileno()
+    dest_fd = dest_sock.fileno()
+    poller = select.poll()
+    poller.register(source_fd, select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR)
+    transferred = 0
+    fallback_to_copy = False
+    try:
+        while not stop_event.is_set():
+            # 以1秒为间隔检查 stop_event，与复制引擎的超时语义保持一致
+            if not poller.poll(1000):
+                continue
+            try:
+                received = os.splice(source_fd, pipe_write_fd, RELAY_BUFFER_SIZE,
+                                     flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            except BlockingIOError:
+                continue
+            except OSError as e:
+                if transferred == 0 and e.errno in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    fallback_to_copy = True
+                    break
+                raise
+            if received == 0:
+                if trace:
+                    socks_trace_logger.debug("转发器 %s: 源连接已关闭 (收到空数据)。", direction_log)
+                break
+            if relay_activity is not None:
+                relay_activity[0] = time.monotonic()
+            if bandwidth_bucket is not None:
+                throttle_delay = bandwidth_bucket.consume(received)
+                if throttle_delay and stop_event.wait(throttle_delay):
+                    break
+
+            remaining = received
+            while remaining:
+                try:
+                    remaining -= os.splice(pipe_read_fd, dest_fd, remaining, flags=os.SPLICE_F_MOVE)
+                except BlockingIOError:
+                    # 目标套接字处于非阻塞模式时，等待其可写
+                    if stop_event.is_set():
+                        break
+                    select.select([], [dest_sock], [], 1.0)
+            transferred += received - remaining
+            if remaining:
+                break
+    except (ConnectionResetError, BrokenPipeError):
+        if trace and not stop_event.is_set():
+            socks_trace_logger.debug("转发器 %s: 连接被对方重置。", direction_log)
+    except Exception as e:
+        if not stop_event.is_set():
+            logging.error(f"转发器 {direction_log}: splice 转发时出错: {e}")
+    finally:
+        os.close(pipe_read_fd)
+        os.close(pipe_write_fd)
+        if fallback_to_copy:
+            if trace:
+                socks_trace_logger.debug("转发器 %s: 内核不支持对该连接使用 splice，回退到缓冲区复制。", direction_log)
+        else:
+            if trace:
+                socks_trace_logger.debug("转发器 %s: 正在停止。", direction_log)
+            if direction_key is not None:
+                if relay_bytes is not None:
+                    relay_bytes[direction_key] += transferred
+                _record_relay_bytes(direction_key, transferred)
+            stop_event.set()
+    if fallback_to_copy:
+        _forward_data(source_sock, dest_sock, stop_event, direction_log, relay_bytes, direction_key, trace,
+                      relay_activity, bandwidth_bucket)
+
+def _splice_available():
+    """检查当前平台是否支持 os.splice (Linux, Python 3.10+)。"""
+    return sys.platform.startswith('linux') and hasattr(os, 'splice')
+
+def _select_relay_engine():
+    """根据 SOCKS_RELAY_ENGINE 配置返回 (引擎名称, 转发函数)。"""
+    if SOCKS_RELAY_ENGINE in ('auto', 'splice') and _splice_available():
+        return 'splice', _forward_data_splice
+    if SOCKS_RELAY_ENGINE == 'splice':
+        logging.warning("SOCKS_RELAY_ENGINE=splice 但当前平台不支持 os.splice，将使用缓冲区复制引擎。")
+    return 'copy', _forward_data
+
+def _release_backend_port_after_socks_usage(backend_port_to_release, had_error=False, relayed_byte_count=0):
     """
     管理SOCKS使用后后端端口的释放。
-    从 in_use_proxies 中移除，并可选择性地安排IP刷新。
+    从 in_use_proxies 中移除，并按刷新策略安排IP刷新; 无需刷新的端口立即返回代理池，
+    出错的会话在返回前先验证后端可用性。
     """
-    logging.info(f"SOCKS清理: 正在释放后端端口 {backend_port_to_release}。刷新IP: {refresh_ip_flag}")
+    logging.debug("SOCKS清理: 正在释放后端端口 %s。会话出错: %s", backend_port_to_release, had_error)
+    needs_refresh = False
     with proxy_lock:
-        if backend_port_to_release in in_use_proxies:
+        was_in_use = backend_port_to_release in in_use_proxies
+        if was_in_use:
             proxy_info = in_use_proxies.pop(backend_port_to_release)
             usage_duration = time.time() - proxy_info.get("acquired_at", time.time())
-            logging.info(f"SOCKS清理: 端口 {backend_port_to_release} 已被使用 {usage_duration:.2f} 秒。")
+            logging.debug("SOCKS清理: 端口 %s 已被使用 %.2f 秒。", backend_port_to_release, usage_duration)
+            _record_backend_usage_locked(backend_port_to_release, relayed_byte_count)
+            needs_refresh = _backend_needs_refresh_locked(backend_port_to_release, had_error=had_error)
+            if not needs_refresh and not had_error:
+                _return_port_to_pool_locked(backend_port_to_release)
+
+    if not was_in_use:
+        logging.warning(f"SOCKS清理警告: 在SOCKS释放期间，未在 'in_use_proxies' 中找到后端端口 {backend_port_to_release}。")
+        # 如果端口不在使用中，直接验证并返回到代理池
+        logging.info(f"SOCKS清理: 正在验证端口 {backend_port_to_release} 的可用性...")
+        is_valid = validate_proxy(backend_port_to_release)
+        with proxy_lock:
+            _return_port_to_pool_locked(backend_port_to_release)
+        if is_valid:
+            logging.info(f"SOCKS清理: 后端端口 {backend_port_to_release} 验证成功，已返回代理池。")
         else:
-            logging.warning(f"SOCKS清理警告: 在SOCKS释放期间，未在 'in_use_proxies' 中找到后端端口 {backend_port_to_release}。")
-            # 如果端口不在使用中，直接验证并返回到代理池
-            logging.info(f"SOCKS清理: 正在验证端口 {backend_port_to_release} 的可用性...")
-            is_valid = validate_proxy(backend_port_to_release)
-            with proxy_lock:
-                if is_valid:
-                    available_proxies.put(backend_port_to_release)
-                    logging.info(f"SOCKS清理: 后端端口 {backend_port_to_release} 验证成功，已返回代理池。")
-                else:
-                    # 如果验证失败，将代理端口重新放回队列的末尾，并记录错误
-                    logging.warning(f"SOCKS清理: 后端端口 {backend_port_to_release} 未能通过验证。将端口放回队列末尾以供后续重试。")
-                    available_proxies.put(backend_port_to_release)
-            return
+            # 如果验证失败，将代理端口重新放回队列的末尾，并记录错误
+            logging.warning(f"SOCKS清理: 后端端口 {backend_port_to_release} 未能通过验证。将端口放回队列末尾以供后续重试。")
+        return
 
-    if refresh_ip_flag:
-        threading.Thread(target=_refresh_and_return_task, args=(backend_port_to_release,)).start()
-        logging.info(f"SOCKS清理: 已为 {backend_port_to_release} 启动后台IP刷新任务。")
-    else:
-        # 即使跳过IP刷新，也要验证代理的可用性
+    if needs_refresh:
+        schedule_refresh(backend_port_to_release)
+        logging.debug("SOCKS清理: 已为 %s 安排后台IP刷新任务。", backend_port_to_release)
+    elif had_error:
+        # 会话出错但策略不要求刷新，验证代理的可用性后再返回代理池
         logging.info(f"SOCKS清理: 正在验证端口 {backend_port_to_release} 的可用性 (IP刷新被跳过)...")
         is_valid = validate_proxy(backend_port_to_release)
         with proxy_lock:
-            if is_valid:
-                available_proxies.put(backend_port_to_release)
-                logging.info(f"SOCKS清理: 后端端口 {backend_port_to_release} 验证成功，已返回代理池 (IP刷新被跳过)。")
-            else:
-                # 如果验证失败，将代理端口重新放回队列的末尾，并记录错误
-                logging.warning(f"SOCKS清理: 后端端口 {backend_port_to_release} 未能通过验证。将端口放回队列末尾以供后续重试。")
-                available_proxies.put(backend_port_to_release)
+            _return_port_to_pool_locked(backend_port_to_release)
+        if is_valid:
+            logging.info(f"SOCKS清理: 后端端口 {backend_port_to_release} 验证成功，已返回代理池 (IP刷新被跳过)。")
+        else:
+            # 如果验证失败，将代理端口重新放回队列的末尾，并记录错误
+            logging.warning(f"SOCKS清理: 后端端口 {backend_port_to_release} 未能通过验证。将端口放回队列末尾以供后续重试。")
+    else:
+        logging.debug("SOCKS清理: 按刷新策略无需刷新，后端端口 %s 已直接返回代理池。", backend_port_to_release)
 
-def handle_socks_client_connection(client_socket, client_address_tuple):
-    """处理单个SOCKS5客户端连接。"""
-    client_ip_str = client_address_tuple[0]
-    logging.info(f"SOCKS处理器: 来自 {client_ip_str}:{client_address_tuple[1]} 的新客户端连接")
-    
-    acquired_backend_port = None
-    remote_connection_to_target = None
-    
-    try:
-        client_socket.settimeout(10.0)
-        ver_nmethods = client_socket.recv(2)
-        if not ver_nmethods or ver_nmethods[0] != SOCKS_VERSION:
-            logging.warning(f"SOCKS处理器 {client_ip_str}: 无效的SOCKS版本。应为 {SOCKS_VERSION}, 收到 {ver_nmethods[0] if ver_nmethods else 'None'}。")
-            return
-        
-        num_auth_methods = ver_nmethods[1]
-        auth_methods_offered = client_socket.recv(num_auth_methods)
-        if b'\x00' not in auth_methods_offered:
-            logging.warning(f"SOCKS处理器 {client_ip_str}: 不支持的认证方法。客户端提供: {auth_methods_offered.hex()}。我们需要 0x00 (无认证)。")
-            client_socket.sendall(struct.pack("!BB", SOCKS_VERSION, 0xFF))
-            return
-        
-        client_socket.sendall(struct.pack("!BB", SOCKS_VERSION, 0x00))
-        logging.info(f"SOCKS处理器 {client_ip_str}: 握手成功 (无认证)。")
+def _release_shared_backend_session(backend_port, relayed_byte_count=0, had_error=False):
+    """
+    结束共享模式下的一个SOCKS会话: 减少会话计数并累计转发字节。后端通常仍留在可用池中;
+    若刷新策略 (除 'always' 外) 要求刷新且后端已无活跃会话，则将其移出可用池并安排IP刷新。
+    """
+    needs_refresh = False
+    with proxy_lock:
+        remaining_sessions = backend_active_sessions.get(backend_port, 0) - 1
+        if remaining_sessions > 0:
+            backend_active_sessions[backend_port] = remaining_sessions
+        else:
+            backend_active_sessions.pop(backend_port, None)
+        backend_relayed_bytes[backend_port] = backend_relayed_bytes.get(backend_port, 0) + relayed_byte_count
+        _record_backend_usage_locked(backend_port, relayed_byte_count)
+        drained_state = None
+        if remaining_sessions <= 0 and backend_port in draining_proxies:
+            drained_state = _settle_drained_backend_locked(backend_port)
+        # 共享模式下 'always' 不触发刷新，否则后端每次空闲都会被重连
+        if (remaining_sessions <= 0 and _refresh_policy_for_port(backend_port)[0] != 'always'
+                and backend_port in available_proxies.queue
+                and _backend_needs_refresh_locked(backend_port, had_error=had_error)):
+            available_proxies.queue.remove(backend_port)
+            needs_refresh = True
+        # 释放出的会话容量优先交给等待队列中的请求
+        _dispatch_pool_waiters_locked()
+    logging.debug("SOCKS清理: 共享后端端口 %s 的会话已结束，剩余活跃会话 %s。", backend_port, max(remaining_sessions, 0))
+    if drained_state == 'removed':
+        logging.info(f"后端管理: 排空中的共享后端端口 {backend_port} 已无活跃会话，已从代理池移除。")
+    elif drained_state == 'drained':
+        logging.info(f"后端管理: 共享后端端口 {backend_port} 已排空。")
+    if needs_refresh:
+        schedule_refresh(backend_port)
+        logging.info(f"SOCKS清理: 共享后端端口 {backend_port} 已达到刷新策略阈值，已移出可用池并安排IP刷新。")
 
-        request_header = client_socket.recv(4)
-        if not request_header or request_header[0] != SOCKS_VERSION:
-            logging.warning(f"SOCKS处理器 {client_ip_str}: 请求中的SOCKS版本无效。")
-            return
-        
-        req_ver, req_cmd, req_rsv, req_atyp = request_header
-        
-        if req_cmd != CMD_CONNECT:
-            logging.warning(f"SOCKS处理器 {client_ip_str}: 不支持的命令 {req_cmd}。仅支持 CONNECT ({CMD_CONNECT})。")
-            reply = struct.pack("!BBBB", SOCKS_VERSION, REP_COMMAND_NOT_SUPPORTED, 0x00, ATYP_IPV4) + socket.inet_aton("0.0.0.0") + struct.pack("!H", 0)
-            client_socket.sendall(reply)
-            return
+def _finish_socks_backend_usage(backend_port, had_error=False, relay_bytes=None, session_key=None):
+    """
+    SOCKS会话结束时归还后端: 粘性会话只更新会话计数，共享模式下减少会话计数，
+    独占模式下交给 _release_backend_port_after_socks_usage 按刷新策略处理刷新/验证。
+    """
+    if relay_bytes:
+        for direction_key, byte_count in relay_bytes.items():
+            _metrics_inc("warp_pool_relayed_bytes_total", (("backend", backend_port), ("direction", direction_key.replace("_bytes", ""))), byte_count)
+    if socks_worker_id is not None:
+        _coordinator_finish(backend_port, had_error, relay_bytes, session_key)
+        return
+    _return_socks_backend(backend_port, had_error, relay_bytes, session_key)
 
-        target_host_str = ""
-        if req_atyp == ATYP_IPV4:
-            addr_bytes = client_socket.recv(4)
-            target_host_str = socket.inet_ntoa(addr_bytes)
-        elif req_atyp == ATYP_DOMAINNAME:
-            domain_len = client_socket.recv(1)[0]
-            addr_bytes = client_socket.recv(domain_len)
-            target_host_str = addr_bytes.decode("utf-8", errors="ignore")
-        elif req_atyp == ATYP_IPV6:
-            addr_bytes = client_socket.recv(16)
-            target_host_str = socket.inet_ntop(socket.AF_INET6, addr_bytes)
-        else:
-            logging.warning(f"SOCKS处理器 {client_ip_str}: 不支持的地址类型 {req_atyp}。")
-            reply = struct.pack("!BBBB", SOCKS_VERSION, REP_ADDRESS_TYPE_NOT_SUPPORTED, 0x00, ATYP_IPV4) + socket.inet_aton("0.0.0.0") + struct.pack("!H", 0)
-            client_socket.sendall(reply)
-            return
-            
-        target_port_bytes = client_socket.recv(2)
-        target_port_int = struct.unpack("!H", target_port_bytes)[0]
-        logging.info(f"SOCKS处理器 {client_ip_str}: 请求连接到 {target_host_str}:{target_port_int}")
+def _return_socks_backend(backend_port, had_error=False, relay_bytes=None, session_key=None):
+    """按会话类型归还SOCKS会话使用的后端 (在持有代理池状态的进程中执行)。"""
+    if session_key:
+        _finish_sticky_session_usage(session_key, relay_bytes)
+        return
+    relayed_byte_count = sum(relay_bytes.values()) if relay_bytes else 0
+    if BACKEND_MAX_SESSIONS > 1:
+        _release_shared_backend_session(backend_port, relayed_byte_count, had_error=had_error)
+    else:
+        _release_backend_port_after_socks_usage(backend_port, had_error=had_error, relayed_byte_count=relayed_byte_count)
 
-        with proxy_lock:
-            if available_proxies.empty():
-                logging.warning(f"SOCKS处理器 {client_ip_str}: 没有可用的后端WARP代理来连接 -> {target_host_str}:{target_port_int}")
-                reply = struct.pack("!BBBB", SOCKS_VERSION, REP_GENERAL_FAILURE, 0x00, ATYP_IPV4) + socket.inet_aton("0.0.0.0") + struct.pack("!H", 0)
-                client_socket.sendall(reply)
-                return
-            acquired_backend_port = available_proxies.get()
-            in_use_proxies[acquired_backend_port] = {
-                "type": "socks_direct",
-                "client_address_on_socks_server": client_address_tuple,
-                "requested_target_host": target_host_str,
-                "requested_target_port": target_port_int,
-                "backend_warp_port_used": acquired_backend_port,
-                "acquired_at": time.time()
+def _build_socks_reply(reply_code):
+    """构造一个SOCKS5回复 (绑定地址固定为 0.0.0.0:0)。构造的回复都会被发送，因此在此按回复码计数。"""
+    _metrics_inc("warp_pool_socks_replies_total", (("code", f"0x{reply_code:02x}"),))
+    return struct.pack("!BBBB", SOCKS_VERSION, reply_code, 0x00, ATYP_IPV4) + socket.inet_aton("0.0.0.0") + struct.pack("!H", 0)
+
+def _acquire_backend_port_for_socks(client_address_tuple, target_host_str, target_port_int, wait_seconds=None):
+    """
+    为一个SOCKS客户端连接从可用代理池中取出一个后端端口并登记到 in_use_proxies。
+    共享模式下选择负载最低的后端而不独占它。池为空时最多等待 wait_seconds 秒 (默认 SOCKS_CONNECT_WAIT)。
+    没有可用后端时返回 None。线程模式和 asyncio 模式共用此逻辑。
+    """
+    if wait_seconds is None:
+        wait_seconds = SOCKS_CONNECT_WAIT
+    if socks_worker_id is not None:
+        return _coordinator_acquire(None, client_address_tuple, target_host_str, target_port_int, wait_seconds)
+    in_use_info = {
+        "type": "socks_direct",
+        "client_address_on_socks_server": client_address_tuple,
+        "requested_target_host": target_host_str,
+        "requested_target_port": target_port_int,
+    }
+    acquired_backend_port, failure_reason = _acquire_backend_port(
+        in_use_info, "backend_warp_port_used",
+        shared=BACKEND_MAX_SESSIONS > 1, wait_seconds=wait_seconds
+    )
+    if acquired_backend_port is None and failure_reason != 'empty':
+        logging.warning(f"SOCKS处理器 {client_address_tuple[0]}: 等待后端失败 ({failure_reason})。")
+    return acquired_backend_port
+
+# --- 粘性会话 ---
+# 会话键到后端的映射由独立的 sticky_lock 保护: 已有会话的新连接只做一次字典查找，
+# 只有创建会话 (获取后端) 和过期释放时才会进入代理池的 proxy_lock。
+
+def _select_socks_auth_method(auth_methods_offered):
+    """从客户端提供的认证方法中选择一个: 优先用户名/密码 (用于携带会话键)，其次无认证。"""
+    if AUTH_METHOD_USERNAME_PASSWORD in auth_methods_offered:
+        return AUTH_METHOD_USERNAME_PASSWORD
+    if AUTH_METHOD_NO_AUTH in auth_methods_offered and not SOCKS_AUTH_PASSWORD:
+        return AUTH_METHOD_NO_AUTH
+    return AUTH_METHOD_NO_ACCEPTABLE
+
+def _check_socks_credentials(username, password):
+    """校验用户名/密码认证。未设置 SOCKS_AUTH_PASSWORD 时密码被忽略。"""
+    if SOCKS_AUTH_PASSWORD:
+        return secrets.compare_digest(password.encode("utf-8"), SOCKS_AUTH_PASSWORD.encode("utf-8"))
+    return True
+
+def _acquire_sticky_backend_port(session_key, client_address_tuple, target_host_str, target_port_int):
+    """
+    为携带会话键的SOCKS连接返回会话绑定的后端端口; 会话不存在时从代理池独占获取一个后端并创建会话。
+    没有可用后端时返回 None。
+    """
+    if socks_worker_id is not None:
+        return _coordinator_acquire(session_key, client_address_tuple, target_host_str, target_port_int)
+    with sticky_lock:
+        session = sticky_sessions.get(session_key)
+        if session is not None:
+            session["active_connections"] += 1
+            session["connections_total"] += 1
+            session["last_used"] = time.time()
+            return session["port"]
+
+    in_use_info = {
+        "type": "socks_sticky",
+        "sticky_session_key": session_key,
+        "client_address_on_socks_server": client_address_tuple,
+        "requested_target_host": target_host_str,
+        "requested_target_port": target_port_int,
+    }
+    acquired_backend_port, failure_reason = _acquire_backend_port(
+        in_use_info, "backend_warp_port_used", wait_seconds=SOCKS_CONNECT_WAIT
+    )
+    if acquired_backend_port is None:
+        if failure_reason != 'empty':
+            logging.warning(f"SOCKS处理器 {client_address_tuple[0]}: 等待后端失败 ({failure_reason})。")
+        return None
+
+    surplus_backend_port = None
+    with sticky_lock:
+        session = sticky_sessions.get(session_key)
+        if session is None:
+            now = time.time()
+            sticky_sessions[session_key] = {
+                "port": acquired_backend_port,
+                "active_connections": 1,
+                "connections_total": 1,
+                "relayed_bytes": 0,
+                "created_at": now,
+                "last_used": now
             }
-        logging.info(f"SOCKS处理器 {client_ip_str}: 已获取后端WARP {WARP_INSTANCE_IP}:{acquired_backend_port} 用于连接 -> {target_host_str}:{target_port_int}")
+        else:
+            # 同一会话键的另一个连接抢先创建了会话，使用已有会话的后端并归还多取的端口
+            session["active_connections"] += 1
+            session["connections_total"] += 1
+            session["last_used"] = time.time()
+            surplus_backend_port = acquired_backend_port
+            acquired_backend_port = session["port"]
 
-        try:
-            logging.info(f"SOCKS处理器 {client_ip_str}: 正在通过后端SOCKS5 {WARP_INSTANCE_IP}:{acquired_backend_port} 连接到 ({target_host_str}, {target_port_int})...")
-            remote_connection_to_target = socks.create_connection(
-                (target_host_str, target_port_int),
-                proxy_type=socks.SOCKS5,
-                proxy_addr=WARP_INSTANCE_IP,
-                proxy_port=acquired_backend_port,
-                timeout=20
-            )
-            logging.info(f"SOCKS处理器 {client_ip_str}: 已通过后端WARP {WARP_INSTANCE_IP}:{acquired_backend_port} 成功连接到 {target_host_str}:{target_port_int}")
-            
-            bound_addr_bytes = socket.inet_aton("0.0.0.0")
-            bound_port_bytes = struct.pack("!H", 0)
-            reply = struct.pack("!BBBB", SOCKS_VERSION, REP_SUCCESS, 0x00, ATYP_IPV4) + bound_addr_bytes + bound_port_bytes
-            client_socket.sendall(reply)
+    if surplus_backend_port is not None:
+        with proxy_lock:
+            in_use_proxies.pop(surplus_backend_port, None)
+            _return_port_to_pool_locked(surplus_backend_port)
+    else:
+        logging.info(f"粘性会话: 会话 '{session_key}' 已绑定后端端口 {acquired_backend_port}。")
+        _ensure_sticky_reaper_started()
+    return acquired_backend_port
 
-        except socks.ProxyConnectionError as e_pysocks:
-            logging.error(f"SOCKS处理器 {client_ip_str}: 后端WARP {WARP_INSTANCE_IP}:{acquired_backend_port} 无法连接到目标 {target_host_str}:{target_port_int}。PySocks错误: {e_pysocks}")
-            socks_reply_code = REP_HOST_UNREACHABLE
-            if "Connection refused" in str(e_pysocks): socks_reply_code = REP_CONNECTION_REFUSED
-            elif "Host unreachable" in str(e_pysocks): socks_reply_code = REP_HOST_UNREACHABLE
-            elif "Network is unreachable" in str(e_pysocks): socks_reply_code = REP_NETWORK_UNREACHABLE
-            reply = struct.pack("!BBBB", SOCKS_VERSION, socks_reply_code, 0x00, ATYP_IPV4) + socket.inet_aton("0.0.0.0") + struct.pack("!H", 0)
-            try:
-                client_socket.sendall(reply)
-            except Exception as e_send:
-                logging.warning(f"SOCKS处理器 {client_ip_str}: 发送错误回复时失败: {e_send}")
-            _release_backend_port_after_socks_usage(acquired_backend_port, refresh_ip_flag=False)
-            acquired_backend_port = None
+def _finish_sticky_session_usage(session_key, relay_bytes=None):
+    """粘性会话中的一个连接结束: 只更新会话计数，后端在会话空闲超时后才释放。"""
+    with sticky_lock:
+        session = sticky_sessions.get(session_key)
+        if session is None:
             return
-        except socket.timeout:
-            logging.warning(f"SOCKS处理器 {client_ip_str}: 通过后端WARP {WARP_INSTANCE_IP}:{acquired_backend_port} 连接到 {target_host_str}:{target_port_int} 超时")
-            reply = struct.pack("!BBBB", SOCKS_VERSION, REP_TTL_EXPIRED, 0x00, ATYP_IPV4) + socket.inet_aton("0.0.0.0") + struct.pack("!H", 0)
+        session["active_connections"] = max(session["active_connections"] - 1, 0)
+        session["relayed_bytes"] += sum(relay_bytes.values()) if relay_bytes else 0
+        session["last_used"] = time.time()
+
+def _sticky_session_reaper_loop():
+    """定期释放空闲超时或绑定到排空中后端的粘性会话，后端按刷新策略刷新后返回代理池。"""
+    reap_interval = max(1.0, min(STICKY_SESSION_IDLE_TTL / 4, 10.0))
+    while True:
+        time.sleep(reap_interval)
+        now = time.time()
+        with proxy_lock:
+            draining_ports = set(draining_proxies)
+        with sticky_lock:
+            # 绑定到排空中后端的会话在没有活跃连接时立即释放，之后的连接将绑定新的后端
+            expired_sessions = [
+                (session_key, session) for session_key, session in sticky_sessions.items()
+                if session["active_connections"] == 0
+                and (now - session["last_used"] >= STICKY_SESSION_IDLE_TTL or session["port"] in draining_ports)
+            ]
+            for session_key, _ in expired_sessions:
+                del sticky_sessions[session_key]
+        for session_key, session in expired_sessions:
+            logging.info(f"粘性会话: 会话 '{session_key}' 空闲超过 {STICKY_SESSION_IDLE_TTL:.0f} 秒，释放后端端口 {session['port']} "
+                         f"(共 {session['connections_total']} 个连接, 转发 {session['relayed_bytes']} 字节)。")
             try:
-                client_socket.sendall(reply)
-            except Exception as e_send:
-                logging.warning(f"SOCKS处理器 {client_ip_str}: 发送超时回复时失败: {e_send}")
-            _release_backend_port_after_socks_usage(acquired_backend_port, refresh_ip_flag=False)
-            acquired_backend_port = None
+                _release_backend_port_after_socks_usage(session["port"], relayed_byte_count=session["relayed_bytes"])
+            except Exception as e_release:
+                logging.error(f"粘性会话: 释放会话 '{session_key}' 的后端端口 {session['port']} 时出错: {e_release}")
+
+def _ensure_sticky_reaper_started():
+    """按需启动粘性会话过期回收线程 (只启动一次)。"""
+    global sticky_reaper_started
+    with sticky_lock:
+        if sticky_reaper_started:
             return
-        except socket.gaierror as e_dns:
-            logging.warning(f"SOCKS处理器 {client_ip_str}: 目标 {target_host_str} 的DNS解析失败。错误: {e_dns}")
-            reply = struct.pack("!BBBB", SOCKS_VERSION, REP_HOST_UNREACHABLE, 0x00, ATYP_IPV4) + socket.inet_aton("0.0.0.0") + struct.pack("!H", 0)
+        sticky_reaper_started = True
+    threading.Thread(target=_sticky_session_reaper_loop, name="sticky-session-reaper", daemon=True).start()
+
+def _sticky_sessions_snapshot():
+    """返回粘性会话的快照 (用于 /status)。"""
+    now = time.time()
+    with sticky_lock:
+        return {
+            session_key: {
+                "port": session["port"],
+                "active_connections": session["active_connections"],
+                "connections_total": session["connections_total"],
+                "idle_seconds": round(now - session["last_used"], 1) if session["active_connections"] == 0 else 0.0
+            }
+            for session_key, session in sticky_sessions.items()
+        }
+
+class SocksHandshakeReader:
+    """
+    线程模式下SOCKS5握手的缓冲读取器。每次 recv 尽可能多地读取并缓存数据，
+    因此无论客户端如何分段 (逐字节发送，或把问候、认证、请求和首段负载合并为一个报文段)，
+    握手都只需要一次或少数几次系统调用。握手完成后缓冲区中剩余的字节是客户端在收到
+    CONNECT回复之前发送的乐观数据，应在后端连接建立后立即转发。
+    整个握手受 SOCKS_HANDSHAKE_TIMEOUT 总时限约束，每次 recv 只等待剩余的时间。
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.deadline = time.monotonic() + SOCKS_HANDSHAKE_TIMEOUT
+
+    def read_exactly(self, byte_count):
+        """返回恰好 byte_count 个字节，对端提前关闭时返回 None，超过握手时限时抛出 socket.timeout。"""
+        while len(self.buffer) < byte_count:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("SOCKS握手超时")
+            self.sock.settimeout(remaining)
+            chunk = self.sock.recv(SOCKS_HANDSHAKE_RECV_SIZE)
+            if not chunk:
+                return None
+            self.buffer += chunk
+        data = bytes(self.buffer[:byte_count])
+        del self.buffer[:byte_count]
+        return data
+
+    def take_buffered(self):
+        """取出并清空握手之后已读入缓冲区的字节 (客户端的乐观数据)。"""
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+class SocksSessionLog:
+    """
+    一个SOCKS连接的日志上下文。连接过程中只累积摘要字段，结束时输出一条会话摘要;
+    按 SOCKS_TRACE_SAMPLE_RATE 采样的连接另外以 DEBUG 级别输出每个步骤。
+    """
+    __slots__ = ("fields", "traced", "started_at", "phase_started_at")
+
+    def __init__(self, mode, client_address_tuple):
+        self.started_at = time.monotonic()
+        self.phase_started_at = self.started_at
+        self.traced = SOCKS_TRACE_SAMPLE_RATE > 0 and random.random() < SOCKS_TRACE_SAMPLE_RATE
+        self.fields = {
+            "mode": mode,
+            "client": f"{client_address_tuple[0]}:{client_address_tuple[1]}",
+            "result": "error",
+            "session": None,
+            "target": None,
+            "backend": None,
+            "handshake_ms": None,
+            "connect_ms": None,
+            "duration_s": None,
+            "up_bytes": None,
+            "down_bytes": None,
+        }
+
+    def trace(self, message, *args):
+        """输出一条步骤日志 (仅被采样的连接)。message 使用 % 占位符，参数在输出时才格式化。"""
+        if self.traced:
+            socks_trace_logger.debug("SOCKS处理器 %s: " + message, self.fields["client"], *args)
+
+    def mark(self, field):
+        """把上一阶段 (从连接开始或上一次 mark 起) 的耗时以毫秒记入 field。"""
+        now = time.monotonic()
+        self.fields[field] = round((now - self.phase_started_at) * 1000, 1)
+        self.phase_started_at = now
+
+    def finish(self, relay_bytes=None):
+        """填入转发字节数和总耗时，输出该连接的会话摘要 (logfmt 风格的一行)。"""
+        if relay_bytes:
+            self.fields["up_bytes"] = relay_bytes["client_to_target_bytes"]
+            self.fields["down_bytes"] = relay_bytes["target_to_client_bytes"]
+        self.fields["duration_s"] = round(time.monotonic() - self.started_at, 3)
+        socks_session_logger.info("SOCKS会话 %s", _LogfmtFields(self.fields))
+
+def _open_backend_connection(backend_port, target_host_str, target_port_int, timeout=SOCKS_BACKEND_CONNECT_TIMEOUT):
+    """通过后端WARP连接目标 (线程模式)，并记录连接耗时。"""
+    connect_started_at = time.monotonic()
+    backend_host, backend_connect_port = _backend_address(backend_port)
+    try:
+        connection = socks.create_connection(
+            (target_host_str, target_port_int),
+            proxy_type=socks.SOCKS5,
+            proxy_addr=backend_host,
+            proxy_port=backend_connect_port,
+            timeout=timeout
+        )
+    except Exception:
+        _metrics_observe("warp_pool_backend_connect_duration_seconds", time.monotonic() - connect_started_at, (("result", "failure"),))
+        raise
+    _metrics_observe("warp_pool_backend_connect_duration_seconds", time.monotonic() - connect_started_at, (("result", "success"),))
+    return connection
+
+# --- 后端连接故障转移 ---
+# 后端故障 (不可达、超时、协议错误、通用失败) 时记录一次健康失败并换一个后端重试;
+# 目标本身的错误 (拒绝连接、不可达等) 换后端也无济于事，直接回复客户端。
+
+def _classify_backend_connect_error(error):
+    """将通过后端连接目标时的异常映射为 (回复给客户端的状态码, 是否为后端故障)。"""
+    if isinstance(error, BackendSocksError):
+        return error.reply_code, error.reply_code == REP_GENERAL_FAILURE
+    # PySocks 把后端的失败回复和超时包装在 GeneralProxyError.socket_err 中
+    underlying_error = getattr(error, "socket_err", None) or error
+    if isinstance(underlying_error, socks.SOCKS5Error):
+        try:
+            reply_code = int(str(underlying_error).split(":", 1)[0], 16)
+        except ValueError:
+            reply_code = REP_GENERAL_FAILURE
+        return reply_code, reply_code == REP_GENERAL_FAILURE
+    if isinstance(underlying_error, (socket.timeout, asyncio.TimeoutError)):
+        return REP_TTL_EXPIRED, True
+    return REP_GENERAL_FAILURE, True
+
+def _report_backend_connect_failure(backend_port):
+    """把一次通过后端连接目标的失败计入后端健康统计; 工作进程中转交协调器记录。"""
+    if socks_worker_id is not None:
+        try:
+            _coordinator_call("health", backend_port, None)
+        except Exception as e:
+            logging.warning(f"SOCKS工作进程 {socks_worker_id}: 向协调器报告后端端口 {backend_port} 的连接失败时出错: {e}")
+        return
+    _record_backend_health(backend_port, None)
+
+def _release_backend_after_connect_attempt(backend_port, backend_failed, session_key=None):
+    """归还一次未被采用的连接尝试所用的后端; 后端故障时先记录健康失败，归还时按出错处理 (刷新或验证)。"""
+    if backend_failed:
+        _report_backend_connect_failure(backend_port)
+    _finish_socks_backend_usage(backend_port, had_error=backend_failed, session_key=session_key)
+
+connect_attempt_executor = None # 连接尝试和归还后端的线程池，首次竞速或归还时创建
+connect_attempt_executor_lock = threading.Lock()
+
+def _connect_attempt_executor():
+    global connect_attempt_executor
+    with connect_attempt_executor_lock:
+        if connect_attempt_executor is None:
+            connect_attempt_executor = ThreadPoolExecutor(max_workers=max(SOCKS_CONNECT_THREADS, 1), thread_name_prefix="connect-attempt")
+        return connect_attempt_executor
+
+async_acquire_executor = None # asyncio 模式获取后端的线程池，首次获取时创建
+
+def _async_acquire_executor():
+    global async_acquire_executor
+    with connect_attempt_executor_lock:
+        if async_acquire_executor is None:
+            async_acquire_executor = ThreadPoolExecutor(max_workers=max(SOCKS_ASYNC_ACQUIRE_THREADS, 1), thread_name_prefix="socks-acquire")
+        return async_acquire_executor
+
+def _discard_connect_attempt(backend_port, connection, error, session_key=None):
+    """关闭一次未被采用的连接尝试 (若已连通) 并归还其后端。"""
+    if connection is not None:
+        connection.close()
+        _release_backend_after_connect_attempt(backend_port, False, session_key)
+    else:
+        _release_backend_after_connect_attempt(backend_port, _classify_backend_connect_error(error)[1], session_key)
+
+class _ConnectAttempts:
+    """
+    一个CONNECT请求的各次连接尝试 (线程模式)。尝试的结果 (后端端口, 连接, 异常) 放入 results;
+    请求放弃等待后才结束的尝试由执行它的线程直接关闭连接并归还后端，不再另起线程收尾。
+    """
+    def __init__(self, target_host_str, target_port_int, deadline, session_key=None):
+        self.target_host_str = target_host_str
+        self.target_port_int = target_port_int
+        self.deadline = deadline
+        self.session_key = session_key
+        self.results = Queue()
+        self.lock = threading.Lock()
+        self.abandoned = False # 由 lock 保护
+
+    def run(self, backend_port):
+        """执行一次连接尝试。超时从实际开始执行时算起，在线程池中排队的时间不会让尝试超过总时限。"""
+        timeout = max(min(SOCKS_BACKEND_CONNECT_TIMEOUT, self.deadline - time.monotonic()), 0.1)
+        try:
+            connection = _open_backend_connection(backend_port, self.target_host_str, self.target_port_int, timeout=timeout)
+        except Exception as e:
+            self._report(backend_port, None, e)
+            return
+        self._report(backend_port, connection, None)
+
+    def _report(self, backend_port, connection, error):
+        with self.lock:
+            if not self.abandoned:
+                self.results.put((backend_port, connection, error))
+                return
+        _discard_connect_attempt(backend_port, connection, error, self.session_key)
+
+    def abandon(self):
+        """放弃仍在进行的尝试: 之后结束的尝试自行收尾，已结束但未取走的结果交给线程池归还 (可能需要验证后端)。"""
+        with self.lock:
+            self.abandoned = True
+        while True:
             try:
-                client_socket.sendall(reply)
-            except Exception as e_send:
-                logging.warning(f"SOCKS处理器 {client_ip_str}: 发送DNS错误回复时失败: {e_send}")
-            _release_backend_port_after_socks_usage(acquired_backend_port, refresh_ip_flag=False)
-            acquired_backend_port = None
+                backend_port, connection, error = self.results.get_nowait()
+            except Empty:
+                return
+            _connect_attempt_executor().submit(_discard_connect_attempt, backend_port, connection, error, self.session_key)
+
+def _connect_target_with_failover(first_backend_port, client_address_tuple, target_host_str, target_port_int, session_key=None):
+    """
+    通过后端连接目标 (线程模式)，整个过程不超过 SOCKS_CONNECT_DEADLINE 秒，单个后端不超过 SOCKS_BACKEND_CONNECT_TIMEOUT 秒。
+    后端故障时换一个后端重试，最多使用 SOCKS_CONNECT_MAX_ATTEMPTS 个后端。设置了 SOCKS_CONNECT_RACE_DELAY 时，
+    第一个后端在该时间内未连通则再用一个后端并行连接，先成功者胜出，落败的连接由其尝试线程关闭并归还。
+    不竞速时连接尝试直接在当前线程中进行; 竞速的尝试和故障后端的归还在有界线程池 (SOCKS_CONNECT_THREADS) 中进行。
+    共享模式下 (BACKEND_MAX_SESSIONS > 1) 竞速或重试取回的可能是本请求正在使用的后端，此时归还它，不在同一后端上重复尝试。
+    粘性会话必须保持出口IP，只使用会话绑定的后端。
+    成功时返回 (后端端口, 连接); 失败时所有后端都已 (或将在线程池中) 归还，返回 (None, 回复给客户端的状态码)。
+    """
+    client_ip_str = client_address_tuple[0]
+    allow_failover = not session_key
+    deadline = time.monotonic() + SOCKS_CONNECT_DEADLINE
+    race_at = time.monotonic() + SOCKS_CONNECT_RACE_DELAY if allow_failover and SOCKS_CONNECT_RACE_DELAY > 0 else None
+    attempts = _ConnectAttempts(target_host_str, target_port_int, deadline, session_key)
+    pending_ports = [] # 进行中的尝试所用的后端，每次尝试一项
+    attempted_count = 0
+    failure_reply_code = REP_GENERAL_FAILURE
+
+    def start_attempt(backend_port, inline):
+        nonlocal attempted_count
+        attempted_count += 1
+        pending_ports.append(backend_port)
+        if inline:
+            attempts.run(backend_port) # 不会有并行的尝试，直接在当前线程中连接
+        else:
+            _connect_attempt_executor().submit(attempts.run, backend_port)
+
+    def release_duplicate_backend(backend_port):
+        """共享模式下取回的后端已被本请求使用 (再计了一次会话)，归还多出的这次会话。"""
+        logging.info(f"SOCKS处理器 {client_ip_str}: 取回的后端 {backend_port} 已被本请求使用，不再在其上重复尝试。")
+        _release_backend_after_connect_attempt(backend_port, False, session_key)
+
+    start_attempt(first_backend_port, inline=race_at is None)
+    while pending_ports:
+        now = time.monotonic()
+        if now >= deadline:
+            failure_reply_code = REP_TTL_EXPIRED
+            logging.warning(f"SOCKS处理器 {client_ip_str}: 连接到 {target_host_str}:{target_port_int} 超过总时限 {SOCKS_CONNECT_DEADLINE:.1f} 秒。")
+            break
+        wait_until = deadline if race_at is None else min(deadline, race_at)
+        try:
+            backend_port, connection, error = attempts.results.get(timeout=max(wait_until - now, 0))
+        except Empty:
+            if race_at is not None and time.monotonic() >= race_at:
+                race_at = None
+                racing_port = None
+                if attempted_count < SOCKS_CONNECT_MAX_ATTEMPTS:
+                    racing_port = _acquire_backend_port_for_socks(client_address_tuple, target_host_str, target_port_int, wait_seconds=0)
+                if racing_port is not None and racing_port in pending_ports:
+                    release_duplicate_backend(racing_port)
+                elif racing_port is not None:
+                    logging.info(f"SOCKS处理器 {client_ip_str}: 后端 {sorted(pending_ports)} 在 {SOCKS_CONNECT_RACE_DELAY:.2f} 秒内未连通，"
+                                 f"使用后端 {racing_port} 并行连接 {target_host_str}:{target_port_int}。")
+                    _metrics_inc("warp_pool_socks_connect_failovers_total", (("reason", "race"),))
+                    start_attempt(racing_port, inline=False)
+            continue
+
+        pending_ports.remove(backend_port)
+        if error is None:
+            if pending_ports:
+                logging.info(f"SOCKS处理器 {client_ip_str}: 后端 {backend_port} 率先连通，放弃后端 {sorted(pending_ports)} 上的连接尝试。")
+                attempts.abandon()
+            return backend_port, connection
+
+        failure_reply_code, backend_failed = _classify_backend_connect_error(error)
+        logging.warning(f"SOCKS处理器 {client_ip_str}: 通过后端WARP {_backend_address_label(backend_port)} 连接到 {target_host_str}:{target_port_int} 失败 "
+                        f"({'后端故障' if backend_failed else f'目标错误 0x{failure_reply_code:02x}'})。错误: {error!r}")
+        next_backend_port = None
+        if backend_failed and allow_failover and not pending_ports and attempted_count < SOCKS_CONNECT_MAX_ATTEMPTS:
+            # 先取得下一个后端再归还故障后端，避免立即取回同一个后端
+            next_backend_port = _acquire_backend_port_for_socks(
+                client_address_tuple, target_host_str, target_port_int,
+                wait_seconds=min(SOCKS_CONNECT_WAIT, max(deadline - time.monotonic(), 0))
+            )
+        if next_backend_port is not None and next_backend_port == backend_port:
+            release_duplicate_backend(next_backend_port)
+            next_backend_port = None
+        _connect_attempt_executor().submit(_release_backend_after_connect_attempt, backend_port, backend_failed, session_key)
+        if not backend_failed:
+            break
+        if next_backend_port is not None:
+            logging.info(f"SOCKS处理器 {client_ip_str}: 改用后端 {next_backend_port} 重试连接 {target_host_str}:{target_port_int}。")
+            _metrics_inc("warp_pool_socks_connect_failovers_total", (("reason", "retry"),))
+            start_attempt(next_backend_port, inline=race_at is None)
+
+    if pending_ports:
+        attempts.abandon()
+    return None, failure_reply_code
+
+def handle_socks_client_connection(client_socket, client_address_tuple):
+    """处理单个SOCKS5客户端连接。正常的连接只输出一条会话摘要日志。"""
+    client_ip_str = client_address_tuple[0]
+    session_log = SocksSessionLog("threaded", client_address_tuple)
+    session_log.trace("新客户端连接")
+    _metrics_inc("warp_pool_socks_connections_total", (("mode", "threaded"),))
+    handshake_started_at = time.monotonic()
+    
+    acquired_backend_port = None
+    remote_connection_to_target = None
+    relay_bytes = None
+    session_key = None
+    connection_set_up = False
+    handshaking = True
+    
+    try:
+        client_socket.settimeout(SOCKS_HANDSHAKE_TIMEOUT)
+        handshake_reader = SocksHandshakeReader(client_socket)
+        ver_nmethods = handshake_reader.read_exactly(2)
+        if not ver_nmethods or ver_nmethods[0] != SOCKS_VERSION:
+            session_log.fields["result"] = "bad_version" if ver_nmethods else "client_closed"
+            session_log.trace("无效的SOCKS版本。应为 %s, 收到 %s。", SOCKS_VERSION, ver_nmethods[0] if ver_nmethods else None)
+            return
+        
+        num_auth_methods = ver_nmethods[1]
+        auth_methods_offered = handshake_reader.read_exactly(num_auth_methods)
+        if auth_methods_offered is None:
+            session_log.fields["result"] = "client_closed"
+            session_log.trace("客户端在方法协商阶段关闭了连接。")
+            return
+        auth_method = _select_socks_auth_method(auth_methods_offered)
+        if auth_method == AUTH_METHOD_NO_ACCEPTABLE:
+            session_log.fields["result"] = "no_acceptable_auth"
+            session_log.trace("不支持的认证方法。客户端提供: %s。我们需要 0x00 (无认证) 或 0x02 (用户名/密码)。", auth_methods_offered.hex())
+            client_socket.sendall(struct.pack("!BB", SOCKS_VERSION, AUTH_METHOD_NO_ACCEPTABLE))
+            return
+        
+        client_socket.sendall(struct.pack("!BB", SOCKS_VERSION, auth_method))
+        if auth_method == AUTH_METHOD_USERNAME_PASSWORD:
+            auth_header = handshake_reader.read_exactly(2)
+            if not auth_header or auth_header[0] != USERPASS_AUTH_VERSION:
+                session_log.fields["result"] = "bad_auth_request" if auth_header else "client_closed"
+                session_log.trace("无效的用户名/密码认证请求。")
+                return
+            username_bytes = handshake_reader.read_exactly(auth_header[1])
+            password_len = handshake_reader.read_exactly(1)
+            password_bytes = handshake_reader.read_exactly(password_len[0]) if password_len else b''
+            if username_bytes is None or password_len is None or password_bytes is None:
+                session_log.fields["result"] = "client_closed"
+                session_log.trace("客户端在用户名/密码认证阶段关闭了连接。")
+                return
+            session_key = username_bytes.decode("utf-8", errors="replace")
+            if not _check_socks_credentials(session_key, password_bytes.decode("utf-8", errors="replace")):
+                # 认证失败可能意味着配置错误或探测，始终记录
+                logging.warning(f"SOCKS处理器 {client_ip_str}: 用户名/密码认证失败 (会话键 '{session_key}')。")
+                session_log.fields["result"] = "auth_failed"
+                client_socket.sendall(struct.pack("!BB", USERPASS_AUTH_VERSION, 0x01))
+                return
+            client_socket.sendall(struct.pack("!BB", USERPASS_AUTH_VERSION, 0x00))
+            session_key = session_key or None
+            session_log.fields["session"] = session_key
+            session_log.trace("握手成功 (用户名/密码认证，会话键 '%s')。", session_key)
+        else:
+            session_log.trace("握手成功 (无认证)。")
+
+        request_header = handshake_reader.read_exactly(4)
+        if not request_header or request_header[0] != SOCKS_VERSION:
+            session_log.fields["result"] = "bad_request" if request_header else "client_closed"
+            session_log.trace("请求中的SOCKS版本无效。")
+            return
+        
+        req_ver, req_cmd, req_rsv, req_atyp = request_header
+        
+        if req_cmd != CMD_CONNECT:
+            session_log.fields["result"] = "unsupported_command"
+            session_log.trace("不支持的命令 %s。仅支持 CONNECT (%s)。", req_cmd, CMD_CONNECT)
+            reply = _build_socks_reply(REP_COMMAND_NOT_SUPPORTED)
+            client_socket.sendall(reply)
+            return
+
+        target_host_str = ""
+        if req_atyp == ATYP_IPV4:
+            addr_bytes = handshake_reader.read_exactly(4)
+        elif req_atyp == ATYP_DOMAINNAME:
+            domain_len = handshake_reader.read_exactly(1)
+            addr_bytes = handshake_reader.read_exactly(domain_len[0]) if domain_len else None
+        elif req_atyp == ATYP_IPV6:
+            addr_bytes = handshake_reader.read_exactly(16)
+        else:
+            session_log.fields["result"] = "unsupported_address_type"
+            session_log.trace("不支持的地址类型 %s。", req_atyp)
+            reply = _build_socks_reply(REP_ADDRESS_TYPE_NOT_SUPPORTED)
+            client_socket.sendall(reply)
+            return
+            
+        target_port_bytes = handshake_reader.read_exactly(2) if addr_bytes is not None else None
+        if target_port_bytes is None:
+            session_log.fields["result"] = "client_closed"
+            session_log.trace("客户端在请求阶段关闭了连接。")
+            return
+        if req_atyp == ATYP_IPV4:
+            target_host_str = socket.inet_ntoa(addr_bytes)
+        elif req_atyp == ATYP_DOMAINNAME:
+            target_host_str = addr_bytes.decode("utf-8", errors="ignore")
+        else:
+            target_host_str = socket.inet_ntop(socket.AF_INET6, addr_bytes)
+        target_port_int = struct.unpack("!H", target_port_bytes)[0]
+        _end_socks_handshake_admission()
+        handshaking = False
+        _metrics_observe("warp_pool_socks_handshake_duration_seconds", time.monotonic() - handshake_started_at)
+        session_log.fields["target"] = f"{target_host_str}:{target_port_int}"
+        session_log.mark("handshake_ms")
+        session_log.trace("请求连接到 %s:%s", target_host_str, target_port_int)
+
+        if session_key:
+            acquired_backend_port = _acquire_sticky_backend_port(session_key, client_address_tuple, target_host_str, target_port_int)
+        else:
+            acquired_backend_port = _acquire_backend_port_for_socks(client_address_tuple, target_host_str, target_port_int)
+        if acquired_backend_port is None:
+            session_log.fields["result"] = "no_backend"
+            client_socket.sendall(_build_socks_reply(REP_GENERAL_FAILURE))
             return
-        except Exception as e_conn_target:
-            logging.error(f"SOCKS处理器 {client_ip_str}: 通过后端WARP {WARP_INSTANCE_IP}:{acquired_backend_port} 连接到 {target_host_str}:{target_port_int} 时发生未知错误。错误: {e_conn_target}")
-            reply = struct.pack("!BBBB", SOCKS_VERSION, REP_GENERAL_FAILURE, 0x00, ATYP_IPV4) + socket.inet_aton("0.0.0.0") + struct.pack("!H", 0)
+        session_log.trace("已获取后端WARP %s，正在连接到 %s:%s...", _backend_address_label(acquired_backend_port), target_host_str, target_port_int)
+
+        # 故障转移期间用过的后端都由 _connect_target_with_failover 归还，返回的是最终采用的后端
+        connected_backend_port, connect_result = _connect_target_with_failover(
+            acquired_backend_port, client_address_tuple, target_host_str, target_port_int, session_key
+        )
+        acquired_backend_port = connected_backend_port
+        session_log.mark("connect_ms")
+        if connected_backend_port is None:
+            session_log.fields["result"] = f"connect_failed_0x{connect_result:02x}"
             try:
-                client_socket.sendall(reply)
+                client_socket.sendall(_build_socks_reply(connect_result))
             except Exception as e_send:
-                logging.warning(f"SOCKS处理器 {client_ip_str}: 发送通用错误回复时失败: {e_send}")
-            _release_backend_port_after_socks_usage(acquired_backend_port, refresh_ip_flag=False)
-            acquired_backend_port = None
+                session_log.trace("发送错误回复时失败: %s", e_send)
             return
+        remote_connection_to_target = connect_result
+        session_log.fields["backend"] = acquired_backend_port
+        session_log.trace("已通过后端WARP %s 成功连接到 %s:%s", _backend_address_label(acquired_backend_port), target_host_str, target_port_int)
+        # 客户端在收到回复前已发送的数据 (例如 TLS ClientHello) 先于回复转发给目标，节省一个往返
+        early_data = handshake_reader.take_buffered()
+        if early_data:
+            remote_connection_to_target.sendall(early_data)
+            _metrics_inc("warp_pool_socks_early_data_bytes_total", value=len(early_data))
+
+        client_socket.sendall(_build_socks_reply(REP_SUCCESS))
+        _socks_connection_set_up()
+        connection_set_up = True
 
-        logging.info(f"SOCKS处理器 {client_ip_str}: 正在客户端和 {target_host_str}:{target_port_int} (通过后端 {acquired_backend_port}) 之间中继数据")
+        relay_engine_name, relay_forward_func = _select_relay_engine()
+        session_log.trace("正在客户端和 %s:%s (通过后端 %s) 之间中继数据 (引擎: %s)", target_host_str, target_port_int, acquired_backend_port, relay_engine_name)
         client_socket.settimeout(None)
         remote_connection_to_target.settimeout(None)
+        with relay_stats_lock:
+            relay_stats["sessions_by_engine"][relay_engine_name] += 1
 
         stop_event = threading.Event()
+        relay_bytes = {"client_to_target_bytes": len(early_data), "target_to_client_bytes": 0}
+        _record_relay_bytes("client_to_target_bytes", len(early_data))
+        relay_started_at = time.monotonic()
+        relay_activity = [relay_started_at] if _relay_timeouts_enabled() else None
+        bandwidth_bucket = _client_bandwidth_bucket(client_ip_str)
         
-        thread_client_to_target = threading.Thread(target=_forward_data, args=(client_socket, remote_connection_to_target, stop_event, f"客户端({client_ip_str})->目标({target_host_str})"))
-        thread_target_to_client = threading.Thread(target=_forward_data, args=(remote_connection_to_target, client_socket, stop_event, f"目标({target_host_str})->客户端({client_ip_str})"))
+        thread_client_to_target = threading.Thread(target=relay_forward_func, args=(client_socket, remote_connection_to_target, stop_event, f"客户端({client_ip_str})->目标({target_host_str})", relay_bytes, "client_to_target_bytes", session_log.traced, relay_activity, bandwidth_bucket))
+        thread_target_to_client = threading.Thread(target=relay_forward_func, args=(remote_connection_to_target, client_socket, stop_event, f"目标({target_host_str})->客户端({client_ip_str})", relay_bytes, "target_to_client_bytes", session_log.traced, relay_activity, bandwidth_bucket))
         
         thread_client_to_target.daemon = True
         thread_target_to_client.daemon = True
         thread_client_to_target.start()
         thread_target_to_client.start()
         
-        stop_event.wait()
-
-        logging.info(f"SOCKS处理器 {client_ip_str}: 与 {target_host_str}:{target_port_int} (后端 {acquired_backend_port}) 的数据中继已完成。")
+        relay_timeout = _wait_relay_finished(stop_event, relay_activity, relay_started_at)
+        # 一个方向结束后关闭双向传输，唤醒仍阻塞在另一方向上的转发线程，以便统计完整的字节数
+        for relay_sock in (client_socket, remote_connection_to_target):
+            try:
+                relay_sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        thread_client_to_target.join(timeout=2.0)
+        thread_target_to_client.join(timeout=2.0)
+        if relay_timeout is not None:
+            _metrics_inc("warp_pool_socks_relay_timeouts_total", (("reason", relay_timeout),))
+        session_log.fields["result"] = relay_timeout or "ok"
 
     except ConnectionResetError:
-        logging.warning(f"SOCKS处理器 {client_ip_str}: 客户端在操作期间重置了连接。")
+        session_log.fields["result"] = "client_reset"
     except BrokenPipeError:
-        logging.warning(f"SOCKS处理器 {client_ip_str}: 管道破裂 (客户端可能已关闭连接)。")
+        session_log.fields["result"] = "broken_pipe"
     except socket.timeout:
-        logging.warning(f"SOCKS处理器 {client_ip_str}: 在初始握手/请求阶段套接字超时。")
+        session_log.fields["result"] = "handshake_timeout"
     except Exception as e_handler:
         logging.error(f"SOCKS处理器 {client_ip_str}: 客户端处理器中发生未处理的错误: {e_handler}")
         import traceback
         logging.error(traceback.format_exc())
     finally:
-        logging.info(f"SOCKS处理器 {client_ip_str}: 正在清理SOCKS连接。")
         if remote_connection_to_target:
             try:
                 remote_connection_to_target.close()
             except Exception as e_close_remote:
-                logging.warning(f"SOCKS处理器 {client_ip_str}: 关闭到目标的连接时出错: {e_close_remote}")
+                session_log.trace("关闭到目标的连接时出错: %s", e_close_remote)
         try:
             client_socket.close()
         except Exception as e_close_client:
-            logging.warning(f"SOCKS处理器 {client_ip_str}: 关闭客户端连接时出错: {e_close_client}")
+            session_log.trace("关闭客户端连接时出错: %s", e_close_client)
         
         if acquired_backend_port is not None:
-            _release_backend_port_after_socks_usage(acquired_backend_port, refresh_ip_flag=True)
+            _finish_socks_backend_usage(acquired_backend_port, had_error=False, relay_bytes=relay_bytes, session_key=session_key)
         
-        logging.info(f"SOCKS处理器 {client_ip_str}: 连接已完全关闭，资源已处理。")
+        session_log.finish(relay_bytes)
+        _release_socks_client_admission(client_ip_str, handshaking)
+        _socks_connection_closed(connection_set_up)
 
-def start_central_socks5_server():
-    """初始化并启动SOCKS5代理服务器，监听客户端连接。"""
+def _create_socks_listener(reuse_port=False):
+    """创建绑定到 SOCKS_SERVER_HOST:SOCKS_SERVER_PORT 的监听套接字。多进程模式下每个工作进程一个，以 SO_REUSEPORT 共同监听。"""
     listener_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     listener_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # 多个工作进程共同监听同一端口，由内核分发新连接
+        listener_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     try:
         listener_socket.bind((SOCKS_SERVER_HOST, SOCKS_SERVER_PORT))
         listener_socket.listen(128)
-        logging.info(f"中央SOCKS5服务器已成功启动，监听地址 {SOCKS_SERVER_HOST}:{SOCKS_SERVER_PORT}")
-    except Exception as e_bind:
-        logging.critical(f"严重错误: 无法在 {SOCKS_SERVER_HOST}:{SOCKS_SERVER_PORT} 上绑定或启动SOCKS5服务器。错误: {e_bind}")
-        return
+    except Exception:
+        listener_socket.close()
+        raise
+    return listener_socket
 
+def start_central_socks5_server(listener_socket):
+    """在已绑定的监听套接字上运行SOCKS5代理服务器，接受客户端连接。"""
+    logging.info(f"中央SOCKS5服务器已成功启动，监听地址 {SOCKS_SERVER_HOST}:{SOCKS_SERVER_PORT}")
+    # 定期检查 socks_accepting，平滑重启时停止接受新连接 (未接受的连接留在监听队列中，由新进程接受)
+    listener_socket.settimeout(0.5)
     while True:
+        if not socks_accepting.is_set():
+            socks_accept_paused.set()
+            socks_accepting.wait()
+            socks_accept_paused.clear()
+            continue
         try:
             client_conn_socket, client_address_info = listener_socket.accept()
+        except socket.timeout:
+            continue
+        except Exception as e_accept:
+            logging.error(f"SOCKS服务器主循环: 接受新客户端连接时出错: {e_accept}")
+            time.sleep(0.01)
+            continue
+        # 超出准入限制的连接在接受线程中直接拒绝，不创建处理线程
+        if _admit_socks_client(client_address_info[0]) is not None:
+            _reject_socks_client(client_conn_socket)
+            continue
+        # 在接受连接的线程中计数，暂停接受后等待握手中的连接数归零时不会遗漏尚未启动的处理线程
+        _socks_connection_opened()
+        try:
             client_handler_thread = threading.Thread(
                 target=handle_socks_client_connection,
                 args=(client_conn_socket, client_address_info)
             )
             client_handler_thread.daemon = True
             client_handler_thread.start()
+        except Exception as e_start:
+            logging.error(f"SOCKS服务器主循环: 启动客户端处理线程时出错: {e_start}")
+            client_conn_socket.close()
+            _release_socks_client_admission(client_address_info[0], True)
+            _socks_connection_closed(False)
+
+# --- asyncio SOCKS5 服务器实现 ---
+# 在单个事件循环中完成所有客户端的握手、后端连接和数据中继，
+# 避免每个连接占用三个线程。代理池的获取/释放语义与线程模式完全一致。
+
+class BackendSocksError(Exception):
+    """后端WARP SOCKS5代理返回了失败回复或协议错误。reply_code 为应回复给客户端的状态码。"""
+    def __init__(self, message, reply_code=REP_GENERAL_FAILURE):
+        super().__init__(message)
+        self.reply_code = reply_code
+
+def _encode_socks_target_address(target_host_str):
+    """将目标主机编码为SOCKS5请求中的 ATYP + 地址字段。"""
+    try:
+        return struct.pack("!B", ATYP_IPV4) + socket.inet_aton(target_host_str)
+    except OSError:
+        pass
+    try:
+        return struct.pack("!B", ATYP_IPV6) + socket.inet_pton(socket.AF_INET6, target_host_str)
+    except OSError:
+        pass
+    host_bytes = target_host_str.encode("idna")
+    return struct.pack("!BB", ATYP_DOMAINNAME, len(host_bytes)) + host_bytes
+
+async def _async_open_backend_connection(backend_port, target_host_str, target_port_int):
+    """
+    通过后端WARP SOCKS5代理 (无认证) 异步连接到目标，返回 (reader, writer)。
+    后端返回失败时抛出 BackendSocksError。
+    """
+    reader, writer = await asyncio.open_connection(*_backend_address(backend_port))
+    try:
+        writer.write(struct.pack("!BBB", SOCKS_VERSION, 1, 0x00))
+        method_reply = await reader.readexactly(2)
+        if method_reply[0] != SOCKS_VERSION or method_reply[1] != 0x00:
+            raise BackendSocksError(f"后端拒绝了无认证方法: {method_reply.hex()}")
+
+        writer.write(struct.pack("!BBB", SOCKS_VERSION, CMD_CONNECT, 0x00)
+                     + _encode_socks_target_address(target_host_str)
+                     + struct.pack("!H", target_port_int))
+        reply_header = await reader.readexactly(4)
+        if reply_header[0] != SOCKS_VERSION:
+            raise BackendSocksError(f"后端回复了无效的SOCKS版本: {reply_header[0]}")
+        if reply_header[1] != REP_SUCCESS:
+            raise BackendSocksError(f"后端回复失败状态码 {reply_header[1]}", reply_code=reply_header[1])
+
+        # 读取并丢弃后端返回的绑定地址
+        bound_atyp = reply_header[3]
+        if bound_atyp == ATYP_IPV4:
+            await reader.readexactly(4 + 2)
+        elif bound_atyp == ATYP_IPV6:
+            await reader.readexactly(16 + 2)
+        elif bound_atyp == ATYP_DOMAINNAME:
+            bound_len = (await reader.readexactly(1))[0]
+            await reader.readexactly(bound_len + 2)
+        else:
+            raise BackendSocksError(f"后端回复了未知的地址类型: {bound_atyp}")
+        return reader, writer
+    except BaseException:
+        writer.close()
+        raise
+
+async def _async_backend_connect_attempt(backend_port, target_host_str, target_port_int, timeout):
+    """asyncio 模式下的一次连接尝试，返回 (reader, writer) 并记录连接耗时。"""
+    connect_started_at = time.monotonic()
+    try:
+        backend_streams = await asyncio.wait_for(
+            _async_open_backend_connection(backend_port, target_host_str, target_port_int),
+            timeout=timeout
+        )
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        _metrics_observe("warp_pool_backend_connect_duration_seconds", time.monotonic() - connect_started_at, (("result", "failure"),))
+        raise
+    _metrics_observe("warp_pool_backend_connect_duration_seconds", time.monotonic() - connect_started_at, (("result", "success"),))
+    return backend_streams
+
+async def _async_connect_target_with_failover(first_backend_port, client_address_tuple, target_host_str, target_port_int, session_key=None):
+    """
+    _connect_target_with_failover 的 asyncio 版本: 每次尝试是一个任务，落败的竞速任务被直接取消。
+    成功时返回 (后端端口, (reader, writer)); 失败时返回 (None, 回复给客户端的状态码)。
+    """
+    loop = asyncio.get_running_loop()
+    client_ip_str = client_address_tuple[0]
+    allow_failover = not session_key
+    deadline = loop.time() + SOCKS_CONNECT_DEADLINE
+    race_at = loop.time() + SOCKS_CONNECT_RACE_DELAY if allow_failover and SOCKS_CONNECT_RACE_DELAY > 0 else None
+    attempt_tasks = {} # 任务 -> 后端端口
+    attempted_count = 0
+    failure_reply_code = REP_GENERAL_FAILURE
+    winner = None
+
+    def start_attempt(backend_port):
+        nonlocal attempted_count
+        attempted_count += 1
+        attempt_timeout = max(min(SOCKS_BACKEND_CONNECT_TIMEOUT, deadline - loop.time()), 0.1)
+        attempt_tasks[asyncio.ensure_future(
+            _async_backend_connect_attempt(backend_port, target_host_str, target_port_int, attempt_timeout)
+        )] = backend_port
+
+    def release_in_background(backend_port, backend_failed):
+        # 归还可能包含阻塞的验证连接，交给线程池执行，不等待其完成
+        loop.run_in_executor(_connect_attempt_executor(), _release_backend_after_connect_attempt, backend_port, backend_failed, session_key)
+
+    start_attempt(first_backend_port)
+    try:
+        while attempt_tasks and winner is None:
+            now = loop.time()
+            if now >= deadline:
+                failure_reply_code = REP_TTL_EXPIRED
+                logging.warning(f"SOCKS处理器 {client_ip_str}: 连接到 {target_host_str}:{target_port_int} 超过总时限 {SOCKS_CONNECT_DEADLINE:.1f} 秒。")
+                break
+            wait_until = deadline if race_at is None else min(deadline, race_at)
+            done, _ = await asyncio.wait(list(attempt_tasks), timeout=max(wait_until - now, 0), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if race_at is not None and loop.time() >= race_at:
+                    race_at = None
+                    racing_port = None
+                    if attempted_count < SOCKS_CONNECT_MAX_ATTEMPTS:
+                        racing_port = await loop.run_in_executor(
+                            _async_acquire_executor(), _acquire_backend_port_for_socks, client_address_tuple, target_host_str, target_port_int, 0
+                        )
+                    if racing_port is not None and racing_port in attempt_tasks.values():
+                        # 共享模式下取回了本请求正在使用的后端，归还多出的这次会话，不在同一后端上重复尝试
+                        release_in_background(racing_port, False)
+                    elif racing_port is not None:
+                        logging.info(f"SOCKS处理器 {client_ip_str}: 后端 {sorted(attempt_tasks.values())} 在 {SOCKS_CONNECT_RACE_DELAY:.2f} 秒内未连通，"
+                                     f"使用后端 {racing_port} 并行连接 {target_host_str}:{target_port_int}。")
+                        _metrics_inc("warp_pool_socks_connect_failovers_total", (("reason", "race"),))
+                        start_attempt(racing_port)
+                continue
+
+            target_failed = False
+            for task in done:
+                backend_port = attempt_tasks.pop(task)
+                error = task.exception()
+                if error is None:
+                    if winner is None:
+                        winner = (backend_port, task.result())
+                    else:
+                        # 同时完成的另一个成功连接落败
+                        await _async_close_writer(task.result()[1])
+                        release_in_background(backend_port, False)
+                    continue
+                failure_reply_code, backend_failed = _classify_backend_connect_error(error)
+                logging.warning(f"SOCKS处理器 {client_ip_str}: 通过后端WARP {_backend_address_label(backend_port)} 连接到 {target_host_str}:{target_port_int} 失败 "
+                                f"({'后端故障' if backend_failed else f'目标错误 0x{failure_reply_code:02x}'})。错误: {error!r}")
+                next_backend_port = None
+                if (backend_failed and allow_failover and winner is None and not attempt_tasks
+                        and attempted_count < SOCKS_CONNECT_MAX_ATTEMPTS):
+                    # 先取得下一个后端再归还故障后端，避免立即取回同一个后端
+                    next_backend_port = await loop.run_in_executor(
+                        _async_acquire_executor(), _acquire_backend_port_for_socks, client_address_tuple, target_host_str, target_port_int,
+                        min(SOCKS_CONNECT_WAIT, max(deadline - loop.time(), 0))
+                    )
+                if next_backend_port is not None and next_backend_port == backend_port:
+                    release_in_background(next_backend_port, False)
+                    next_backend_port = None
+                release_in_background(backend_port, backend_failed)
+                target_failed = target_failed or not backend_failed
+                if next_backend_port is not None:
+                    logging.info(f"SOCKS处理器 {client_ip_str}: 改用后端 {next_backend_port} 重试连接 {target_host_str}:{target_port_int}。")
+                    _metrics_inc("warp_pool_socks_connect_failovers_total", (("reason", "retry"),))
+                    start_attempt(next_backend_port)
+            if target_failed and winner is None:
+                break
+    finally:
+        # 取消仍在进行的尝试 (竞速落败、超过总时限、目标错误或处理器被取消)，并归还它们的后端
+        for task in attempt_tasks:
+            task.cancel()
+        if attempt_tasks:
+            if winner is not None:
+                logging.info(f"SOCKS处理器 {client_ip_str}: 后端 {winner[0]} 率先连通，取消后端 {sorted(attempt_tasks.values())} 上的连接尝试。")
+            await asyncio.gather(*attempt_tasks, return_exceptions=True)
+        for task, backend_port in attempt_tasks.items():
+            if not task.cancelled() and task.exception() is None:
+                await _async_close_writer(task.result()[1])
+            release_in_background(backend_port, False)
+
+    if winner is not None:
+        return winner
+    return None, failure_reply_code
+
+async def _async_forward_data(reader, writer, direction_log, relay_bytes=None, direction_key=None, trace=False,
+                              relay_activity=None, bandwidth_bucket=None):
+    """
+    在两个流之间转发数据，直到源端关闭或出错。trace 为 True 时输出逐步骤的调试日志。
+    relay_activity 和 bandwidth_bucket 的含义与线程模式的 _forward_data 相同。
+    """
+    transferred = 0
+    try:
+        while True:
+            data = await reader.read(RELAY_BUFFER_SIZE)
+            if not data:
+                if trace:
+                    socks_trace_logger.debug("转发器 %s: 源连接已关闭 (收到空数据)。", direction_log)
+                break
+            if relay_activity is not None:
+                relay_activity[0] = time.monotonic()
+            if bandwidth_bucket is not None:
+                throttle_delay = bandwidth_bucket.consume(len(data))
+                if throttle_delay:
+                    await asyncio.sleep(throttle_delay)
+            writer.write(data)
+            await writer.drain()
+            transferred += len(data)
+    except (ConnectionResetError, BrokenPipeError):
+        if trace:
+            socks_trace_logger.debug("转发器 %s: 连接被对方重置。", direction_log)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logging.error(f"转发器 {direction_log}: 转发时出错: {e}")
+    finally:
+        if trace:
+            socks_trace_logger.debug("转发器 %s: 正在停止。", direction_log)
+        if direction_key is not None:
+            if relay_bytes is not None:
+                relay_bytes[direction_key] += transferred
+            _record_relay_bytes(direction_key, transferred)
+
+async def _async_close_writer(writer):
+    """关闭一个 StreamWriter，忽略关闭过程中的错误。"""
+    try:
+        writer.close()
+        await writer.wait_closed()
+    except Exception:
+        pass
+
+async def _async_read_socks_request(reader, writer, session_log):
+    """
+    完成SOCKS5方法协商 (含可选的用户名/密码认证) 并读取CONNECT请求。
+    成功时返回 (target_host_str, target_port_int, session_key)，已回复错误或协议无效时返回 None，
+    失败原因记录在 session_log 的 result 字段中。
+    """
+    ver_nmethods = await reader.readexactly(2)
+    if ver_nmethods[0] != SOCKS_VERSION:
+        session_log.fields["result"] = "bad_version"
+        session_log.trace("无效的SOCKS版本。应为 %s, 收到 %s。", SOCKS_VERSION, ver_nmethods[0])
+        return None
+
+    auth_methods_offered = await reader.readexactly(ver_nmethods[1])
+    auth_method = _select_socks_auth_method(auth_methods_offered)
+    if auth_method == AUTH_METHOD_NO_ACCEPTABLE:
+        session_log.fields["result"] = "no_acceptable_auth"
+        session_log.trace("不支持的认证方法。客户端提供: %s。我们需要 0x00 (无认证) 或 0x02 (用户名/密码)。", auth_methods_offered.hex())
+        writer.write(struct.pack("!BB", SOCKS_VERSION, AUTH_METHOD_NO_ACCEPTABLE))
+        await writer.drain()
+        return None
+
+    writer.write(struct.pack("!BB", SOCKS_VERSION, auth_method))
+    await writer.drain()
+    session_key = None
+    if auth_method == AUTH_METHOD_USERNAME_PASSWORD:
+        auth_version, username_len = await reader.readexactly(2)
+        if auth_version != USERPASS_AUTH_VERSION:
+            session_log.fields["result"] = "bad_auth_request"
+            session_log.trace("无效的用户名/密码认证请求。")
+            return None
+        session_key = (await reader.readexactly(username_len)).decode("utf-8", errors="replace")
+        password_len = (await reader.readexactly(1))[0]
+        password = (await reader.readexactly(password_len)).decode("utf-8", errors="replace")
+        if not _check_socks_credentials(session_key, password):
+            # 认证失败可能意味着配置错误或探测，始终记录
+            logging.warning(f"SOCKS处理器 {session_log.fields['client']}: 用户名/密码认证失败 (会话键 '{session_key}')。")
+            session_log.fields["result"] = "auth_failed"
+            writer.write(struct.pack("!BB", USERPASS_AUTH_VERSION, 0x01))
+            await writer.drain()
+            return None
+        writer.write(struct.pack("!BB", USERPASS_AUTH_VERSION, 0x00))
+        await writer.drain()
+        session_key = session_key or None
+        session_log.fields["session"] = session_key
+        session_log.trace("握手成功 (用户名/密码认证，会话键 '%s')。", session_key)
+    else:
+        session_log.trace("握手成功 (无认证)。")
+
+    req_ver, req_cmd, req_rsv, req_atyp = await reader.readexactly(4)
+    if req_ver != SOCKS_VERSION:
+        session_log.fields["result"] = "bad_request"
+        session_log.trace("请求中的SOCKS版本无效。")
+        return None
+
+    if req_cmd != CMD_CONNECT:
+        session_log.fields["result"] = "unsupported_command"
+        session_log.trace("不支持的命令 %s。仅支持 CONNECT (%s)。", req_cmd, CMD_CONNECT)
+        writer.write(_build_socks_reply(REP_COMMAND_NOT_SUPPORTED))
+        await writer.drain()
+        return None
+
+    if req_atyp == ATYP_IPV4:
+        target_host_str = socket.inet_ntoa(await reader.readexactly(4))
+    elif req_atyp == ATYP_DOMAINNAME:
+        domain_len = (await reader.readexactly(1))[0]
+        target_host_str = (await reader.readexactly(domain_len)).decode("utf-8", errors="ignore")
+    elif req_atyp == ATYP_IPV6:
+        target_host_str = socket.inet_ntop(socket.AF_INET6, await reader.readexactly(16))
+    else:
+        session_log.fields["result"] = "unsupported_address_type"
+        session_log.trace("不支持的地址类型 %s。", req_atyp)
+        writer.write(_build_socks_reply(REP_ADDRESS_TYPE_NOT_SUPPORTED))
+        await writer.drain()
+        return None
+
+    target_port_int = struct.unpack("!H", await reader.readexactly(2))[0]
+    return target_host_str, target_port_int, session_key
+
+async def async_handle_socks_client_connection(client_reader, client_writer):
+    """在事件循环中处理单个SOCKS5客户端连接。正常的连接只输出一条会话摘要日志。"""
+    client_address_tuple = client_writer.get_extra_info('peername') or ('unknown', 0)
+    client_ip_str = client_address_tuple[0]
+    if _admit_socks_client(client_ip_str) is not None:
+        # 超出准入限制: 不读取握手数据，回复"没有可接受的认证方法"后关闭
+        client_writer.write(struct.pack("!BB", SOCKS_VERSION, AUTH_METHOD_NO_ACCEPTABLE))
+        client_writer.close()
+        return
+    session_log = SocksSessionLog("asyncio", client_address_tuple)
+    session_log.trace("新客户端连接 (asyncio)")
+    _metrics_inc("warp_pool_socks_connections_total", (("mode", "asyncio"),))
+    _socks_connection_opened()
+    handshake_started_at = time.monotonic()
+
+    acquired_backend_port = None
+    backend_writer = None
+    relay_bytes = None
+    session_key = None
+    connection_set_up = False
+    handshaking = True
+
+    try:
+        socks_request = await asyncio.wait_for(
+            _async_read_socks_request(client_reader, client_writer, session_log),
+            timeout=SOCKS_HANDSHAKE_TIMEOUT
+        )
+        if socks_request is None:
+            return
+        _end_socks_handshake_admission()
+        handshaking = False
+        target_host_str, target_port_int, session_key = socks_request
+        _metrics_observe("warp_pool_socks_handshake_duration_seconds", time.monotonic() - handshake_started_at)
+        session_log.fields["target"] = f"{target_host_str}:{target_port_int}"
+        session_log.mark("handshake_ms")
+        session_log.trace("请求连接到 %s:%s", target_host_str, target_port_int)
+
+        acquire_func = _acquire_backend_port_for_socks
+        acquire_args = (client_address_tuple, target_host_str, target_port_int)
+        if session_key:
+            acquire_func = _acquire_sticky_backend_port
+            acquire_args = (session_key,) + acquire_args
+        # 获取后端需要 proxy_lock (粘性会话还需要 sticky_lock)，刷新、回收和API线程持有这些锁时会阻塞调用线程;
+        # 等待队列和工作进程中与协调器的往返同样会阻塞。始终放到独立的线程池中执行，事件循环上的其他会话不受影响，
+        # 等待中的获取也不会占满默认线程池而使归还排队
+        acquired_backend_port = await asyncio.get_running_loop().run_in_executor(_async_acquire_executor(), acquire_func, *acquire_args)
+        if acquired_backend_port is None:
+            session_log.fields["result"] = "no_backend"
+            client_writer.write(_build_socks_reply(REP_GENERAL_FAILURE))
+            await client_writer.drain()
+            return
+        session_log.trace("已获取后端WARP %s，正在连接到 %s:%s...", _backend_address_label(acquired_backend_port), target_host_str, target_port_int)
+
+        # 故障转移期间用过的后端都由 _async_connect_target_with_failover 归还，返回的是最终采用的后端
+        connected_backend_port, connect_result = await _async_connect_target_with_failover(
+            acquired_backend_port, client_address_tuple, target_host_str, target_port_int, session_key
+        )
+        acquired_backend_port = connected_backend_port
+        session_log.mark("connect_ms")
+        if connected_backend_port is None:
+            session_log.fields["result"] = f"connect_failed_0x{connect_result:02x}"
+            try:
+                client_writer.write(_build_socks_reply(connect_result))
+                await client_writer.drain()
+            except Exception as e_send:
+                session_log.trace("发送错误回复时失败: %s", e_send)
+            return
+        backend_reader, backend_writer = connect_result
+        session_log.fields["backend"] = acquired_backend_port
+
+        session_log.trace("已通过后端WARP %s 成功连接到 %s:%s", _backend_address_label(acquired_backend_port), target_host_str, target_port_int)
+        session_log.trace("正在客户端和 %s:%s (通过后端 %s) 之间中继数据 (引擎: asyncio)", target_host_str, target_port_int, acquired_backend_port)
+        with relay_stats_lock:
+            relay_stats["sessions_by_engine"]["asyncio"] += 1
+        relay_bytes = {"client_to_target_bytes": 0, "target_to_client_bytes": 0}
+        relay_started_at = time.monotonic()
+        relay_activity = [relay_started_at] if _relay_timeouts_enabled() else None
+        bandwidth_bucket = _client_bandwidth_bucket(client_ip_str)
+        # 先启动客户端->目标方向的转发再发送回复: 客户端在回复之前已发送、仍留在 StreamReader
+        # 缓冲区中的乐观数据会立即转发给目标，而不必等待回复写出
+        relay_tasks = [
+            asyncio.ensure_future(_async_forward_data(client_reader, backend_writer, f"客户端({client_ip_str})->目标({target_host_str})", relay_bytes, "client_to_target_bytes", session_log.traced, relay_activity, bandwidth_bucket)),
+        ]
+        client_writer.write(_build_socks_reply(REP_SUCCESS))
+        await client_writer.drain()
+        _socks_connection_set_up()
+        connection_set_up = True
+        relay_tasks.append(
+            asyncio.ensure_future(_async_forward_data(backend_reader, client_writer, f"目标({target_host_str})->客户端({client_ip_str})", relay_bytes, "target_to_client_bytes", session_log.traced, relay_activity, bandwidth_bucket))
+        )
+        # 任一方向结束即视为会话结束，与线程模式的 stop_event 语义一致; 中继空闲超时或达到最长时长时也结束会话
+        relay_timeout = None
+        while True:
+            done, pending = await asyncio.wait(relay_tasks, return_when=asyncio.FIRST_COMPLETED,
+                                               timeout=RELAY_TIMEOUT_CHECK_INTERVAL if relay_activity is not None else None)
+            if done:
+                break
+            relay_timeout = _relay_timeout_reason(relay_activity, relay_started_at)
+            if relay_timeout is not None:
+                break
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if relay_timeout is not None:
+            _metrics_inc("warp_pool_socks_relay_timeouts_total", (("reason", relay_timeout),))
+        session_log.fields["result"] = relay_timeout or "ok"
+
+    except asyncio.IncompleteReadError:
+        session_log.fields["result"] = "client_closed"
+    except asyncio.TimeoutError:
+        session_log.fields["result"] = "handshake_timeout"
+    except (ConnectionResetError, BrokenPipeError):
+        session_log.fields["result"] = "client_reset"
+    except Exception as e_handler:
+        logging.error(f"SOCKS处理器 {client_ip_str}: 客户端处理器中发生未处理的错误: {e_handler}")
+        import traceback
+        logging.error(traceback.format_exc())
+    finally:
+        if backend_writer is not None:
+            await _async_close_writer(backend_writer)
+        await _async_close_writer(client_writer)
+
+        if acquired_backend_port is not None:
+            # 释放过程可能包含阻塞的验证连接，放到线程池中执行以免阻塞事件循环
+            await asyncio.get_running_loop().run_in_executor(
+                _connect_attempt_executor(), _finish_socks_backend_usage, acquired_backend_port, False, relay_bytes, session_key
+            )
+
+        session_log.finish(relay_bytes)
+        _release_socks_client_admission(client_ip_str, handshaking)
+        _socks_connection_closed(connection_set_up)
+
+async def _async_socks5_server_main(listener_socket):
+    """
+    在已绑定的监听套接字上运行 asyncio 监听服务器。
+    asyncio 服务器关闭时会关闭它使用的套接字，因此每次使用监听套接字的副本: 平滑重启暂停接受新连接时
+    关闭服务器，监听套接字本身保持打开，放弃重启时用新的副本重新启动服务器。
+    """
+    logging.info(f"中央SOCKS5服务器已成功启动 (asyncio 模式)，监听地址 {SOCKS_SERVER_HOST}:{SOCKS_SERVER_PORT}")
+    server = None
+    while True:
+        if socks_accepting.is_set() and server is None:
+            server = await asyncio.start_server(async_handle_socks_client_connection, sock=listener_socket.dup())
+            socks_accept_paused.clear()
+        elif not socks_accepting.is_set() and server is not None:
+            # 不等待 wait_closed(): 它会等到已有的连接全部结束
+            server.close()
+            server = None
+            # 关闭前已接受的连接可能尚未进入处理函数，让它们先完成计数
+            await asyncio.sleep(0.1)
+            socks_accept_paused.set()
+        await asyncio.sleep(0.5)
+
+def start_central_socks5_server_asyncio(listener_socket):
+    """在当前线程中运行 asyncio 事件循环版的中央SOCKS5服务器。"""
+    asyncio.run(_async_socks5_server_main(listener_socket))
+
+# --- 多进程模式: 协调器与SOCKS工作进程 ---
+# 协调器 (主进程) 持有代理池的全部状态，工作进程只负责SOCKS握手和数据中继。
+# 两者之间使用按行分隔的 JSON 请求/响应: {"op", "worker", "args"} -> {"result"} 或 {"error"}。
+
+socks_workers_lock = threading.Lock()
+socks_worker_processes = {} # 工作进程编号 -> subprocess.Popen (由 socks_workers_lock 保护)
+# 工作进程编号 -> {"metrics", "relay", "updated_at"}，最近一次上报的累计值 (由 socks_workers_lock 保护)。
+# 已退出工作进程的最后一次上报合并到 "retired" 条目，使汇总的计数器保持单调递增。
+socks_worker_stats = {}
+socks_worker_holds = {} # 工作进程编号 -> {(端口, 会话键): 数量}，工作进程尚未归还的后端 (由 socks_workers_lock 保护)
+coordinator_connections = [] # 工作进程中空闲的协调器连接 (由 coordinator_connections_lock 保护)
+coordinator_connections_lock = threading.Lock()
+# 协调器实际监听的套接字路径。平滑重启后新旧协调器同时运行，新进程在 POOL_COORDINATOR_SOCKET 后附加自己的PID，
+# 工作进程由 SOCKS_WORKER_COORDINATOR_SOCKET 得知所属协调器的路径
+pool_coordinator_socket_path = os.environ.get('SOCKS_WORKER_COORDINATOR_SOCKET') or POOL_COORDINATOR_SOCKET
+# 协调器下发给工作进程的平滑重启指令 {"generation", "action"}，action 为 'serve'、'pause' 或 'drain' (由 socks_workers_lock 保护)。
+# 工作进程随每次统计上报取得指令，并在下一次上报中回报执行到的代次和状态
+socks_worker_reload_command = {"generation": 0, "action": "serve"}
+
+def _coordinator_call(op, *args):
+    """工作进程: 向协调器发送一个请求并等待结果。连接在调用之间复用。"""
+    with coordinator_connections_lock:
+        connection = coordinator_connections.pop() if coordinator_connections else None
+    if connection is None:
+        coordinator_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            coordinator_socket.connect(pool_coordinator_socket_path)
+        except OSError:
+            coordinator_socket.close()
+            raise
+        connection = (coordinator_socket, coordinator_socket.makefile('rb'))
+    coordinator_socket, coordinator_reader = connection
+    try:
+        coordinator_socket.sendall(json.dumps({"op": op, "worker": socks_worker_id, "args": args}).encode("utf-8") + b"\n")
+        response_line = coordinator_reader.readline()
+        if not response_line:
+            raise ConnectionError("协调器关闭了连接")
+        response = json.loads(response_line)
+    except Exception:
+        coordinator_reader.close()
+        coordinator_socket.close()
+        raise
+    with coordinator_connections_lock:
+        coordinator_connections.append(connection)
+    if "error" in response:
+        raise RuntimeError(response["error"])
+    return response["result"]
+
+def _coordinator_acquire(session_key, client_address_tuple, target_host_str, target_port_int, wait_seconds=None):
+    """工作进程: 通过协调器获取后端端口，协调器不可用时返回 None。"""
+    try:
+        acquired = _coordinator_call("acquire", session_key, client_address_tuple, target_host_str, target_port_int, wait_seconds)
+    except Exception as e:
+        logging.error(f"SOCKS工作进程 {socks_worker_id}: 向协调器获取后端失败: {e}")
+        return None
+    if acquired is None:
+        return None
+    backend_port, backend_address = acquired
+    backend_direct_addresses[backend_port] = tuple(backend_address)
+    return backend_port
+
+def _coordinator_finish(backend_port, had_error, relay_bytes, session_key):
+    """工作进程: 通过协调器归还后端。协调器暂时不可用时重试，避免端口泄漏。"""
+    for attempt in range(5):
+        try:
+            _coordinator_call("finish", backend_port, had_error, relay_bytes, session_key)
+            return
+        except Exception as e:
+            logging.warning(f"SOCKS工作进程 {socks_worker_id}: 向协调器归还后端端口 {backend_port} 失败 (第 {attempt + 1} 次): {e}")
+            time.sleep(0.2 * (attempt + 1))
+    logging.error(f"SOCKS工作进程 {socks_worker_id}: 无法归还后端端口 {backend_port}，将在工作进程退出时由协调器回收。")
+
+def _serialize_metrics_totals(totals):
+    """将指标汇总转换为可 JSON 序列化的形式 (标签元组转为列表)。"""
+    return {
+        kind: [[name, [list(label) for label in labels], value] for (name, labels), value in totals[kind].items()]
+        for kind in ("counters", "histograms")
+    }
+
+def _deserialize_metrics_totals(serialized):
+    """_serialize_metrics_totals 的逆操作。"""
+    return {
+        kind: {(name, tuple(tuple(label) for label in labels)): value for name, labels, value in serialized[kind]}
+        for kind in ("counters", "histograms")
+    }
+
+def _coordinator_op_acquire(worker_id, session_key, client_address, target_host_str, target_port_int, wait_seconds=None):
+    """协调器: 为工作进程中的一个SOCKS连接获取后端，并记录该工作进程持有的后端。"""
+    client_address_tuple = tuple(client_address)
+    if session_key:
+        backend_port = _acquire_sticky_backend_port(session_key, client_address_tuple, target_host_str, target_port_int)
+    else:
+        backend_port = _acquire_backend_port_for_socks(client_address_tuple, target_host_str, target_port_int, wait_seconds)
+    if backend_port is None:
+        return None
+    with socks_workers_lock:
+        holds = socks_worker_holds.setdefault(worker_id, {})
+        holds[(backend_port, session_key)] = holds.get((backend_port, session_key), 0) + 1
+    # 工作进程没有代理池配置，连接后端所需的地址随端口一起返回
+    return [backend_port, list(_backend_address(backend_port))]
+
+def _coordinator_op_finish(worker_id, backend_port, had_error, relay_bytes, session_key):
+    """协调器: 归还工作进程中一个SOCKS会话使用的后端。"""
+    with socks_workers_lock:
+        holds = socks_worker_holds.get(worker_id, {})
+        hold_key = (backend_port, session_key)
+        if holds.get(hold_key, 0) <= 1:
+            holds.pop(hold_key, None)
+        else:
+            holds[hold_key] -= 1
+    _return_socks_backend(backend_port, had_error, relay_bytes, session_key)
+
+def _coordinator_op_health(worker_id, backend_port, latency):
+    """协调器: 记录工作进程观察到的一次后端连接结果。"""
+    _record_backend_health(backend_port, latency)
+
+def _coordinator_op_stats(worker_id, serialized_metrics, relay_snapshot, reload_report=None, admission_snapshot=None):
+    """
+    协调器: 保存工作进程上报的指标、中继统计 (均为累计值，覆盖上一次上报)、平滑重启状态和准入控制状态，
+    返回工作进程当前应执行的平滑重启指令。
+    """
+    with socks_workers_lock:
+        socks_worker_stats[worker_id] = {
+            "metrics": _deserialize_metrics_totals(serialized_metrics),
+            "relay": relay_snapshot,
+            "reload": reload_report,
+            "admission": admission_snapshot,
+            "updated_at": time.time()
+        }
+        return dict(socks_worker_reload_command)
+
+COORDINATOR_OPERATIONS = {
+    "acquire": _coordinator_op_acquire,
+    "finish": _coordinator_op_finish,
+    "health": _coordinator_op_health,
+    "stats": _coordinator_op_stats,
+}
+
+def _serve_coordinator_connection(connection):
+    """协调器: 依次处理一个工作进程连接上的请求。"""
+    reader = connection.makefile('rb')
+    try:
+        for request_line in reader:
+            request_data = json.loads(request_line)
+            operation = COORDINATOR_OPERATIONS.get(request_data.get("op"))
+            try:
+                if operation is None:
+                    raise ValueError(f"未知的操作: {request_data.get('op')}")
+                response = {"result": operation(request_data.get("worker"), *request_data.get("args", []))}
+            except Exception as e:
+                logging.error(f"协调器: 处理工作进程 {request_data.get('worker')} 的 '{request_data.get('op')}' 请求时出错: {e}")
+                response = {"error": str(e)}
+            connection.sendall(json.dumps(response).encode("utf-8") + b"\n")
+    except (OSError, ValueError) as e:
+        logging.debug(f"协调器: 工作进程连接已断开: {e}")
+    finally:
+        reader.close()
+        connection.close()
+
+def start_pool_coordinator():
+    """协调器: 在 pool_coordinator_socket_path 上监听工作进程连接，每个连接一个线程。"""
+    if os.path.exists(pool_coordinator_socket_path):
+        os.unlink(pool_coordinator_socket_path)
+    listener_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener_socket.bind(pool_coordinator_socket_path)
+    # 只有运行管理器的用户可以获取和归还后端
+    os.chmod(pool_coordinator_socket_path, 0o600)
+    listener_socket.listen(128)
+    logging.info(f"协调器: 正在监听 {pool_coordinator_socket_path}")
+    while True:
+        try:
+            connection, _ = listener_socket.accept()
+            threading.Thread(target=_serve_coordinator_connection, args=(connection,), daemon=True).start()
         except Exception as e_accept:
-            logging.error(f"SOCKS服务器主循环: 接受新客户端连接时出错: {e_accept}")
+            logging.error(f"协调器: 接受工作进程连接时出错: {e_accept}")
             time.sleep(0.01)
+
+def _release_worker_holds(worker_id):
+    """协调器: 工作进程退出后，归还它尚未归还的全部后端 (按出错处理)。"""
+    with socks_workers_lock:
+        holds = socks_worker_holds.pop(worker_id, {})
+        final_stats = socks_worker_stats.pop(worker_id, None)
+        if final_stats is not None:
+            retired_stats = socks_worker_stats.setdefault("retired", {
+                "metrics": {"counters": {}, "histograms": {}},
+                "relay": {"client_to_target_bytes": 0, "target_to_client_bytes": 0, "sessions_by_engine": {}},
+                "updated_at": None
+            })
+            _merge_metrics_shard(retired_stats["metrics"], final_stats["metrics"])
+            for direction_key in ("client_to_target_bytes", "target_to_client_bytes"):
+                retired_stats["relay"][direction_key] += final_stats["relay"][direction_key]
+            for engine_name, session_count in final_stats["relay"]["sessions_by_engine"].items():
+                retired_stats["relay"]["sessions_by_engine"][engine_name] = retired_stats["relay"]["sessions_by_engine"].get(engine_name, 0) + session_count
+    for (backend_port, session_key), hold_count in holds.items():
+        logging.warning(f"协调器: 工作进程 {worker_id} 退出时仍持有后端端口 {backend_port} ({hold_count} 个会话)，正在回收。")
+        for _ in range(hold_count):
+            _return_socks_backend(backend_port, had_error=True, session_key=session_key)
+
+def _run_socks_worker_process(worker_id, listener_socket):
+    """
+    协调器: 启动一个SOCKS工作进程，退出后回收其持有的后端并重新启动。
+    监听套接字由协调器持有并传给工作进程，工作进程重启期间到达的连接留在监听队列中。
+    """
+    while True:
+        worker_process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)],
+            pass_fds=(listener_socket.fileno(),),
+            env=dict(os.environ, SOCKS_WORKER_ID=str(worker_id), SOCKS_WORKER_LISTEN_FD=str(listener_socket.fileno()),
+                     SOCKS_WORKER_COORDINATOR_SOCKET=pool_coordinator_socket_path)
+        )
+        with socks_workers_lock:
+            socks_worker_processes[worker_id] = worker_process
+        logging.info(f"协调器: SOCKS工作进程 {worker_id} 已启动 (PID: {worker_process.pid})。")
+        return_code = worker_process.wait()
+        if reload_state["phase"] == 'handed_off':
+            # 已交接给新进程: 工作进程持有的后端由新进程在本进程退出后回收
+            logging.info(f"协调器: SOCKS工作进程 {worker_id} (PID: {worker_process.pid}) 已排空并退出，返回码 {return_code}。")
+            return
+        logging.error(f"协调器: SOCKS工作进程 {worker_id} (PID: {worker_process.pid}) 已退出，返回码 {return_code}，1 秒后重启。")
+        _release_worker_holds(worker_id)
+        time.sleep(1)
+        # 平滑重启暂停期间不启动新的工作进程，它会立即开始接受连接
+        while socks_worker_reload_command["action"] != 'serve' and reload_state["phase"] != 'handed_off':
+            time.sleep(0.5)
+        if reload_state["phase"] == 'handed_off':
+            return
+
+def _socks_workers_snapshot():
+    """返回各SOCKS工作进程的状态 (用于 /status 和 /metrics)。"""
+    now = time.time()
+    with socks_workers_lock:
+        return {
+            worker_id: {
+                "pid": worker_process.pid,
+                "alive": worker_process.poll() is None,
+                "backends_held": sum(socks_worker_holds.get(worker_id, {}).values()),
+                "admission": socks_worker_stats[worker_id]["admission"] if worker_id in socks_worker_stats else None,
+                "stats_age_seconds": round(now - socks_worker_stats[worker_id]["updated_at"], 1) if worker_id in socks_worker_stats else None
+            }
+            for worker_id, worker_process in socks_worker_processes.items()
+        }
+
+def _socks_worker_reload_report(generation):
+    """工作进程: 返回上报给协调器的平滑重启状态: 'serving'、'pausing' 或 'paused' (已停止接受新连接且没有握手中的连接)。"""
+    if socks_accepting.is_set():
+        mode = 'serving'
+    else:
+        with reload_cond:
+            mode = 'paused' if socks_accept_paused.is_set() and reload_state["socks_setting_up"] == 0 else 'pausing'
+    return {"generation": generation, "mode": mode}
+
+def _apply_socks_worker_reload_command(command):
+    """工作进程: 执行协调器下发的平滑重启指令。排空完成 (已停止接受新连接且没有任何连接) 时退出工作进程。"""
+    if command["action"] == 'serve':
+        socks_accepting.set()
+        return
+    socks_accepting.clear()
+    if command["action"] == 'drain' and socks_accept_paused.is_set():
+        with reload_cond:
+            idle = reload_state["socks_setting_up"] == 0 and reload_state["socks_relaying"] == 0
+        if idle:
+            logging.info("已交接给新进程，所有连接已结束，SOCKS工作进程退出。")
+            _exit_after_logs_flushed(0)
+
+def _socks_worker_stats_loop():
+    """
+    工作进程: 定期向协调器上报指标、中继统计和平滑重启状态，并执行协调器返回的平滑重启指令。
+    协调器不可用或已退出时结束工作进程。
+    """
+    coordinator_pid = os.getppid()
+    consecutive_failures = 0
+    reload_command = {"generation": 0, "action": "serve"}
+    while True:
+        time.sleep(SOCKS_WORKER_STATS_INTERVAL)
+        if os.getppid() != coordinator_pid:
+            logging.error("协调器进程已退出，SOCKS工作进程随之退出。")
+            os._exit(1)
+        with relay_stats_lock:
+            relay_snapshot = dict(relay_stats)
+            relay_snapshot["sessions_by_engine"] = dict(relay_stats["sessions_by_engine"])
+        try:
+            reload_command = _coordinator_call("stats", _serialize_metrics_totals(_metrics_totals()), relay_snapshot,
+                                               _socks_worker_reload_report(reload_command["generation"]),
+                                               _admission_snapshot())
+            consecutive_failures = 0
+            _apply_socks_worker_reload_command(reload_command)
+        except Exception as e:
+            consecutive_failures += 1
+            logging.warning(f"向协调器上报统计失败 (连续 {consecutive_failures} 次): {e}")
+            if consecutive_failures >= 10:
+                logging.error("长时间无法连接协调器，SOCKS工作进程退出。")
+                os._exit(1)
+
+def socks_worker_main():
+    """工作进程入口: 在协调器传入的 SO_REUSEPORT 监听套接字上接受连接，后端的获取和归还交给协调器。"""
+    log_output_handler.setFormatter(logging.Formatter(
+        f'%(asctime)s - %(levelname)s - [SOCKS工作进程 {socks_worker_id}] %(message)s', datefmt='%Y-%m-%d %H:%M:%S'
+    ))
+    # 平滑重启由协调器统一调度，工作进程忽略误发的 SIGUSR2 (默认动作会终止进程)
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+    logging.info(f"SOCKS工作进程正在启动 (PID: {os.getpid()}, 模式: {SOCKS_SERVER_MODE})...")
+    listener_socket = socket.socket(fileno=int(os.environ['SOCKS_WORKER_LISTEN_FD']))
+    threading.Thread(target=_socks_worker_stats_loop, name="worker-stats", daemon=True).start()
+    if SOCKS_SERVER_MODE == 'asyncio':
+        start_central_socks5_server_asyncio(listener_socket)
+    else:
+        start_central_socks5_server(listener_socket)
+
+# --- 平滑重启 ---
+# 收到 SIGUSR2 时: 暂停IP刷新、停止接受新的SOCKS连接和API连接 (监听套接字保持打开，新连接留在监听队列中)，
+# 等待握手中的SOCKS连接和处理中的API请求完成后，把代理池状态写入快照文件，并启动新进程接管监听套接字。
+# 新进程从快照恢复代理池，不重新验证后端，就绪后通知本进程; 本进程随后只等待已有的中继结束再退出。
+# 旧进程中的连接仍在使用的后端，由新进程在旧进程退出后回收。新进程未能就绪时放弃重启，本进程恢复服务。
+
+reload_cond = threading.Condition() # 保护 reload_state
+# phase: 'serving' 正常服务; 'pausing' 平滑重启中，新的API请求等待重启结果; 'handed_off' 已交接给新进程。
+# socks_setting_up / socks_relaying: 本进程中正在握手 (含获取后端和连接目标) / 正在中继的SOCKS连接数
+reload_state = {"phase": "serving", "api_requests_in_flight": 0, "socks_setting_up": 0, "socks_relaying": 0}
+reload_lock = threading.Lock() # 同一时间只进行一次平滑重启
+socks_accepting = threading.Event() # 清除时SOCKS服务器停止接受新连接
+socks_accepting.set()
+socks_accept_paused = threading.Event() # SOCKS服务器已停止接受新连接
+listen_sockets = {"socks": [], "api": []} # 本进程的监听套接字，平滑重启时传给新进程
+api_server_kind = None # 'waitress' 或 'flask'
+api_http_server = None # 正在运行的API服务器
+api_reload_supported = True # waitress 缺少平滑重启依赖的内部属性时为 False
+api_accepting = threading.Event() # Flask 开发服务器被暂停后，主线程等待该事件再恢复服务 (或在交接后结束服务)
+api_accepting.set()
+
+def _socks_connection_opened():
+    with reload_cond:
+        reload_state["socks_setting_up"] += 1
+
+def _socks_connection_set_up():
+    """SOCKS连接完成握手和后端连接，开始中继。之后不再获取后端。"""
+    with reload_cond:
+        reload_state["socks_setting_up"] -= 1
+        reload_state["socks_relaying"] += 1
+        reload_cond.notify_all()
+
+def _socks_connection_closed(set_up):
+    with reload_cond:
+        reload_state["socks_relaying" if set_up else "socks_setting_up"] -= 1
+        reload_cond.notify_all()
+
+@app.before_request
+def _reload_api_request_gate():
+    """平滑重启期间新的API请求等待重启结果; 已交接给新进程后返回 503 并关闭连接，客户端重新连接后由新进程处理。"""
+    with reload_cond:
+        while reload_state["phase"] == 'pausing':
+            reload_cond.wait()
+        handed_off = reload_state["phase"] == 'handed_off'
+        if not handed_off:
+            reload_state["api_requests_in_flight"] += 1
+            g.reload_request_counted = True
+    if handed_off:
+        response = jsonify({"error": "服务已交接给新进程，请重新连接后重试"})
+        response.status_code = 503
+        response.headers["Connection"] = "close"
+        return response
+
+@app.teardown_request
+def _reload_api_request_done(exc):
+    if g.pop("reload_request_counted", False):
+        with reload_cond:
+            reload_state["api_requests_in_flight"] -= 1
+            reload_cond.notify_all()
+
+def _exit_after_logs_flushed(exit_code):
+    """写完日志队列中剩余的记录后立即结束进程，不等待其他线程。"""
+    if LOG_QUEUE_SIZE > 0:
+        log_listener.stop()
+    os._exit(exit_code)
+
+# waitress 没有公开暂停接受连接和关闭空闲长连接的接口。平滑重启只通过以下几个函数使用它的内部属性
+# (trigger.pull_trigger、accepting、active_channels、channel.requests/will_close，在 requirements.txt 固定的版本上验证)，
+# 启动时检查这些属性，缺少时禁用平滑重启，而不是在重启过程中出错。
+WAITRESS_LOOP_CALL_TIMEOUT = 5 # 等待 waitress 事件循环执行操作的最长时间(秒)
+
+def _waitress_reload_supported(server):
+    """检查 waitress 服务器是否提供平滑重启使用的内部属性。"""
+    return (callable(getattr(getattr(server, "trigger", None), "pull_trigger", None))
+            and hasattr(server, "accepting")
+            and isinstance(getattr(server, "active_channels", None), dict)
+            and hasattr(getattr(server, "channel_class", None), "will_close"))
+
+def _run_in_waitress_loop(func):
+    """
+    在 waitress 的事件循环线程中执行 func 并等待其完成，避免与正在进行的 accept 和读写竞争。
+    func 抛出异常或事件循环未在 WAITRESS_LOOP_CALL_TIMEOUT 秒内执行它时抛出 RuntimeError。
+    """
+    done = threading.Event()
+    outcome = {}
+    def run():
+        try:
+            func()
+        except Exception as e:
+            outcome["error"] = e
+        finally:
+            done.set()
+    api_http_server.trigger.pull_trigger(run)
+    if not done.wait(WAITRESS_LOOP_CALL_TIMEOUT):
+        raise RuntimeError(f"waitress 事件循环在 {WAITRESS_LOOP_CALL_TIMEOUT} 秒内未执行操作")
+    if "error" in outcome:
+        raise RuntimeError(f"在 waitress 事件循环中执行操作失败: {outcome['error']}")
+
+def _set_api_accepting(accepting):
+    """暂停或恢复API服务器接受新连接，失败时抛出 RuntimeError。Flask 开发服务器通过结束并重新启动服务循环实现。"""
+    if api_server_kind == 'waitress':
+        def apply_accepting():
+            api_http_server.accepting = accepting
+        _run_in_waitress_loop(apply_accepting)
+    elif accepting:
+        api_accepting.set()
+    else:
+        api_accepting.clear()
+        api_http_server.shutdown()
+
+def _close_idle_api_connections():
+    """交接后关闭 waitress 上空闲的长连接，客户端的下一个请求将连接到新进程。"""
+    if api_server_kind != 'waitress':
+        return
+    def close_idle():
+        for channel in list(api_http_server.active_channels.values()):
+            if not getattr(channel, "requests", True):
+                channel.will_close = True
+    _run_in_waitress_loop(close_idle)
+
+def _send_socks_worker_reload_command(action):
+    """协调器: 更新下发给所有工作进程的平滑重启指令，返回指令代次。"""
+    with socks_workers_lock:
+        socks_worker_reload_command["generation"] += 1
+        socks_worker_reload_command["action"] = action
+        return socks_worker_reload_command["generation"]
+
+def _socks_workers_paused(generation):
+    """协调器: 所有运行中的工作进程是否都已执行指定代次的暂停指令，且没有握手中的连接。"""
+    with socks_workers_lock:
+        for worker_id, worker_process in socks_worker_processes.items():
+            if worker_process.poll() is not None:
+                continue
+            reload_report = socks_worker_stats.get(worker_id, {}).get("reload")
+            if not reload_report or reload_report["generation"] != generation or reload_report["mode"] != 'paused':
+                return False
+    return True
+
+def _wait_socks_paused(pause_generation, deadline):
+    """等待SOCKS服务器停止接受新连接且没有握手中的连接。返回是否在截止时间前完成。"""
+    if SOCKS_WORKER_PROCESSES > 0:
+        while not _socks_workers_paused(pause_generation):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
+    if listen_sockets["socks"] and not socks_accept_paused.wait(max(deadline - time.monotonic(), 0)):
+        return False
+    with reload_cond:
+        while reload_state["socks_setting_up"] > 0:
+            if time.monotonic() >= deadline:
+                return False
+            reload_cond.wait(deadline - time.monotonic())
+    return True
+
+def _wait_api_requests_finished(deadline):
+    """等待处理中的API请求全部完成。返回是否在截止时间前完成。"""
+    with reload_cond:
+        while reload_state["api_requests_in_flight"] > 0:
+            if time.monotonic() >= deadline:
+                return False
+            reload_cond.wait(deadline - time.monotonic())
+    return True
+
+def _port_keyed(mapping):
+    """把以端口为键的字典转换为可 JSON 序列化的形式 (键转为字符串，值复制一份)。"""
+    return {str(port): dict(value) if isinstance(value, dict) else value for port, value in mapping.items()}
+
+def _int_keyed(mapping):
+    return {int(port): value for port, value in mapping.items()}
+
+POOL_STATE_SNAPSHOT_VERSION = 1 # 快照格式版本，格式不兼容时递增; 新进程不恢复版本不同的快照
+POOL_STATE_SNAPSHOT_KEYS = (
+    "ports", "available", "in_use", "shared_sessions", "backend_relayed_bytes", "backend_usage", "backend_health",
+    "quarantined", "draining", "exit_ips", "recent_exit_ips", "exit_ip_rerolls", "refresh", "sticky_sessions", "api_leases"
+)
+
+def _build_pool_state_snapshot():
+    """
+    生成代理池状态快照。刷新调度器状态最先读取: 刷新已暂停，之后才可能发生的变化只有会话结束时的释放，
+    恢复时能据此判断出在两次读取之间被释放的端口。
+    """
+    with refresh_cond:
+        refresh_state = {
+            "pending": _port_keyed(refresh_pending),
+            "in_flight": sorted(refresh_in_flight),
+            "failures": _port_keyed(refresh_failures)
+        }
+    with proxy_lock:
+        pool_state = {
+            "ports": sorted(WARP_POOL_CONFIG),
+            "available": list(available_proxies.queue),
+            "in_use": _port_keyed(in_use_proxies),
+            "shared_sessions": _port_keyed(backend_active_sessions),
+            "backend_relayed_bytes": _port_keyed(backend_relayed_bytes),
+            "backend_usage": _port_keyed(backend_usage),
+            "backend_health": _port_keyed(backend_health),
+            "quarantined": _port_keyed(quarantined_proxies),
+            "draining": _port_keyed(draining_proxies),
+            "exit_ips": {
+                str(port): dict(entry, history=[list(item) for item in entry["history"]])
+                for port, entry in backend_exit_ips.items()
+            },
+            "recent_exit_ips": dict(recent_exit_ips),
+            "exit_ip_rerolls": _port_keyed(exit_ip_rerolls)
+        }
+    with sticky_lock:
+        sticky_state = {session_key: dict(session) for session_key, session in sticky_sessions.items()}
+    with lease_cond:
+        lease_state = {lease_id: dict(lease) for lease_id, lease in api_leases.items()}
+    # 其他节点的后端不在配置文件中，新进程据此在同步节点之前登记它们 (包括离线节点上仍在排空的后端)
+    with pool_nodes_lock:
+        node_instances = [instance for node in pool_nodes.values() for instance in node["backends"]]
+    pool_state["node_backends"] = [instance for instance in node_instances if instance["port"] in pool_state["ports"]]
+    return {
+        "version": POOL_STATE_SNAPSHOT_VERSION,
+        "created_at": time.time(),
+        "pid": os.getpid(),
+        **pool_state,
+        "refresh": refresh_state,
+        "sticky_sessions": sticky_state,
+        "api_leases": lease_state
+    }
+
+def _write_pool_state_snapshot(snapshot):
+    """以原子方式写入状态快照文件 (仅运行管理器的用户可读)。"""
+    temporary_path = f"{RELOAD_STATE_FILE}.tmp"
+    with os.fdopen(os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as snapshot_file:
+        json.dump(snapshot, snapshot_file)
+    os.replace(temporary_path, RELOAD_STATE_FILE)
+
+def _restore_pool_state_snapshot(state_file):
+    """
+    新进程: 从状态快照恢复代理池 (不重新验证后端)，恢复成功后删除快照文件。快照中没有的新端口留在可用代理池中并查询出口IP。
+    其他节点的后端按快照登记 (POOL_NODES 中已不存在的节点，以及虚拟端口与当前节点序号不符的后端除外)，之后由节点同步对齐。
+    返回旧进程退出后需要回收的后端: {"release": [端口], "shared": {端口: 会话数}, "sticky": {会话键: 连接数}, "refresh": [端口]}。
+    快照版本不符或缺少字段时抛出 ValueError，此时代理池状态未被修改，快照文件保留以便排查。
+    """
+    with open(state_file) as snapshot_file:
+        snapshot = json.load(snapshot_file)
+    _validate_pool_state_snapshot(snapshot)
+
+    node_backends = [
+        instance for instance in snapshot.get("node_backends", [])
+        if instance["node"] in pool_nodes and instance["port"] == _node_backend_port(pool_nodes[instance["node"]], instance["id"])
+    ]
+    if node_backends:
+        initialize_proxy_pool_from_config(node_backends, index_exit_ips=False)
+    with proxy_lock:
+        configured_ports = set(WARP_POOL_CONFIG)
+    def configured(mapping):
+        return {port: value for port, value in _int_keyed(mapping).items() if port in configured_ports}
+    in_use = configured(snapshot["in_use"])
+    shared_sessions = configured(snapshot["shared_sessions"])
+    quarantined = configured(snapshot["quarantined"])
+    draining = configured(snapshot["draining"])
+    sticky_state = {
+        session_key: session for session_key, session in snapshot["sticky_sessions"].items() if session["port"] in configured_ports
+    }
+    lease_state = {lease_id: lease for lease_id, lease in snapshot["api_leases"].items() if lease["port"] in configured_ports}
+    # 仍在使用的端口优先: 读取刷新状态之后才被释放的端口在两处都出现，由旧进程退出后的回收重新决定去向
+    pending = {port: job for port, job in configured(snapshot["refresh"]["pending"]).items() if port not in in_use}
+    available = []
+    for port in snapshot["available"]:
+        if port in configured_ports and port not in in_use and port not in pending and port not in available:
+            available.append(port)
+    new_ports = sorted(port for port in configured_ports if port not in snapshot["ports"])
+    available.extend(new_ports)
+
+    handoff = {"release": [], "shared": shared_sessions, "sticky": {}, "refresh": []}
+    for port, proxy_info in in_use.items():
+        proxy_type = proxy_info.get("type")
+        if proxy_type == "socks_sticky" and proxy_info.get("sticky_session_key") in sticky_state:
+            continue
+        if proxy_type == "api_acquired" and (proxy_info.get("lease_id") is None or proxy_info["lease_id"] in lease_state):
+            continue
+        # 旧进程中的独占SOCKS会话，以及会话或租约在快照读取期间已结束的端口
+        handoff["release"].append(port)
+    for session_key, session in sticky_state.items():
+        if session["active_connections"] > 0:
+            handoff["sticky"][session_key] = session["active_connections"]
+    accounted_ports = set(available) | set(in_use) | set(pending) | set(shared_sessions)
+    accounted_ports |= {port for port, entry in quarantined.items() if entry["parked"]}
+    accounted_ports |= {port for port, entry in draining.items() if entry["idle"]}
+    # 其余端口在快照时正在刷新 (或刷新完成后仍在返回途中)，旧进程退出后重新刷新
+    handoff["refresh"] = sorted(configured_ports - accounted_ports - set(new_ports))
+    now = time.time()
+    for port in handoff["refresh"]:
+        in_use[port] = {"type": "reload_handoff", "acquired_at": now}
+
+    with refresh_cond:
+        refresh_pending.update(pending)
+        refresh_failures.update(configured(snapshot["refresh"]["failures"]))
+    with proxy_lock:
+        available_proxies.queue.clear()
+        for port in available:
+            available_proxies.put(port)
+        in_use_proxies.update(in_use)
+        backend_active_sessions.update(shared_sessions)
+        backend_relayed_bytes.update(configured(snapshot["backend_relayed_bytes"]))
+        backend_usage.update(configured(snapshot["backend_usage"]))
+        backend_health.update(configured(snapshot["backend_health"]))
+        quarantined_proxies.update(quarantined)
+        draining_proxies.update(draining)
+        for port, entry in configured(snapshot["exit_ips"]).items():
+            entry["history"] = deque((tuple(item) for item in entry["history"]), maxlen=EXIT_IP_HISTORY_SIZE)
+            backend_exit_ips[port] = entry
+        recent_exit_ips.update(snapshot["recent_exit_ips"])
+        exit_ip_rerolls.update(configured(snapshot["exit_ip_rerolls"]))
+    with sticky_lock:
+        sticky_sessions.update(sticky_state)
+    with lease_cond:
+        api_leases.update(lease_state)
+        lease_heap[:] = [(lease["expires_at"], lease_id) for lease_id, lease in api_leases.items()]
+        heapq.heapify(lease_heap)
+        lease_cond.notify()
+
+    if lease_state:
+        _ensure_lease_reaper_started()
+    if sticky_state:
+        _ensure_sticky_reaper_started()
+    if pending:
+        _ensure_refresh_workers_started()
+    if new_ports and EXIT_IP_TRACE_URL:
+        threading.Thread(target=_index_backend_exit_ips, args=(new_ports,), name="exit-ip-indexer", daemon=True).start()
+    os.unlink(state_file)
+    logging.info(f"平滑重启: 已从状态快照恢复代理池 (可用 {len(available)}, 使用中 {len(in_use)}, 待刷新 {len(pending)}, "
+                 f"租约 {len(lease_state)}, 粘性会话 {len(sticky_state)}, 新增端口 {new_ports})。")
+    return handoff
+
+def _validate_pool_state_snapshot(snapshot):
+    """在修改任何状态之前检查快照的版本和必需字段，不符合时抛出 ValueError。"""
+    if not isinstance(snapshot, dict):
+        raise ValueError("快照内容不是 JSON 对象")
+    if snapshot.get("version") != POOL_STATE_SNAPSHOT_VERSION:
+        raise ValueError(f"快照版本 {snapshot.get('version')!r} 与当前版本 {POOL_STATE_SNAPSHOT_VERSION} 不符")
+    missing_keys = [key for key in POOL_STATE_SNAPSHOT_KEYS if key not in snapshot]
+    if not isinstance(snapshot.get("refresh"), dict):
+        missing_keys.append("refresh")
+    else:
+        missing_keys += [f"refresh.{key}" for key in ("pending", "in_flight", "failures") if key not in snapshot["refresh"]]
+    if missing_keys:
+        raise ValueError(f"快照缺少字段 {missing_keys}")
+
+def _release_reload_handoff(parent_pid, handoff):
+    """新进程: 等待旧进程退出后，回收旧进程中的连接仍在使用的后端。"""
+    while os.getppid() == parent_pid:
+        time.sleep(0.5)
+    logging.info(f"平滑重启: 旧进程 (PID: {parent_pid}) 已退出，正在回收其连接使用的后端: 独占 {handoff['release']}, "
+                 f"共享 {handoff['shared']}, 粘性会话 {list(handoff['sticky'])}, 待刷新 {handoff['refresh']}。")
+    for port in handoff["release"]:
+        _release_backend_port_after_socks_usage(port)
+    for port, session_count in handoff["shared"].items():
+        for _ in range(session_count):
+            _release_shared_backend_session(port)
+    for session_key, connection_count in handoff["sticky"].items():
+        for _ in range(connection_count):
+            _finish_sticky_session_usage(session_key)
+    for port in handoff["refresh"]:
+        with proxy_lock:
+            in_use_proxies.pop(port, None)
+        schedule_refresh(port, REFRESH_PRIORITY_HIGH)
+
+def _spawn_reload_successor():
+    """启动接管监听套接字的新进程并等待其就绪 (在启动API服务前通过管道写入一个字节)。未能就绪时终止新进程并抛出异常。"""
+    ready_read_fd, ready_write_fd = os.pipe()
+    listen_fds = [(name, listener_socket.fileno()) for name, sockets in listen_sockets.items() for listener_socket in sockets]
+    try:
+        successor = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)],
+            pass_fds=[fd for _, fd in listen_fds] + [ready_write_fd],
+            env=dict(os.environ,
+                     WARP_POOL_LISTEN_FDS=",".join(f"{name}:{fd}" for name, fd in listen_fds),
+                     WARP_POOL_RELOAD_STATE=RELOAD_STATE_FILE,
+                     WARP_POOL_RELOAD_READY_FD=str(ready_write_fd),
+                     WARP_POOL_RELOAD_PARENT_PID=str(os.getpid()))
+        )
+    finally:
+        os.close(ready_write_fd)
+    try:
+        readable, _, _ = select.select([ready_read_fd], [], [], RELOAD_READY_TIMEOUT)
+        # 新进程启动失败退出时管道的写端被关闭，读到的是空字节串
+        ready = bool(readable) and os.read(ready_read_fd, 1) == b"1"
+    finally:
+        os.close(ready_read_fd)
+    if not ready:
+        if successor.poll() is not None:
+            raise RuntimeError(f"新进程 (PID: {successor.pid}) 在就绪前退出，返回码 {successor.returncode}")
+        successor.terminate()
+        try:
+            successor.wait(5)
+        except subprocess.TimeoutExpired:
+            successor.kill()
+        raise RuntimeError(f"新进程 (PID: {successor.pid}) 未能在 {RELOAD_READY_TIMEOUT:.0f} 秒内就绪")
+    return successor
+
+def _drain_after_handoff(timeout):
+    """交接后等待本进程 (或各工作进程) 中已有的SOCKS连接全部结束。返回是否在 timeout 内完成。"""
+    deadline = time.monotonic() + timeout
+    if SOCKS_WORKER_PROCESSES > 0:
+        _send_socks_worker_reload_command('drain')
+        while True:
+            with socks_workers_lock:
+                running_workers = [worker_process for worker_process in socks_worker_processes.values() if worker_process.poll() is None]
+            if not running_workers:
+                return True
+            if time.monotonic() >= deadline:
+                for worker_process in running_workers:
+                    worker_process.terminate()
+                return False
+            time.sleep(0.5)
+    with reload_cond:
+        while reload_state["socks_setting_up"] + reload_state["socks_relaying"] > 0:
+            if time.monotonic() >= deadline:
+                return False
+            reload_cond.wait(deadline - time.monotonic())
+    return True
+
+def _finish_reload_handoff(successor):
+    """已交接给新进程: 拒绝剩余的API请求，等待已有中继结束后退出本进程。"""
+    logging.info(f"平滑重启: 已交接给新进程 (PID: {successor.pid})，等待本进程中已有的中继结束 (最长 {RELOAD_DRAIN_TIMEOUT:.0f} 秒)...")
+    with reload_cond:
+        reload_state["phase"] = 'handed_off'
+        reload_cond.notify_all()
+    if PROXY_MANAGER_PID_FILE:
+        try:
+            with open(PROXY_MANAGER_PID_FILE, 'w') as pid_file:
+                pid_file.write(f"{successor.pid}\n")
+        except OSError as e:
+            logging.warning(f"平滑重启: 无法写入PID文件 '{PROXY_MANAGER_PID_FILE}': {e}")
+    try:
+        _close_idle_api_connections()
+    except RuntimeError as e:
+        logging.warning(f"平滑重启: 无法关闭空闲的API长连接，这些连接将在本进程退出时断开: {e}")
+    # Flask 开发服务器: 让主线程结束服务循环
+    api_accepting.set()
+    if _drain_after_handoff(RELOAD_DRAIN_TIMEOUT):
+        logging.info("平滑重启: 所有中继已结束，旧进程退出。")
+    else:
+        logging.warning(f"平滑重启: {RELOAD_DRAIN_TIMEOUT:.0f} 秒后仍有未结束的中继，旧进程强制退出。")
+    if SOCKS_WORKER_PROCESSES > 0:
+        try:
+            os.unlink(pool_coordinator_socket_path)
+        except OSError:
+            pass
+    _exit_after_logs_flushed(0)
+
+def _graceful_reload():
+    """执行一次平滑重启 (在独立线程中运行)。失败时恢复服务。"""
+    if not reload_lock.acquire(blocking=False):
+        logging.warning("平滑重启: 已有平滑重启正在进行，忽略本次请求。")
+        return
+    try:
+        if api_http_server is None:
+            logging.warning("平滑重启: 服务尚未完成启动，忽略本次请求。")
+            return
+        if not api_reload_supported:
+            logging.warning("平滑重启: 当前 waitress 版本不提供暂停接受连接所需的属性，不支持平滑重启，忽略本次请求。")
+            return
+        logging.info("平滑重启: 开始，暂停IP刷新...")
+        refreshing_ports = _pause_refresh_workers(RELOAD_REFRESH_WAIT)
+        if refreshing_ports:
+            logging.warning(f"平滑重启: 端口 {refreshing_ports} 的IP刷新仍未完成，将由新进程在本进程退出后重新刷新。")
+        try:
+            _set_api_accepting(False)
+            if SOCKS_WORKER_PROCESSES > 0:
+                pause_generation = _send_socks_worker_reload_command('pause')
+            else:
+                pause_generation = None
+                socks_accepting.clear()
+            with reload_cond:
+                reload_state["phase"] = 'pausing'
+            # 唤醒等待后端的请求，使其以 'reloading' 失败而不是拖到等待超时
+            with proxy_lock:
+                for waiter in pool_waiters:
+                    waiter.event.set()
+            deadline = time.monotonic() + RELOAD_PAUSE_TIMEOUT
+            if not (_wait_socks_paused(pause_generation, deadline) and _wait_api_requests_finished(deadline)):
+                raise RuntimeError(f"{RELOAD_PAUSE_TIMEOUT:.0f} 秒内仍有握手中的SOCKS连接或处理中的API请求")
+            _write_pool_state_snapshot(_build_pool_state_snapshot())
+            logging.info(f"平滑重启: 代理池状态已写入 '{RELOAD_STATE_FILE}'，正在启动新进程...")
+            successor = _spawn_reload_successor()
+        except Exception as e:
+            logging.error(f"平滑重启失败，恢复服务: {e}")
+            try:
+                os.unlink(RELOAD_STATE_FILE)
+            except OSError:
+                pass
+            with reload_cond:
+                reload_state["phase"] = 'serving'
+                reload_cond.notify_all()
+            if SOCKS_WORKER_PROCESSES > 0:
+                _send_socks_worker_reload_command('serve')
+            else:
+                socks_accepting.set()
+            _resume_refresh_workers()
+            try:
+                _set_api_accepting(True)
+            except RuntimeError as resume_error:
+                logging.error(f"平滑重启: 无法恢复API服务器接受新连接: {resume_error}")
+            return
+        _finish_reload_handoff(successor)
+    finally:
+        reload_lock.release()
+
+def _handle_reload_signal(signum, frame):
+    """SIGUSR2: 在独立线程中执行平滑重启 (信号处理函数中不做其他事情)。"""
+    threading.Thread(target=_graceful_reload, name="graceful-reload", daemon=True).start()
+
+def _take_reload_handoff_env():
+    """
+    新进程: 取出旧进程传入的平滑重启参数 (并从环境变量中移除，避免再传给工作进程或下一次重启的新进程)。
+    不是由平滑重启启动时返回 None。
+    """
+    state_file = os.environ.pop('WARP_POOL_RELOAD_STATE', None)
+    ready_fd = os.environ.pop('WARP_POOL_RELOAD_READY_FD', None)
+    parent_pid = os.environ.pop('WARP_POOL_RELOAD_PARENT_PID', None)
+    if state_file is None:
+        return None
+    return {"state_file": state_file, "ready_fd": int(ready_fd) if ready_fd else None, "parent_pid": int(parent_pid or 0)}
+
+def _inherited_listen_sockets(api_port):
+    """
+    返回继承的监听套接字 {"socks": [...], "api": [...]}。平滑重启时由旧进程通过 WARP_POOL_LISTEN_FDS ("名称:fd,...") 传入;
+    也支持 systemd 套接字激活 (LISTEN_PID/LISTEN_FDS，fd 从 3 开始)，可用 FileDescriptorName=socks/api 命名，未命名时按监听端口区分。
+    """
+    inherited = {"socks": [], "api": []}
+    named_fds = []
+    for item in os.environ.pop('WARP_POOL_LISTEN_FDS', '').split(','):
+        if item:
+            name, _, fd = item.partition(':')
+            named_fds.append((name, int(fd)))
+    listen_pid = os.environ.pop('LISTEN_PID', None)
+    listen_fd_count = os.environ.pop('LISTEN_FDS', None)
+    listen_fd_names = os.environ.pop('LISTEN_FDNAMES', '').split(':')
+    if listen_pid == str(os.getpid()) and listen_fd_count:
+        for index in range(int(listen_fd_count)):
+            named_fds.append((listen_fd_names[index] if index < len(listen_fd_names) else '', 3 + index))
+    for name, fd in named_fds:
+        listener_socket = socket.socket(fileno=fd)
+        if name not in inherited:
+            listen_port = listener_socket.getsockname()[1]
+            name = 'socks' if listen_port == SOCKS_SERVER_PORT else 'api' if listen_port == api_port else None
+        if name is None:
+            logging.warning(f"忽略继承的监听套接字 fd {fd} ({listener_socket.getsockname()})，它既不是SOCKS端口也不是API端口。")
+            listener_socket.close()
+            continue
+        inherited[name].append(listener_socket)
+    return inherited
+
+def _signal_reload_ready(reload_handoff):
+    """新进程: API服务器即将开始服务时通知旧进程已就绪。"""
+    if reload_handoff is None or reload_handoff["ready_fd"] is None:
+        return
+    try:
+        os.write(reload_handoff["ready_fd"], b"1")
+        os.close(reload_handoff["ready_fd"])
+    except OSError as e:
+        logging.warning(f"平滑重启: 无法通知旧进程新进程已就绪: {e}")
+    reload_handoff["ready_fd"] = None
+
+def _create_api_listener(api_port):
+    """创建绑定到 0.0.0.0:api_port 的API监听套接字。"""
+    listener_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        listener_socket.bind(('0.0.0.0', api_port))
+        listener_socket.listen(1024)
+    except Exception:
+        listener_socket.close()
+        raise
+    return listener_socket
+
+def _serve_api_with_werkzeug(api_listen_socket, api_port, reload_handoff):
+    """
+    用 Flask 开发服务器提供API。平滑重启暂停接受新连接时服务循环结束 (werkzeug 同时关闭它持有的套接字副本)，
+    恢复时在同一个监听套接字上重新创建服务器。交接给新进程后返回。
+    """
+    global api_http_server
+    while reload_state["phase"] != 'handed_off':
+        api_http_server = make_server('0.0.0.0', api_port, app, threaded=True, fd=api_listen_socket.fileno())
+        _signal_reload_ready(reload_handoff)
+        api_http_server.serve_forever()
+        api_accepting.wait()
+
 # --- 主程序执行 ---
-if __name__ == '__main__':
+def main():
+    """加载代理池配置，启动后台线程、中央SOCKS5服务器 (或协调器与工作进程) 和 Flask API 服务器。"""
+    global pool_coordinator_socket_path, api_server_kind, api_http_server, api_reload_supported
+    if socks_worker_id is not None:
+        socks_worker_main()
+        sys.exit(1)
+
     logging.info("代理管理器服务正在启动...")
+    if API_SECRET_TOKEN_GENERATED:
+        logging.warning("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+        logging.warning("!!! 警告: 环境变量 'API_SECRET_TOKEN' 未设置。               !!!")
+        logging.warning("!!! 为安全起见，已生成一个临时的随机令牌。                  !!!")
+        logging.warning(f"!!! 临时令牌: {API_SECRET_TOKEN}                      !!!")
+        logging.warning("!!! 在生产环境中，请务必设置一个安全的、持久的令牌。        !!!")
+        logging.warning("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+    api_port = int(os.environ.get('API_PORT', 5000))
+    reload_handoff = _take_reload_handoff_env()
+    inherited_sockets = _inherited_listen_sockets(api_port)
+    if reload_handoff is not None:
+        logging.info(f"平滑重启: 由旧进程 (PID: {reload_handoff['parent_pid']}) 启动，接管监听套接字 "
+                     f"(SOCKS: {len(inherited_sockets['socks'])} 个, API: {len(inherited_sockets['api'])} 个)。")
+        # 旧进程的协调器在其工作进程排空前仍在运行，使用另一个套接字路径
+        pool_coordinator_socket_path = f"{POOL_COORDINATOR_SOCKET}.{os.getpid()}"
     
+    try:
+        pool_nodes.update(_parse_pool_nodes(POOL_NODES))
+    except ValueError as e:
+        logging.critical(f"严重错误: POOL_NODES 配置无效: {e}")
+        sys.exit(1)
+    if pool_nodes:
+        node_urls = ", ".join(f"{node_name}={node['url']}" for node_name, node in pool_nodes.items())
+        logging.info(f"多节点: 已配置 {len(pool_nodes)} 个节点 ({node_urls})，"
+                     f"{'优先使用本机后端' if PREFER_LOCAL_BACKENDS else '本机与其他节点的后端同等调度'}。")
+        if not POOL_AGENT_TOKEN:
+            logging.warning("多节点: 未设置 POOL_AGENT_TOKEN，节点代理将拒绝同步和刷新请求。")
+
     # --- 从 JSON 文件加载代理池配置 ---
     logging.info(f"正在从 '{WARP_POOL_CONFIG_FILE}' 加载代理池配置...")
+    config_signature = pool_config_file_signature()
     try:
-        with open(WARP_POOL_CONFIG_FILE, 'r') as f:
-            config_list = json.load(f)
-        if not isinstance(config_list, list) or not config_list:
+        config_list = load_pool_config_file()
+        if not config_list and WARP_POOL_CONFIG_WATCH_INTERVAL <= 0 and not pool_nodes:
             raise ValueError("配置文件内容不是一个有效的非空列表。")
     except FileNotFoundError:
-        logging.critical(f"严重错误: 配置文件 '{WARP_POOL_CONFIG_FILE}' 未找到。脚本无法启动。")
-        sys.exit(1)
+        if not pool_nodes:
+            logging.critical(f"严重错误: 配置文件 '{WARP_POOL_CONFIG_FILE}' 未找到。脚本无法启动。")
+            sys.exit(1)
+        # 只调度其他节点的后端 (本机没有代理池)
+        logging.warning(f"配置文件 '{WARP_POOL_CONFIG_FILE}' 未找到，本机没有后端，只使用其他节点的后端。")
+        config_list = []
     except json.JSONDecodeError:
         logging.critical(f"严重错误: 无法解析配置文件 '{WARP_POOL_CONFIG_FILE}'。请检查其JSON格式。")
         sys.exit(1)
@@ -602,32 +4906,107 @@ if __name__ == '__main__':
         sys.exit(1)
 
     # --- 初始化代理池 ---
-    if not initialize_proxy_pool_from_config(config_list):
+    pool_initialized = initialize_proxy_pool_from_config(config_list, index_exit_ips=reload_handoff is None)
+    if reload_handoff is not None:
+        try:
+            handoff_backends = _restore_pool_state_snapshot(reload_handoff["state_file"])
+            threading.Thread(target=_release_reload_handoff, args=(reload_handoff["parent_pid"], handoff_backends),
+                             name="reload-handoff", daemon=True).start()
+        except Exception as e:
+            logging.error(f"平滑重启: 无法从状态快照 '{reload_handoff['state_file']}' 恢复代理池 (快照文件已保留)，"
+                          f"将使用按配置文件初始化的代理池: {e}")
+            if EXIT_IP_TRACE_URL and WARP_POOL_CONFIG:
+                threading.Thread(target=_index_backend_exit_ips, args=(sorted(WARP_POOL_CONFIG),), name="exit-ip-indexer", daemon=True).start()
+    if pool_nodes:
+        _sync_pool_nodes()
+        threading.Thread(target=_pool_node_sync_loop, name="pool-node-sync", daemon=True).start()
+    if pool_initialized:
+        logging.info("✅ 代理池已成功从配置文件初始化。")
+    elif pool_nodes:
+        logging.warning(f"本机暂无就绪的实例，当前使用其他节点的 {len(WARP_POOL_CONFIG)} 个后端。")
+    elif WARP_POOL_CONFIG_WATCH_INTERVAL > 0:
+        logging.warning("配置文件中暂无就绪的实例，将在实例创建完成后自动加入代理池。")
+    else:
         logging.critical("严重错误: 从配置文件初始化代理池失败，没有可用的代理。脚本将退出。")
         sys.exit(1)
 
-    logging.info("✅ 代理池已成功从配置文件初始化。")
+    if WARP_POOL_CONFIG_WATCH_INTERVAL > 0:
+        threading.Thread(target=_pool_config_watcher_loop, args=(config_signature,), name="pool-config-watcher", daemon=True).start()
     logging.info(f"当前后端WARP代理池大小: {len(WARP_POOL_CONFIG)}")
     logging.info(f"队列中初始可用的后端端口: {list(available_proxies.queue)}")
     logging.info("重要提示: 本脚本在刷新IP时可能会使用 'sudo' 执行 'ip netns exec warp-cli' 命令。")
     logging.info("请确保已安装 PySocks: 'pip install PySocks'")
 
-    # 在独立的守护线程中启动中央SOCKS5服务器
-    logging.info(f"正在启动中央SOCKS5服务器线程，监听地址 {SOCKS_SERVER_HOST}:{SOCKS_SERVER_PORT}...")
-    socks_server_daemon_thread = threading.Thread(target=start_central_socks5_server, daemon=True)
-    socks_server_daemon_thread.start()
-    
-    if socks_server_daemon_thread.is_alive():
-        logging.info("中央SOCKS5服务器线程已启动。")
+    if HEALTH_PROBE_INTERVAL > 0:
+        threading.Thread(target=_health_prober_loop, name="health-prober", daemon=True).start()
+
+    if SOCKS_WORKER_PROCESSES > 0:
+        # 多进程模式: 本进程作为协调器，SOCKS连接由工作进程处理。监听套接字由协调器创建 (或继承) 后传给工作进程
+        try:
+            socks_listeners = inherited_sockets["socks"] or [_create_socks_listener(reuse_port=True) for _ in range(SOCKS_WORKER_PROCESSES)]
+        except Exception as e_bind:
+            logging.critical(f"严重错误: 无法在 {SOCKS_SERVER_HOST}:{SOCKS_SERVER_PORT} 上绑定或启动SOCKS5服务器。错误: {e_bind}")
+            socks_listeners = []
+        listen_sockets["socks"].extend(socks_listeners)
+        if socks_listeners:
+            threading.Thread(target=start_pool_coordinator, name="pool-coordinator", daemon=True).start()
+            for worker_id in range(SOCKS_WORKER_PROCESSES):
+                threading.Thread(target=_run_socks_worker_process, args=(worker_id, socks_listeners[worker_id % len(socks_listeners)]),
+                                 name=f"socks-worker-{worker_id}", daemon=True).start()
+            logging.info(f"多进程模式: 已启动 {SOCKS_WORKER_PROCESSES} 个SOCKS工作进程，共同监听 {SOCKS_SERVER_HOST}:{SOCKS_SERVER_PORT}。")
     else:
-        logging.warning("警告: 中央SOCKS5服务器线程已初始化，但可能未在运行 (请检查日志中的绑定错误)。")
+        # 在独立的守护线程中启动中央SOCKS5服务器
+        if SOCKS_SERVER_MODE == 'asyncio':
+            socks_server_target = start_central_socks5_server_asyncio
+        else:
+            if SOCKS_SERVER_MODE != 'threaded':
+                logging.warning(f"未知的 SOCKS_SERVER_MODE '{SOCKS_SERVER_MODE}'，将使用 'threaded' 模式。")
+            socks_server_target = start_central_socks5_server
+        logging.info(f"正在启动中央SOCKS5服务器线程 (模式: {SOCKS_SERVER_MODE})，监听地址 {SOCKS_SERVER_HOST}:{SOCKS_SERVER_PORT}...")
+        try:
+            socks_listener = inherited_sockets["socks"][0] if inherited_sockets["socks"] else _create_socks_listener()
+        except Exception as e_bind:
+            logging.critical(f"严重错误: 无法在 {SOCKS_SERVER_HOST}:{SOCKS_SERVER_PORT} 上绑定或启动SOCKS5服务器。错误: {e_bind}")
+            socks_listener = None
+        if socks_listener is not None:
+            listen_sockets["socks"].append(socks_listener)
+            socks_server_daemon_thread = threading.Thread(target=socks_server_target, args=(socks_listener,), daemon=True)
+            socks_server_daemon_thread.start()
+            logging.info("中央SOCKS5服务器线程已启动。")
 
-    # 启动 Flask HTTP API 服务器
-    api_port = int(os.environ.get('API_PORT', 5000))
-    logging.info(f"正在启动 Flask HTTP API 服务器，监听地址 0.0.0.0, 端口 {api_port}。")
+    # 启动 HTTP API 服务器
+    api_server = API_SERVER
+    if api_server not in ('auto', 'waitress', 'flask'):
+        logging.warning(f"未知的 API_SERVER '{API_SERVER}'，将自动选择。")
+        api_server = 'auto'
+    if api_server != 'flask' and waitress is None:
+        if api_server == 'waitress':
+            logging.warning("API_SERVER=waitress 但未安装 waitress (pip install waitress)，将使用 Flask 开发服务器。")
+        api_server = 'flask'
+    signal.signal(signal.SIGUSR2, _handle_reload_signal)
     try:
-        app.run(host='0.0.0.0', port=api_port, threaded=True)
+        api_listen_socket = inherited_sockets["api"][0] if inherited_sockets["api"] else _create_api_listener(api_port)
+        listen_sockets["api"].append(api_listen_socket)
+        api_server_kind = 'flask' if api_server == 'flask' else 'waitress'
+        if api_server == 'flask':
+            logging.info(f"正在启动 Flask HTTP API 服务器，监听地址 0.0.0.0, 端口 {api_port}。")
+            _serve_api_with_werkzeug(api_listen_socket, api_port, reload_handoff)
+        else:
+            logging.info(f"正在启动 waitress HTTP API 服务器 ({API_SERVER_THREADS} 个线程)，监听地址 0.0.0.0, 端口 {api_port}。")
+            api_http_server = waitress.create_server(app, sockets=[api_listen_socket], threads=API_SERVER_THREADS,
+                                                     connection_limit=API_SERVER_CONNECTION_LIMIT, backlog=1024, asyncore_use_poll=True)
+            api_reload_supported = _waitress_reload_supported(api_http_server)
+            if not api_reload_supported:
+                logging.warning("当前 waitress 版本不提供平滑重启所需的内部属性，SIGUSR2 平滑重启已禁用 (requirements.txt 固定了经过验证的版本)。")
+            _signal_reload_ready(reload_handoff)
+            api_http_server.run()
     except Exception as e_flask:
-        logging.critical(f"严重错误: Flask API 服务器启动失败: {e_flask}")
-    
-    logging.info("代理管理器服务正在关闭或 Flask 服务器已退出。")
\ No newline at end of file
+        logging.critical(f"严重错误: API 服务器启动失败: {e_flask}")
+
+    if reload_state["phase"] == 'handed_off':
+        # 已交接给新进程: 由平滑重启线程在已有中继结束后结束本进程
+        threading.Event().wait()
+    logging.info("代理管理器服务正在关闭或 Flask 服务器已退出。")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import os
+import sys
+from collections import deque
+from queue import Queue
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, os.path.abspath(SRC_DIR))
+
+# 在导入管理器之前设置: 固定令牌，并在调用线程中同步写日志 (不启动日志监听线程)
+os.environ.setdefault('API_SECRET_TOKEN', 'test-token')
+os.environ.setdefault('LOG_QUEUE_SIZE', '0')
+
+import proxy_manager  # noqa: E402
+
+# 测试之间互不影响的代理池状态: 每个测试使用一份新的空容器
+POOL_STATE_FACTORIES = {
+    "WARP_POOL_CONFIG": dict,
+    "available_proxies": Queue,
+    "in_use_proxies": dict,
+    "backend_active_sessions": dict,
+    "backend_relayed_bytes": dict,
+    "pool_waiters": deque,
+    "refresh_pending": dict,
+    "refresh_in_flight": dict,
+    "refresh_failures": dict,
+    "refresh_timings": dict,
+    "backend_usage": dict,
+    "sticky_sessions": dict,
+    "api_leases": dict,
+    "lease_heap": list,
+    "backend_health": dict,
+    "quarantined_proxies": dict,
+    "backend_exit_ips": dict,
+    "recent_exit_ips": dict,
+    "exit_ip_rerolls": dict,
+    "backend_direct_addresses": dict,
+    "draining_proxies": dict,
+    "pool_nodes": dict,
+}
+
+@pytest.fixture
+def reset_pool(monkeypatch):
+    """返回一个函数，调用时把代理池状态替换为新的空容器 (模拟一个新进程)。"""
+    def reset():
+        for name, factory in POOL_STATE_FACTORIES.items():
+            monkeypatch.setattr(proxy_manager, name, factory())
+        monkeypatch.setattr(proxy_manager, "lease_stats", dict.fromkeys(proxy_manager.lease_stats, 0))
+    return reset
+
+@pytest.fixture
+def pool(monkeypatch, reset_pool):
+    """返回 proxy_manager 模块，其代理池状态为空，且不会启动回收、刷新和出口IP查询线程。"""
+    reset_pool()
+    monkeypatch.setattr(proxy_manager, "_ensure_lease_reaper_started", lambda: None)
+    monkeypatch.setattr(proxy_manager, "_ensure_sticky_reaper_started", lambda: None)
+    monkeypatch.setattr(proxy_manager, "_ensure_refresh_workers_started", lambda: None)
+    monkeypatch.setattr(proxy_manager, "EXIT_IP_TRACE_URL", "")
+    return proxy_manager
+
+@pytest.fixture
+def pool_config():
+    """四个本机后端 (10800-10803) 的配置文件内容。"""
+    return [{"id": index, "namespace": f"ns{index}", "port": 10800 + index} for index in range(4)]
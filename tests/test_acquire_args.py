@@ -0,0 +1,27 @@
+import pytest
+
+import proxy_manager
+
+def parse(query):
+    with proxy_manager.app.test_request_context(f"/acquire?{query}"):
+        return proxy_manager._parse_acquire_args()
+
+def test_defaults():
+    assert parse("") == (0.0, proxy_manager.LEASE_DEFAULT_TTL, None)
+
+def test_wait_is_clamped():
+    assert parse("wait=-3")[0] == 0.0
+    assert parse(f"wait={proxy_manager.ACQUIRE_MAX_WAIT * 10}")[0] == proxy_manager.ACQUIRE_MAX_WAIT
+    assert parse("wait=2.5&ttl=60") == (2.5, 60.0, None)
+
+@pytest.mark.parametrize("wait", ["abc", "nan", "inf", "-inf"])
+def test_invalid_wait_is_an_error(wait):
+    wait_seconds, lease_ttl, error = parse(f"wait={wait}")
+    assert (wait_seconds, lease_ttl) == (None, None)
+    assert "wait" in error
+
+@pytest.mark.parametrize("ttl", ["0", "-1", "abc", "nan", "inf"])
+def test_invalid_ttl_is_an_error(ttl):
+    wait_seconds, lease_ttl, error = parse(f"ttl={ttl}")
+    assert (wait_seconds, lease_ttl) == (None, None)
+    assert "ttl" in error
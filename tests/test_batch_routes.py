@@ -0,0 +1,55 @@
+import pytest
+
+class ApiClient:
+    """在请求上下文中直接分发请求 (不经过 Flask 测试客户端)。"""
+    def __init__(self, app):
+        self.app = app
+
+    def post(self, path, headers=None, json=None):
+        with self.app.test_request_context(path, method="POST", headers=headers, json=json):
+            return self.app.full_dispatch_request()
+
+@pytest.fixture
+def client(pool, pool_config):
+    pool.initialize_proxy_pool_from_config(pool_config, index_exit_ips=False)
+    return ApiClient(pool.app)
+
+@pytest.fixture
+def auth_headers(pool):
+    return {"Authorization": f"Bearer {pool.app.config['API_SECRET_TOKEN']}"}
+
+@pytest.mark.parametrize("query", [
+    "count=2&wait=nan",
+    "count=2&wait=inf",
+    "count=2&ttl=inf",
+    "count=2&ttl=nan",
+    "count=2&ttl=0",
+    "count=0",
+    "count=2&mode=some",
+])
+def test_acquire_batch_rejects_invalid_arguments(pool, client, auth_headers, query):
+    response = client.post(f"/acquire/batch?{query}", headers=auth_headers)
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+    assert pool.in_use_proxies == {}
+    assert pool.api_leases == {}
+
+def test_release_batch_rejects_overflowing_refresh_policy(pool, client, auth_headers):
+    leases = client.post("/acquire/batch?count=2&ttl=30", headers=auth_headers).get_json()["leases"]
+    lease_ids = [lease["lease_id"] for lease in leases]
+    response = client.post(f"/release/batch?refresh=uses:{'9' * 400}", headers=auth_headers, json={"lease_ids": lease_ids})
+    assert response.status_code == 400
+    assert set(pool.api_leases) == set(lease_ids)
+
+def test_acquire_and_release_batch(pool, client, auth_headers):
+    response = client.post("/acquire/batch?count=2&ttl=30", headers=auth_headers)
+    assert response.status_code == 200
+    leases = response.get_json()["leases"]
+    assert len(leases) == 2
+    assert {pool.api_leases[lease["lease_id"]]["ttl"] for lease in leases} == {30.0}
+    assert len(pool.in_use_proxies) == 2
+
+    response = client.post("/release/batch", headers=auth_headers, json={"lease_ids": [lease["lease_id"] for lease in leases]})
+    assert response.status_code == 200
+    assert pool.in_use_proxies == {}
+    assert pool.api_leases == {}
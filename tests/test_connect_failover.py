@@ -0,0 +1,112 @@
+import threading
+import time
+
+import pytest
+
+CLIENT = ("192.0.2.1", 40000)
+TARGET = ("example.com", 80)
+
+class FakeConnection:
+    def __init__(self, backend_port):
+        self.backend_port = backend_port
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class StubBackends:
+    """替代 _open_backend_connection: 按端口设定连接耗时和是否失败，并记录每次尝试。"""
+    def __init__(self, delays=None, failing_ports=()):
+        self.delays = delays or {}
+        self.failing_ports = set(failing_ports)
+        self.attempts = [] # (端口, 线程名)
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def __call__(self, backend_port, target_host_str, target_port_int, timeout=None):
+        with self.lock:
+            self.attempts.append((backend_port, threading.current_thread().name))
+        time.sleep(self.delays.get(backend_port, 0))
+        if backend_port in self.failing_ports:
+            raise OSError(f"后端 {backend_port} 不可达")
+        connection = FakeConnection(backend_port)
+        with self.lock:
+            self.connections.append(connection)
+        return connection
+
+@pytest.fixture
+def shared_pool(pool, monkeypatch):
+    """共享模式 (每个后端最多 4 个会话) 的代理池，连接尝试使用独立的线程池，测试结束时等待其中的归还完成。"""
+    monkeypatch.setattr(pool, "BACKEND_MAX_SESSIONS", 4)
+    monkeypatch.setattr(pool, "SOCKS_CONNECT_RACE_DELAY", 0)
+    monkeypatch.setattr(pool, "connect_attempt_executor", None)
+    yield pool
+    drain_connect_attempts(pool)
+
+def drain_connect_attempts(pool):
+    if pool.connect_attempt_executor is not None:
+        pool.connect_attempt_executor.shutdown(wait=True)
+        pool.connect_attempt_executor = None
+
+def start_pool(pool, pool_config, backend_count, monkeypatch, stub):
+    pool.initialize_proxy_pool_from_config(pool_config[:backend_count], index_exit_ips=False)
+    monkeypatch.setattr(pool, "_open_backend_connection", stub)
+    return pool._acquire_backend_port_for_socks(CLIENT, *TARGET, wait_seconds=0)
+
+def connect(pool, first_port):
+    return pool._connect_target_with_failover(first_port, CLIENT, *TARGET)
+
+def test_race_does_not_reuse_the_pending_backend(shared_pool, pool_config, monkeypatch):
+    monkeypatch.setattr(shared_pool, "SOCKS_CONNECT_RACE_DELAY", 0.05)
+    stub = StubBackends(delays={10800: 0.2})
+    first_port = start_pool(shared_pool, pool_config, 1, monkeypatch, stub)
+
+    backend_port, connection = connect(shared_pool, first_port)
+    assert backend_port == 10800
+    assert [port for port, _ in stub.attempts] == [10800]
+    assert shared_pool.backend_active_sessions == {10800: 1}
+
+    shared_pool._finish_socks_backend_usage(backend_port)
+    drain_connect_attempts(shared_pool)
+    assert shared_pool.backend_active_sessions == {}
+
+def test_race_loser_is_closed_and_released(shared_pool, pool_config, monkeypatch):
+    monkeypatch.setattr(shared_pool, "SOCKS_CONNECT_RACE_DELAY", 0.05)
+    stub = StubBackends(delays={10800: 0.3})
+    first_port = start_pool(shared_pool, pool_config, 2, monkeypatch, stub)
+
+    backend_port, connection = connect(shared_pool, first_port)
+    assert backend_port == 10801
+    # 两次尝试都不在处理器线程中进行
+    assert {thread_name.startswith("connect-attempt") for _, thread_name in stub.attempts} == {True}
+
+    drain_connect_attempts(shared_pool)
+    loser, = [candidate for candidate in stub.connections if candidate is not connection]
+    assert loser.closed and not connection.closed
+    assert shared_pool.backend_active_sessions == {10801: 1}
+    shared_pool._finish_socks_backend_usage(backend_port)
+    assert shared_pool.backend_active_sessions == {}
+
+def test_retry_does_not_reuse_the_failed_backend(shared_pool, pool_config, monkeypatch):
+    stub = StubBackends(failing_ports={10800})
+    first_port = start_pool(shared_pool, pool_config, 1, monkeypatch, stub)
+
+    backend_port, reply_code = connect(shared_pool, first_port)
+    assert backend_port is None
+    assert reply_code == shared_pool.REP_GENERAL_FAILURE
+    assert [port for port, _ in stub.attempts] == [10800]
+
+    drain_connect_attempts(shared_pool)
+    assert shared_pool.backend_active_sessions == {}
+
+def test_retry_moves_to_another_backend(shared_pool, pool_config, monkeypatch):
+    stub = StubBackends(failing_ports={10800})
+    first_port = start_pool(shared_pool, pool_config, 2, monkeypatch, stub)
+
+    backend_port, connection = connect(shared_pool, first_port)
+    assert backend_port == 10801
+    assert [port for port, _ in stub.attempts] == [10800, 10801]
+
+    shared_pool._finish_socks_backend_usage(backend_port)
+    drain_connect_attempts(shared_pool)
+    assert shared_pool.backend_active_sessions == {}
@@ -0,0 +1,78 @@
+import time
+
+import pytest
+
+import proxy_manager
+
+@pytest.mark.parametrize("raw_ttl, expected", [
+    ("30", 30.0),
+    ("0.5", 0.5),
+    ("1e9", proxy_manager.LEASE_MAX_TTL),
+])
+def test_parse_lease_ttl_accepts_positive_seconds(raw_ttl, expected):
+    assert proxy_manager._parse_lease_ttl(raw_ttl) == expected
+
+def test_parse_lease_ttl_defaults_when_missing():
+    assert proxy_manager._parse_lease_ttl(None) == proxy_manager.LEASE_DEFAULT_TTL
+
+@pytest.mark.parametrize("raw_ttl", ["0", "-5", "abc", "", "nan", "inf", "-inf"])
+def test_parse_lease_ttl_rejects_invalid_values(raw_ttl):
+    assert proxy_manager._parse_lease_ttl(raw_ttl) is None
+
+def test_heap_top_is_earliest_expiry(pool):
+    pool._create_lease("late", 10800, 30, "192.0.2.1")
+    pool._create_lease("early", 10801, 10, "192.0.2.1")
+    assert pool.lease_heap[0][1] == "early"
+
+def test_pop_expired_leases_only_returns_due_leases(pool):
+    pool._create_lease("short", 10800, 10, "192.0.2.1")
+    pool._create_lease("long", 10801, 100, "192.0.2.1")
+    with pool.lease_cond:
+        expired = pool._pop_expired_leases_locked(time.time() + 50)
+    assert [lease_id for lease_id, _ in expired] == ["short"]
+    assert expired[0][1]["port"] == 10800
+    assert set(pool.api_leases) == {"long"}
+    assert pool.lease_stats["expired_total"] == 1
+
+def test_renewed_lease_skips_stale_heap_entry(pool):
+    pool._create_lease("lease", 10800, 10, "192.0.2.1")
+    renewed = pool._renew_lease("lease", ttl=100)
+    assert renewed["ttl"] == 100
+    with pool.lease_cond:
+        assert pool._pop_expired_leases_locked(time.time() + 50) == []
+        assert "lease" in pool.api_leases
+        expired = pool._pop_expired_leases_locked(time.time() + 200)
+    assert [lease_id for lease_id, _ in expired] == ["lease"]
+    assert pool.lease_heap == []
+
+def test_released_lease_never_expires(pool):
+    pool._create_lease("lease", 10800, 10, "192.0.2.1")
+    assert pool._drop_lease("lease")["port"] == 10800
+    with pool.lease_cond:
+        assert pool._pop_expired_leases_locked(time.time() + 50) == []
+    assert pool.lease_stats == {"granted_total": 1, "renewed_total": 0, "released_total": 1, "expired_total": 0}
+
+def test_renew_rebuilds_heap_full_of_stale_entries(pool):
+    pool._create_lease("lease", 10800, 10, "192.0.2.1")
+    for _ in range(100):
+        pool._renew_lease("lease")
+    assert len(pool.lease_heap) <= 2 * len(pool.api_leases) + 64
+
+def test_expired_lease_port_is_reclaimed_for_refresh(pool, pool_config):
+    pool.initialize_proxy_pool_from_config(pool_config, index_exit_ips=False)
+    port = pool.available_proxies.get_nowait()
+    pool.in_use_proxies[port] = {"type": "api_acquired", "lease_id": "lease"}
+    pool._create_lease("lease", port, 10, "192.0.2.1")
+    with pool.lease_cond:
+        (lease_id, lease), = pool._pop_expired_leases_locked(time.time() + 50)
+    pool._reclaim_expired_lease(lease_id, lease)
+    assert port not in pool.in_use_proxies
+    assert port in pool.refresh_pending
+
+def test_reclaim_ignores_port_held_under_another_lease(pool, pool_config):
+    pool.initialize_proxy_pool_from_config(pool_config, index_exit_ips=False)
+    port = pool.available_proxies.get_nowait()
+    pool.in_use_proxies[port] = {"type": "api_acquired", "lease_id": "new-lease"}
+    pool._reclaim_expired_lease("old-lease", {"port": port, "client_ip": "192.0.2.1"})
+    assert pool.in_use_proxies[port]["lease_id"] == "new-lease"
+    assert pool.refresh_pending == {}
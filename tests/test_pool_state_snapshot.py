@@ -0,0 +1,86 @@
+import json
+import time
+
+import pytest
+
+@pytest.fixture
+def state_file(tmp_path):
+    return tmp_path / "pool_state.json"
+
+def write_snapshot(path, snapshot):
+    path.write_text(json.dumps(snapshot))
+
+def take_port(pool, in_use_info):
+    port = pool.available_proxies.get_nowait()
+    pool.in_use_proxies[port] = in_use_info
+    return port
+
+def test_round_trip_restores_pool_leases_and_sessions(pool, pool_config, reset_pool, state_file):
+    pool.initialize_proxy_pool_from_config(pool_config, index_exit_ips=False)
+    leased_port = take_port(pool, {"type": "api_acquired", "lease_id": "lease", "acquired_at": time.time()})
+    pool._create_lease("lease", leased_port, 60, "192.0.2.1")
+    sticky_port = take_port(pool, {"type": "socks_sticky", "sticky_session_key": "alice", "acquired_at": time.time()})
+    now = time.time()
+    pool.sticky_sessions["alice"] = {
+        "port": sticky_port, "active_connections": 2, "connections_total": 5, "relayed_bytes": 0, "created_at": now, "last_used": now
+    }
+    refreshing_port = pool.available_proxies.get_nowait()
+    pool.schedule_refresh(refreshing_port)
+    available_ports = list(pool.available_proxies.queue)
+    expires_at = pool.api_leases["lease"]["expires_at"]
+
+    write_snapshot(state_file, pool._build_pool_state_snapshot())
+    reset_pool()
+    pool.initialize_proxy_pool_from_config(pool_config, index_exit_ips=False)
+    handoff = pool._restore_pool_state_snapshot(str(state_file))
+
+    assert list(pool.available_proxies.queue) == available_ports
+    assert set(pool.in_use_proxies) == {leased_port, sticky_port}
+    assert pool.in_use_proxies[leased_port]["lease_id"] == "lease"
+    assert set(pool.refresh_pending) == {refreshing_port}
+    assert pool.api_leases["lease"]["expires_at"] == expires_at
+    assert pool.lease_heap == [(expires_at, "lease")]
+    assert pool.sticky_sessions["alice"]["port"] == sticky_port
+    assert handoff == {"release": [], "shared": {}, "sticky": {"alice": 2}, "refresh": []}
+    assert not state_file.exists()
+
+def test_exclusive_socks_sessions_are_handed_back_for_release(pool, pool_config, reset_pool, state_file):
+    pool.initialize_proxy_pool_from_config(pool_config, index_exit_ips=False)
+    socks_port = take_port(pool, {"type": "socks_direct", "acquired_at": time.time()})
+
+    write_snapshot(state_file, pool._build_pool_state_snapshot())
+    reset_pool()
+    pool.initialize_proxy_pool_from_config(pool_config, index_exit_ips=False)
+    handoff = pool._restore_pool_state_snapshot(str(state_file))
+
+    assert handoff["release"] == [socks_port]
+    assert socks_port in pool.in_use_proxies
+    assert socks_port not in pool.available_proxies.queue
+
+def test_ports_new_to_the_config_become_available(pool, pool_config, reset_pool, state_file):
+    pool.initialize_proxy_pool_from_config(pool_config[:2], index_exit_ips=False)
+    write_snapshot(state_file, pool._build_pool_state_snapshot())
+    reset_pool()
+    pool.initialize_proxy_pool_from_config(pool_config, index_exit_ips=False)
+    pool._restore_pool_state_snapshot(str(state_file))
+    assert sorted(pool.available_proxies.queue) == [10800, 10801, 10802, 10803]
+
+@pytest.mark.parametrize("corrupt", [
+    lambda snapshot: snapshot.update(version=snapshot["version"] + 1),
+    lambda snapshot: snapshot.pop("api_leases"),
+    lambda snapshot: snapshot["refresh"].pop("pending"),
+])
+def test_invalid_snapshot_is_rejected_before_any_change(pool, pool_config, reset_pool, state_file, corrupt):
+    pool.initialize_proxy_pool_from_config(pool_config, index_exit_ips=False)
+    take_port(pool, {"type": "socks_direct", "acquired_at": time.time()})
+    snapshot = pool._build_pool_state_snapshot()
+    corrupt(snapshot)
+    write_snapshot(state_file, snapshot)
+    reset_pool()
+    pool.initialize_proxy_pool_from_config(pool_config, index_exit_ips=False)
+
+    with pytest.raises(ValueError):
+        pool._restore_pool_state_snapshot(str(state_file))
+    assert sorted(pool.available_proxies.queue) == [10800, 10801, 10802, 10803]
+    assert pool.in_use_proxies == {}
+    assert state_file.exists()
@@ -0,0 +1,47 @@
+import socket
+
+import pytest
+
+import proxy_manager
+
+@pytest.fixture
+def socket_pair():
+    client, server = socket.socketpair()
+    yield client, server
+    client.close()
+    server.close()
+
+def test_read_exactly_reassembles_fragmented_greeting(socket_pair):
+    client, server = socket_pair
+    reader = proxy_manager.SocksHandshakeReader(server)
+    for byte in b"\x05\x01\x00":
+        client.sendall(bytes([byte]))
+    assert reader.read_exactly(2) == b"\x05\x01"
+    assert reader.read_exactly(1) == b"\x00"
+
+def test_coalesced_handshake_keeps_optimistic_data(socket_pair):
+    client, server = socket_pair
+    reader = proxy_manager.SocksHandshakeReader(server)
+    greeting = b"\x05\x01\x00"
+    connect_request = b"\x05\x01\x00\x01\x7f\x00\x00\x01\x00\x50"
+    client.sendall(greeting + connect_request + b"GET / HTTP/1.1\r\n")
+    assert reader.read_exactly(len(greeting)) == greeting
+    assert reader.read_exactly(4) == connect_request[:4]
+    assert reader.read_exactly(6) == connect_request[4:]
+    assert reader.take_buffered() == b"GET / HTTP/1.1\r\n"
+    assert reader.take_buffered() == b""
+
+def test_read_exactly_returns_none_when_peer_closes(socket_pair):
+    client, server = socket_pair
+    reader = proxy_manager.SocksHandshakeReader(server)
+    client.sendall(b"\x05")
+    client.shutdown(socket.SHUT_WR)
+    assert reader.read_exactly(2) is None
+
+def test_read_exactly_enforces_handshake_deadline(socket_pair, monkeypatch):
+    client, server = socket_pair
+    monkeypatch.setattr(proxy_manager, "SOCKS_HANDSHAKE_TIMEOUT", 0.05)
+    reader = proxy_manager.SocksHandshakeReader(server)
+    client.sendall(b"\x05")
+    with pytest.raises(socket.timeout):
+        reader.read_exactly(3)
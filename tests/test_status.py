@@ -0,0 +1,23 @@
+import time
+
+def get_status(pool):
+    with pool.app.test_request_context("/status"):
+        return pool.app.full_dispatch_request().get_data(as_text=True)
+
+def test_status_hides_lease_ids_and_sticky_session_keys(pool, pool_config):
+    pool.initialize_proxy_pool_from_config(pool_config, index_exit_ips=False)
+    now = time.time()
+    leased_port = pool.available_proxies.get_nowait()
+    pool.in_use_proxies[leased_port] = {"type": "api_acquired", "lease_id": "secret-lease-id", "acquired_at": now}
+    sticky_port = pool.available_proxies.get_nowait()
+    pool.in_use_proxies[sticky_port] = {"type": "socks_sticky", "sticky_session_key": "alice-username", "acquired_at": now}
+    pool.sticky_sessions["alice-username"] = {
+        "port": sticky_port, "active_connections": 1, "connections_total": 1, "relayed_bytes": 0, "created_at": now, "last_used": now
+    }
+
+    body = get_status(pool)
+    assert "secret-lease-id" not in body
+    assert "alice-username" not in body
+    assert pool._status_redacted("secret-lease-id") in body
+    # 同一会话键在使用中详情和粘性会话列表中的散列相同
+    assert body.count(pool._status_redacted("alice-username")) == 2
@@ -0,0 +1,38 @@
+import pytest
+
+import proxy_manager
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_clock = FakeClock()
+    monkeypatch.setattr(proxy_manager.time, "monotonic", fake_clock)
+    return fake_clock
+
+def test_burst_is_free_then_deficit_is_delayed(clock):
+    bucket = proxy_manager._TokenBucket(rate=1000, capacity=2000)
+    assert bucket.consume(2000) == 0.0
+    assert bucket.consume(500) == pytest.approx(0.5)
+    # 令牌不足时仍然扣除，下一块数据要等前面的欠额一起还清
+    assert bucket.consume(500) == pytest.approx(1.0)
+
+def test_tokens_refill_at_rate_up_to_capacity(clock):
+    bucket = proxy_manager._TokenBucket(rate=1000, capacity=2000)
+    bucket.consume(2000)
+    clock.now += 1.0
+    assert bucket.consume(1000) == 0.0
+    clock.now += 60.0
+    assert bucket.consume(2000) == 0.0
+    assert bucket.consume(1000) == pytest.approx(1.0)
+
+def test_capacity_is_at_least_one_byte(clock):
+    bucket = proxy_manager._TokenBucket(rate=100, capacity=0)
+    assert bucket.capacity == 1.0
+    assert bucket.consume(1) == 0.0
+    assert bucket.consume(100) == pytest.approx(1.0)